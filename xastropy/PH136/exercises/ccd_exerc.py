@@ -162,28 +162,11 @@ def show_all_fit(path):
     
 #### ###############################
 #  Loop through all .FIT files in the path
-def stack_img(files, outfil):
+def stack_img(files, outfil, method='median'):
 
-    from astropy.io.fits import getdata
-
-    # Create the image array
-    flg = 0
-    for ff in files:
-        print 'File = ', ff
-        arr,head = getdata(ff,0,header=True)
-
-        # Save
-        if flg == 0:
-            flg=1
-            all_arr = [arr] 
-        else:
-            all_arr.append(arr)
-            #print 'shape', array(all_bias).shape
-    
-    # Stack away!
-    all_arr = array(all_arr)
-    final_arr = median(all_arr,0)
-    #print 'shape', final_bias.shape
+    # Median stack, streaming the frames in blocks of rows
+    from xastropy.xutils import imcombine
+    final_arr = imcombine.combine(files, method=method)
 
     # Write
     print 'Writing stacked frame to ', outfil
@@ -237,7 +220,7 @@ def make_stacks(biaslist,darklist,path=0,biasout=0,darkout=0):
 
     # Plot histogram
     import ccd_exerc_plots as cep
-    cep.hist_plot(pp2,biasout)
+    cep.hist_plot(pp,biasout)
 
     # Plot image
     cep.plot_img(pp,biasout)
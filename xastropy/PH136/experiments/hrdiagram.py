@@ -161,11 +161,13 @@ def mk_log(file_path=None,outfil=None):
 def mk_bias(file_list=None,file_path=None,outfil=None):
     # There is no overscan region (yes there is!)
     #  So, we need a bias image
+    #  It is only rebuilt if the input frames have changed
     import xastropy.PH136.experiments.hrdiagram as hrd
     from astropy.io.fits import getdata
     from astropy.io.fits import Column
     from astropy.io import fits 
     from astropy.stats import sigma_clip 
+    from xastropy.xutils import ccdreduce
 
     # Defaults
     if file_path == None: 
@@ -175,35 +177,35 @@ def mk_bias(file_list=None,file_path=None,outfil=None):
         outfil = 'Bias.fits'
 
     # Files
-    bias_fil = None
+    bias_fil = file_list
     if file_list == None:
         # Generate them ourself
         biasfrm = 2 + np.arange(10)
         bias_fil = hrd.mk_file_list(biasfrm, file_path=file_path)
 
-    # Read Noise
-    arr,head = getdata(str(bias_fil[0]),0,header=True)
-    clip_arr = sigma_clip(arr, 2.5, None)
-    rnoise = np.std(clip_arr,dtype=np.float64)
-    print 'Read Noise = ', rnoise, ' counts'
+    def build():
+        # Read Noise
+        arr,head = getdata(str(bias_fil[0]),0,header=True)
+        clip_arr = sigma_clip(arr, 2.5, None)
+        rnoise = np.std(clip_arr,dtype=np.float64)
+        print 'Read Noise = ', rnoise, ' counts'
 
-    #pdb.set_trace()
-    #dpt = ds9.ds9()
-    #dpt.set_np2arr(arr)
-
-    # Stack the frames
-    img = hrd.stack_img(bias_fil)
+        # Stack the frames
+        img = hrd.stack_img(bias_fil)
+        head['RNOISE'] = (rnoise, 'READ NOISE')
+        return img, head
 
     # Write
-    head.update('RNOISE', rnoise, 'READ NOISE')
-    fits.writeto(outfil, img, head, clobber=True)
+    ccdreduce.cached_product(outfil, bias_fil, build)
     return
 
 ####################################
 # Generate the Sky flats for each Filter
 def mk_skyflats(file_list=None,file_path=None, bias_fil=None):
+    # Each flat is only rebuilt if its frames or the bias have changed
     import xastropy.PH136.experiments.hrdiagram as hrd
     from astropy.io.fits import getdata
+    from xastropy.xutils import ccdreduce
 
     # Frames
     B_sky = 32 + np.arange(5)
@@ -218,8 +220,6 @@ def mk_skyflats(file_list=None,file_path=None, bias_fil=None):
     # Bias
     if bias_fil == None:
         bias_fil = 'Bias.fits'
-    bias_img,bias_head = getdata(bias_fil,0,header=True)
-    
 
     # Loop on Filters
     for ff in filters:
@@ -227,21 +227,21 @@ def mk_skyflats(file_list=None,file_path=None, bias_fil=None):
         idx = filters.index(ff)
 
         # Generate file names
-        files= hrd.mk_file_list(all_sky[idx])
+        files= hrd.mk_file_list(all_sky[idx], file_path=file_path)
 
-        # Stack with scaling
-        img = hrd.stack_img(files, bias_img=bias_img, norm=True)
+        def build():
+            # Stack with scaling (bias is streamed from its file)
+            img = hrd.stack_img(files, bias_img=bias_fil, norm=True)
 
-        # Trim
-        trim_img = hrd.trimflip_img(img)
+            # Trim
+            trim_img = np.ascontiguousarray(hrd.trimflip_img(img))
 
-        # Deal with zeros
-        zro = np.where( trim_img == 0.)
-        trim_img[zro] = 1.
+            # Deal with zeros
+            trim_img[trim_img == 0.] = 1.
+            return trim_img, None
 
         # Write
-        print 'Sky Flats: Writing ', outfil[idx]
-        fits.writeto(outfil[idx], trim_img, clobber=True)
+        ccdreduce.cached_product(outfil[idx], files+[bias_fil], build, params=(hrd.TRIMSEC,))
 
     print 'Sky Flats: All done'
     return
@@ -251,35 +251,20 @@ def mk_skyflats(file_list=None,file_path=None, bias_fil=None):
 ####################################
 # Stack a given set of images
 ######
-def stack_img(file_list, outfil=None, norm=False, bias_img=None):
-    from astropy.io.fits import getdata
-
-    # file_list is a List of filenames
-    all_arr = []    
-    for ff in file_list:
-        print 'Reading ', ff
-        arr,head = getdata(ff,0,header=True)
-
-        # Bias subtract?
-        if bias_img != None:
-            if arr.shape != bias_img.shape:
-                raise NameError('stack_img: Bad shapes!')
-            arr = arr - bias_img
-
-        # Normalize (for flats)
-        if norm:
-            norm_val = np.median(arr)
-        else: 
-            norm_val = 1.
-        arr = arr/norm_val
-
-        # Save
-        all_arr.append(arr)
-    
-    # Median Stack 
-    all_arr = np.array(all_arr)
-    final_arr = np.median(all_arr,0)
-
+def stack_img(file_list, outfil=None, norm=False, bias_img=None, method='median'):
+    # Frames are streamed in blocks of rows (see xutils.imcombine),
+    #   so the whole stack never sits in memory
+    from xastropy.xutils import imcombine
+
+    # Bias subtract, normalize (for flats) and median stack
+    if norm:
+        scale = 'median'
+    else:
+        scale = None
+    try:
+        final_arr = imcombine.combine(file_list, method=method, bias=bias_img, scale=scale)
+    except imcombine.ShapeError as err:
+        raise NameError('stack_img: Bad shapes! ({:s})'.format(str(err)))
 
     # Write
     if outfil != None:
@@ -305,27 +290,31 @@ def mk_file_list(frames, file_path=None):
 
 ####################################
 # Trim and flip the images down (remove overscan, etc.)
+# Rows, columns kept:  bottom row and overscan removed
+TRIMSEC = (1, None, None, 1000)
+
 def trimflip_img(img):
 
-    # Bottom row and overscan
-    trim = img[1:,:1000]
-    #pdb.set_trace()
+    # Bottom row and overscan (a view, not a copy)
+    trim = img[TRIMSEC[0]:TRIMSEC[1],TRIMSEC[2]:TRIMSEC[3]]
 
     # flip
-    #pdb.set_trace()
     newimg = np.flipud(trim)
 
     return newimg
 
 ####################################
 # Process M67 images
-def proc_m67(file_path=None,outdir=None, bias_fil=None):
+def proc_m67(file_path=None,outdir=None, bias_fil=None, nproc=None):
+    # Frames are reduced on a pool of nproc processes;  those already
+    #   reduced from unchanged inputs are skipped
 
     from astropy.coordinates import ICRS 
     from astropy.io import ascii
     from astropy import units as u
-    from astropy.io.fits import getdata
+    from astropy.io.fits import getheader
     import xastropy.PH136.experiments.hrdiagram as hrd
+    from xastropy.xutils import ccdreduce
 
     # Defaults
     if file_path == None: 
@@ -336,8 +325,6 @@ def proc_m67(file_path=None,outdir=None, bias_fil=None):
     # Bias frame
     if bias_fil == None:
         bias_fil = 'Bias.fits'
-    bias_img,bias_head = getdata(bias_fil,0,header=True)
-    
 
     # Read Log
     data = ascii.read('simple.log',delimiter='|')
@@ -365,31 +352,19 @@ def proc_m67(file_path=None,outdir=None, bias_fil=None):
 
     # Loop on Filterse
     all_fil = []
+    jobs = []
     for ff in filters:
 
-        # Load Sky frame
+        # Sky frame
         skyfil = 'Sky_'+ff+'.fits'
-        sky_img,head = getdata(skyfil,0,header=True)
 
         # Images
         idx = np.where(m67['Filter'] == ff) 
 
         # Loop on images
         for kk in np.concatenate(idx,axis=0):
-            # Read
-            img,head = getdata(m67[kk]['File'],0,header=True)
-
-            # Bias subtract
-            img = img - bias_img
-
-            # Trim
-            timg = hrd.trimflip_img(img)
-
-            # Flat field
-            timg = timg / sky_img
-
-            # Normalize by exposure
-            timg = timg / m67[kk]['Exp']
+            # Header
+            head = getheader(m67[kk]['File'],0)
 
             # Filename
             coord = ICRS(head['RA'], head['DEC'], unit=(u.hour,u.degree))
@@ -405,23 +380,27 @@ def proc_m67(file_path=None,outdir=None, bias_fil=None):
                 print 'Skipping...'
                 continue
             all_fil.append(outfil)
-            
 
-            # Write
-            print 'Writing ', outfil
-            fits.writeto(outfil, timg, clobber=True)
+            # Bias subtract, trim, flat field and normalize by exposure
+            jobs.append(dict(infile=m67[kk]['File'], outfil=outfil, flat=skyfil,
+                             exptime=float(m67[kk]['Exp']), keephead=False))
+
+    # Process
+    ccdreduce.reduce_frames(jobs, bias=bias_fil, trim=hrd.TRIMSEC, flip=True, nproc=nproc)
             
     return
 
 ####################################
 # Process SA 104 images
-def proc_sa104(file_path=None,outdir=None, bias_fil=None):
+def proc_sa104(file_path=None,outdir=None, bias_fil=None, nproc=None):
+    # Frames are reduced on a pool of nproc processes;  those already
+    #   reduced from unchanged inputs are skipped
 
     from astropy.coordinates import ICRS 
     from astropy.io import ascii
     from astropy import units as u
-    from astropy.io.fits import getdata
     import xastropy.PH136.experiments.hrdiagram as hrd
+    from xastropy.xutils import ccdreduce
 
     # Defaults
     if file_path == None: 
@@ -432,8 +411,6 @@ def proc_sa104(file_path=None,outdir=None, bias_fil=None):
     # Bias frame
     if bias_fil == None:
         bias_fil = 'Bias.fits'
-    bias_img,bias_head = getdata(bias_fil,0,header=True)
-    
 
     # Read Log
     data = ascii.read('simple.log',delimiter='|')
@@ -456,32 +433,17 @@ def proc_sa104(file_path=None,outdir=None, bias_fil=None):
 
     # Loop on Filterse
     all_fil = []
+    jobs = []
     for ff in filters:
 
-        # Load Sky frame
+        # Sky frame
         skyfil = 'Sky_'+ff+'.fits'
-        sky_img,head = getdata(skyfil,0,header=True)
 
         # Images
         idx = np.where(sa104['Filter'] == ff) 
 
         # Loop on images
         for kk in np.concatenate(idx,axis=0):
-            # Read
-            img,head = getdata(sa104[kk]['File'],0,header=True)
-
-            # Bias subtract
-            img = img - bias_img
-
-            # Trim
-            timg = hrd.trimflip_img(img)
-
-            # Flat field
-            timg = timg / sky_img
-
-            # Normalize by exposure
-            timg = timg / sa104[kk]['Exp']
-
             # Filename
             outfil = outdir+'SA104_t'+str(int(sa104[kk]['Exp']))+'_'+ff+'.fits'
 
@@ -493,11 +455,13 @@ def proc_sa104(file_path=None,outdir=None, bias_fil=None):
                 print 'Skipping...'
                 continue
             all_fil.append(outfil)
-            
 
-            # Write
-            print 'Writing ', outfil
-            fits.writeto(outfil, timg, head, clobber=True)
+            # Bias subtract, trim, flat field and normalize by exposure
+            jobs.append(dict(infile=sa104[kk]['File'], outfil=outfil, flat=skyfil,
+                             exptime=float(sa104[kk]['Exp'])))
+
+    # Process
+    ccdreduce.reduce_frames(jobs, bias=bias_fil, trim=hrd.TRIMSEC, flip=True, nproc=nproc)
             
     return
 
@@ -0,0 +1,301 @@
+"""
+#;+
+#; NAME:
+#; field_db
+#;    Version 1.0
+#;
+#; PURPOSE:
+#;    Columnar database of the galaxies of a CASBAH field.  The scalar
+#;      columns (RA, DEC, Z, ...) of the SDSS, HECTOSPEC and DEIMOS tables
+#;      are held as a catalog, and the spectra are memory-mapped from
+#;      .npy files, so they are only read when asked for.
+#;-
+#;------------------------------------------------------------------------------
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+import os, json
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Table, Column, vstack
+
+from xastropy.casbah import utils as xcasbahu
+from xastropy.obs import radec as xra
+
+# class FieldDB :: Galaxy catalog, spectra and index of a field
+# def get_db :: FieldDB of a field, shared by all callers
+
+_SURVEYS = ('SDSS', 'HECTOSPEC', 'DEIMOS')
+_SPEC_COLS = ('WAVE', 'FLUX', 'SIG')
+# Columns of the combined catalog (when the survey table has them)
+_CAT_COLS = ('RA', 'DEC', 'Z', 'Z_ERR', 'TELESCOPE', 'INSTRUMENT')
+
+
+def _mtimes(field, surveys=_SURVEYS):
+    '''Modification times of the survey tables of a field (None if absent)
+    '''
+    mtimes = {}
+    for survey in surveys:
+        fil = xcasbahu.get_filename(field, survey)
+        mtimes[survey] = os.path.getmtime(fil) if os.path.exists(fil) else None
+    return mtimes
+
+
+def _unitvec(ra, dec):
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).T
+
+
+class FieldDB(object):
+    '''Galaxy database of a CASBAH field
+
+    The first time a survey table is used, its scalar columns are
+    written to <survey>.fits and its spectra to <survey>_WAVE.npy etc.
+    in cachedir, with the modification time of the table in
+    <survey>_meta.json.
+    The cache is rebuilt if the table changes.  The modification times
+    of the tables are kept in mtimes.
+
+    Parameters:
+    ----------
+    field: tuple
+      (Name, ra, dec) with the QSO at (ra, dec)
+    surveys: list, optional
+      Galaxy tables to include (those without a file are skipped)
+    cachedir: str, optional
+      Folder for the cache [default: get_filename(field, 'DB')]
+
+    Examples:
+    ---------
+    >>> db = FieldDB(field)  # doctest: +SKIP
+    >>> rows, rho = db.impact(0.1, 0.2, 300*u.kpc)  # doctest: +SKIP
+    >>> wave, flux, sig = db.spectrum(rows[0])  # doctest: +SKIP
+    '''
+    def __init__(self, field, surveys=_SURVEYS, cachedir=None, verbose=False):
+        self.field = field
+        self.qso = xra.to_coord((field[1], field[2]))
+        if cachedir is None:
+            cachedir = xcasbahu.get_filename(field, 'DB')
+        self.cachedir = cachedir
+        self.verbose = verbose
+        self.surveys = []
+        self.mtimes = _mtimes(field, surveys)
+        self._tables = {}
+        self._spec = {}
+        for survey in surveys:
+            if self.mtimes[survey] is None:
+                continue
+            self._load(survey, xcasbahu.get_filename(field, survey), self.mtimes[survey])
+            self.surveys.append(survey)
+        self.catalog = self._build_catalog()
+        self._tree = None
+        self._zorder = None
+        self._scale = {}
+
+    # Cache
+    def _load(self, survey, fil, mtime):
+        try:
+            with open(os.path.join(self.cachedir, survey+'_meta.json')) as fh:
+                meta = json.load(fh)
+        except (IOError, OSError, ValueError):
+            meta = None
+        if (meta is None) or (meta['mtime'] != mtime):
+            self._build(survey, fil, mtime)
+        else:
+            self._tables[survey] = Table.read(os.path.join(self.cachedir, survey+'.fits'))
+
+    def _build(self, survey, fil, mtime):
+        '''Split a survey table into scalar columns and spectra
+        '''
+        if self.verbose:
+            print('FieldDB: Caching {:s} in {:s}'.format(fil, self.cachedir))
+        tab = Table.read(fil)
+        spec = [name for name in _SPEC_COLS if name in tab.colnames]
+        scalars = Table([tab[name] for name in tab.colnames
+            if (name not in spec) and (tab[name].ndim == 1)], copy=False)
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            # Write to temporary files and rename, so that other processes
+            # never see a partial cache
+            tmp = '.tmp{:d}'.format(os.getpid())
+            for name in spec:
+                npyfil = os.path.join(self.cachedir, survey+'_'+name+'.npy')
+                with open(npyfil+tmp, 'wb') as fh:
+                    np.save(fh, np.asarray(tab[name]))
+                os.rename(npyfil+tmp, npyfil)
+            catfil = os.path.join(self.cachedir, survey+'.fits')
+            scalars.write(catfil+tmp, format='fits')
+            os.rename(catfil+tmp, catfil)
+            metafil = os.path.join(self.cachedir, survey+'_meta.json')
+            with open(metafil+tmp, 'w') as fh:
+                json.dump(dict(mtime=mtime, nrow=len(tab), spectra=spec), fh)
+            os.rename(metafil+tmp, metafil)
+        except (IOError, OSError):
+            if self.verbose:
+                print('FieldDB: Cannot write {:s}; keeping the spectra in memory'.format(
+                    self.cachedir))
+            for name in spec:
+                self._spec[(survey, name)] = np.asarray(tab[name])
+        self._tables[survey] = scalars
+
+    def _build_catalog(self):
+        cats = []
+        for survey in self.surveys:
+            tab = self._tables[survey]
+            cat = Table([tab[name] for name in _CAT_COLS if name in tab.colnames], copy=False)
+            cat['SURVEY'] = Column([str(survey)]*len(tab))
+            cat['SROW'] = Column(np.arange(len(tab)))
+            cats.append(cat)
+        if len(cats) == 0:
+            cat = Table(names=('RA', 'DEC', 'Z', 'SURVEY', 'SROW'),
+                dtype=(float, float, float, 'S9', int))
+        else:
+            cat = vstack(cats, join_type='outer')
+        for name in ['RA', 'DEC']:
+            cat[name].unit = None
+        # Separation from the sightline
+        gcoord = SkyCoord(ra=np.asarray(cat['RA'], dtype=float)*u.deg,
+            dec=np.asarray(cat['DEC'], dtype=float)*u.deg)
+        cat['SEP'] = Column(gcoord.separation(self.qso).to(u.arcsec).value, unit=u.arcsec)
+        return cat
+
+    def survey(self, survey):
+        '''Scalar columns of one survey table
+        '''
+        return self._tables[survey]
+
+    # Spectra
+    def _spectra(self, survey, name):
+        key = (survey, name)
+        if key not in self._spec:
+            self._spec[key] = np.load(os.path.join(self.cachedir, survey+'_'+name+'.npy'),
+                mmap_mode='r')
+        return self._spec[key]
+
+    def spectrum(self, idx):
+        '''Spectrum of one galaxy, read from the cache
+
+        Parameters:
+        ----------
+        idx: int
+          Row of the catalog
+
+        Returns:
+        --------
+        wave, flux, sig: Quantity, ndarray, ndarray
+          Only pixels with wave > 0 (the tables are zero-padded)
+        '''
+        survey = str(self.catalog['SURVEY'][idx])
+        row = int(self.catalog['SROW'][idx])
+        wave = np.array(self._spectra(survey, 'WAVE')[row])
+        gdp = wave > 0.
+        flux = np.array(self._spectra(survey, 'FLUX')[row][gdp])
+        sig = np.array(self._spectra(survey, 'SIG')[row][gdp])
+        return wave[gdp]*u.AA, flux, sig
+
+    # Index
+    def _get_tree(self):
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(_unitvec(self.catalog['RA'], self.catalog['DEC']))
+        return self._tree
+
+    def _get_zorder(self):
+        if self._zorder is None:
+            zval = np.asarray(self.catalog['Z'], dtype=float)
+            order = np.argsort(zval, kind='mergesort')
+            self._zorder = (zval[order], order)
+        return self._zorder
+
+    def zrange(self, zmin=None, zmax=None):
+        '''Catalog rows with zmin <= Z <= zmax (sorted by z)
+        '''
+        zsort, order = self._get_zorder()
+        i0 = 0 if zmin is None else np.searchsorted(zsort, zmin, side='left')
+        i1 = len(zsort) if zmax is None else np.searchsorted(zsort, zmax, side='right')
+        return order[i0:i1]
+
+    def cone(self, coord, radius):
+        '''Catalog rows within radius of a position
+
+        Parameters:
+        ----------
+        coord: SkyCoord, tuple or str
+          See radec.to_coord
+        radius: Angle or Quantity
+
+        Returns:
+        --------
+        rows: ndarray
+        '''
+        coord = xra.to_coord(coord)
+        chord = 2.*np.sin(0.5*u.Quantity(radius).to(u.rad).value)
+        rows = self._get_tree().query_ball_point(
+            _unitvec(coord.icrs.ra.deg, coord.icrs.dec.deg), chord)
+        return np.sort(np.array(rows, dtype=int))
+
+    def _kpc_per_arcsec(self, zval, comoving):
+        '''Scale at each z, interpolated from a grid of the cosmology
+
+        The grid is log-spaced, so that the scale is accurate (to ~1e-4)
+        at low z even when the catalog reaches z ~ 6.
+        '''
+        if comoving not in self._scale:
+            from astropy.cosmology import Planck15 as cosmo
+            zall = np.asarray(self.catalog['Z'], dtype=float)
+            zgrid = np.logspace(np.log10(max(np.nanmin(zall), 1e-4)),
+                                np.log10(max(np.nanmax(zall), 1e-3)), 200)
+            if comoving:
+                scale = cosmo.kpc_comoving_per_arcmin(zgrid)
+            else:
+                scale = cosmo.kpc_proper_per_arcmin(zgrid)
+            self._scale[comoving] = (zgrid, scale.to(u.kpc/u.arcsec).value)
+        zgrid, scale = self._scale[comoving]
+        return np.interp(zval, zgrid, scale)
+
+    def impact(self, zmin, zmax, rhomax, comoving=False):
+        '''Galaxies within an impact parameter of the QSO sightline
+
+        Parameters:
+        ----------
+        zmin, zmax: float
+          Redshift interval
+        rhomax: Quantity
+          Maximum impact parameter (e.g. 300*u.kpc)
+        comoving: bool, optional
+          Comoving (instead of proper) impact parameters
+
+        Returns:
+        --------
+        rows: ndarray
+          Catalog rows, sorted by impact parameter
+        rho: Quantity
+          Impact parameters (kpc)
+        '''
+        rows = self.zrange(zmin, zmax)
+        zval = np.asarray(self.catalog['Z'], dtype=float)[rows]
+        rho = np.asarray(self.catalog['SEP'])[rows] * self._kpc_per_arcsec(zval, comoving)
+        gd = np.where(rho <= u.Quantity(rhomax).to(u.kpc).value)[0]
+        srt = gd[np.argsort(rho[gd], kind='mergesort')]
+        return rows[srt], rho[srt]*u.kpc
+
+    def __len__(self):
+        return len(self.catalog)
+
+
+_dbs = {}
+
+def get_db(field, cachedir=None, verbose=False):
+    '''FieldDB of a field, shared by later calls until one of its
+    survey tables is changed, added or removed
+    '''
+    key = (field[0], cachedir)
+    db = _dbs.get(key)
+    if (db is None) or (db.mtimes != _mtimes(field)):
+        db = FieldDB(field, cachedir=cachedir, verbose=verbose)
+        _dbs[key] = db
+    return db
@@ -36,7 +36,7 @@ from xastropy.obs import radec as xra
 from xastropy.xutils import xdebug as xdb
 
 # SDSS
-def build_sdss(field, radius=2.0*u.deg):
+def build_sdss(field, radius=2.0*u.deg, fetcher=None, cachedir=None, nthreads=4):
     """ Grab SDSS photometry and spectra for those fields in the footprint
 
     Includes BOSS data.
@@ -46,6 +46,8 @@ def build_sdss(field, radius=2.0*u.deg):
     field : tuple
       (name, ra_deg, dec_deg)
     radius : Angle or Quantity, optional
+    fetcher, cachedir, nthreads : optional
+      For the spectra; see grab_sdss_spectra
     """
 
     # Directory
@@ -56,17 +58,45 @@ def build_sdss(field, radius=2.0*u.deg):
     print('CASBAH_SDSS: Building {:s}'.format(sdss_fil))
     print('CASBAH_SDSS: Be patient..')
     grab_sdss_spectra((field[1],field[2]),
-        radius=radius, outfil=sdss_fil, maxsep=20., zmin=500./3e5)
+        radius=radius, outfil=sdss_fil, maxsep=20., zmin=500./3e5,
+        fetcher=fetcher, cachedir=cachedir, nthreads=nthreads)
         #outfig = os.environ.get('DROPBOX_DIR')+'/CASBAH/Galaxies/SDSS/PG1407+265_SDSS.pdf'
 
-def build_spectra(field, obs_path=None, path='./'):
+def _read_hecto(spfile, wave, flux, sig, row):
+    """Read one spHect file into rows row: of the preallocated arrays
+
+    Returns
+    -------
+    tbl : Table
+      Plugmap structure (fiber info)
+    """
+    print('Reading {:s}'.format(spfile))
+    hdu = fits.open(spfile)
+    try:
+        nfib = hdu[1].data.shape[0]
+        wave[row:row+nfib] = hdu[0].data
+        flux[row:row+nfib] = hdu[1].data
+        ivar = hdu[2].data
+        gd = ivar > 0.
+        isig = sig[row:row+nfib]
+        isig[:] = 0.
+        isig[gd] = np.sqrt(ivar[gd])
+        tbl = Table(hdu[5].data)
+    finally:
+        hdu.close()
+    return tbl
+
+def build_spectra(field, obs_path=None, path='./', nthreads=4):
     """Top-level program to build spectra files
 
     Parameters
     ----------
     field : tuple
       (Name, ra, dec)
+    nthreads : int, optional
+      Number of spectra files read at once
     """
+    from multiprocessing.pool import ThreadPool
     if obs_path is None:
         obs_path = os.getenv('DROPBOX_DIR')+'CASBAH_Observing/'
     """
@@ -86,30 +116,34 @@ def build_spectra(field, obs_path=None, path='./'):
     hecto_path = '/Galx_Spectra/Hectospec/'
     spfiles = glob.glob(obs_path+field[0]+hecto_path+'spHect-*')
     spfiles.sort()
+    zfiles = [spfile for spfile in spfiles if 'zcat' in spfile]  # z values
+    spfiles = [spfile for spfile in spfiles if 'zcat' not in spfile]  # Spectra
+    # Size the arrays from the headers
+    nfibs, npixs = [], []
     for spfile in spfiles:
-        if 'zcat' not in spfile:  # Spectra
-            hdu = fits.open(spfile)
-            print('Reading {:s}'.format(spfile))
-            wave = hdu[0].data
-            flux = hdu[1].data
-            ivar = hdu[2].data
-            sig = np.zeros_like(flux)
-            gd = ivar > 0.
-            sig[gd] = np.sqrt(ivar[gd])
-            tbl = Table(hdu[5].data)
-            if 'hecto_wave' not in locals():
-                hecto_wave, hecto_flux, hecto_sig, hecto_stbl = wave, flux, sig, tbl
-            else:
-                hecto_wave = np.concatenate((hecto_wave, wave))
-                hecto_flux = np.concatenate((hecto_flux, flux))
-                hecto_sig = np.concatenate((hecto_sig, sig))
-                hecto_stbl = vstack([hecto_stbl,tbl])
-        else:
-            tmp = Table.read(spfile)  # z values
-            if 'hecto_ztbl' not in locals():
-                hecto_ztbl = tmp
-            else:
-                hecto_ztbl = vstack([hecto_ztbl,tmp])
+        head = fits.getheader(spfile, 1)
+        nfibs.append(head['NAXIS2'])
+        npixs.append(head['NAXIS1'])
+    if len(set(npixs)) > 1:
+        raise ValueError("Hectospec files have different numbers of pixels")
+    rows = np.concatenate([[0], np.cumsum(nfibs)]).astype(int)
+    shape = (rows[-1], npixs[0])
+    # Same types as in the files
+    bitpix = {-32: np.float32, -64: np.float64}
+    hecto_wave = np.zeros(shape, dtype=bitpix.get(fits.getheader(spfiles[0], 0)['BITPIX'], float))
+    hecto_flux = np.zeros(shape, dtype=bitpix.get(head['BITPIX'], float))
+    hecto_sig = np.zeros_like(hecto_flux)
+    # Read the spectra in parallel
+    def read_one(ii):
+        return _read_hecto(spfiles[ii], hecto_wave, hecto_flux, hecto_sig, rows[ii])
+    pool = ThreadPool(max(min(nthreads, len(spfiles)), 1))
+    try:
+        stbls = pool.map(read_one, range(len(spfiles)))
+    finally:
+        pool.close()
+        pool.join()
+    hecto_stbl = vstack(stbls)
+    hecto_ztbl = vstack([Table.read(zfile) for zfile in zfiles])
     # Check
     if len(hecto_stbl) != len(hecto_ztbl):
         raise ValueError("Bad Hecto tables..")
@@ -126,21 +160,20 @@ def build_spectra(field, obs_path=None, path='./'):
         targs = Table.read(targ_file,delimiter='|', format='ascii.fixed_width',
                                 fill_values=[('--','0','MASK_NAME')])
         tcoord = SkyCoord(ra=targs['TARG_RA']*u.deg, dec=targs['TARG_DEC']*u.deg)
-        # Loop on duplicates
-        dup = np.where(counts>1)[0]
-        for idup in dup:
-            dobj = np.where(hecto_ztbl['ID'] == str(uni[idup]))[0]
-            # Loop on objects
-            for idobj in dobj:
-                dcoord = SkyCoord(ra=hecto_stbl['RA'][idobj]*u.deg,
-                                  dec=hecto_stbl['DEC'][idobj]*u.deg)
-                # Match by RA/DEC
-                mt = np.argmin(dcoord.separation(tcoord))
-                # Reset ID
-                #xdb.set_trace()
-                print('Setting ID to {:s} from {:s}'.format(
-                        str(targs['TARG_ID'][mt]), hecto_ztbl['ID'][idobj]))
-                hecto_ztbl['ID'][idobj] = str(targs['TARG_ID'][mt])
+        # All objects with a duplicated ID
+        dup = np.sort(uni[counts>1].astype(str))
+        allid = np.array(hecto_ztbl['ID']).astype(str)
+        idup = np.minimum(np.searchsorted(dup, allid), len(dup)-1)
+        dobj = np.where(dup[idup] == allid)[0]
+        # Match by RA/DEC, all at once
+        dcoord = SkyCoord(ra=np.array(hecto_stbl['RA'][dobj])*u.deg,
+                          dec=np.array(hecto_stbl['DEC'][dobj])*u.deg)
+        mts, d2d, d3d = coords.match_coordinates_sky(dcoord, tcoord, nthneighbor=1)
+        # Reset ID
+        for idobj, mt in zip(dobj, mts):
+            print('Setting ID to {:s} from {:s}'.format(
+                    str(targs['TARG_ID'][mt]), hecto_ztbl['ID'][idobj]))
+            hecto_ztbl['ID'][idobj] = str(targs['TARG_ID'][mt])
     # Double check
     idval = np.array(hecto_ztbl[gdobj]['ID']).astype(int)
     uni, counts = np.unique(idval, return_counts=True)
@@ -425,18 +458,18 @@ def deimos_targets(field, obs_path, deimos_path=None):
         mask_dict, targ_tab, obs_tab = parse_deimos_mask_file(msk_file)
         # Fill up SEx file
         if sex_targ is not None:
-            for targ in targ_tab:
-                targ_coord = xra.to_coord((targ['RAS'], targ['DECS']))
-                sep = targ_coord.separation(sex_coord)
-                isep = np.argmin(sep)
-                if sep[isep] > 0.5*u.arcsec:
-                    raise ValueError('No match in SExtractor?!')
-                else: # Fill
-                    if sex_msk_clms['MASK_NAME'][isep] == smsk:
-                        sex_msk_clms['MASK_NAME'][isep] = mask_dict['MASK_NAME']
-                    else: # Already full 
-                        sex_targ.add_row(sex_targ[isep])
-                        sex_msk_clms['MASK_NAME'].append(mask_dict['MASK_NAME'])
+            # Match all of the mask targets at once
+            rad, decd = xra.stod(targ_tab['RAS'], targ_tab['DECS'])
+            targ_coord = SkyCoord(ra=rad, dec=decd)
+            idx, d2d, d3d = coords.match_coordinates_sky(targ_coord, sex_coord, nthneighbor=1)
+            if np.any(d2d > 0.5*u.arcsec):
+                raise ValueError('No match in SExtractor?!')
+            for isep in idx: # Fill
+                if sex_msk_clms['MASK_NAME'][isep] == smsk:
+                    sex_msk_clms['MASK_NAME'][isep] = mask_dict['MASK_NAME']
+                else: # Already full 
+                    sex_targ.add_row(sex_targ[isep])
+                    sex_msk_clms['MASK_NAME'].append(mask_dict['MASK_NAME'])
         # Append
         all_masks.append(mask_dict)
         all_masktarg.append(targ_tab)
@@ -587,11 +620,10 @@ def hecto_targets(field, obs_path, hecto_path=None):
     targs.rename_column('dec','DECS')
     targs.add_column(Column([0.]*nrow,name='TARG_RA'))
     targs.add_column(Column([0.]*nrow,name='TARG_DEC'))
-    # Get RA/DEC in degrees
-    for k,row in enumerate(targs):
-        coord = ltu.radec_to_coord((row['RAS'], row['DECS']))
-        targs[k]['TARG_RA'] = coord.ra.value
-        targs[k]['TARG_DEC'] = coord.dec.value
+    # Get RA/DEC in degrees (all rows at once)
+    rad, decd = xra.stod(targs['RAS'], targs['DECS'])
+    targs['TARG_RA'][:] = rad.value
+    targs['TARG_DEC'][:] = decd.value
     # ID/Mag (not always present)
     targ_coord = SkyCoord(ra=targs['TARG_RA']*u.deg, dec=targs['TARG_DEC']*u.deg)
     try:
@@ -744,8 +776,123 @@ def galaxy_attrib():
     return attrib
 
 
+class SDSSFetcher(object):
+    """ Fetch SDSS/BOSS spectra with astroquery, in batches
+
+    Each spectrum is kept on disk (as .npz, keyed by plate-mjd-fiber)
+    when a cache folder is given, so a field can be rebuilt without
+    downloading it again.  Subclass and replace _get() to read the
+    spectra from elsewhere; see LocalFetcher.
+
+    Parameters
+    ----------
+    cachedir : str, optional
+      Folder for the cached spectra [default: no cache]
+    timeout : float, optional
+      Timeout limit for connection with SDSS
+    """
+    def __init__(self, cachedir=None, timeout=600.):
+        self.cachedir = cachedir
+        self.timeout = timeout
+        if cachedir is not None and not exists(cachedir):
+            makedirs(cachedir)
+
+    @staticmethod
+    def key(row):
+        return 'spec-{:04d}-{:05d}-{:04d}'.format(int(row['plate']), int(row['mjd']),
+                                                 int(row['fiberID']))
+
+    @staticmethod
+    def parse(hdulist):
+        """ Spectrum and redshift from an SDSS spec HDUList
+
+        Returns
+        -------
+        spec : dict
+          loglam, flux, ivar, Z, Z_ERR
+        """
+        data = hdulist[1].data
+        meta = hdulist[2].data
+        return dict(loglam=np.asarray(data['loglam'], dtype=np.float64),
+                    flux=np.asarray(data['flux'], dtype=np.float32),
+                    ivar=np.asarray(data['ivar'], dtype=np.float32),
+                    Z=float(meta['Z'][0]), Z_ERR=float(meta['Z_ERR'][0]))
+
+    def _cachefil(self, row):
+        return os.path.join(self.cachedir, self.key(row)+'.npz')
+
+    def _get(self, matches):
+        """ HDULists for the rows of matches, in order """
+        return SDSS.get_spectra(matches=matches, timeout=self.timeout)
+
+    def fetch(self, matches):
+        """ Spectra for the rows of a spectroscopic catalog
+
+        Parameters
+        ----------
+        matches : Table
+          Needs plate, mjd and fiberID (as from SDSS.query_region)
+
+        Returns
+        -------
+        specs : list of dict
+          See parse()
+        """
+        specs = [None]*len(matches)
+        if self.cachedir is not None:
+            for ii, row in enumerate(matches):
+                cfil = self._cachefil(row)
+                if exists(cfil):
+                    with np.load(cfil) as npz:
+                        specs[ii] = dict((key, npz[key][()]) for key in npz.files)
+        todo = [ii for ii, spec in enumerate(specs) if spec is None]
+        if len(todo) > 0:
+            hdus = self._get(matches[todo])
+            if len(hdus) != len(todo):
+                raise IOError('SDSSFetcher: Got {:d} spectra for {:d} requests'.format(
+                    len(hdus), len(todo)))
+            for ii, hdulist in zip(todo, hdus):
+                specs[ii] = self.parse(hdulist)
+                if self.cachedir is not None:
+                    # Write, then rename, so a killed build never leaves
+                    # a partial file behind
+                    cfil = self._cachefil(matches[ii])
+                    tmp = cfil+'.{:d}.tmp.npz'.format(os.getpid())
+                    np.savez(tmp, **specs[ii])
+                    os.rename(tmp, cfil)
+        return specs
+
+
+class LocalFetcher(SDSSFetcher):
+    """ Read SDSS/BOSS spectra from a local archive of spec files
+
+    Parameters
+    ----------
+    path : str
+      Root of the archive
+    pattern : str, optional
+      File name, relative to path, formatted with plate, mjd and fiber
+    """
+    def __init__(self, path, pattern='{plate:04d}/spec-{plate:04d}-{mjd:05d}-{fiber:04d}.fits',
+                 cachedir=None):
+        SDSSFetcher.__init__(self, cachedir=cachedir)
+        self.path = path
+        self.pattern = pattern
+
+    def _get(self, matches):
+        hdus = []
+        for row in matches:
+            fil = os.path.join(self.path, self.pattern.format(
+                plate=int(row['plate']), mjd=int(row['mjd']), fiber=int(row['fiberID'])))
+            if not exists(fil) and exists(fil+'.gz'):
+                fil = fil+'.gz'
+            hdus.append(fits.open(fil))
+        return hdus
+
+
 def grab_sdss_spectra(radec, radius=0.1*u.deg, outfil=None,
-                      debug=False, maxsep=None, timeout=600., zmin=None):
+                      debug=False, maxsep=None, timeout=600., zmin=None,
+                      fetcher=None, cachedir=None, nthreads=4, batch=20):
     """ Grab SDSS spectra
 
     Parameters
@@ -762,14 +909,26 @@ def grab_sdss_spectra(radec, radius=0.1*u.deg, outfil=None,
       Maximum separation to include
     zmin : float (None)
       Minimum redshift to include
+    fetcher : SDSSFetcher, optional
+      Source of the spectra, e.g. a LocalFetcher
+      [default: SDSSFetcher(cachedir, timeout)]
+    cachedir : str, optional
+      Folder for caching the spectra of the default fetcher
+    nthreads : int, optional
+      Number of batches fetched at once
+    batch : int, optional
+      Number of spectra per batch
 
     Returns
     -------
     tbl : Table
 
     """
+    from multiprocessing.pool import ThreadPool
 
     cC = coords.SkyCoord(ra=radec[0], dec=radec[1])
+    if fetcher is None:
+        fetcher = SDSSFetcher(cachedir=cachedir, timeout=timeout)
 
     # Query
     photoobj_fs = ['ra', 'dec', 'objid', 'run', 'rerun', 'camcol', 'field']
@@ -789,36 +948,60 @@ def grab_sdss_spectra(radec, radius=0.1*u.deg, outfil=None,
     sgal = SkyCoord(ra=spec_catalog['ra']*u.degree, dec=spec_catalog['dec']*u.degree)
     sepgal = cgal.separation(cC) #in degrees
 
-    # Check for problems and parse z
-    zobj = np.zeros(nobj)
+    # Check for problems and parse z (sources without a spectrum have
+    # no redshift, so fail the separation cut; else they are dropped below)
     idx, d2d, d3d = coords.match_coordinates_sky(cgal, sgal, nthneighbor=1)
-    if np.max(d2d) > 1.*u.arcsec:
-        print('No spectral match!')
-        xdb.set_trace()
-    else:
-        zobj = spec_catalog['z'][idx]
+    zobj = np.array(spec_catalog['z'][idx], dtype=float)
+    zobj[d2d > 1.*u.arcsec] = np.nan
 
     idx, d2d, d3d = coords.match_coordinates_sky(cgal, cgal, nthneighbor=2)
     if np.min(d2d.to('arcsec')) < 1.*u.arcsec:
         print('Two photometric sources with same RA/DEC')
         xdb.set_trace()
 
-    #xdb.set_trace()
-
-
     # Cut on Separation
     if not maxsep is None:
         print('grab_sdss_spectra: Restricting to {:g} Mpc separation.'.format(maxsep))
-        sepgal_kpc = cosmo.kpc_comoving_per_arcmin(zobj) * sepgal.to('arcmin')
+        gdz = np.where(np.isfinite(zobj))[0]
+        sepgal_kpc = cosmo.kpc_comoving_per_arcmin(zobj[gdz]) * sepgal[gdz].to('arcmin')
         sepgal_mpc = sepgal_kpc.to('Mpc')
-        gdg = np.where( sepgal_mpc < (maxsep * u.Unit('Mpc')))[0]
+        gdg = gdz[sepgal_mpc < (maxsep * u.Unit('Mpc'))]
         phot_catalog = phot_catalog[gdg]
-        #xdb.set_trace()
+        cgal = cgal[gdg]
 
     nobj = len(phot_catalog)
     print('grab_sdss_spectra: Grabbing data for {:d} sources.'.format(nobj))
 
-    # Grab Spectra from SDSS
+    # Match every spectrum to its photometric source (there may be
+    # duplicates), then take one per source: BOSS if you have it,
+    # else the first.  Sources without a spectrum are dropped.
+    pidx, d2d, d3d = coords.match_coordinates_sky(sgal, cgal, nthneighbor=1)
+    ispec = np.where(d2d.to('arcsec') < 1.*u.Unit('arcsec'))[0]
+    instr = np.char.strip(np.asarray(spec_catalog['instrument']).astype(str))
+    srt = np.lexsort((ispec, instr[ispec] != 'BOSS', pidx[ispec]))
+    uobj, ufirst = np.unique(pidx[ispec][srt], return_index=True)
+    if len(uobj) < nobj:
+        print('grab_sdss_spectra: No spectrum for {:d} sources; dropping them'.format(
+            nobj-len(uobj)))
+        phot_catalog = phot_catalog[uobj]
+        cgal = cgal[uobj]
+        nobj = len(uobj)
+    mt = ispec[srt][ufirst]
+
+    # Grab Spectra from SDSS, a batch at a time
+    matches = Table(spec_catalog[mt])
+    chunks = [np.arange(ii, min(ii+batch, nobj)) for ii in range(0, nobj, batch)]
+    nthreads = max(min(int(nthreads), len(chunks)), 1)
+    if nthreads == 1:
+        specs = [fetcher.fetch(matches[chunk]) for chunk in chunks]
+    else:
+        pool = ThreadPool(nthreads)
+        try:
+            specs = pool.map(lambda chunk: fetcher.fetch(matches[chunk]), chunks)
+        finally:
+            pool.close()
+            pool.join()
+    specs = [spec for chunk in specs for spec in chunk]
 
     # Generate output table
     attribs = galaxy_attrib()
@@ -826,60 +1009,32 @@ def grab_sdss_spectra(radec, radius=0.1*u.deg, outfil=None,
     spec_attrib = [(str('FLUX'), np.float32, (npix,)),
                    (str('SIG'), np.float32, (npix,)),
                    (str('WAVE'), np.float64, (npix,))]
-    tbl = np.recarray( (nobj,), dtype=attribs+spec_attrib)
+    tbl = np.zeros( (nobj,), dtype=attribs+spec_attrib).view(np.recarray)
 
     tbl['RA'] = phot_catalog['ra']
     tbl['DEC'] = phot_catalog['dec']
     tbl['TELESCOPE'] = str('SDSS 2.5-M')
-
-    # Deal with spectra separately (for now)
-    npix = 5000 #len( spec_hdus[0][1].data.flux )
-
-    for idx,obj in enumerate(phot_catalog):
-        #print('idx = {:d}'.format(idx))
-
-        # Grab spectra (there may be duplicates)
-        mt = np.where( sgal.separation(cgal[idx]).to('arcsec') < 1.*u.Unit('arcsec'))[0]
-        if len(mt) > 1:
-            # Use BOSS if you have it
-            mmt = np.where( spec_catalog[mt]['instrument'] == 'BOSS')[0]
-            if len(mmt) > 0:
-                mt = mt[mmt[0]]
-            else:
-                mt = mt[0]
-        elif len(mt) == 0:
-            xdb.set_trace()
-        else:
-            mt = mt[0]
-
-        # Grab spectra
-        spec_hdus = SDSS.get_spectra(matches=Table(spec_catalog[mt]))
-
-        tbl[idx]['INSTRUMENT'] = spec_catalog[mt]['instrument']
-        spec = spec_hdus[0][1].data
-        npp = len(spec.flux)
-        tbl[idx]['FLUX'][0:npp] = spec.flux
-        sig = np.zeros(npp)
-        gdi = np.where(spec.ivar > 0.)[0]
-        if len(gdi) > 0:
-            sig[gdi] = np.sqrt( 1./spec.ivar[gdi] )
-        tbl[idx]['SIG'][0:npp] = sig
-        tbl[idx]['WAVE'][0:npp] = 10.**spec.loglam
+    tbl['INSTRUMENT'] = instr[mt]
+    tbl['SDSS_MAG'] = np.array([phot_catalog[phot] for phot in mags]).T
+    tbl['SDSS_MAGERR'] = np.array([phot_catalog[phot] for phot in magsErr]).T
+
+    for idx, spec in enumerate(specs):
+        npp = min(len(spec['flux']), npix)
+        tbl['FLUX'][idx, 0:npp] = spec['flux'][0:npp]
+        ivar = spec['ivar'][0:npp]
+        gdi = ivar > 0.
+        tbl['SIG'][idx, 0:npp][gdi] = np.sqrt( 1./ivar[gdi] )
+        tbl['WAVE'][idx, 0:npp] = 10.**spec['loglam'][0:npp]
 
         # Redshifts
-        meta = spec_hdus[0][2].data
         for attrib in ['Z','Z_ERR']:
-            tbl[idx][attrib] = meta[attrib]
+            tbl[attrib][idx] = spec[attrib]
 
         if debug:
             sep_to_qso = cgal[idx].separation(cC).to('arcmin')
             print('z = {:g}, Separation = {:g}'.format(tbl[idx].Z, sep_to_qso))
             xdb.set_trace()
 
-        # Fill in rest
-        tbl[idx].SDSS_MAG = np.array( [obj[phot] for phot in mags])
-        tbl[idx].SDSS_MAGERR = np.array( [obj[phot] for phot in magsErr])
-
     # Clip on redshift to excise stars/quasars
     if zmin is not None:
         gd = np.where(tbl['Z'] > zmin)[0]
@@ -895,8 +1050,8 @@ def grab_sdss_spectra(radec, radius=0.1*u.deg, outfil=None,
 
         thdulist = fits.HDUList([prihdu, tbhdu])
         thdulist.writeto(outfil,clobber=True)
+        print('Wrote SDSS table to {:s}'.format(outfil))
 
-    print('Wrote SDSS table to {:s}'.format(outfil))
     return tbl
 
 
@@ -20,27 +20,30 @@ from astropy.table import Table
 from pyigm.field.igmfield import IgmGalaxyField
 
 #from astropy import constants as const
-from xastropy.casbah import galaxy_data as xcgd
+from xastropy.casbah import field_db as xcfdb
 from xastropy.casbah import utils as xcasbahu
 from xastropy.xutils import lists as xxul
 
 from xastropy.xutils import xdebug as xdb
 
 # SDSS
-def load_field(field):
+def load_field(field, cachedir=None):
     ''' Load up CASBAH data for a given field
 
     Parameters:
     -----------
     field: tuple
       (Name, ra, dec)
+    cachedir: str, optional
+      Folder for the galaxy database; see field_db.FieldDB
 
     Returns:
     --------
     lfield:     
       Loaded IgmGalaxyField class
+      galaxies holds the scalar columns of all the galaxy tables;
+      the spectra are read on demand with lfield.db.spectrum(row)
     '''
-    reload(xcasbahu)
     lfield = IgmGalaxyField((field[1],field[2]), name=field[0])
 
     # Load targets
@@ -56,13 +59,9 @@ def load_field(field):
         fill_values=[('--','0','DATE_OBS','TEXP')])
     lfield.observing = Table(lfield.observing,masked=True) # Insist on Masked
 
-    # Load galaxies
-    sdss_file = xcasbahu.get_filename(field,'SDSS')
-    sdss_tab = Table.read(sdss_file)
-    # VSTACK
-    hectospec_file = xcasbahu.get_filename(field,'HECTOSPEC')
-
-    lfield.galaxies = sdss_tab
+    # Load galaxies (SDSS, HECTOSPEC, DEIMOS), without their spectra
+    lfield.db = xcfdb.get_db(field, cachedir=cachedir)
+    lfield.galaxies = lfield.db.catalog
 
     # Return
     return lfield
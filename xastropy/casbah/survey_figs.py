@@ -45,10 +45,9 @@ def hectospec_targets(field, outfil=None):
         outfil = xcasu.get_filename(field,'HECTO_TARG_FIG')
     # Load field
     lfield = xcasl.load_field(field)
-    targ_coord = SkyCoord(ra=lfield.targets['TARG_RA']*u.deg,
-        dec=lfield.targets['TARG_DEC']*u.deg)
-    all_pa = fcoord.position_angle(targ_coord)
-    all_sep = fcoord.separation(targ_coord).to('arcmin')
+    (all_dra, all_ddec), _ = xra.sph_offsets(fcoord.ra, fcoord.dec,
+        lfield.targets['TARG_RA'], lfield.targets['TARG_DEC'])
+    all_dra, all_ddec = all_dra.to('arcmin'), all_ddec.to('arcmin')
 
     # Start the plot
     if outfil is not None: 
@@ -97,8 +96,8 @@ def hectospec_targets(field, outfil=None):
 
         # Targets
         hecto_targ = np.where(lfield.targets['INSTR'] == 'HECTOSPEC')[0]
-        ddec = all_sep[hecto_targ]*np.cos(all_pa[hecto_targ])
-        dra = all_sep[hecto_targ]*np.sin(all_pa[hecto_targ])
+        ddec = all_ddec[hecto_targ]
+        dra = all_dra[hecto_targ]
         #xdb.set_trace()
         ax_hecto.scatter(dra,ddec, marker='o',color='gray',s=10.,
             facecolor='none',linewidth=0.3, alpha=0.5)
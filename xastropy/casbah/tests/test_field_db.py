@@ -0,0 +1,108 @@
+# Module to run tests on the CASBAH field database
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import os
+import pytest
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+
+from xastropy.casbah import field_db as xfdb
+
+FIELD = ('F1', 150.*u.deg, 2.*u.deg)
+
+
+def _tables(path, nsdss=30, nhecto=10):
+    # Zero-padded spectra of different lengths; FLUX holds the row number
+    rng = np.random.RandomState(3)
+    os.makedirs(os.path.join(path, 'F1'))
+    for survey, nrow, npix, nspec in [('SDSS', nsdss, 60, 50), ('HECTOSPEC', nhecto, 40, 40)]:
+        wave = np.zeros((nrow, npix))
+        wave[:, :nspec] = np.linspace(4000., 9000., nspec)
+        tab = Table([150. + rng.uniform(-0.2, 0.2, nrow), 2. + rng.uniform(-0.2, 0.2, nrow),
+                     rng.uniform(0.01, 0.3, nrow), np.zeros(nrow), ['X']*nrow, wave,
+                     np.tile(np.arange(nrow, dtype=np.float32)[:, None], (1, npix)),
+                     np.ones((nrow, npix), dtype=np.float32)],
+                    names=('RA', 'DEC', 'Z', 'Z_ERR', 'INSTRUMENT', 'WAVE', 'FLUX', 'SIG'))
+        tab.write(os.path.join(path, 'F1', 'F1_'+survey+'.fits'), overwrite=True)
+
+
+def test_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('CASBAH_GALAXIES', str(tmpdir))
+    _tables(str(tmpdir))
+    db = xfdb.FieldDB(FIELD)
+    assert db.surveys == ['SDSS', 'HECTOSPEC']
+    assert len(db) == 40
+    assert os.path.isfile(os.path.join(db.cachedir, 'SDSS_FLUX.npy'))
+    # Read back from the cache, with the spectra memory-mapped
+    db = xfdb.FieldDB(FIELD)
+    wave, flux, sig = db.spectrum(33)
+    assert isinstance(db._spectra('HECTOSPEC', 'FLUX'), np.memmap)
+    assert len(wave) == 40 and wave.unit == u.AA
+    assert np.all(flux == 3.)
+    assert len(db.spectrum(3)[0]) == 50
+    np.testing.assert_allclose(db.catalog['Z'][:30], db.survey('SDSS')['Z'])
+
+
+def test_get_db(tmpdir, monkeypatch):
+    monkeypatch.setenv('CASBAH_GALAXIES', str(tmpdir))
+    _tables(str(tmpdir))
+    db = xfdb.get_db(FIELD)
+    assert xfdb.get_db(FIELD) is db
+    # A changed table gives a new database
+    fil = os.path.join(str(tmpdir), 'F1', 'F1_SDSS.fits')
+    tab = Table.read(fil)
+    tab['Z'] += 1.
+    tab.write(fil, overwrite=True)
+    stat = os.stat(fil)
+    os.utime(fil, (stat.st_atime, stat.st_mtime+10.))
+    db2 = xfdb.get_db(FIELD)
+    assert db2 is not db
+    np.testing.assert_allclose(db2.catalog['Z'][:30], db.catalog['Z'][:30] + 1.)
+    assert xfdb.get_db(FIELD) is db2
+
+
+def test_impact(tmpdir, monkeypatch):
+    from astropy.cosmology import Planck15 as cosmo
+    monkeypatch.setenv('CASBAH_GALAXIES', str(tmpdir))
+    _tables(str(tmpdir))
+    db = xfdb.FieldDB(FIELD)
+    rows, rho = db.impact(0.05, 0.25, 1.5*u.Mpc)
+    zval = np.asarray(db.catalog['Z'])
+    gcoord = SkyCoord(ra=db.catalog['RA']*u.deg, dec=db.catalog['DEC']*u.deg)
+    sep = gcoord.separation(SkyCoord(ra=150.*u.deg, dec=2.*u.deg))
+    good = np.where((zval >= 0.05) & (zval <= 0.25))[0]
+    rho_true = (sep[good] * cosmo.kpc_proper_per_arcmin(zval[good])).to(u.kpc).value
+    assert 0 < len(rows) < len(good)
+    assert set(rows) == set(good[rho_true <= 1500.])
+    assert np.all(np.diff(rho.value) >= 0.)
+    np.testing.assert_allclose(rho.value, rho_true[np.searchsorted(good, rows)], rtol=1e-3)
+    # Cone search
+    rows = db.cone(SkyCoord(ra=150.*u.deg, dec=2.*u.deg), 10*u.arcmin)
+    np.testing.assert_array_equal(rows, np.where(sep < 10*u.arcmin)[0])
+
+
+def test_impact_highz(tmpdir, monkeypatch):
+    # One z~3 object must not spoil the scale at low z
+    from astropy.cosmology import Planck15 as cosmo
+    monkeypatch.setenv('CASBAH_GALAXIES', str(tmpdir))
+    _tables(str(tmpdir))
+    fil = os.path.join(str(tmpdir), 'F1', 'F1_SDSS.fits')
+    tab = Table.read(fil)
+    tab['Z'][:20] = np.linspace(0.01, 0.02, 20)
+    tab['Z'][20] = 3.
+    tab.write(fil, overwrite=True)
+    db = xfdb.FieldDB(FIELD)
+    for comoving in [False, True]:
+        rows, rho = db.impact(0.005, 0.025, 10*u.Mpc, comoving=comoving)
+        assert set(range(20)) <= set(rows)
+        zval = np.asarray(db.catalog['Z'])[rows]
+        if comoving:
+            scale = cosmo.kpc_comoving_per_arcmin(zval)
+        else:
+            scale = cosmo.kpc_proper_per_arcmin(zval)
+        rho_true = (np.asarray(db.catalog['SEP'])[rows]*u.arcsec * scale).to(u.kpc).value
+        np.testing.assert_allclose(rho.value, rho_true, rtol=1e-3)
@@ -0,0 +1,119 @@
+# Module to run tests on grabbing SDSS spectra (offline, with a fake SDSS)
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import os
+import pytest
+
+from astropy import units as u
+from astropy.io import fits
+from astropy.table import Table
+
+from xastropy.casbah import galaxies as xcg
+
+NOBJ = 12
+RADEC = (150.1*u.deg, 2.1*u.deg)
+
+
+def _catalogs():
+    # Photometric sources on a 4x3 grid; one spectrum each, except
+    # source 3 (none), and a BOSS duplicate for sources 0 and 5
+    ra = 150.05 + 0.03*(np.arange(NOBJ) % 4)
+    dec = 2.05 + 0.03*(np.arange(NOBJ) // 4)
+    phot = Table([ra, dec] + [np.full(NOBJ, 18.+ii) for ii in range(10)],
+                 names=['ra', 'dec'] + ['petroMag_'+b for b in 'ugriz'] +
+                 ['petroMagErr_'+b for b in 'ugriz'])
+    src = [ii for ii in range(NOBJ) if ii != 3] + [0, 5]
+    instr = ['SDSS']*(NOBJ-1) + ['BOSS']*2
+    fiber = [ii for ii in range(NOBJ) if ii != 3] + [100, 105]
+    order = np.random.RandomState(4).permutation(len(src))
+    spec = Table([ra[src]+1e-5, dec[src], 0.01*(np.array(src)+1), np.full(len(src), 300),
+                  np.full(len(src), 51000), fiber, instr],
+                 names=['ra', 'dec', 'z', 'plate', 'mjd', 'fiberID', 'instrument'])
+    return phot, spec[order]
+
+
+def _hdulist(row):
+    # FLUX holds the fiber number
+    npix = 4600 if row['instrument'] == 'BOSS' else 3800
+    data = Table([np.linspace(3.55, 3.9, npix), np.full(npix, row['fiberID'], np.float32),
+                  np.full(npix, 4., np.float32)], names=['loglam', 'flux', 'ivar'])
+    meta = Table([[row['z']], [1e-4]], names=['Z', 'Z_ERR'])
+    return fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU(data), fits.BinTableHDU(meta)])
+
+
+class FakeSDSS(object):
+    '''astroquery.sdss.SDSS on fixed catalogs, counting the spectra
+    fetched in each call
+    '''
+    def __init__(self):
+        self.phot, self.spec = _catalogs()
+        self.calls = []
+
+    def query_region(self, coord, spectro=True, radius=None, timeout=None,
+                     photoobj_fields=None):
+        return self.phot if photoobj_fields is not None else self.spec
+
+    def get_spectra(self, matches=None, timeout=None):
+        self.calls.append(len(matches))
+        return [_hdulist(row) for row in matches]
+
+
+class FakeFetcher(xcg.SDSSFetcher):
+    def _get(self, matches):
+        return [_hdulist(row) for row in matches]
+
+
+# Fiber of the spectrum taken for each source with one (BOSS first)
+FIBERS = [100, 1, 2, 4, 105, 6, 7, 8, 9, 10, 11]
+
+
+def test_grab_sdss_spectra(tmpdir, monkeypatch, capsys):
+    sdss = FakeSDSS()
+    monkeypatch.setattr(xcg, 'SDSS', sdss)
+    cachedir = str(tmpdir.join('cache'))
+    tbl = xcg.grab_sdss_spectra(RADEC, cachedir=cachedir, nthreads=1, batch=4)
+    # Source 3 has no spectrum and is dropped
+    assert len(tbl) == NOBJ-1
+    np.testing.assert_allclose(tbl['RA'], np.delete(sdss.phot['ra'], 3))
+    np.testing.assert_array_equal(tbl['FLUX'][:, 0], FIBERS)
+    np.testing.assert_array_equal(np.char.strip(tbl['INSTRUMENT'].astype(str)) == 'BOSS',
+                                  np.isin(FIBERS, [100, 105]))
+    np.testing.assert_allclose(tbl['SIG'][:, 0], 0.5)
+    assert tbl['SIG'][1, 3800] == 0.
+    np.testing.assert_allclose(tbl['Z'], 0.01*(np.delete(np.arange(NOBJ), 3)+1))
+    # Batches of 4
+    assert sdss.calls == [4, 4, 3]
+    assert len(os.listdir(cachedir)) == NOBJ-1
+    # Read back from the cache
+    sdss.calls = []
+    tbl2 = xcg.grab_sdss_spectra(RADEC, cachedir=cachedir, nthreads=2, batch=4)
+    assert sdss.calls == []
+    np.testing.assert_array_equal(tbl2['FLUX'], tbl['FLUX'])
+    np.testing.assert_array_equal(tbl2['WAVE'], tbl['WAVE'])
+    # Cuts on separation and redshift; several threads.  Source 3 has
+    # no redshift, so fails the separation cut
+    capsys.readouterr()
+    tbl3 = xcg.grab_sdss_spectra(RADEC, fetcher=FakeFetcher(), nthreads=3, batch=2,
+                                 maxsep=100., zmin=0.045)
+    assert 'Grabbing data for {:d} sources'.format(NOBJ-1) in capsys.readouterr().out
+    np.testing.assert_array_equal(tbl3['FLUX'][:, 0], FIBERS[3:])
+
+
+def test_local_fetcher(tmpdir):
+    phot, spec = _catalogs()
+    for row in spec:
+        fil = str(tmpdir.join('0300', 'spec-0300-51000-{:04d}.fits'.format(row['fiberID'])))
+        if not os.path.isdir(os.path.dirname(fil)):
+            os.makedirs(os.path.dirname(fil))
+        if row['fiberID'] == 1:
+            fil += '.gz'
+        _hdulist(row).writeto(fil)
+    fetcher = xcg.LocalFetcher(str(tmpdir))
+    specs = fetcher.fetch(spec)
+    np.testing.assert_array_equal([sp['flux'][0] for sp in specs], spec['fiberID'])
+    np.testing.assert_allclose([sp['Z'] for sp in specs], spec['z'])
+    with pytest.raises(IOError):
+        spec['fiberID'][0] = 999
+        fetcher.fetch(spec)
@@ -43,6 +43,10 @@ def get_filename(field, ftype):
         filename = path+'/'+field[0]+'/'+field[0]+'_SDSS.fits'
     elif ftype == 'HECTOSPEC':
         filename = path+'/'+field[0]+'/'+field[0]+'_HECTOSPEC.fits'
+    elif ftype == 'DEIMOS':
+        filename = path+'/'+field[0]+'/'+field[0]+'_DEIMOS.fits'
+    elif ftype == 'DB':
+        filename = path+'/'+field[0]+'/'+field[0]+'_db'
     elif ftype == 'DEIMOS_TARG_FIG':
         filename = path+'/'+field[0]+'/'+field[0]+'_deimostarg.pdf'
     elif ftype == 'HECTO_TARG_FIG':
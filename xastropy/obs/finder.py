@@ -49,6 +49,7 @@
 
 # Import libraries
 import numpy as np
+import os, hashlib
 
 from astropy.io import fits, ascii
 from astropy import units as astrou
@@ -61,6 +62,11 @@ from xastropy.obs import x_getsdssimg as xgs
 from xastropy.xutils import xdebug as xdb
 from xastropy.obs import radec as x_r
 
+# def get_coord :: Read a target list
+# def get_image :: Grab an image for a finder, via a disk cache
+# def main :: Finder chart(s), one at a time
+# def make_finders :: Finder charts for a target list, on a process pool
+
 #### ###############################
 #  Deal with the RA/DEC
 def get_coord(targ_file, radec=None):
@@ -78,7 +84,7 @@ def get_coord(targ_file, radec=None):
     # Import Tables
     if radec == None:
         # Read 
-        ra_tab = ascii.read(targ_file) #, names=('Name','RA','DEC','Epoch'))
+        ra_tab = ascii.read(targ_file, format='no_header') #, names=('Name','RA','DEC','Epoch'))
         # Rename the columns
         ra_tab.rename_column('col1','Name')
         if isinstance(ra_tab['col2'][0],basestring):
@@ -100,7 +106,7 @@ def get_coord(targ_file, radec=None):
         if len(targ_file) != 3:
             return -1
         # Manipulate
-        ras, decs = x_radec.dtos1((targ_file[1], targ_file[2]))
+        ras, decs = x_r.dtos1((targ_file[1], targ_file[2]))
         # Generate the Table
         ra_tab = QTable( [ [targ_file[0]], [ras], [decs] ], names=('Name','RA','DEC') )
     else:
@@ -108,8 +114,8 @@ def get_coord(targ_file, radec=None):
 
     # Add dummy columns for decimal degrees and EPOCH
     nrow = len(ra_tab)
-    col_RAD = Column(name='RAD', data=np.zeros(nrow), unit=u.degree)
-    col_DECD = Column(name='DECD', data=np.zeros(nrow), unit=u.degree)
+    col_RAD = Column(name='RAD', data=np.zeros(nrow), unit=astrou.degree)
+    col_DECD = Column(name='DECD', data=np.zeros(nrow), unit=astrou.degree)
     col_EPOCH = Column(name='EPOCH', data=np.zeros(nrow))
     ra_tab.add_columns( [col_RAD, col_DECD, col_EPOCH] )
     # Assume 2000 for now
@@ -117,13 +123,241 @@ def get_coord(targ_file, radec=None):
         
     return ra_tab
 
+#### ###############################
+#  Image, via the cache
+def get_image(ra, dec, imsize, BW=False, DSS=None, cachedir=None, provider=None):
+    '''
+    Grab the image for a finder chart, reading it from cachedir if it
+    was grabbed before
+
+    Parameters:
+    ---------
+    ra, dec: float
+       RA, DEC in decimal degrees
+    imsize: float
+       Image size in arcmin
+    BW, DSS: optional
+       See x_getsdssimg.getimg
+    cachedir: str, optional
+       Folder for cached images, keyed by survey, RA, DEC, size and BW
+    provider: optional
+       Object with a getimg method of the same call as
+       x_getsdssimg.getimg, e.g. x_getsdssimg.LocalProvider to read
+       from local mosaics [default: x_getsdssimg, i.e. the provider
+       set there]
+
+    Returns:
+    ---------
+    img: ndarray or PIL Image
+    BW: bool
+       B&W image?
+    '''
+    if provider is None:
+        provider = xgs
+    ra = astrou.Quantity(ra, astrou.deg).value
+    dec = astrou.Quantity(dec, astrou.deg).value
+    cfil = None
+    if cachedir is not None:
+        key = '{:s}|{:.6f}|{:.6f}|{:.4f}|{:d}'.format('SDSS' if DSS is None else 'DSS',
+            ra, dec, imsize, int(bool(BW)))
+        cfil = os.path.join(cachedir, hashlib.sha1(key.encode('utf-8')).hexdigest()+'.npz')
+        if os.path.isfile(cfil):
+            npz = np.load(cfil)
+            return npz['img'], bool(npz['BW'])
+    img, oBW = provider.getimg(ra, dec, imsize, BW=BW, DSS=DSS)
+    if cfil is not None:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        img = np.asarray(img)
+        tmp = cfil+'.tmp{:d}.npz'.format(os.getpid())
+        np.savez(tmp, img=img, BW=bool(oBW))
+        os.rename(tmp, cfil)
+    return img, oBW
+
+#### ###############################
+#  Plot one chart
+def _render(obj, img, oBW, imsize, outfil, show_circ=True, spec_img=None):
+    '''
+    Draw and write one finder chart without pyplot, so that charts can
+    be made in parallel
+    obj: dict-like with Name, RAS, DECS
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.patches import Circle
+    import matplotlib.cm as cm
+
+    cradius = imsize / 50. 
+    nm = "".join(obj['Name'].split()) 
+    with matplotlib.rc_context({'font.family': 'times new roman'}):
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        fig.set_size_inches(8.0,10.5)
+
+        # Font
+        ticks_font = matplotlib.font_manager.FontProperties(family='times new roman', 
+           style='normal', size=16, weight='normal', stretch='normal')
+        ax = fig.add_subplot(111)
+        for label in ax.get_yticklabels() :
+            label.set_fontproperties(ticks_font)
+        for label in ax.get_xticklabels() :
+            label.set_fontproperties(ticks_font)
+
+        # Image
+        if oBW == 1: 
+            cmm = cm.Greys_r
+        else: 
+            cmm = None 
+        ax.imshow(img,cmap=cmm,aspect='equal',extent=(-imsize/2., imsize/2, -imsize/2.,imsize/2))
+
+        # Axes
+        ax.set_xlim(-imsize/2., imsize/2.)
+        ax.set_ylim(-imsize/2., imsize/2.)
+
+        # Label
+        ax.set_xlabel('Relative ArcMin', fontsize=20)
+        xpos = 0.12*imsize
+        ypos = 0.02*imsize
+        ax.text(-imsize/2.-xpos, 0., 'EAST', rotation=90.,fontsize=20)
+        ax.text(0.,imsize/2.+ypos, 'NORTH', fontsize=20, horizontalalignment='center')
+
+        # Title
+        ax.text(0.5,1.24, str(nm), fontsize=32, 
+            horizontalalignment='center',transform=ax.transAxes)
+        ax.text(0.5,1.16, 'RA (J2000) = '+str(obj['RAS']), fontsize=28, 
+            horizontalalignment='center',transform=ax.transAxes)
+        ax.text(0.5,1.10, 'DEC (J2000) = '+str(obj['DECS']), fontsize=28, 
+            horizontalalignment='center',transform=ax.transAxes)
+
+        # Circle
+        if show_circ:
+            ax.add_artist(Circle((0,0),cradius,color='y', fill=False))
+
+        # Spectrum??
+        if spec_img is not None:
+            ax.imshow(spec_img,extent=(-imsize/2.1, imsize*(-0.1), -imsize/2.1, imsize*(-0.2)))
+
+        # Write (at the 100 dpi savefig default these charts were designed
+        # for; a 1200 dpi raster of the page takes GBs of memory)
+        if spec_img is not None:
+            fig.savefig(outfil, dpi=300)
+        else:
+            fig.savefig(outfil, dpi=100)
+    print('finder: Wrote '+outfil)
+
+def _outfil(name, fpath, OUT_TYPE):
+    nm = "".join(name.split()) 
+    if OUT_TYPE=='PNG':
+        return fpath+ nm + '.png'
+    else:
+        return fpath+ nm + '.pdf'
+
+def _one_finder(job):
+    '''Grab the image and write one chart (for make_finders)
+    '''
+    obj, kwargs = job
+    img, oBW = get_image(obj['RA'], obj['DEC'], kwargs['imsize'], BW=kwargs['BW'],
+        DSS=kwargs['DSS'], cachedir=kwargs['cachedir'], provider=kwargs['provider'])
+    spec_img = None
+    if kwargs['show_spec']:
+        provider = xgs if kwargs['provider'] is None else kwargs['provider']
+        spec_img = provider.get_spec_img(obj['RA'], obj['DEC']) 
+    _render(obj, img, oBW, kwargs['imsize'], obj['outfil'], show_circ=kwargs['show_circ'],
+        spec_img=spec_img)
+    return obj['outfil']
+
+def _targets(targets):
+    '''One dict (Name, RA, DEC in degrees, RAS, DECS) per row of a
+    target table, e.g. from get_coord
+    '''
+    colnames = targets.colnames
+    name_tag = [tag for tag in ['Name', 'NAME', 'Target', 'QSO'] if tag in colnames][0]
+    if 'RAS' in colnames:
+        ras, decs = targets['RAS'], targets['DECS']
+        ra, dec = x_r.stod(ras, decs)
+    elif isinstance(targets['RA'][0],basestring):
+        ras, decs = targets['RA'], targets['DEC']
+        ra, dec = x_r.stod(ras, decs)
+    else:
+        ra, dec = targets['RA'], targets['DEC']
+        ras, decs = x_r.dtos(ra, dec)
+    ra = astrou.Quantity(ra, astrou.deg).value
+    dec = astrou.Quantity(dec, astrou.deg).value
+    return [dict(Name=str(targets[name_tag][ii]), RA=float(ra[ii]), DEC=float(dec[ii]),
+        RAS=str(ras[ii]), DECS=str(decs[ii])) for ii in range(len(targets))]
+
+#### ###############################
+#  Many charts
+def make_finders(targets, fpath=None, nproc=None, cachedir=None, provider=None,
+    show_circ=True, DSS=None, BW=False, imsize=5.*astrou.arcmin, show_spec=False,
+    OUT_TYPE='PDF'):
+    '''
+    Finder charts for a list of targets, made on a process pool
+
+    Parameters:
+    ---------
+    targets: Table or str
+       Table with a name column (Name, NAME, Target or QSO) and RA, DEC
+       as decimal degrees (or Quantity) or as : separated strings;
+       or an ASCII file as for get_coord
+    fpath: str, optional
+       Output folder [default: ./]
+    nproc: int, optional
+       Number of processes [default: number of CPUs]; 1 runs serially
+    cachedir: str, optional
+       Cache the images here, so that reruns need not grab them again
+    provider: optional
+       Image provider; see get_image.  Must be picklable if nproc > 1.
+    show_circ, DSS, BW, imsize, show_spec, OUT_TYPE: optional
+       See main
+
+    Returns:
+    ---------
+    outfils: list
+       Finder charts written
+    '''
+    import multiprocessing
+
+    if fpath is None:
+        fpath = './'
+    try:
+        imsize=imsize.to('arcmin').value
+    except AttributeError:
+        raise AttributeError('finder: Input imsize needs to be an Angle')
+
+    # Targets
+    if isinstance(targets,basestring):
+        targets = get_coord(targets)
+    kwargs = dict(imsize=imsize, BW=BW, DSS=DSS, cachedir=cachedir, provider=provider,
+        show_circ=show_circ, show_spec=show_spec)
+    jobs = []
+    for obj in _targets(targets):
+        obj['outfil'] = _outfil(obj['Name'], fpath, OUT_TYPE)
+        jobs.append((obj, kwargs))
+
+    # Make the charts
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    nproc = max(min(nproc, len(jobs)), 1)
+    if nproc == 1:
+        outfils = [_one_finder(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            outfils = pool.map(_one_finder, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    print('finder: All done.')
+    return outfils
+
 #### ###############################
 #  Main driver
 #  finder.main(['TST', '10:31:38.87', '+25:59:02.3'])
 #  imsize is in arcmin
 def main(inp, survey='2r', radec=None, deci=None, fpath=None, show_circ=True,
          EPOCH=0., DSS=None, BW=False, imsize=5.*astrou.arcmin, show_spec=False,
-         OUT_TYPE='PDF'):
+         OUT_TYPE='PDF', cachedir=None, provider=None):
     '''
     Parameters:
     ---------
@@ -148,12 +382,12 @@ def main(inp, survey='2r', radec=None, deci=None, fpath=None, show_circ=True,
        Image size 
     OUT_TYPE: str, optional  
        File type -- 'PDF', 'PNG'
+    cachedir: str, optional
+       Cache the images here; see get_image
+    provider: optional
+       Image provider; see get_image
+    For many targets, make_finders is faster
     '''
-    reload(x_r)
-    reload(xgs)
-    import matplotlib.pyplot as plt
-    import matplotlib.cm as cm
-
     # Init
     if fpath is None:
         fpath = './'
@@ -161,11 +395,10 @@ def main(inp, survey='2r', radec=None, deci=None, fpath=None, show_circ=True,
         imsize=imsize.to('arcmin').value
     except AttributeError:
         raise AttributeError('finder: Input imsize needs to be an Angle')
-    cradius = imsize / 50. 
 
     # Read in the Target list
     if isinstance(inp,basestring):
-        ra_tab = get_coord(targ_file, radec=radec)
+        ra_tab = _targets(get_coord(inp, radec=radec))
     else:
         ira_tab = {}
         ira_tab['Name'] = inp[0]
@@ -198,22 +431,19 @@ def main(inp, survey='2r', radec=None, deci=None, fpath=None, show_circ=True,
 
     # Precess (as necessary)
     if EPOCH > 1000.:
-        from astropy import units as u
         from astropy.coordinates import FK5
         from astropy.time import Time
         # Precess to 2000.
         tEPOCH = Time(EPOCH, format='jyear', scale='utc')
-        # Load into astropy
-        fk5c = FK5(ra=ra_tab['RA'], dec=ra_tab['DEC'], equinox=tEPOCH, unit=(u.degree,u.degree))
-        # Precess
         newEPOCH = Time(2000., format='jyear', scale='utc')
-        newfk5 = fk5c.precess_to(newEPOCH)
-        # Save
-        ra_tab['RA'] = newfk5.ra.degree
-        ra_tab['DEC'] = newfk5.dec.degree
-        # Strings too?
-        ra_tab['RAS'] = str(newfk5.ra.to_string(unit=u.hour,sep=':'))
-        ra_tab['DECS'] = str(newfk5.dec.to_string(unit=u.hour,sep=':'))
+        for obj in ra_tab:
+            fk5c = FK5(ra=astrou.Quantity(obj['RA'], astrou.deg),
+                dec=astrou.Quantity(obj['DEC'], astrou.deg), equinox=tEPOCH)
+            newfk5 = fk5c.transform_to(FK5(equinox=newEPOCH))
+            # Save, strings too
+            obj['RA'] = newfk5.ra.degree
+            obj['DEC'] = newfk5.dec.degree
+            obj['RAS'], obj['DECS'] = x_r.dtos1((obj['RA']*astrou.deg, obj['DEC']*astrou.deg))
             
     
     ## 
@@ -221,79 +451,22 @@ def main(inp, survey='2r', radec=None, deci=None, fpath=None, show_circ=True,
     for obj in ra_tab: 
 
         # Outfil
-        nm = "".join(obj['Name'].split()) 
-        if OUT_TYPE=='PNG':
-            outfil = fpath+ nm + '.png'
-        else:
-            outfil = fpath+ nm + '.pdf'
+        outfil = _outfil(obj['Name'], fpath, OUT_TYPE)
         print(outfil)
 
         # Grab the Image
-        reload(xgs)
-        img, oBW = xgs.getimg(obj['RA'], obj['DEC'], imsize, BW=BW,DSS=DSS)
-
-        # Generate the plot
-        plt.clf()
-        fig = plt.figure(dpi=1200)
-        fig.set_size_inches(8.0,10.5)
-
-        # Font
-        plt.rcParams['font.family']= 'times new roman'
-        ticks_font = matplotlib.font_manager.FontProperties(family='times new roman', 
-           style='normal', size=16, weight='normal', stretch='normal')
-        ax = plt.gca()
-        for label in ax.get_yticklabels() :
-            label.set_fontproperties(ticks_font)
-        for label in ax.get_xticklabels() :
-            label.set_fontproperties(ticks_font)
-
-        # Image
-        if oBW == 1: 
-            cmm = cm.Greys_r
-        else: 
-            cmm = None 
-        plt.imshow(img,cmap=cmm,aspect='equal',extent=(-imsize/2., imsize/2, -imsize/2.,imsize/2))
-
-        # Axes
-        plt.xlim(-imsize/2., imsize/2.)
-        plt.ylim(-imsize/2., imsize/2.)
-
-        # Label
-        plt.xlabel('Relative ArcMin', fontsize=20)
-        xpos = 0.12*imsize
-        ypos = 0.02*imsize
-        plt.text(-imsize/2.-xpos, 0., 'EAST', rotation=90.,fontsize=20)
-        plt.text(0.,imsize/2.+ypos, 'NORTH', fontsize=20, horizontalalignment='center')
-
-        # Title
-        plt.text(0.5,1.24, str(nm), fontsize=32, 
-            horizontalalignment='center',transform=ax.transAxes)
-        plt.text(0.5,1.16, 'RA (J2000) = '+str(obj['RAS']), fontsize=28, 
-            horizontalalignment='center',transform=ax.transAxes)
-        plt.text(0.5,1.10, 'DEC (J2000) = '+str(obj['DECS']), fontsize=28, 
-            horizontalalignment='center',transform=ax.transAxes)
-        #import pdb; pdb.set_trace()
-
-        # Circle
-        if show_circ:
-            circle=plt.Circle((0,0),cradius,color='y', fill=False)
-            plt.gca().add_artist(circle)
+        img, oBW = get_image(obj['RA'], obj['DEC'], imsize, BW=BW, DSS=DSS,
+            cachedir=cachedir, provider=provider)
 
         # Spectrum??
+        spec_img = None
         if show_spec:
-            spec_img = xgs.get_spec_img(obj['RA'], obj['DEC']) 
-            plt.imshow(spec_img,extent=(-imsize/2.1, imsize*(-0.1), -imsize/2.1, imsize*(-0.2)))
+            spec_img = (xgs if provider is None else provider).get_spec_img(obj['RA'], obj['DEC']) 
 
-        # Write
-        if show_spec:
-            plt.savefig(outfil, dpi=300)
-        else:
-            plt.savefig(outfil)
-        print 'finder: Wrote '+outfil
-        plt.close()
-        #xdb.set_trace()
+        # Generate the plot
+        _render(obj, img, oBW, imsize, outfil, show_circ=show_circ, spec_img=spec_img)
 
-    print 'finder: All done.'
+    print('finder: All done.')
     return oBW
 
 # ################
@@ -26,7 +26,8 @@ from xastropy.obs import finder as x_finder
 # def starlist :: Generate a starlist file
 
 #### ###############################
-def wiki(targs, keys, fndr_pth=None, dbx_pth=None, outfil=None):
+def wiki(targs, keys, fndr_pth=None, dbx_pth=None, outfil=None, nproc=None,
+    cachedir=None, provider=None):
     """
     Generate a Wiki table for Keck observing.
     Should work for any of the Wiki pages
@@ -40,10 +41,11 @@ def wiki(targs, keys, fndr_pth=None, dbx_pth=None, outfil=None):
       Folder for finder charts
     dbx_pth: string
       Dropbox path for the finders
+    nproc, cachedir, provider: optional
+      For the finders; see finder.make_finders
 
     Writes a file to disk that can be pasted into the Wiki
     """
-    reload(x_finder)
     # Outfil
     if outfil is None:
         outfil = 'tmp_wiki.txt'
@@ -64,17 +66,15 @@ def wiki(targs, keys, fndr_pth=None, dbx_pth=None, outfil=None):
         print('keck.wiki: Will copy finders to {:s}'.format(dbx_folder))
         # Get name tag
         name_tag = get_name_tag(targs.dtype.names)
-        # Finders
+        # Finders (all at once)
+        fndr_tab = Table([targs[name_tag], targs['RA'], targs['DEC']], names=('Name','RA','DEC'))
+        fils = x_finder.make_finders(fndr_tab, fpath=fndr_pth, nproc=nproc,
+            cachedir=cachedir, provider=provider)
         fndr_files = []
-        for targ in targs:
-            x_finder.main([targ[name_tag], targ['RA'], targ['DEC']], radec=1,
-                          fpath=fndr_pth)
+        for fil1 in fils:
             # Copy? + Save
-            nm = "".join(targ[name_tag].split()) 
-            fil1 = fndr_pth+ nm + '.pdf'
-            fil2 = dbx_folder
             subprocess.call(["cp", fil1, dbx_folder])
-            fndr_files.append(dbx_pth+nm+'.pdf')
+            fndr_files.append(dbx_pth+os.path.basename(fil1))
         
     # Header
     lin = '||' 
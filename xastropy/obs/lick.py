@@ -27,7 +27,8 @@ from xastropy.obs import radec as x_rad
 # def starlist :: Generate a starlist file
 
 #### ###############################
-def wiki(targs, keys, fndr_pth=None, dbx_pth=None, outfil=None, skip_finder=False):
+def wiki(targs, keys, fndr_pth=None, dbx_pth=None, outfil=None, skip_finder=False,
+    nproc=None, cachedir=None, provider=None):
     """
     Generate a Wiki table for Lick observing.
     Should work for any of the Wiki pages
@@ -43,10 +44,11 @@ def wiki(targs, keys, fndr_pth=None, dbx_pth=None, outfil=None, skip_finder=Fals
       Dropbox path for the finders
     skip_finder: False
       Skip making the finders
+    nproc, cachedir, provider: optional
+      For the finders; see finder.make_finders
 
     Writes a file to disk that can be pasted into the Wiki
     """
-    reload(x_finder)
     # Outfil
     if outfil is None:
         outfil = 'tmp_wiki.txt'
@@ -72,19 +74,18 @@ def wiki(targs, keys, fndr_pth=None, dbx_pth=None, outfil=None, skip_finder=Fals
         #    radec = 1 # : separated strings
         #else:
         #    radec = 2 # decimal degrees
-        # Finders
+        # Finders (all at once)
+        if not skip_finder:
+            fndr_tab = Table([targs[name_tag], targs['RA'], targs['DEC']], names=('Name','RA','DEC'))
+            fils = x_finder.make_finders(fndr_tab, fpath=fndr_pth, nproc=nproc,
+                cachedir=cachedir, provider=provider)
+            for fil1 in fils:
+                subprocess.call(["cp", fil1, dbx_folder])
+        # Save
         fndr_files = []
         for targ in targs:
-            # Finder
-            #xdb.set_trace()
-            if not skip_finder:
-                x_finder.main([targ[name_tag], targ['RA'], targ['DEC']], fpath=fndr_pth)
-            # Copy? + Save
-            fil1 = fndr_pth+targ[name_tag]+'.pdf'
-            fil2 = dbx_folder
-            if not skip_finder:
-                subprocess.call(["cp", fil1, dbx_folder])
-            fndr_files.append(dbx_pth+targ[name_tag]+'.pdf')
+            nm = "".join(targ[name_tag].split()) 
+            fndr_files.append(dbx_pth+nm+'.pdf')
         
     # Header
     lin = '||' 
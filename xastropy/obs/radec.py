@@ -12,6 +12,7 @@
 
 # Import libraries
 import numpy as np
+import re
 from astropy.table import QTable, Column, Table
 from astropy.coordinates import SkyCoord
 from astropy import units as u
@@ -20,6 +21,9 @@ from astropy.units import Quantity
 from xastropy.xutils import xdebug as xdb
 
 # def stod1 :: Input one RA/DEC pair as strings and return RA/DEC in decimal degrees
+# def stod :: Input arrays of RA/DEC strings (or J names) and return RA/DEC in decimal degrees
+# def dtos :: Input arrays of RA/DEC and return strings
+# def sph_offsets :: RA/DEC offsets and PA between arrays of positions
 # def to_coord :: Input RA/DEC in one of several formats and return SkyCoord
 
 #### ###############################
@@ -75,6 +79,120 @@ def stod1(rads):
 
     return rad*u.degree, decd*u.degree
 
+# JXXXXXX.X+XXXXXX.X, optionally with a prefix (e.g. SDSSJ...)
+_jname_re = re.compile(r'^(?:[^\n]*?J)?(\d\d)(\d\d)(\d+(?:\.\d*)?)([+-])(\d\d)(\d\d)(\d+(?:\.\d*)?)[ \t]*$',
+    re.M)
+# XX:XX:XX.X or XX XX XX.X, with any sign prefix (e.g. $-$); seconds optional
+_sexa_re = re.compile(r'^[ \t]*([^\d\n]*?)(\d+(?:\.\d*)?)[: \t]+(\d+(?:\.\d*)?)(?:[: \t]+(\d+(?:\.\d*)?))?[ \t]*$',
+    re.M)
+
+def _strarr(strs):
+    '''1D array of str (decoding bytes, e.g. from FITS)
+    '''
+    strs = np.atleast_1d(np.asarray(strs))
+    if strs.dtype.kind == 'S':
+        strs = np.char.decode(strs, 'ascii')
+    return strs.astype(str).ravel()
+
+def _match_all(regex, strs):
+    '''Match every string with regex in one pass; (N, ngroup) str array
+    '''
+    fields = regex.findall('\n'.join(strs.tolist()))
+    if len(fields) != len(strs):
+        for istr in strs:
+            if regex.match(istr) is None:
+                raise ValueError('radec: Unable to parse {:s}'.format(istr))
+    return np.array(fields, dtype=str).reshape(len(strs), regex.groups)
+
+def _tofloat(fields):
+    return np.where(fields == '', '0', fields).astype(float)
+
+#### ###############################
+#  Many strings to decimal degrees
+def stod(in_rads, decs=None):
+    """
+    Input arrays of RA/DEC strings and return RA/DEC in decimal degrees
+    Vectorized version of stod1:  each array is parsed in one regex pass
+
+    Parameters:
+    ----------
+    in_rads:
+        array of str (JXXXXXX.X+XXXXXX.X format), or
+        array of RA str (colon or space format) with decs, or
+        QTable (see stod_table)
+    decs: array of DEC str, optional
+
+    Returns:
+    ----------
+    rad: tuple (RA, DEC arrays in decimal degrees with units)
+    """
+    if isinstance(in_rads, QTable):
+        return stod_table(in_rads)
+    if decs is None:
+        fields = _match_all(_jname_re, _strarr(in_rads))
+        flg_neg = fields[:,3] == '-'
+        ra, dec = _tofloat(fields[:,0:3]), _tofloat(fields[:,4:7])
+    else:
+        rafields = _match_all(_sexa_re, _strarr(in_rads))
+        decfields = _match_all(_sexa_re, _strarr(decs))
+        ra = _tofloat(rafields[:,1:])
+        dec = _tofloat(decfields[:,1:])
+        flg_neg = np.char.find(decfields[:,0], '-') >= 0
+    # RA
+    rad = (360./24.)*(ra[:,0] + ra[:,1]/60. + ra[:,2]/3600.)
+    # DEC
+    decd = dec[:,0] + dec[:,1]/60. + dec[:,2]/3600.
+    decd[flg_neg] *= -1.
+
+    return rad*u.degree, decd*u.degree
+
+#### ###############################
+#  Many decimal degrees to strings
+def dtos(ra, dec=None, fmt=0):
+    '''
+    Converts arrays of RA/DEC into strings, without building SkyCoords
+    RA is rounded to 0.01s and DEC to 0.1", carrying into the minutes
+
+    Parameters
+    ----------
+    ra: RA array (Quantity or decimal degrees) or SkyCoord
+    dec: DEC array (Quantity or decimal degrees)
+    fmt: int (0)
+      0: colon delimitered, e.g. '11:23:21.23', '+23:11:45.0'
+      1: J name, e.g. 'J112321.23+231145.0'
+
+    Returns
+    -------
+    ras, decs: str arrays (fmt=0)
+    names: str array (fmt=1)
+    '''
+    if isinstance(ra, SkyCoord):
+        ra, dec = ra.ra.degree, ra.dec.degree
+    ra = np.atleast_1d(Quantity(ra, u.degree).value)
+    dec = np.atleast_1d(Quantity(dec, u.degree).value)
+    sep = ':' if fmt == 0 else ''
+    # RA in hundredths of a second of time
+    tot = np.round(np.mod(ra, 360.)*(3600.*100./15.)).astype(np.int64) % (24*3600*100)
+    ras = _join([tot//360000, (tot//6000) % 60, (tot//100) % 60], tot % 100, 2, sep)
+    # DEC in tenths of an arcsecond
+    tot = np.round(np.abs(dec)*3600.*10.).astype(np.int64)
+    decs = _join([tot//36000, (tot//600) % 60, (tot//10) % 60], tot % 10, 1, sep)
+    decs = np.char.add(np.where(dec < 0., '-', '+'), decs)
+    if fmt == 0:
+        return ras, decs
+    elif fmt == 1:
+        return np.char.add(np.char.add('J', ras), decs)
+    else:
+        raise ValueError('radec.dtos: Bad fmt {:d}'.format(fmt))
+
+def _join(parts, frac, ndig, sep):
+    '''Format XX[sep]XX[sep]XX.frac from integer arrays
+    '''
+    out = np.char.mod('%02d', parts[0])
+    for part in parts[1:]:
+        out = np.char.add(np.char.add(out, sep), np.char.mod('%02d', part))
+    return np.char.add(np.char.add(out, '.'), np.char.mod('%0{:d}d'.format(ndig), frac))
+
 #### ###############################
 #  Decimal degress or SkyCoord to string
 def dtos1(irad, fmt=0):
@@ -88,7 +206,7 @@ def dtos1(irad, fmt=0):
       0: colon delimitered, e.g. '11:23:21.23', '+23:11:45.0'
       1: J name, e.g. 'J112321.23+231145.0'
     '''
-    # Get to SkyCoord
+    # Get to SkyCoord (for many coordinates, dtos is faster)
     if type(irad) is SkyCoord:
         coord = irad
     else:
@@ -101,14 +219,12 @@ def dtos1(irad, fmt=0):
             
         coord = to_coord(rad) 
     # String
-    if fmt == 0:
-        ras = coord.ra.to_string(unit=u.hour,sep=':',pad=True, precision=2)
-        decs = coord.dec.to_string(sep=':',pad=True, alwayssign=True, precision=1)
-        return str(ras), str(decs)
-    elif fmt == 1:
-        ras = coord.ra.to_string(unit=u.hour,sep='',pad=True, precision=2)
-        decs = coord.dec.to_string(sep='',pad=True, alwayssign=True, precision=1)
-        return str('J'+ras+decs)
+    strs = dtos(coord, fmt=fmt)
+    if coord.isscalar:
+        if fmt == 0:
+            return str(strs[0][0]), str(strs[1][0])
+        return str(strs[0])
+    return strs
 
 
 #### ###############################
@@ -124,31 +240,25 @@ def stod_table(table):
     if not isinstance(table,QTable):
         raise TypeError('radec.stod_table: table needs to be a QTable')
 
-    # Generate Columns (as needed)
-    for card in ['RA','DEC']:
-        if card not in table.dtype.names:
-            table.add_column( Column( np.zeros(len(table)), name=card, unit=u.degree) )
-
-    # Loop on rows
-    for k,row in enumerate(table):
-        try:
-            rad, decd = stod1( (row['RAS'], row['DECS']) )
-        except KeyError:
-            rad, decd = stod1( (row['RA'], row['DEC']) )
-        table['RA'][k] = rad
-        table['DEC'][k] = decd
-
-#### ###############################
-#  String to decimal degress
-def stod(in_rads, radec=None):
-
-    import radec as x_r
-    from astropy.table import Table
-
-    x_r.stod_table(in_rads)
+    # Parse all rows at once
+    try:
+        rad, decd = stod(table['RAS'], table['DECS'])
+    except KeyError:
+        rad, decd = stod(table['RA'], table['DEC'])
+
+    # Fill or generate Columns (replacing string columns)
+    for card, val in zip(['RA','DEC'], [rad, decd]):
+        if card in table.colnames:
+            if table[card].dtype.kind == 'f':
+                table[card][:] = val
+                continue
+            idx = table.colnames.index(card)
+            table.remove_column(card)
+        else:
+            idx = len(table.colnames)
+        table.add_column( Column(val.value, name=card, unit=u.degree), index=idx)
 
 
-    
 #### ###############################
 #  Main conversion
 def to_coord(irad):
@@ -186,11 +296,45 @@ def to_coord(irad):
     return SkyCoord(ra=rad[0], dec=rad[1])
 
 
+#### ###############################
+#  Offsets for arrays
+def sph_offsets(ra1, dec1, ra2, dec2):
+    """
+    RA/DEC offsets and position angles between arrays of positions,
+    by spherical trigonometry (as SkyCoord.separation and position_angle)
+
+    Parameters:
+    ----------
+    ra1, dec1 : RA/DEC of the origin(s); Quantity or decimal degrees
+    ra2, dec2 : RA/DEC of the destination(s); Quantity or decimal degrees
+      The arrays broadcast, e.g. one origin against many destinations
+
+    Returns:
+    -------
+    offsets, PA : Tuple of offsets (itself a Tuple of arrays in arcsec) and Position Angle (degrees)
+    """
+    lon1, lat1, lon2, lat2 = [np.radians(Quantity(val, u.degree).value)
+        for val in [ra1, dec1, ra2, dec2]]
+    dlon = lon2 - lon1
+    clat2 = np.cos(lat2)
+    # East and North components; the separation is the Vincenty formula
+    east = clat2*np.sin(dlon)
+    north = np.cos(lat1)*np.sin(lat2) - np.sin(lat1)*clat2*np.cos(dlon)
+    chord = np.hypot(east, north)
+    sep = np.degrees(np.arctan2(chord, np.sin(lat1)*np.sin(lat2) + np.cos(lat1)*clat2*np.cos(dlon)))*3600.
+    PA = np.mod(np.degrees(np.arctan2(east, north)), 360.)
+    # RA/DEC (East is *higher* RA)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ra_off = np.where(chord > 0., sep*east/chord, 0.)
+        dec_off = np.where(chord > 0., sep*north/chord, 0.)
+    return (ra_off*u.arcsec, dec_off*u.arcsec), PA*u.degree
+
 #### ###############################
 #  Offsets
 def offsets(irad1, irad2, verbose=True):
     """
     Input a pair of RA/DEC and calculate the RA/DEC offsets between them
+    Either may be an array of positions (see sph_offsets)
 
     Parameters:
     ----------
@@ -206,22 +350,18 @@ def offsets(irad1, irad2, verbose=True):
     # Convert to SkyCoord
     coord1 = to_coord(irad1)
     coord2 = to_coord(irad2)
+    if coord2.frame.name != coord1.frame.name:
+        coord2 = coord2.transform_to(coord1.frame)
 
-    # Angular separation
-    sep = coord1.separation(coord2).to('arcsec')
-
-    # PA
-    PA = coord1.position_angle(coord2)
-
-    # RA/DEC
-    dec_off = np.cos(PA) * sep # arcsec
-    ra_off = np.sin(PA) * sep # arcsec (East is *higher* RA)
+    # RA/DEC offsets, PA
+    (ra_off, dec_off), PA = sph_offsets(coord1.spherical.lon, coord1.spherical.lat,
+        coord2.spherical.lon, coord2.spherical.lat)
 
     # Print
-    if verbose:
+    if verbose and PA.isscalar:
         print('RA Offset from 1 to 2 is {:g}'.format(ra_off))
         print('DEC Offset from 1 to 2 is {:g}'.format(dec_off))
-        print('PA = {:g}'.format(PA.degree*u.degree))
+        print('PA = {:g}'.format(PA))
 
     # Return
-    return (ra_off, dec_off), PA.degree * u.degree
+    return (ra_off, dec_off), PA
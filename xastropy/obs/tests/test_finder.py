@@ -0,0 +1,66 @@
+# Module to run tests on the finder charts (offline, with a fake image provider)
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import os
+import pytest
+
+from astropy import units as u
+from astropy.table import Table
+
+from xastropy.obs import finder as xf
+
+
+class FakeProvider(object):
+    '''Gray image whose level is the RA, counting the calls
+    '''
+    def __init__(self):
+        self.ncall = 0
+
+    def getimg(self, ra, dec, imsize, BW=False, DSS=None):
+        self.ncall += 1
+        return np.full((10, 10), ra), True
+
+
+def test_get_image(tmpdir):
+    provider = FakeProvider()
+    cachedir = str(tmpdir.join('cache'))
+    for ii in range(2):
+        img, BW = xf.get_image(157.9*u.deg, 25.98, 5., cachedir=cachedir, provider=provider)
+        assert BW
+        np.testing.assert_allclose(img, 157.9)
+    assert provider.ncall == 1
+    # Another size is another image
+    xf.get_image(157.9, 25.98, 3., cachedir=cachedir, provider=provider)
+    assert provider.ncall == 2
+
+
+@pytest.mark.parametrize('coords', [('10:31:38.87', '+25:59:02.3'), ('157.91196', '25.98397')])
+def test_make_finders(tmpdir, coords):
+    targ_file = str(tmpdir.join('targets.lst'))
+    with open(targ_file, 'w') as fh:
+        fh.write('TST1 {:s} {:s}\n'.format(*coords))
+        fh.write('TST2 {:s} {:s}\n'.format(*coords))
+    fpath = str(tmpdir)+'/'
+    provider = FakeProvider()
+    outfils = xf.make_finders(targ_file, fpath=fpath, nproc=1, provider=provider,
+                              OUT_TYPE='PNG', imsize=2*u.arcmin)
+    assert outfils == [fpath+'TST1.png', fpath+'TST2.png']
+    assert all(os.path.isfile(fil) for fil in outfils)
+    # One at a time, as main does for a target file
+    os.remove(outfils[0])
+    xf.main(targ_file, fpath=fpath, provider=provider, OUT_TYPE='PNG', imsize=2*u.arcmin)
+    assert os.path.isfile(outfils[0])
+    assert provider.ncall == 4
+
+
+def test_targets():
+    tab = Table()
+    tab['QSO'] = ['A']
+    tab['RA'] = [157.911958]
+    tab['DEC'] = [-25.9839722]
+    obj = xf._targets(tab)[0]
+    assert obj['Name'] == 'A'
+    assert obj['RAS'] == '10:31:38.87'
+    assert obj['DECS'] == '-25:59:02.3'
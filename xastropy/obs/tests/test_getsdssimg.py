@@ -0,0 +1,76 @@
+# Module to run tests on the image providers of x_getsdssimg (offline)
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import os, glob, pickle
+import pytest
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from xastropy.obs import x_getsdssimg as xgs
+
+
+def _mosaic(fil, ra, dec, rot=30., flip=True, npix=200, pixscale=1./3600.):
+    '''uint16 mosaic (BZERO=32768) with a rotated WCS, and a star 20"
+    east and 20" north of (ra, dec)
+    '''
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [npix/2., npix/2.]
+    theta = np.radians(rot)
+    east = 1. if flip else -1.
+    wcs.wcs.cd = pixscale * np.array([[east*np.cos(theta), -np.sin(theta)],
+                                      [east*np.sin(theta), np.cos(theta)]])
+    img = np.full((npix, npix), 1000.)
+    xs, ys = wcs.wcs_world2pix([[ra + 20./3600./np.cos(np.radians(dec)), dec + 20./3600.]], 0)[0]
+    yy, xx = np.mgrid[0:npix, 0:npix]
+    img += 30000. * np.exp(-0.5*((xx-xs)**2 + (yy-ys)**2)/2.**2)
+    hdu = fits.PrimaryHDU(np.round(img).astype(np.uint16), header=wcs.to_header())
+    hdu.writeto(fil)
+
+
+@pytest.mark.parametrize('flip', [False, True])
+def test_local_provider(tmpdir, flip):
+    _mosaic(str(tmpdir.join('m1.fits.gz')), 150., 20., flip=flip)
+    provider = xgs.LocalProvider(str(tmpdir))
+    img, BW = provider.getimg(150., 20., 1.)
+    assert BW
+    data = np.asarray(img)
+    assert data.shape == (60, 60)
+    # The star is up (north) and to the left (east)
+    iy, ix = np.nonzero(data > 128)
+    assert abs(iy.mean() - 9.5) < 1.
+    assert abs(ix.mean() - 9.5) < 1.
+    with pytest.raises(IOError):
+        provider.getimg(10., -20., 1.)
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.urls = []
+
+    def get(self, url, timeout=None):
+        self.urls.append(url)
+        return self
+
+    def raise_for_status(self):
+        pass
+
+    content = b'image'
+
+
+def test_http_cache(tmpdir):
+    provider = xgs.HTTPProvider(cachedir=str(tmpdir))
+    session = FakeSession()
+    provider.session = lambda: session
+    for url in ['http://a', 'http://b', 'http://a']:
+        assert provider.fetch(url) == b'image'
+    assert session.urls == ['http://a', 'http://b']
+    # Identical content is stored once
+    assert len(glob.glob(os.path.join(str(tmpdir), 'objects', '*', '*'))) == 1
+    # Picklable, for process pools
+    provider = pickle.loads(pickle.dumps(xgs.HTTPProvider(cachedir=str(tmpdir))))
+    assert provider.fetch('http://b') == b'image'
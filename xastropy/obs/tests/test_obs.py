@@ -30,3 +30,35 @@ def test_tocoord():
 	coord = x_r.to_coord(radec)
 	# 
 	assert isinstance(coord,SkyCoord)
+
+def test_stod_array():
+	names = ['J103138.87+255902.3', 'J000009.42-102751.9']
+	ra, dec = x_r.stod(names)
+	for k,name in enumerate(names):
+		radec = x_r.stod1(name)
+		np.testing.assert_allclose(ra[k].value, radec[0].value)
+		np.testing.assert_allclose(dec[k].value, radec[1].value)
+	# Colon format
+	ra2, dec2 = x_r.stod(['10:31:38.87','00:00:09.42'], ['+25:59:02.3','-10:27:51.9'])
+	np.testing.assert_allclose(ra2.value, ra.value)
+	np.testing.assert_allclose(dec2.value, dec.value)
+
+def test_dtos():
+	ras, decs = x_r.dtos(np.array([157.91195833333336, 0.03925]),
+		np.array([25.983972222, -10.464416667]))
+	assert ras[0] == '10:31:38.87'
+	assert decs[1] == '-10:27:51.9'
+	names = x_r.dtos(np.array([157.91195833333336]), np.array([25.983972222]), fmt=1)
+	assert names[0] == 'J103138.87+255902.3'
+
+def test_offsets():
+	from astropy.coordinates import SkyCoord
+	coord1 = SkyCoord(ra=150.*u.deg, dec=2.2*u.deg)
+	ras = np.array([150.01, 149.99, 150.])
+	decs = np.array([2.21, 2.2, 2.1])
+	(ra_off, dec_off), PA = x_r.offsets(coord1, (ras*u.deg, decs*u.deg), verbose=False)
+	coord2 = SkyCoord(ra=ras*u.deg, dec=decs*u.deg)
+	np.testing.assert_allclose(PA.value, coord1.position_angle(coord2).degree)
+	sep = coord1.separation(coord2).to('arcsec').value
+	np.testing.assert_allclose(np.hypot(ra_off.value, dec_off.value), sep)
+	assert ra_off[1] < 0.*u.arcsec
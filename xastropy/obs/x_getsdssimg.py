@@ -6,6 +6,9 @@
 #; PURPOSE:
 #;    Returns an Image by querying the SDSS website
 #;      Will use DSS2-red as a backup 
+#;    Images come from a provider:  HTTPProvider (the default) reuses
+#;      connections, retries and caches on disk; LocalProvider cuts
+#;      images out of local FITS mosaics
 #;
 #; CALLING SEQUENCE:
 #;
@@ -33,8 +36,10 @@
 # Import libraries
 from __future__ import print_function, absolute_import, division#, unicode_literals
 
+import numpy as np
+import os, glob, hashlib, threading
 import requests
-from cStringIO import StringIO
+from io import BytesIO
 
 from astroquery.sdss import SDSS
 
@@ -43,6 +48,11 @@ from astropy import units as u
 
 from xastropy.xutils import xdebug as xdb
 
+# class HTTPProvider :: Images from SDSS/DSS over a pooled session, cached on disk
+# class LocalProvider :: Images cut out of local FITS mosaics
+# def getimg :: Image from the default provider
+# def get_spec_img :: SDSS spectrum image from the default provider
+
 
 # Generate the SDSS URL (default is 202" on a side)
 def sdsshttp(ra, dec, imsize, scale=0.39612, grid=None, label=None, invert=None):#, xs, ys):
@@ -108,19 +118,9 @@ def dsshttp(ra, dec, imsize):
     return url
     
 
-# ##########################################
-def getimg(ira, idec, imsize, BW=False, DSS=None):
-    ''' Grab an SDSS image from the given URL, if possible
-
-    Parameters:
-    ----------
-    ira: (float or Quantity) RA in decimal degrees
-    idec: (float or Quantity) DEC in decimal degrees
-    imsize: Image size in arcmin (without units)
+def _strip(ira, idec):
+    ''' RA, DEC in decimal degrees, stripping units as need be
     '''
-    import PIL
-    from PIL import Image
-    # Strip units as need be
     try:
         ra = ira.value
     except AttributeError:
@@ -128,59 +128,298 @@ def getimg(ira, idec, imsize, BW=False, DSS=None):
         dec = idec
     else:
         dec = idec.value
-    
-    # Get URL
-    if DSS == None:  # Default
-        url = sdsshttp(ra,dec,imsize)
-    else:
-        url = dsshttp(ra,dec,imsize) # DSS
+    return ra, dec
+
+def _to_bw(img):
+    import PIL.ImageOps
+    img2 = img.convert("L")
+    return PIL.ImageOps.invert(img2)
+
+# ##########################################
+class HTTPProvider(object):
+    ''' Grab images from the SDSS (or DSS) websites
+
+    One keep-alive session is shared by all requests of a process, at
+    most maxconn requests are made at once, and failed requests are
+    retried with exponential backoff.  Downloads can be cached on disk,
+    stored by the SHA-1 of their content (with one small reference file
+    per URL), so identical images are kept once.
+
+    Parameters:
+    ----------
+    cachedir: str, optional
+      Folder for the cache [default: no cache]
+    maxconn: int, optional
+      Maximum number of simultaneous connections
+    retries: int, optional
+      Number of retries for failed connections and 5xx responses
+    backoff: float, optional
+      Backoff factor (s) between retries
+    timeout: float, optional
+      Timeout (s) of each request
+    '''
+    def __init__(self, cachedir=None, maxconn=4, retries=3, backoff=0.5, timeout=60.):
+        self.cachedir = cachedir
+        self.maxconn = maxconn
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._session = None
+        self._pid = None
+        self._lock = threading.BoundedSemaphore(maxconn)
+
+    def __getstate__(self):
+        # Sessions and locks are made again in each process
+        state = self.__dict__.copy()
+        state['_session'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.BoundedSemaphore(self.maxconn)
+
+    def session(self):
+        ''' The requests Session of this process
+        '''
+        if (self._session is None) or (self._pid != os.getpid()):
+            from requests.adapters import HTTPAdapter
+            try:
+                from urllib3.util.retry import Retry
+            except ImportError:
+                from requests.packages.urllib3.util.retry import Retry
+            retry = Retry(total=self.retries, backoff_factor=self.backoff,
+                status_forcelist=[500, 502, 503, 504])
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.maxconn,
+                pool_maxsize=self.maxconn, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+            self._pid = os.getpid()
+        return self._session
+
+    def _cachefil(self, kind, key):
+        return os.path.join(self.cachedir, kind, key[:2], key)
+
+    def fetch(self, url):
+        ''' Content of a URL, from the cache if possible
+
+        Returns:
+        ----------
+        content: bytes
+        '''
+        if self.cachedir is not None:
+            ref = self._cachefil('refs', hashlib.sha1(url.encode('utf-8')).hexdigest())
+            if os.path.isfile(ref):
+                with open(ref) as fh:
+                    obj = self._cachefil('objects', fh.read().strip())
+                if os.path.isfile(obj):
+                    with open(obj, 'rb') as fh:
+                        return fh.read()
+        # Request
+        with self._lock:
+            rtv = self.session().get(url, timeout=self.timeout)
+        rtv.raise_for_status()
+        content = rtv.content
+        # Cache
+        if self.cachedir is not None:
+            digest = hashlib.sha1(content).hexdigest()
+            obj = self._cachefil('objects', digest)
+            for fil, data, mode in [(obj, content, 'wb'), (ref, digest, 'w')]:
+                if not os.path.isdir(os.path.dirname(fil)):
+                    try:
+                        os.makedirs(os.path.dirname(fil))
+                    except OSError: # Made by another process
+                        pass
+                tmp = fil+'.tmp{:d}'.format(os.getpid())
+                with open(tmp, mode) as fh:
+                    fh.write(data)
+                os.rename(tmp, fil)
+        return content
+
+    def getimg(self, ira, idec, imsize, BW=False, DSS=None):
+        ''' Grab an SDSS image, if possible, else DSS; see getimg
+        '''
+        from PIL import Image
+        ra, dec = _strip(ira, idec)
+
+        # Get URL
+        if DSS == None:  # Default
+            # Query for photometry
+            coord = SkyCoord(ra=ra*u.degree, dec=dec*u.degree)
+            phot = SDSS.query_region(coord, radius=0.02*u.deg)
+            if phot is None:
+                print('getimg: Pulling from DSS instead of SDSS')
+                BW = 1
+                url = dsshttp(ra,dec,imsize) # DSS
+            else:
+                url = sdsshttp(ra,dec,imsize)
+        else:
+            url = dsshttp(ra,dec,imsize) # DSS
 
-    # Request
-    rtv = requests.get(url) 
+        img = Image.open(BytesIO(self.fetch(url)))
 
-    # Query for photometry
-    coord = SkyCoord(ra=ra*u.degree, dec=dec*u.degree)
-    phot = SDSS.query_region(coord, radius=0.02*u.deg)
+        # B&W ?
+        if BW:
+            img = _to_bw(img)
+        return img, BW
 
-    if phot is None:
-        print('getimg: Pulling from DSS instead of SDSS')
-        BW = 1
-        url = dsshttp(ra,dec,imsize) # DSS
-        rtv = requests.get(url) 
+    def get_spec_img(self, ra, dec):
+        ''' Image of the SDSS spectrum at RA, DEC; see get_spec_img
+        '''
+        from PIL import Image
 
-    img = Image.open(StringIO(rtv.content))
+        # Coord
+        if hasattr(ra,'unit'):
+            coord = SkyCoord(ra=ra, dec=dec)
+        else:
+            coord = SkyCoord(ra=ra*u.degree, dec=dec*u.degree)
 
-    # B&W ?
-    if BW:
-        import PIL.ImageOps
-        img2 = img.convert("L")
-        img2 = PIL.ImageOps.invert(img2)
-        img = img2
+        # Query database
+        radius = 1*u.arcsec
+        spec_catalog = SDSS.query_region(coord,spectro=True, radius=radius.to('degree'))
 
-    return img, BW
+        # Request
+        url = 'http://skyserver.sdss.org/dr12/en/get/SpecById.ashx?id='+str(int(spec_catalog['specobjid']))
+        return Image.open(BytesIO(self.fetch(url)))
 
 # ##########################################
-def get_spec_img(ra, dec):
+class LocalProvider(object):
+    ''' Cut images out of local FITS mosaics (e.g. for offline work)
 
-    from PIL import Image
-    from cStringIO import StringIO
+    The WCS of every mosaic is read once, on the first request.  Images
+    are resampled north up and east left, as from the websites.
 
-    # Coord
-    if hasattr(ra,'unit'):
-        coord = SkyCoord(ra=ra, dec=dec)
-    else:
-        coord = SkyCoord(ra=ra*u.degree, dec=dec*u.degree)
+    Parameters:
+    ----------
+    path: str
+      Folder with the FITS mosaics
+    pattern: str, optional
+      Glob pattern of the mosaics within path
+    exten: int, optional
+      FITS extension holding the image
+    stretch: tuple, optional
+      Lower and upper percentiles mapped to black and white
+    '''
+    def __init__(self, path, pattern='*.fits*', exten=0, stretch=(1., 99.5)):
+        self.path = path
+        self.pattern = pattern
+        self.exten = exten
+        self.stretch = stretch
+        self._mosaics = None
 
-    # Query database
-    radius = 1*u.arcsec
-    spec_catalog = SDSS.query_region(coord,spectro=True, radius=radius.to('degree'))
+    def mosaics(self):
+        ''' List of (file, WCS, shape) of the mosaics
+        '''
+        from astropy.io import fits
+        from astropy.wcs import WCS
+        if self._mosaics is None:
+            self._mosaics = []
+            for fil in sorted(glob.glob(os.path.join(self.path, self.pattern))):
+                head = fits.getheader(fil, self.exten)
+                self._mosaics.append((fil, WCS(head).celestial,
+                    (head['NAXIS2'], head['NAXIS1'])))
+        return self._mosaics
 
-    # Request
-    url = 'http://skyserver.sdss.org/dr12/en/get/SpecById.ashx?id='+str(int(spec_catalog['specobjid']))
-    rtv = requests.get(url) 
-    img = Image.open(StringIO(rtv.content))
+    def getimg(self, ira, idec, imsize, BW=False, DSS=None):
+        ''' Image imsize (arcmin) on a side centered on RA, DEC
 
-    return img
+        The first mosaic covering the position is used.  The image is
+        resampled (bilinear) onto a north up, east left tangent-plane
+        grid at the pixel scale of the mosaic, so rotated or flipped
+        mosaics come out as from the websites.  Only the section of the
+        mosaic under the image is read, and scaled (BZERO/BSCALE; BLANK
+        pixels are black).  Images are grayscale, so BW is returned as
+        True; DSS is ignored.
+        '''
+        from PIL import Image
+        from astropy.io import fits
+        from astropy.wcs import WCS
+        from scipy import ndimage
+        ra, dec = _strip(ira, idec)
+        for fil, wcs, shape in self.mosaics():
+            xpix, ypix = wcs.wcs_world2pix(np.array([[ra, dec]]), 0)[0]
+            if (0 <= xpix < shape[1]) and (0 <= ypix < shape[0]):
+                break
+        else:
+            raise IOError('LocalProvider: No mosaic in {:s} covers RA={:g}, DEC={:g}'.format(
+                self.path, ra, dec))
+
+        # North up, east left grid (row 0 at the bottom, for now)
+        pixscale = np.sqrt(np.abs(np.linalg.det(wcs.pixel_scale_matrix)))
+        npix = max(int(round(imsize/60./pixscale)), 1)
+        grid = WCS(naxis=2)
+        grid.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        grid.wcs.crval = [ra, dec]
+        grid.wcs.crpix = [(npix+1)/2., (npix+1)/2.]
+        grid.wcs.cdelt = [-pixscale, pixscale]
+        yy, xx = np.mgrid[0:npix, 0:npix]
+        gra, gdec = grid.wcs_pix2world(xx.ravel(), yy.ravel(), 0)
+        mx, my = wcs.wcs_world2pix(gra, gdec, 0)
+
+        # Section of the mosaic under the grid
+        x0, y0 = max(int(np.floor(mx.min())), 0), max(int(np.floor(my.min())), 0)
+        x1 = min(int(np.ceil(mx.max()))+1, shape[1])
+        y1 = min(int(np.ceil(my.max()))+1, shape[0])
+        hdulist = fits.open(fil, memmap=True, do_not_scale_image_data=True)
+        try:
+            head = hdulist[self.exten].header
+            raw = np.array(hdulist[self.exten].data[y0:y1, x0:x1])
+        finally:
+            hdulist.close()
+        section = raw.astype(float)
+        if (head['BITPIX'] > 0) and ('BLANK' in head):
+            section[raw == head['BLANK']] = np.nan
+        section = section*head.get('BSCALE', 1.) + head.get('BZERO', 0.)
+        data = ndimage.map_coordinates(section, [my-y0, mx-x0], order=1,
+            mode='constant', cval=np.nan).reshape(npix, npix)
+        # Off the mosaic
+        data[((mx < -0.5) | (mx > shape[1]-0.5) | (my < -0.5) |
+            (my > shape[0]-0.5)).reshape(npix, npix)] = np.nan
+        # Row 0 at the top (north), as from SDSS/DSS
+        data = data[::-1]
+
+        # Stretch to 8 bits
+        good = np.isfinite(data)
+        if np.any(good):
+            lo, hi = np.percentile(data[good], self.stretch)
+        else:
+            lo, hi = 0., 1.
+        scaled = np.clip((data-lo)/max(hi-lo, 1e-30), 0., 1.)
+        scaled[~good] = 0.
+        img = Image.fromarray((255*scaled).astype(np.uint8))
+        return img, True
+
+    def get_spec_img(self, ra, dec):
+        raise IOError('LocalProvider: No spectra')
+
+# Default provider (one pooled session per process)
+_provider = HTTPProvider()
+
+def set_provider(provider):
+    ''' Set the provider used by getimg and get_spec_img, e.g.
+    HTTPProvider(cachedir='...') or LocalProvider('...')
+    '''
+    global _provider
+    _provider = provider
+
+# ##########################################
+def getimg(ira, idec, imsize, BW=False, DSS=None):
+    ''' Grab an SDSS image from the given URL, if possible
+
+    Parameters:
+    ----------
+    ira: (float or Quantity) RA in decimal degrees
+    idec: (float or Quantity) DEC in decimal degrees
+    imsize: Image size in arcmin (without units)
+    See set_provider for where the image comes from
+    '''
+    return _provider.getimg(ira, idec, imsize, BW=BW, DSS=DSS)
+
+# ##########################################
+def get_spec_img(ra, dec):
+    return _provider.get_spec_img(ra, dec)
 
 
 # #############
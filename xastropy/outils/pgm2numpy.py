@@ -12,60 +12,106 @@ Slightly modified for format of K1DM3 data
 """
 
 import re
+import os
+import glob
+import warnings
 import numpy
-import math
-import array
 
 def pgm_nextline(fin):
     while True:
         header  = fin.readline().strip()
+        if isinstance(header, bytes):
+            header = header.decode('ascii')
         if header.startswith('#'):
             continue
         else:
             break
     return header
-            
-def pgm2numpy_p5(fin, debug = True):
+
+def pgm_header(fin, ntoken=3):
+    '''Read the next ntoken whitespace-separated header values
+    (width, height, maxval by default), skipping comments.
+
+    Exactly one whitespace character is consumed after the last
+    value, so for P5 files fin is left at the start of the raster.
+
+    Returns
+    -------
+    list of int
+    '''
+    tokens = []
+    tok = b''
+    while len(tokens) < ntoken:
+        c = fin.read(1)
+        if isinstance(c, str) and not isinstance(c, bytes):
+            c = c.encode('ascii')
+        if c == b'':
+            raise IOError('pgm2numpy: Unexpected end of header')
+        if c == b'#' and tok == b'':
+            fin.readline()
+        elif c.isspace():
+            if tok != b'':
+                tokens.append(int(tok))
+                tok = b''
+        else:
+            tok += c
+    return tokens
+
+def _p2_dtype(maxval):
+    # Minimum image type is int16
+    if maxval < 2**15:
+        return numpy.int16
+    return numpy.int32
+
+def pgm2numpy_p5(fin, debug = True, memmap=False):
+    '''Parse a binary (P5) PGM, positioned just after the magic number
+
+    Parameters:
+    ----------
+    fin: file
+    memmap: bool, optional [False]
+      Return a read-only memory map of the raster (big-endian for
+      16-bit data) instead of reading it
+
+    Returns:
+    ---------
+    numpy array of the image, uint8 (maxval < 256) or uint16
+    '''
     try:
-        
-        rows, cols = 0, 0
-        raw_data = re.split('\W+', pgm_nextline(fin))
-        rows = int(raw_data[1])
-        cols = int(raw_data[0])
-        raw_data = re.split('\W+', pgm_nextline(fin))
-        bits = (int(raw_data[0])+1)/256
-        
+        cols, rows, maxval = pgm_header(fin)
+
         assert (rows, cols) != (0,0)
-        
+        assert maxval > 0
         if debug:
             print('Rows: %d, cols: %d' %(rows, cols))
-        
-        assert bits > 0
-        
-        if debug:
-            print('color bit is %d' % bits)
-        
-        if bits<=1:
-            binvalues = array.array('c') # unsigned char 
-        elif bits<=2 and bits>1:
-            binvalues = array.array('H') # unsigned short
-        elif bits<=4 and bits>2:
-            binvalues = array.array('f') # float
+            print('maxval is %d' % maxval)
+
+        # 16-bit samples are big-endian
+        if maxval < 256:
+            dtype = numpy.dtype(numpy.uint8)
+        elif maxval < 65536:
+            dtype = numpy.dtype('>u2')
         else:
-            print('color bit is %d too big' % bits)
-        result = numpy.fromfile(fin, dtype=numpy.uint8)
-        result = numpy.reshape(result, (rows, cols))
-        
-        return result
-            
+            raise ValueError('pgm2numpy: maxval %d too big' % maxval)
+
+        if memmap:
+            return numpy.memmap(fin.name, dtype=dtype, mode='r', offset=fin.tell(),
+                                shape=(rows, cols))
+        result = numpy.fromfile(fin, dtype=dtype, count=rows*cols)
+        if result.size != rows*cols:
+            if debug:
+                print('Insufficient image data:', result.size)
+            return None
+        return result.reshape(rows, cols).astype(dtype.newbyteorder('='))
+
     finally:
         if fin != None:
             fin.close()
         fin = None
-    
+
     return None
-    
-    
+
+
 def pgm2numpy_p2(fin, debug = True, K1DM3=True):
     '''Algorithm to parse a PGM P2 filename
     I also modified the minimum image type to be int16
@@ -73,8 +119,9 @@ def pgm2numpy_p2(fin, debug = True, K1DM3=True):
     ----------
     fin: file 
     K1DM3: bool, optional [True]
-      Removes first and last characters which are '' for 
-      K1DM3 data (Alignment Telesope)
+      Kept for backwards compatibility.  Leading and trailing
+      whitespace (as in K1DM3 data from the Alignment Telescope)
+      is always ignored.
 
     Returns:
     ---------
@@ -82,84 +129,57 @@ def pgm2numpy_p2(fin, debug = True, K1DM3=True):
     '''
 
     try:
-        rows, cols = 0, 0
-        
-        raw_data = re.split('\W+', pgm_nextline(fin))
-        
-        rows = int(raw_data[1])
-        cols = int(raw_data[0])
-        raw_data = re.split('\W+', pgm_nextline(fin))
-        bits = (int(raw_data[0])+1)/256
-        
+        cols, rows, maxval = pgm_header(fin)
+
         assert (rows, cols) != (0,0)
-        
+        assert maxval > 0
         if debug:
             print('Rows: %d, cols: %d' %(rows, cols))
-        
-        assert bits > 0
-        
-        if debug:
-            print('color bit is %d' % bits)
-        #
-        # Initialise a 2D numpy array
-        #
-        if bits<=1:
-            #result = numpy.zeros((rows, cols), numpy.int8) # Original
-            result = numpy.zeros((rows, cols), numpy.int16)
-        elif bits<=2 and bits>1:
-            result = numpy.zeros((rows, cols), numpy.int16)
-        elif bits<=4 and bits>2:
-            result = numpy.zeros((rows, cols), numpy.int32)
-        else:
-            print('color bit is %d too big' % bits)
-        pxs = []
-        raw_data = re.split('\W+', fin.read())
-        # Remove first and last character
-        if K1DM3:
-          raw_data.pop(0)
-          raw_data.pop(-1)
-        #
-        # Read to EOF
-        #
-        #xdb.set_trace()
-        for v in raw_data:
-            if v == '':
-                break
-            if int(v) <0:
-                xdb.set_trace()
-            pxs.append(int(v))
-        
-        if len(pxs) != rows*cols:
+            print('maxval is %d' % maxval)
+
+        # Parse the whole body in C
+        body = fin.read()
+        if isinstance(body, bytes):
+            body = body.decode('ascii')
+        pxs = None
+        if '#' not in body:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                pxs = numpy.fromstring(body, dtype=numpy.int64, sep=' ')
+        if pxs is None or pxs.size != rows*cols:
+            # Comments or odd separators;  take the integers
+            body = re.sub('#[^\n]*', ' ', body)
+            pxs = numpy.array(re.findall(r'-?\d+', body), dtype=numpy.int64)
+
+        if pxs.size != rows*cols:
             if debug:
-                print('Insufficient image data:', len(pxs))
+                print('Insufficient image data:', pxs.size)
             return None
-        
-        for r in range(rows):
-            for c in range(cols):
-                #
-                # Index into the numpy array and set the pixel value
-                #
-                result[r, c] = pxs[r*cols+c]
-        return result
-    
+
+        return pxs.reshape(rows, cols).astype(_p2_dtype(maxval))
+
     finally:
         if fin != None:
             fin.close()
         fin = None
-    
+
     return None
 
-def pgm2numpy(filename):
+def pgm2numpy(filename, debug=True, memmap=False):
     '''
     Read a PGM into a numpy array. 
+
+    memmap: bool, optional [False]
+      Memory map P5 (binary) files rather than reading them
     '''
     fin = None 
-    debug = True
     r = None
 
-    print('Reading: {:s}'.format(filename))
+    if debug:
+        print('Reading: {:s}'.format(filename))
     fin = open(filename, 'rb')
-    header = pgm_nextline(fin)
+    # Magic number;  the rest of the header may share its line
+    header = fin.read(2).decode('ascii', 'replace')
  
     if header == 'P1':
         pass
@@ -172,13 +192,37 @@ def pgm2numpy(filename):
     elif header == 'P5':
         if debug:
             print('PBM is p5 format')
-        r =  pgm2numpy_p5(fin, debug)
+        r =  pgm2numpy_p5(fin, debug, memmap=memmap)
     else:
         #
         # unexpected header.
         #
         if debug:
             print('Bad mode: ', header)
+        fin.close()
         return None
-    return r    
-        
+    return r
+
+def pgm_frames(path, pattern='*.pgm', debug=False, memmap=False):
+    '''Generator over the PGM frames in a directory, in filename order
+
+    Only one frame is in memory at a time (none, with memmap=True and
+    P5 frames), so image sequences of any length can be processed.
+
+    Parameters:
+    ----------
+    path: str
+      Directory (or a single file)
+    pattern: str, optional ['*.pgm']
+      Glob pattern of the frames within path
+
+    Returns:
+    ---------
+    Yields (filename, numpy array) for each frame
+    '''
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, pattern)))
+    else:
+        files = [path]
+    for filename in files:
+        yield filename, pgm2numpy(filename, debug=debug, memmap=memmap)
@@ -0,0 +1,52 @@
+# Module to run tests on reading PGM images
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from xastropy.outils import pgm2numpy as xpgm
+
+
+def _p5(fil, img, maxval):
+    with open(fil, 'wb') as fh:
+        fh.write('P5\n# comment\n{:d} {:d}\n{:d}\n'.format(img.shape[1], img.shape[0],
+                                                         maxval).encode('ascii'))
+        fh.write(img.astype('>u2' if maxval > 255 else np.uint8).tobytes())
+
+
+def test_p2(tmpdir):
+    img = np.arange(12).reshape(3, 4) * 10
+    fil = str(tmpdir.join('a.pgm'))
+    # Leading whitespace and comments within the raster (as in K1DM3 data)
+    lines = ['P2', '# comment', '4 3', '255'] + ['  ' + ' '.join(str(v) for v in row)
+                                                 for row in img]
+    lines.insert(5, '# another')
+    with open(fil, 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+    out = xpgm.pgm2numpy(fil, debug=False)
+    assert out.dtype == np.int16
+    np.testing.assert_array_equal(out, img)
+    # Too few pixels
+    with open(fil, 'w') as fh:
+        fh.write('P2 4 3 255\n1 2 3\n')
+    assert xpgm.pgm2numpy(fil, debug=False) is None
+
+
+@pytest.mark.parametrize('maxval', [255, 4095])
+def test_p5(tmpdir, maxval):
+    img = (np.arange(20).reshape(4, 5) * 13) % (maxval+1)
+    fil = str(tmpdir.join('b.pgm'))
+    _p5(fil, img, maxval)
+    out = xpgm.pgm2numpy(fil, debug=False)
+    assert out.dtype == (np.uint8 if maxval == 255 else np.uint16)
+    np.testing.assert_array_equal(out, img)
+    np.testing.assert_array_equal(xpgm.pgm2numpy(fil, debug=False, memmap=True), img)
+
+
+def test_pgm_frames(tmpdir):
+    for ii in [2, 0, 1]:
+        _p5(str(tmpdir.join('f{:d}.pgm'.format(ii))), np.full((2, 3), ii), 255)
+    frames = list(xpgm.pgm_frames(str(tmpdir)))
+    assert [fil[-6:] for fil, img in frames] == ['f0.pgm', 'f1.pgm', 'f2.pgm']
+    assert [img[0, 0] for fil, img in frames] == [0, 1, 2]
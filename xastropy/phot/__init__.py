@@ -1,2 +1,8 @@
 import ian_phot
 import ian_analysis
+import filters
+import background
+import aperture
+import psf
+import profiles
+import linfit
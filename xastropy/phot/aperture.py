@@ -0,0 +1,248 @@
+"""Batch aperture photometry of many stars in many frames.
+
+:func:`batchphot` measures every position of a catalog in every frame
+of a list, working only on small postage stamps cut around each
+source.  Partial pixels in the target aperture are weighted by their
+exact geometric overlap with the circular aperture (see
+:func:`circleoverlap`) rather than by resampling the frame, and the
+results come back as one columnar table.
+
+For a single star in a single frame, :func:`ian_phot.aperphot` is
+still available.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+
+from xastropy.phot import background
+
+
+def _circlequadrant(x, y, r):
+    """Area of the circle of radius r (centered at the origin) with
+    X <= x and Y <= y.  Vectorized over all inputs.
+    """
+    def halfchord(t):  # integral of sqrt(r^2 - t^2) from -r to t
+        t = np.clip(t, -r, r)
+        return 0.5 * (t * np.sqrt(np.clip(r**2 - t**2, 0., None)) + \
+                          r**2 * np.arcsin(t / r)) + 0.25 * np.pi * r**2
+
+    x = np.clip(x, -r, r)
+    c = np.sqrt(np.clip(r**2 - y**2, 0., None))
+    sgn = np.sign(y)
+    inner = sgn * halfchord(np.minimum(x, -c)) + \
+        y * (np.clip(x, -c, c) + c) + \
+        sgn * (halfchord(np.maximum(x, c)) - halfchord(c))
+    return inner + halfchord(x)
+
+
+def circleoverlap(dx, dy, r, halfwidth=0.5):
+    """Exact area of overlap between a circle and square pixels.
+
+    :INPUTS:
+       dx, dy -- arrays.  Pixel-center coordinates relative to the
+                 circle's center.
+
+       r -- scalar or array.  Radius of the circle.
+
+    :OPTIONAL_INPUTS:
+       halfwidth -- half the width of a pixel.
+
+    :OUTPUT:
+       Array of overlap areas, broadcast from the inputs.  For unit
+       pixels these are the fractions of each pixel within the circle.
+
+    :EXAMPLE:
+       ::
+
+           dy, dx = np.mgrid[-5:6, -5:6]
+           circleoverlap(dx, dy, 3.).sum()   # --> pi * 3**2
+    """
+    dx = np.asarray(dx, dtype=float)
+    dy = np.asarray(dy, dtype=float)
+    r = np.asarray(r, dtype=float)
+    x0, x1 = dx - halfwidth, dx + halfwidth
+    y0, y1 = dy - halfwidth, dy + halfwidth
+    area = _circlequadrant(x1, y1, r) - _circlequadrant(x0, y1, r) - \
+        _circlequadrant(x1, y0, r) + _circlequadrant(x0, y0, r)
+    return np.clip(area, 0., None)
+
+
+def cutstamps(frame, xpos, ypos, halfsize, fill=np.nan):
+    """Cut square postage stamps around many positions in one frame.
+
+    :INPUTS:
+       frame -- 2D array.
+
+       xpos, ypos -- 1D arrays.  Column and row of each source.
+
+       halfsize -- int.  Stamps are (2*halfsize+1) pixels on a side,
+                   centered on the pixel nearest each position.
+
+    :OPTIONAL_INPUTS:
+       fill -- value for stamp pixels that fall off the frame.
+
+    :OUTPUTS:
+       stamps -- 3D array of shape (nsource, 2*halfsize+1, 2*halfsize+1)
+
+       dx, dy -- 3D arrays of pixel-center offsets from each position,
+                 of the same shape.
+    """
+    xpos = np.atleast_1d(np.asarray(xpos, dtype=float))
+    ypos = np.atleast_1d(np.asarray(ypos, dtype=float))
+    offsets = np.arange(-halfsize, halfsize+1)
+    ix = np.round(xpos).astype(int)[:, None, None] + offsets[None, None, :]
+    iy = np.round(ypos).astype(int)[:, None, None] + offsets[None, :, None]
+    ix, iy = np.broadcast_arrays(ix, iy)
+    inside = (ix >= 0) & (ix < frame.shape[1]) & (iy >= 0) & (iy < frame.shape[0])
+    stamps = frame[np.clip(iy, 0, frame.shape[0]-1), np.clip(ix, 0, frame.shape[1]-1)]
+    stamps = np.where(inside, stamps, fill)
+    return stamps, ix - xpos[:, None, None], iy - ypos[:, None, None]
+
+
+def scalestamps(stamps, header):
+    """Apply the BSCALE/BZERO/BLANK keywords of a FITS image to stamps
+    cut from its raw (unscaled) data.  BLANK pixels become NaN.
+    """
+    stamps = np.asarray(stamps, dtype=float)
+    if 'BLANK' in header:
+        stamps = np.where(stamps==header['BLANK'], np.nan, stamps)
+    return stamps * header.get('BSCALE', 1.) + header.get('BZERO', 0.)
+
+
+def stampphot(stamps, dx, dy, dap, nsigma=3, niter=99, skymethod='mean'):
+    """Aperture photometry on a stack of postage stamps.
+
+    :INPUTS:
+       stamps, dx, dy -- 3D arrays as returned by :func:`cutstamps`.
+
+       dap -- 3-sequence of aperture DIAMETERS (target, inner sky,
+              outer sky), as for :func:`ian_phot.aperphot`.
+
+    :OPTIONAL_INPUTS:
+       nsigma, niter -- sigma-clipping of the sky annulus pixels.
+
+       skymethod -- sky estimator; see :func:`background.skystats`.
+
+    :OUTPUT:
+       dict of 1D arrays: phot, ephot, bg, ebg, ntarg, nsky,
+       peak_targ, peak_annulus.
+    """
+    rtarg, rin, rout = 0.5 * np.asarray(dap, dtype=float)
+    nstamp = stamps.shape[0]
+    flat = stamps.reshape(nstamp, -1)
+    good = np.isfinite(flat)
+
+    # Sky: pixel centers within the annulus, as in aperphot:
+    rsq = (dx**2 + dy**2).reshape(nstamp, -1)
+    insky = (rsq < rout**2) & (rsq >= rin**2) & good
+    nsky = insky.sum(1)
+    bg, ebg = background.skystats(flat, mask=insky, method=skymethod, \
+                                      nsigma=nsigma, niter=niter, axis=1)[0:2]
+
+    # Target: exact partial-pixel weights:
+    weight = circleoverlap(dx, dy, rtarg).reshape(nstamp, -1)
+    weight[~good] = 0.
+    phot = (weight * (np.where(good, flat, 0.) - bg[:, None])).sum(1)
+    ntarg = weight.sum(1)
+    with np.errstate(invalid='ignore'):
+        ephot = np.sqrt(phot + np.sqrt(nsky) * bg)   # as in aperphot
+
+    intarg = (weight > 0) & good
+    peak_targ = np.where(intarg, flat, -np.inf).max(1)
+    peak_annulus = np.where(insky, flat, -np.inf).max(1)
+    return dict(phot=phot, ephot=ephot, bg=bg, ebg=ebg, ntarg=ntarg, nsky=nsky, \
+                    peak_targ=peak_targ, peak_annulus=peak_annulus)
+
+
+def batchphot(frames, positions, dap=(2, 4, 6), timekey=None, nsigma=3, niter=99, skymethod='mean'):
+    """Aperture photometry of a catalog of positions in a list of frames.
+
+    :INPUTS:
+       frames -- list of FITS filenames and/or 2D arrays, or a 3D array.
+
+       positions -- array of shape (nstar, 2) giving the (x, y) =
+                    (column, row) of each star in every frame, or of
+                    shape (nframe, nstar, 2) to give per-frame
+                    positions (e.g., to follow a drift).  In the
+                    latter case nframe must equal the number of frames.
+
+    :OPTIONAL_INPUTS:
+       dap -- 3-sequence of aperture DIAMETERS (target, inner sky,
+              outer sky), as for :func:`ian_phot.aperphot`.
+
+       timekey -- None, or FITS header keyword to record as 'time'.
+
+       nsigma, niter -- sigma-clipping of the sky annulus pixels.
+
+       skymethod -- sky estimator; see :func:`background.skystats`.
+
+    :OUTPUT:
+       astropy Table with one row per (frame, star) and columns frame,
+       star, x, y, phot, ephot, bg, ebg, ntarg, nsky, peak_targ,
+       peak_annulus, filename and (if timekey is set) time.
+
+    :EXAMPLE:
+       ::
+
+           from xastropy.phot import aperture
+           cat = np.array([[512.3, 200.8], [100.1, 877.4]])
+           tab = aperture.batchphot(filelist, cat, dap=[8, 16, 24])
+           lc = tab['phot'][tab['star']==0]
+    """
+    from astropy.table import Table
+    from astropy.io import fits
+
+    positions = np.asarray(positions, dtype=float)
+    perframe = positions.ndim==3
+    if perframe and hasattr(frames, '__len__') and len(frames)!=positions.shape[0]:
+        raise ValueError("positions give %i frames, but there are %i frames" \
+                             % (positions.shape[0], len(frames)))
+    nstar = positions.shape[-2]
+    halfsize = int(np.ceil(0.5 * max(dap))) + 1
+
+    columns = dict()
+    filenames = []
+    times = []
+    for iframe, frame in enumerate(frames):
+        if not perframe:
+            xy = positions
+        elif iframe < positions.shape[0]:
+            xy = positions[iframe]
+        else:
+            raise ValueError("positions give only %i frames" % positions.shape[0])
+        if isinstance(frame, np.ndarray):
+            header = None
+            stamps, dx, dy = cutstamps(frame, xy[:, 0], xy[:, 1], halfsize)
+            filenames.append('')
+        else:
+            # Only the stamp pixels are read from the memory-mapped data
+            # (gzipped files are read whole); scaled integer images
+            # (e.g. uint16 with BZERO) are scaled stamp by stamp:
+            with fits.open(frame, memmap=True, do_not_scale_image_data=True) as hdulist:
+                header = hdulist[0].header
+                stamps, dx, dy = cutstamps(hdulist[0].data, xy[:, 0], xy[:, 1], halfsize)
+                stamps = scalestamps(stamps, header)
+            filenames.append(frame)
+        if timekey is not None:
+            times.append(header[timekey] if header is not None and timekey in header else np.nan)
+
+        result = stampphot(stamps.astype(float), dx, dy, dap, nsigma=nsigma, niter=niter, \
+                               skymethod=skymethod)
+        result['x'], result['y'] = xy[:, 0], xy[:, 1]
+        for key in result:
+            columns.setdefault(key, []).append(result[key])
+
+    nframe = len(filenames)
+    if perframe and nframe!=positions.shape[0]:
+        raise ValueError("positions give %i frames, but there are %i frames" \
+                             % (positions.shape[0], nframe))
+    tab = Table()
+    tab['frame'] = np.repeat(np.arange(nframe), nstar)
+    tab['star'] = np.tile(np.arange(nstar), nframe)
+    for key in ['x', 'y', 'phot', 'ephot', 'bg', 'ebg', 'ntarg', 'nsky', \
+                    'peak_targ', 'peak_annulus']:
+        tab[key] = np.concatenate(columns[key]) if nframe > 0 else np.zeros(0)
+    tab['filename'] = np.repeat(np.array(filenames, dtype=str), nstar)
+    if timekey is not None:
+        tab['time'] = np.repeat(np.array(times, dtype=float), nstar)
+    return tab
@@ -0,0 +1,123 @@
+"""Robust sky-background estimates for many apertures at once.
+
+:func:`skystats` works on a stack of sky samples -- e.g. the pixels of
+many sky annuli, one annulus per row, with unused pixels masked or set
+to NaN -- and sigma-clips and summarizes every row in one vectorized
+pass.  :func:`gaussfit_hist` replaces the iterative Gaussian fit to a
+histogram formerly done in :func:`ian_phot.estbg`.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+
+from xastropy.phot import filters
+
+
+def skystats(data, mask=None, method='mean', nsigma=3, niter=10, axis=-1):
+    """Sigma-clipped sky level and its uncertainty for a stack of samples.
+
+    :INPUTS:
+       data -- N-D array (or masked array) of sky values; each 1D lane
+               along 'axis' is one sky region.
+
+    :OPTIONAL_INPUTS:
+       mask -- None, or boolean array of the same shape as 'data':
+               True (or nonzero) where a value should be used.  Masked
+               array masks and non-finite values are also honoured.
+
+       method -- how to estimate the sky from the clipped values:
+            'mean'   : clipped mean.
+            'median' : clipped median.
+            'mode'   : Pearson's mode, 3*median - 2*mean.
+            'mmm'    : as SExtractor: 2.5*median - 1.5*mean, unless
+                       the distribution is strongly skewed
+                       (|mean - median| > 0.3*sigma), in which case
+                       the median.
+
+       nsigma, niter -- sigma-clipping parameters; see
+                        :func:`filters.sigmaclip`.
+
+    :OUTPUTS:
+       (sky, esky, sigma, nused) -- arrays with 'axis' removed: the
+       sky level, its standard error (sigma / sqrt(nused)), the
+       clipped standard deviation and the number of values used.
+
+    :EXAMPLE:
+       ::
+
+           from xastropy.phot import background
+           annuli = np.random.normal(100., 5., size=(50, 400))
+           annuli[:, 0] = 1e4   # a star in every annulus
+           sky, esky, sig, n = background.skystats(annuli, method='mmm')
+    """
+    if np.ma.isMaskedArray(data):
+        good = ~np.ma.getmaskarray(data)
+        data = data.filled(np.nan)
+    else:
+        good = np.ones(np.shape(data), dtype=bool)
+    data = np.asarray(data, dtype=float)
+    if mask is not None:
+        good &= np.asarray(mask).astype(bool)
+    good &= np.isfinite(data)
+
+    kept = filters.sigmaclip(np.where(good, data, np.nan), nsigma, niter=niter, axis=axis)
+    nused = kept.sum(axis=axis)
+    mean = filters.maskedmean(data, kept, axis=axis)
+    sigma = filters.maskedstd(data, kept, axis=axis)
+
+    if method=='mean':
+        sky = mean
+    else:
+        median = filters.maskedmedian(data, kept, axis=axis)
+        if method=='median':
+            sky = median
+        elif method=='mode':
+            sky = 3.*median - 2.*mean
+        elif method=='mmm':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                skewed = np.abs(mean - median) > 0.3 * sigma
+            sky = np.where(skewed, median, 2.5*median - 1.5*mean)
+        else:
+            raise ValueError("method must be 'mean', 'median', 'mode' or 'mmm'")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        esky = sigma / np.sqrt(nused)
+    return sky, esky, sigma, nused
+
+
+def gaussfit_hist(centers, counts):
+    """Fit a Gaussian to a histogram in closed form.
+
+    Fits a parabola to the logarithm of the non-empty bins, weighted by
+    the squared counts (Guo 2011, IEEE Sig. Proc. Mag. 28, 134), which
+    needs no iterative optimizer.
+
+    :INPUTS:
+       centers -- 1D array.  Bin centers.
+
+       counts -- 1D array.  Number of values in each bin.
+
+    :OUTPUT:
+       (area, sigma, mu) in the convention of
+       :func:`ian_analysis.gaussian`, or None if the fit fails (e.g.,
+       too few non-empty bins or a non-negative curvature).
+    """
+    centers = np.asarray(centers, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    use = counts > 0
+    if use.sum() < 3:
+        return None
+    # Center and scale x to keep the normal equations well conditioned:
+    x0 = centers[use].mean()
+    dx = centers[use].std()
+    x = (centers[use] - x0) / dx
+    w = counts[use]
+    design = np.vstack((np.ones(x.size), x, x**2)).T
+    coef = np.linalg.lstsq(design * w[:, None], np.log(counts[use]) * w, rcond=-1)[0]
+    if coef[2] >= 0:
+        return None
+    sigma = np.sqrt(-0.5 / coef[2])
+    mu = -0.5 * coef[1] / coef[2]
+    peak = np.exp(coef[0] - 0.25 * coef[1]**2 / coef[2])
+    area = peak * sigma * dx * np.sqrt(2*np.pi)
+    return area, sigma * dx, mu * dx + x0
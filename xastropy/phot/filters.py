@@ -0,0 +1,408 @@
+"""Fast sliding-window filters and sigma-clipping for arrays and images.
+
+The 2D filters here replace the pixel-by-pixel loops formerly used in
+:func:`ian_analysis.medianfilter` and :func:`ian_analysis.stdfilt2d`.
+Images are processed in strips of rows (plus a halo of neighbouring
+rows), so memory use stays bounded on large detector frames.  Edges are
+handled by mirror-reflection (scipy.ndimage's 'reflect' mode) and NaNs
+are ignored within each window.
+
+The 1D filters and the sigma-clipping routines work along any axis of
+an N-D stack, using cumulative sums and boolean masks rather than
+Python loops; they back :func:`ian_analysis.stdfilt`,
+:func:`ian_analysis.wmeanfilt`, :func:`ian_analysis.removeoutliers`
+and the :func:`ian_analysis.meanr` family.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy import ndimage
+
+
+def _filtersize(filtersize):
+    """Return a (rows, columns) 2-tuple of ints from a scalar or sequence."""
+    if not hasattr(filtersize, '__iter__'):
+        filtersize = [filtersize]
+    filtersize = [int(f) for f in filtersize]
+    if len(filtersize)<1 or min(filtersize)<1:
+        raise ValueError("filtersize must be a positive 1- or 2-element value")
+    elif len(filtersize)==1:
+        filtersize = filtersize*2
+    return tuple(filtersize[0:2])
+
+
+def iter_tiles(data, filtersize, tilerows=256):
+    """Iterate over padded row-strips of a 2D image.
+
+    :INPUTS:
+       data -- 2D array.
+
+       filtersize -- 2-tuple of ints. Size of the filter window.
+
+    :OPTIONAL_INPUTS:
+       tilerows -- int.  Number of output rows per strip.
+
+    :OUTPUTS:
+       Yields (rowslice, padded) pairs, where 'padded' is the strip of
+       'data' extended by the filter halo on all sides (mirror-reflected
+       at the image edges), and 'rowslice' gives the output rows it
+       covers.  The halo follows scipy.ndimage's convention, so for
+       even sizes the window extends one pixel further before the
+       center than after it.
+    """
+    ky, kx = filtersize
+    before = (ky//2, kx//2)
+    after = (ky - 1 - ky//2, kx - 1 - kx//2)
+    nrow = data.shape[0]
+    tilerows = max(1, int(tilerows))
+    for r0 in range(0, nrow, tilerows):
+        r1 = min(r0 + tilerows, nrow)
+        i0 = max(r0 - before[0], 0)
+        i1 = min(r1 + after[0], nrow)
+        strip = data[i0:i1]
+        padrows = (before[0] - (r0 - i0), after[0] - (i1 - r1))
+        padded = np.pad(strip, (padrows, (before[1], after[1])), mode='symmetric')
+        yield slice(r0, r1), padded
+
+
+def windowview(padded, filtersize):
+    """Return a read-only 4D strided view of all windows in a padded image.
+
+    Element [i, j] of the output is the (ky, kx) window whose top-left
+    corner is padded[i, j]; no data are copied.
+    """
+    ky, kx = filtersize
+    ny, nx = padded.shape[0] - ky + 1, padded.shape[1] - kx + 1
+    s0, s1 = padded.strides
+    ret = as_strided(padded, shape=(ny, nx, ky, kx), strides=(s0, s1, s0, s1))
+    ret.flags.writeable = False
+    return ret
+
+
+def boxmoments(padded, filtersize):
+    """Compute NaN-aware window counts, means and variances via integral images.
+
+    :INPUTS:
+       padded -- 2D array, already extended by the filter halo
+                 (see :func:`iter_tiles`).
+
+       filtersize -- 2-tuple of ints.
+
+    :OUTPUTS:
+       (count, mean, var) -- 2D arrays with the number of finite
+       pixels, their mean and their (population) variance in each
+       window.  Windows with no finite pixels have NaN mean and var.
+    """
+    ky, kx = filtersize
+    good = np.isfinite(padded)
+    # Work relative to a typical value to limit round-off in sum(x^2):
+    offset = np.median(padded[good]) if good.any() else 0.
+    vals = np.where(good, padded - offset, 0.)
+
+    def boxsum(arr):
+        integral = np.zeros((arr.shape[0]+1, arr.shape[1]+1), dtype=float)
+        integral[1:, 1:] = arr.cumsum(0).cumsum(1)
+        return integral[ky:, kx:] - integral[:-ky, kx:] - \
+            integral[ky:, :-kx] + integral[:-ky, :-kx]
+
+    count = np.round(boxsum(good.astype(float)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = boxsum(vals) / count
+        var = boxsum(vals**2) / count - mean**2
+    var = np.clip(var, 0., None)
+    mean[count==0] = np.nan
+    var[count==0] = np.nan
+    return count, mean + offset, var
+
+
+def median2d(data, filtersize, tilerows=256, maxwindow=2**22):
+    """Sliding-window median of a 2D image, ignoring NaNs.
+
+    :INPUTS:
+       data -- 2D array.
+
+       filtersize -- int or 2-sequence.  Size of the filter window.
+                     The median of an even number of values is the
+                     mean of the two middle ones.
+
+    :OPTIONAL_INPUTS:
+       tilerows -- int.  Number of rows processed at once.
+
+       maxwindow -- int.  Strips containing NaNs are medianed from a
+                    windowed view in chunks of at most this many
+                    elements (rows x columns x window size).
+
+    :EXAMPLE:
+       ::
+
+           from xastropy.phot import filters
+           smooth = filters.median2d(frame, 5)
+    """
+    filtersize = _filtersize(filtersize)
+    data = np.asarray(data, dtype=float)
+    ret = np.empty(data.shape, dtype=float)
+    ky, kx = filtersize
+    # ndimage.median_filter takes the upper of the two middle values of
+    # an even-sized window, so it is only used for odd windows.
+    odd = (ky % 2==1) and (kx % 2==1)
+    for rowslice, padded in iter_tiles(data, filtersize, tilerows):
+        finite = np.isfinite(padded).all()
+        if finite and odd:
+            med = ndimage.median_filter(padded, size=filtersize, mode='reflect')
+            ret[rowslice] = med[ky//2:ky//2 + rowslice.stop - rowslice.start, \
+                                    kx//2:kx//2 + data.shape[1]]
+        else:
+            medfunc = np.median if finite else np.nanmedian
+            windows = windowview(padded, filtersize)
+            chunk = max(1, maxwindow // (windows.shape[1] * ky * kx))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                for c0 in range(0, windows.shape[0], chunk):
+                    c1 = min(c0 + chunk, windows.shape[0])
+                    ret[rowslice.start + c0:rowslice.start + c1] = \
+                        medfunc(windows[c0:c1].reshape(c1 - c0, windows.shape[1], -1), axis=2)
+    return ret
+
+
+def std2d(data, filtersize, tilerows=256):
+    """Sliding-window (population) standard deviation of a 2D image,
+    ignoring NaNs.  Uses integral images, so the cost is independent
+    of the window size.
+    """
+    filtersize = _filtersize(filtersize)
+    data = np.asarray(data, dtype=float)
+    ret = np.empty(data.shape, dtype=float)
+    for rowslice, padded in iter_tiles(data, filtersize, tilerows):
+        ret[rowslice] = np.sqrt(boxmoments(padded, filtersize)[2])
+    return ret
+
+
+def mean2d(data, filtersize, tilerows=256):
+    """Sliding-window mean of a 2D image, ignoring NaNs."""
+    filtersize = _filtersize(filtersize)
+    data = np.asarray(data, dtype=float)
+    ret = np.empty(data.shape, dtype=float)
+    for rowslice, padded in iter_tiles(data, filtersize, tilerows):
+        ret[rowslice] = boxmoments(padded, filtersize)[1]
+    return ret
+
+
+def replace_outliers2d(data, filtersize, threshold=None, tilerows=256):
+    """Replace pixels by their local median where they deviate strongly.
+
+    :INPUTS:
+       data -- 2D array.
+
+       filtersize -- int or 2-sequence.  Size of the filter window.
+
+    :OPTIONAL_INPUTS:
+       threshold -- None or scalar.
+            If None, return the median-filtered image.
+
+            If >= 0, replace only pixels where |data - median| /
+            std >= threshold, with median and std computed in the
+            local window.
+
+            If < 0, first mask pixels more than |threshold| local
+            standard deviations from the local median, recompute the
+            local median and std without them, and then apply the
+            threshold |threshold| as above.
+    """
+    filtersize = _filtersize(filtersize)
+    data = np.asarray(data, dtype=float)
+    med = median2d(data, filtersize, tilerows=tilerows)
+    if threshold is None:
+        return med
+
+    std = std2d(data, filtersize, tilerows=tilerows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        nsig = np.abs(data - med) / std
+        if threshold < 0:
+            threshold = np.abs(threshold)
+            clipped = np.where(nsig >= threshold, np.nan, data)
+            med = median2d(clipped, filtersize, tilerows=tilerows)
+            std = std2d(clipped, filtersize, tilerows=tilerows)
+            nsig = np.abs(data - med) / std
+        replace = nsig >= threshold
+
+    ret = data.copy()
+    ret[replace] = med[replace]
+    return ret
+
+
+# Upper limit on sigma-clipping passes when niter=Inf is requested:
+MAXITER = 100
+
+
+def slidingsum(x, wid, axis=-1):
+    """Sum of x in a sliding window of width 'wid' along 'axis'.
+
+    The window for element i spans [i - wid/2, i + wid/2], truncated at
+    the ends of the array (so it is symmetric only for odd 'wid').
+    Computed from cumulative sums, so the cost does not depend on 'wid'.
+    x must be finite; see :func:`slidingmean` for NaN handling.
+    """
+    x = np.asarray(x, dtype=float)
+    wid = max(int(wid), 1)
+    n = x.shape[axis]
+    csum = np.cumsum(x, axis=axis)
+    pad = [(0, 0)] * x.ndim
+    pad[axis] = (1, 0)
+    csum = np.pad(csum, pad, mode='constant')
+    index = np.arange(n)
+    i0 = np.clip(index - wid//2, 0, n)
+    i1 = np.clip(index + wid//2 + 1, 0, n)
+    return np.take(csum, i1, axis=axis) - np.take(csum, i0, axis=axis)
+
+
+def _badwindows(bad, wid, axis):
+    """True for the windows that contain a flagged element."""
+    return slidingsum(bad.astype(float), wid, axis=axis) > 0.5
+
+
+def slidingmean(x, wid, w=None, axis=-1):
+    """(Weighted) mean of x in a sliding window along 'axis'.
+
+    :INPUTS:
+       x -- N-D array.
+
+       wid -- int.  Width of the window; see :func:`slidingsum`.
+
+    :OPTIONAL_INPUTS:
+       w -- None, or array of weights (e.g. 1/sigma^2) of the same
+            shape as x.
+
+    :NOTES:
+       As for the loops this replaces, windows containing a non-finite
+       value (of x or w) are NaN; the rest of the output is unaffected.
+    """
+    x = np.asarray(x, dtype=float)
+    if w is None:
+        w = np.ones(x.shape, dtype=float)
+    else:
+        w = np.array(np.broadcast_to(np.asarray(w, dtype=float), x.shape))
+    bad = ~(np.isfinite(x) & np.isfinite(w))
+    x = np.where(bad, 0., x)
+    w = np.where(bad, 0., w)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ret = slidingsum(x*w, wid, axis=axis) / slidingsum(w, wid, axis=axis)
+    ret[_badwindows(bad, wid, axis)] = np.nan
+    return ret
+
+
+def slidingstd(x, wid, axis=-1):
+    """(Population) standard deviation of x in a sliding window along 'axis'.
+
+    Windows containing a non-finite value are NaN, as in
+    :func:`slidingmean`.
+    """
+    x = np.asarray(x, dtype=float)
+    bad = ~np.isfinite(x)
+    x = np.where(bad, 0., x)
+    # Work relative to the mean of the finite values to limit round-off
+    # in sum(x^2):
+    ngood = np.maximum((~bad).sum(axis=axis, keepdims=True), 1)
+    x = np.where(bad, 0., x - x.sum(axis=axis, keepdims=True) / ngood)
+    count = slidingsum(np.ones(x.shape), wid, axis=axis)
+    mean = slidingsum(x, wid, axis=axis) / count
+    var = slidingsum(x**2, wid, axis=axis) / count - mean**2
+    ret = np.sqrt(np.clip(var, 0., None))
+    ret[_badwindows(bad, wid, axis)] = np.nan
+    return ret
+
+
+def maskedmean(x, good, axis=None):
+    """Mean of the elements of x where 'good' is True, along 'axis'."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(good, x, 0.).sum(axis=axis) / good.sum(axis=axis)
+
+
+def maskedstd(x, good, axis=None):
+    """(Population) standard deviation of x where 'good' is True, along 'axis'."""
+    mean = maskedmean(x, good, axis=axis)
+    if axis is not None:
+        mean = np.expand_dims(mean, axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = np.where(good, (x - mean)**2, 0.).sum(axis=axis) / good.sum(axis=axis)
+    return np.sqrt(var)
+
+
+def maskedmedian(x, good, axis=None):
+    """Median of the elements of x where 'good' is True, along 'axis'."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(np.where(good, x, np.nan), axis=axis)
+
+
+def sigmaclip(x, nsigma=3, niter=MAXITER, center='mean', remove='both', \
+                  axis=None, verbose=False):
+    """Iteratively sigma-clip an array, returning a mask of the kept values.
+
+    Each 1D lane along 'axis' is clipped independently, but all lanes
+    are processed together.  Non-finite values are always rejected.
+
+    :INPUTS:
+       x -- N-D array.
+
+    :OPTIONAL_INPUTS:
+       nsigma -- positive number.  Clipping limit, in standard deviations
+                 from the center of the data.
+
+       niter -- number of iterations.  Clipping also stops once no
+                lane changes; Inf is replaced by MAXITER.
+
+       center -- 'mean', 'median', or a number.
+
+       remove -- 'min', 'max' or 'both': which side(s) to clip.
+
+       axis -- None (treat x as 1D) or int.
+
+    :OUTPUT:
+       good -- boolean array of the same shape as x.
+
+    :EXAMPLE:
+       ::
+
+           cube = np.random.normal(size=(100, 64, 64))
+           cube[3, 10, 10] = 1e3
+           good = sigmaclip(cube, 3, axis=0)
+           clean = maskedmean(cube, good, axis=0)
+    """
+    x = np.asarray(x, dtype=float)
+    shape = x.shape
+    if axis is None:
+        x = x.ravel()
+        axis = 0
+    niter = MAXITER if not np.isfinite(niter) else int(niter)
+
+    good = np.isfinite(x)
+    ngood = good.sum(axis=axis)
+    for ii in range(niter):
+        if center=='median':
+            cen = np.expand_dims(maskedmedian(x, good, axis=axis), axis)
+        elif center=='mean':
+            cen = np.expand_dims(maskedmean(x, good, axis=axis), axis)
+        else:
+            cen = center
+        stdev = np.expand_dims(maskedstd(x, good, axis=axis), axis)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            distance = np.where(stdev==0, 0., (x - cen) / stdev)
+        if remove=='min':
+            good &= distance > -nsigma
+        elif remove=='max':
+            good &= distance < nsigma
+        else:
+            good &= np.abs(distance) <= nsigma
+
+        newgood = good.sum(axis=axis)
+        if verbose:
+            print("Iteration %i: kept %i of %i values" % (ii+1, newgood.sum(), x.size))
+        if (newgood==ngood).all():
+            break
+        ngood = newgood
+
+    return good.reshape(shape)
@@ -32,6 +32,7 @@
 import numpy as np
 from numpy import ones, std, sum, mean, median, array, linalg, tile, concatenate, floor, Inf, arange, meshgrid, zeros, sin, cos, tan, arctan, sqrt, exp, nan, max
 import pdb
+from warnings import warn
 from pylab import find
 from scipy import optimize
 
@@ -452,6 +453,11 @@ def rveph(p, jd):
     planet at a given JD.  RV ephemeris is defined by the having
     radial velocity equal to zero.
 
+    jd may be an array.  The orbit number is floor((jd-time0)/per),
+    so the ephemeris returned is never after jd, also for dates before
+    the reference ephemeris time0.  (Earlier versions truncated the
+    orbit number toward zero, which gave the *next* ephemeris for dates
+    before time0.)
 
 
         :EXAMPLE:
@@ -471,7 +477,7 @@ def rveph(p, jd):
     #    "Extrasolar Planets," R. Dvorak ed.
     # 2010-03-12 09:34 IJC: Updated for new planet-style object.
 
-    from numpy import cos, arccos, arctan, sqrt, tan, pi, sin, int
+    from numpy import cos, arccos, sin
 
     if p.__class__<>planet:
         raise Exception, "First input must be a 'planet' object."
@@ -481,12 +487,12 @@ def rveph(p, jd):
     ecc = p.ecc
     per = p.per
     f = arccos(-ecc * cos(omega)) - omega  # true anomaly
-    u = 2.*arctan(sqrt((1-ecc)/(1+ecc))*tan(f/2.)) # eccentric anomaly
+    u = eccentricanomaly(ecc, tanom=f) # eccentric anomaly
     n = 2*pi/per
 
     time0 = tau+ (u-ecc*sin(u))/n
-    norb = int((time0-jd)/per)
-    time = time0-norb*per
+    norb = np.floor((np.asarray(jd, dtype=float) - time0)/per)
+    time = time0 + norb*per
     return time
 
 
@@ -576,19 +582,14 @@ def rv(p, jd=None, e=None, reteanom=False, tol=1e-8):
     if ecc > 1:
         ecc = 1. - tol
 
+    n = 2.*pi/per    # mean motion
     if e is None:
-        n = 2.*pi/per    # mean motion
         m = n*(jd - tau) # mean anomaly
-        e = []
-        for element in m: # compute eccentric anomaly
-            def kep(e): return element - e + ecc*sin(e)
-            e.append(optimize.brentq(kep, element-1, element+1,  xtol=tol, disp=False))
-            #e.append(optimize.newton(kep, 0, tol=tol))
+        e = solvekepler(m, ecc, tol=tol)  # compute eccentric anomaly
     else:
-        pass
+        e = np.asarray(e)
 
-    e = array(e, copy=False)
-    f = 2. * arctan(  sqrt((1+ecc)/(1.-ecc)) * tan(e/2.)  )
+    f = trueanomaly(ecc, eanom=e)
     #r = a*(1-ecc*cos(e))
     #x = r*cos(f)
     #y = r*sin(f)
@@ -686,16 +687,12 @@ def rvstar(p, jd=None, e=None, reteanom=False, tol=1e-8):
     if e is None:
         n = 2.*pi/per    # mean motion
         m = n*(jd - tau) # mean anomaly
-        e = np.zeros(m.shape)
-        for ii,element in enumerate(m): # compute eccentric anomaly
-            def kep(e): return element - e + ecc*sin(e)
-            e[ii] = optimize.brentq(kep, element-1, element+1,  xtol=tol, disp=False)
-            #e.append(optimize.newton(kep, 0, tol=tol))
+        e = solvekepler(m, ecc, tol=tol)  # compute eccentric anomaly
     else:
-        pass
+        e = np.asarray(e)
 
     # Compute true anomaly:
-    f = 2. * arctan(  sqrt((1+ecc)/(1.-ecc)) * tan(e/2.)  )
+    f = trueanomaly(ecc, eanom=e)
     
     vrstar = k * (np.cos(f + omega) + ecc*np.cos(omega)) + gamma
 
@@ -938,6 +935,12 @@ def gpolyval(c,x, mode='poly', retp=False):
         return ret
     return -1
 
+def _warn_finite(name, finite):
+    """Warn that the 'finite' keyword of stdr/meanr/medianr is ignored."""
+    if not finite:
+        warn("%s: finite=False is deprecated and ignored; non-finite values "
+             "are always removed" % name, DeprecationWarning, stacklevel=3)
+
 def stdr(x, nsigma=3, niter=Inf, finite=True, verbose=False, axis=None):
     """Return the standard deviation of an array after removing outliers.
     
@@ -946,8 +949,9 @@ def stdr(x, nsigma=3, niter=Inf, finite=True, verbose=False, axis=None):
 
     :OPTIONAL INPUT:
       nsigma -- (float) number of standard deviations for clipping
-      niter -- number of iterations.
-      finite -- if True, remove all non-finite elements (e.g. Inf, NaN)
+      niter -- number of iterations (Inf means filters.MAXITER).
+      finite -- deprecated and ignored: non-finite elements (e.g. Inf,
+                NaN) are always removed
       axis -- (int) axis along which to compute the mean.
 
     :EXAMPLE:
@@ -965,40 +969,15 @@ def stdr(x, nsigma=3, niter=Inf, finite=True, verbose=False, axis=None):
     """
     # 2010-02-16 14:57 IJC: Created from mear
     # 2010-07-01 14:06 IJC: ADded support for higher dimensions
-    from numpy import array, isfinite, zeros, swapaxes
+    from xastropy.phot import filters
+    _warn_finite('stdr', finite)
 
-    x = array(x, copy=True)
-    xshape = x.shape
-    ndim =  len(xshape)
-    if ndim==0:
+    x = np.asarray(x, dtype=float)
+    if x.ndim==0:
         return x
 
-    if  ndim==1 or axis is None:
-        # "1D" array
-        x = x.ravel()
-        if finite:
-            x = x[isfinite(x)]
-        x = removeoutliers(x, nsigma, niter=Inf, verbose=verbose)
-        return x.std()
-    else:
-        newshape = list(xshape)
-        oldDimension = newshape.pop(axis) 
-        ret = zeros(newshape, float)
-
-        # Prevent us from taking the action along the axis of primary incidices:
-        if axis==0: 
-            x=swapaxes(x,0,1)
-
-        if axis>1:
-            nextaxis = axis-1
-        else:
-            nextaxis = 0
-
-        for ii in range(newshape[0]):
-            #print 'x.shape>>',x.shape, 'newshape>>',newshape, 'x[ii].shape>>',x[ii].shape, 'ret[ii].shape>>',ret[ii].shape,'ii>>',ii
-            ret[ii] = stdr(x[ii], nsigma=nsigma,niter=niter,finite=finite,\
-                                 verbose=verbose, axis=nextaxis)
-        return ret
+    good = filters.sigmaclip(x, nsigma, niter=niter, axis=axis, verbose=verbose)
+    return filters.maskedstd(x, good, axis=axis)
 
 
 def meanr(x, nsigma=3, niter=Inf, finite=True, verbose=False,axis=None):
@@ -1009,8 +988,9 @@ def meanr(x, nsigma=3, niter=Inf, finite=True, verbose=False,axis=None):
 
     :OPTIONAL INPUT:
       nsigma -- (float) number of standard deviations for clipping
-      niter -- number of iterations.
-      finite -- if True, remove all non-finite elements (e.g. Inf, NaN)
+      niter -- number of iterations (Inf means filters.MAXITER).
+      finite -- deprecated and ignored: non-finite elements (e.g. Inf,
+                NaN) are always removed
       axis -- (int) axis along which to compute the mean.
 
     :EXAMPLE:
@@ -1028,42 +1008,15 @@ def meanr(x, nsigma=3, niter=Inf, finite=True, verbose=False,axis=None):
     """
     # 2009-10-01 10:44 IJC: Created
     # 2010-07-01 13:52 IJC: Now handles higher dimensions.
-    from numpy import array, isfinite, zeros, swapaxes
+    from xastropy.phot import filters
+    _warn_finite('meanr', finite)
 
-    x = array(x, copy=True)
-    xshape = x.shape
-    ndim =  len(xshape)
-    if ndim==0:
+    x = np.asarray(x, dtype=float)
+    if x.ndim==0:
         return x
 
-    if  ndim==1 or axis is None:
-        # "1D" array
-        x = x.ravel()
-        if finite:
-            x = x[isfinite(x)]
-        x = removeoutliers(x, nsigma, niter=Inf, verbose=verbose)
-        return x.mean()
-    else:
-        newshape = list(xshape)
-        oldDimension = newshape.pop(axis) 
-        ret = zeros(newshape, float)
-
-        # Prevent us from taking the mean along the axis of primary incidices:
-        if axis==0: 
-            x=swapaxes(x,0,1)
-
-        if axis>1:
-            nextaxis = axis-1
-        else:
-            nextaxis = 0
-
-        for ii in range(newshape[0]):
-            #print 'x.shape>>',x.shape, 'newshape>>',newshape, 'x[ii].shape>>',x[ii].shape, 'ret[ii].shape>>',ret[ii].shape,'ii>>',ii
-            ret[ii] = meanr(x[ii], nsigma=nsigma,niter=niter,finite=finite,\
-                                 verbose=verbose, axis=nextaxis)
-        return ret
-            
-        
+    good = filters.sigmaclip(x, nsigma, niter=niter, axis=axis, verbose=verbose)
+    return filters.maskedmean(x, good, axis=axis)
 
 
 def medianr(x, nsigma=3, niter=Inf, finite=True, verbose=False,axis=None):
@@ -1074,8 +1027,9 @@ def medianr(x, nsigma=3, niter=Inf, finite=True, verbose=False,axis=None):
 
     :OPTIONAL INPUT:
       nsigma -- (float) number of standard deviations for clipping
-      niter -- number of iterations.
-      finite -- if True, remove all non-finite elements (e.g. Inf, NaN)
+      niter -- number of iterations (Inf means filters.MAXITER).
+      finite -- deprecated and ignored: non-finite elements (e.g. Inf,
+                NaN) are always removed
       axis -- (int) axis along which to compute the mean.
 
     :EXAMPLE:
@@ -1093,43 +1047,17 @@ def medianr(x, nsigma=3, niter=Inf, finite=True, verbose=False,axis=None):
     """
     # 2009-10-01 10:44 IJC: Created
     #2010-07-01 14:04 IJC: Added support for higher dimensions
-    from numpy import array, isfinite, zeros, median, swapaxes
+    from xastropy.phot import filters
+    _warn_finite('medianr', finite)
 
-    x = array(x, copy=True)
-    xshape = x.shape
-    ndim =  len(xshape)
-    if ndim==0:
+    x = np.asarray(x, dtype=float)
+    if x.ndim==0:
         return x
 
-    if  ndim==1 or axis is None:
-        # "1D" array
-        x = x.ravel()
-        if finite:
-            x = x[isfinite(x)]
-        x = removeoutliers(x, nsigma, niter=Inf, verbose=verbose)
-        return median(x)
-    else:
-        newshape = list(xshape)
-        oldDimension = newshape.pop(axis) 
-        ret = zeros(newshape, float)
+    good = filters.sigmaclip(x, nsigma, niter=niter, axis=axis, verbose=verbose)
+    return filters.maskedmedian(x, good, axis=axis)
 
-        # Prevent us from taking the action along the axis of primary incidices:
-        if axis==0: 
-            x=swapaxes(x,0,1)
 
-        if axis>1:
-            nextaxis = axis-1
-        else:
-            nextaxis = 0
-
-        for ii in range(newshape[0]):
-            #print 'x.shape>>',x.shape, 'newshape>>',newshape, 'x[ii].shape>>',x[ii].shape, 'ret[ii].shape>>',ret[ii].shape,'ii>>',ii
-            ret[ii] = medianr(x[ii], nsigma=nsigma,niter=niter,finite=finite,\
-                                 verbose=verbose, axis=nextaxis)
-        return ret
-
-        
-    
 def amedian(a, axis=None):
     """amedian(a, axis=None)
 
@@ -1179,8 +1107,9 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
       coefficients [pk ... p1 p0].
 
     :OPTIONS:
-        w:   a set of weights for the data; uses CARSMath's weighted polynomial 
-             fitting routine instead of numpy's standard polyfit.
+        w:   a set of weights for the data; residuals are then
+             measured in units of 1/sqrt(w), and 's' is an absolute
+             threshold on these.
 
         fev:  number of function evaluations to call before stopping
 
@@ -1193,13 +1122,11 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
         catchLinAlgError : bool
           If True, don't bomb on LinAlgError; instead, return [0, 0, ... 0].
 
-    :REQUIREMENTS:
-       :doc:`CARSMath`
-
     :NOTES:
        Iterates so long as n_newrejections>0 AND n_iter<fev. 
 
-
+       The fitting is done by :func:`linfit.polyclip`, which also fits
+       many vectors (e.g., light curves) sharing the same 'x' at once.
      """
     # 2008-10-01 13:01 IJC: Created & completed
     # 2009-10-01 10:23 IJC: 1 year later! Moved "import" statements within func.
@@ -1210,95 +1137,36 @@ def polyfitr(x, y, N, s, fev=100, w=None, diag=False, clip='both', \
     # 2012-08-27 10:44 IJMC: Verbose < 0 now resets to 0
     # 2013-05-21 23:15 IJMC: Added catchLinAlgError
 
-    from CARSMath import polyfitw
-    from numpy import polyfit, polyval, isfinite, ones
-    from numpy.linalg import LinAlgError
-    from pylab import plot, legend, title
+    from numpy import polyval
+    from xastropy.phot import linfit
 
     if verbose < 0:
         verbose = 0
 
-    xx = array(x, copy=False)
-    yy = array(y, copy=False)
-    noweights = (w==None)
-    if noweights:
-        ww = ones(xx.shape, float)
-    else:
-        ww = array(w, copy=False)
+    xx = np.asarray(x, dtype=float)
+    yy = np.asarray(y, dtype=float)
 
-    ii = 0
-    nrej = 1
-
-    if noweights:
-        goodind = isfinite(xx)*isfinite(yy)
-    else:
-        goodind = isfinite(xx)*isfinite(yy)*isfinite(ww)
-    
-    xx2 = xx[goodind]
-    yy2 = yy[goodind]
-    ww2 = ww[goodind]
-
-    while (ii<fev and (nrej<>0)):
-        if noweights:
-            p = polyfit(xx2,yy2,N)
-            residual = yy2 - polyval(p,xx2)
-            stdResidual = std(residual)
-            clipmetric = s * stdResidual
-        else:
-            if catchLinAlgError:
-                try:
-                    p = polyfitw(xx2,yy2, ww2, N)
-                except LinAlgError:
-                    p = np.zeros(N+1, dtype=float)
-            else:
-                p = polyfitw(xx2,yy2, ww2, N)
+    if plotfit or plotall:
+        from pylab import plot, legend, title
 
-            p = p[::-1]  # polyfitw uses reverse coefficient ordering
-            residual = (yy2 - polyval(p,xx2)) * np.sqrt(ww2)
-            clipmetric = s
-
-        if clip=='both':
-            worstOffender = abs(residual).max()
-            if worstOffender <= clipmetric or worstOffender < eps:
-                ind = ones(residual.shape, dtype=bool)
-            else:
-                ind = abs(residual) <= worstOffender
-        elif clip=='above':
-            worstOffender = residual.max()
-            if worstOffender <= clipmetric:
-                ind = ones(residual.shape, dtype=bool)
-            else:
-                ind = residual < worstOffender
-        elif clip=='below':
-            worstOffender = residual.min()
-            if worstOffender >= -clipmetric:
-                ind = ones(residual.shape, dtype=bool)
-            else:
-                ind = residual > worstOffender
-        else:
-            ind = ones(residual.shape, dtype=bool)
-    
-        xx2 = xx2[ind]
-        yy2 = yy2[ind]
-        if (not noweights):
-            ww2 = ww2[ind]
-        ii = ii + 1
-        nrej = len(residual) - len(xx2)
+    def report(niter, p, goodind):
         if plotall:
-            plot(x,y, '.', xx2,yy2, 'x', x, polyval(p, x), '--')
+            plot(x,y, '.', xx[goodind],yy[goodind], 'x', x, polyval(p, x), '--')
             legend(['data', 'fit data', 'fit'])
-            title('Iter. #' + str(ii) + ' -- Close all windows to continue....')
-
+            title('Iter. #' + str(niter) + ' -- Close all windows to continue....')
         if verbose:
-            print str(len(x)-len(xx2)) + ' points rejected on iteration #' + str(ii)
+            print str((~goodind).sum()) + ' points rejected on iteration #' + str(niter)
+
+    p, chisq, ii, goodind = linfit.polyclip(xx, yy, N, s, w=w, fev=fev, clip=clip, eps=eps, \
+                                                catchLinAlgError=catchLinAlgError, full=True, \
+                                                callback=(report if (verbose or plotall) else None))
 
     if (plotfit or plotall):
-        plot(x,y, '.', xx2,yy2, 'x', x, polyval(p, x), '--')
+        plot(x,y, '.', xx[goodind],yy[goodind], 'x', x, polyval(p, x), '--')
         legend(['data', 'fit data', 'fit'])
         title('Close window to continue....')
 
     if diag:
-        chisq = ( (residual)**2 / yy2 ).sum()
         p = (p, chisq, ii)
 
     return p
@@ -1329,7 +1197,7 @@ def spliner(x, y, k=3, sig=5, s=None, fev=100, w=None, clip='both', \
 
     xx = array(x, copy=True)
     yy = array(y, copy=True)
-    noweights = (w==None)
+    noweights = (w is None)
     if noweights:
         ww = ones(xx.shape, float)
     else:
@@ -1360,13 +1228,10 @@ def spliner(x, y, k=3, sig=5, s=None, fev=100, w=None, clip='both', \
         else:
             ind = ones(residual.shape, bool)
 
-        goodind *= ind
-        #xx = xx[ind]
-        #yy = yy[ind]
-        #ww = ww[ind]
+        nrej = (~ind).sum()
+        goodind[goodind] = ind
 
         ii += 1
-        nrej = len(residual) - len(xx)
         if plotall:
             plot(x,y, '.', xx[goodind],yy[goodind], 'x', x, spline(x), '--')
             legend(['data', 'fit data', 'fit'])
@@ -1381,7 +1246,9 @@ def spliner(x, y, k=3, sig=5, s=None, fev=100, w=None, clip='both', \
         title('Close window to continue....')
 
     if diag:
-        chisq = ( (residual)**2 / yy )[goodind].sum()
+        # goodind was updated after the last fit; use the same points for both
+        residual = yy[goodind] - spline(xx[goodind])
+        chisq = ( (residual)**2 / yy[goodind] ).sum()
         spline = (spline, chisq, ii, goodind)
 
     return spline
@@ -1684,7 +1551,8 @@ def removeoutliers(data, nsigma, remove='both', center='mean', niter=Inf, retind
                  method to compute it.
 
       niter -- number of iterations before exit; defaults to Inf,
-               which can occasionally result in empty arrays returned
+               which is capped at filters.MAXITER and can occasionally
+               result in empty arrays returned
 
       retind -- (bool) whether to return index of good values as
                 second part of a 2-tuple.
@@ -1706,53 +1574,11 @@ def removeoutliers(data, nsigma, remove='both', center='mean', niter=Inf, retind
     # 2009-10-01 10:40 IJC: Added check for stdev==0
     # 2009-12-08 15:42 IJC: Added check for isfinite
 
-    from numpy import median, ones, isfinite
-
-    def getcen(data, method):
-        "Get central value of a 1D array (helper function)"
-        if method.__class__==str:
-            if method=='median':
-                cen = median(data)
-            else:
-                cen = data.mean()
-        else:
-            cen = method
-        return cen
+    from xastropy.phot import filters
 
-    def getgoodindex(data, nsigma, center, stdev, remove):
-        "Get number of outliers (helper function!)"
-        if stdev==0:
-            distance = data*0.0
-        else:
-            distance = (data-center)/stdev
-        if remove=='min':
-            goodind = distance>-nsigma
-        elif remove=='max':
-            goodind = distance<nsigma
-        else:
-            goodind = abs(distance)<=nsigma
-        return goodind
-
-    data = data.ravel().copy()
-
-    ndat0 = len(data)
-    ndat = len(data)
-    iter=0
-    goodind = ones(data.shape,bool)
-    goodind *= isfinite(data)
-    while ((ndat0<>ndat) or (iter==0)) and (iter<niter) and (ndat>0) :
-        ndat0 = len(data[goodind])
-        cen = getcen(data[goodind], center)
-        stdev = data[goodind].std()
-        thisgoodind = getgoodindex(data[goodind], nsigma, cen, stdev, remove)
-        goodind[find(goodind)] = thisgoodind
-        if verbose:
-            print "cen>>",cen
-            print "std>>",stdev
-        ndat = len(data[goodind])
-        iter +=1
-        if verbose:
-            print ndat0, ndat
+    data = np.asarray(data).ravel()
+    goodind = filters.sigmaclip(data, nsigma, niter=niter, center=center, \
+                                    remove=remove, verbose=verbose)
     if retind:
         ret = data[goodind], goodind
     else:
@@ -1760,6 +1586,7 @@ def removeoutliers(data, nsigma, remove='both', center='mean', niter=Inf, retind
     return ret
         
 
+
 def xcorr2_qwik(img0, img1):
     """
     Perform quick 2D cross-correlation between two images.
@@ -1767,10 +1594,14 @@ def xcorr2_qwik(img0, img1):
     Images must be the same size.
 
     Computed via squashing the images along each dimension and
-    computing 1D cross-correlations.
+    computing 1D cross-correlations.  Returns the integer (column,
+    row) lags of img0 relative to img1.
+
+    :SEE_ALSO:
+      :mod:`xastropy.xutils.register`, for subpixel FFT registration
+      of full images, or of many frames against one reference.
     """
     # 2009-12-17 10:13 IJC: Created.  Based on idea by J. Johnson.
-    from numpy import zeros, max, min, sum
 
     im00 = img0.sum(0)
     im01 = img0.sum(1)
@@ -1778,26 +1609,10 @@ def xcorr2_qwik(img0, img1):
     im11 = img1.sum(1)
     n0 = len(im00)
     n1 = len(im01)
-    noffsets0 = 2*n0-1
-    noffsets1 = 2*n1-1
-    corr0 = zeros(noffsets0,float)
-    corr1 = zeros(noffsets1,float)
-
-    for ii in range(noffsets0):
-        firstind0 = max((ii-n0+1,0))
-        lastind0 = min((n0,  ii+1))
-        firstind1 = max((n0-ii-1,0))
-        lastind1 = min((2*n0-ii-1,n0))
-        corr0[ii] = sum(im00[firstind0:lastind0]*im10[firstind1:lastind1])
-
-    for jj in range(noffsets1):
-        firstind0 = max((jj-n0+1,0))
-        lastind0 = min((n0,  jj+1))
-        firstind1 = max((n0-jj-1,0))
-        lastind1 = min((2*n0-jj-1,n0))
-        corr1[jj] = sum(im01[firstind0:lastind0]*im11[firstind1:lastind1])
-
-    ret = find([corr0==corr0.max()])-n0+1, find([corr1==corr1.max()])-n0+1
+    corr0 = np.correlate(im00, im10, 'full')
+    corr1 = np.correlate(im01, im11, 'full')
+
+    ret = find([corr0==corr0.max()])-n0+1, find([corr1==corr1.max()])-n1+1
     return  ret
         
 def lsq(x, z, w=None, retcov=False):
@@ -1809,7 +1624,8 @@ def lsq(x, z, w=None, retcov=False):
         numpy.vstack of this tuple
 
       z : sequence
-        vector of length N; data to fit to.
+        vector of length N; data to fit to.  An NxK array fits K data
+        vectors at once (N-vector weights only).
 
       w : sequence
         Either an N-vector or NxN array of weights (e.g., 1./sigma_z**2)
@@ -1819,7 +1635,10 @@ def lsq(x, z, w=None, retcov=False):
 
 
     :RETURNS: 
-       the tuple of (coef, coeferrs, {cov_matrix})"""
+       the tuple of (coef, coeferrs, {cov_matrix})
+
+    :NOTES:
+       N-vector weights never form an NxN matrix; see :func:`linfit.wlsq`."""
     # 2010-01-13 18:36 IJC: Created
     # 2010-02-08 13:04 IJC: Works for lists or tuples of x
     # 2012-06-05 20:04 IJMC: Finessed the initial checking of 'x';
@@ -1830,21 +1649,21 @@ def lsq(x, z, w=None, retcov=False):
 #    from numpy.linalg import pinv
 
 
+    from xastropy.phot import linfit
+
     if isinstance(x,tuple) or isinstance(x,list):
         Xmat = np.vstack(x).transpose()
     elif isinstance(x, np.ndarray) and x.ndim < 2:
         Xmat = x.reshape(len(x),1)
     else:
-        Xmat = np.array(x, copy=False)
+        Xmat = np.asarray(x)
 
-    z = np.array(z, copy=False)
+    z = np.asarray(z)
 
-    if w==None:
-        w = np.diag(np.ones(Xmat.shape[0],float))
-    else:
-        w = np.array(w,copy=True)
-        if w.ndim < 2:
-            w = np.diag(w)
+    if w is not None:
+        w = np.asarray(w)
+    if w is None or w.ndim < 2:
+        return linfit.wlsq(Xmat, z, w, retcov=retcov)
 
     goodind = np.isfinite(Xmat.sum(1))*np.isfinite(z)*np.isfinite(np.diag(w))
     Wmat = w[goodind][:,goodind]
@@ -1875,8 +1694,8 @@ def lsqsp(x, z, w=None, retcov=False):
       w : sequence (shape N) or sparse matrix (shape N x N)
         Data weights and/or inverse covariances (e.g., 1./sigma_z**2)
 
-      #retcov : bool.  
-      #  If True, also return covariance matrix.
+      retcov : bool.  
+        If True, also return covariance matrix.
 
     :RETURNS: 
        the tuple of (coef, coeferrs, {cov_matrix})
@@ -1890,28 +1709,34 @@ def lsqsp(x, z, w=None, retcov=False):
     # 2012-09-17 14:57 IJMC: Created from lsq
 
     from scipy import sparse
+    from scipy.linalg import cho_factor, cho_solve
 
     
     M, N = x.shape
-    #x2 = sparse.dia_matrix(x)
-    #pdb.set_trace()
-    if w==None:
-        w = sparse.dia_matrix((1./np.ones(M), 0), shape=(M, M))
+    x = sparse.csr_matrix(x)
+    if w is None:
+        w = np.ones(M)
     if max(w.shape)==np.prod(w.shape): # w is 1D:
-        w = sparse.dia_matrix((w, 0), shape=(M, M))
+        if sparse.issparse(w):
+            w = w.toarray()
+        w = sparse.dia_matrix((np.asarray(w, dtype=float).ravel(), 0), shape=(M, M))
 
-    z = sparse.csr_matrix(z)
-    if z.shape[0]==1:
-        z = z.transpose()
+    if sparse.issparse(z):
+        z = z.toarray()
+    z = np.asarray(z, dtype=float).ravel()
     w = sparse.csr_matrix(w)
 
-
-    XtW = np.dot(x.transpose(), w)
-    pinv0 = sparse.csr_matrix(np.linalg.pinv(np.dot(XtW, x).todense()))
-    fitcoef = np.array(np.dot(np.dot(pinv0, XtW), z).todense()).squeeze()
-    
-    covmat = np.linalg.pinv(np.dot(XtW, x).todense())
-    efitcoef = np.sqrt(covmat)
+    XtW = x.transpose().dot(w)
+    XtWX = np.asarray(XtW.dot(x).todense())
+    XtWz = XtW.dot(z)
+    try:
+        cfac = cho_factor(XtWX)
+        fitcoef = cho_solve(cfac, XtWz)
+        covmat = cho_solve(cfac, np.eye(N))
+    except np.linalg.LinAlgError:
+        covmat = np.linalg.pinv(XtWX)
+        fitcoef = np.dot(covmat, XtWz)
+    efitcoef = np.sqrt(np.diag(covmat))
 
     if retcov:
         return fitcoef, efitcoef, covmat
@@ -1920,171 +1745,58 @@ def lsqsp(x, z, w=None, retcov=False):
 
 
 def medianfilter(data, filtersize, threshold=None,verbose=False):
-    """ For now, we assume FILTERSIZE is odd, and that DATA is square!
+    """ Median-filter a 2D array, optionally replacing only outliers.
     
     filt = medianfilter(data, filtersize)
-    
-    This is about the slowest way to do it, but it was easy to write.
-    """
-    # 2006/02/01 IJC at the Jet Propulsion Laboratory
-    # 2010-02-18 13:52 IJC: Converted to python
-    from numpy import zeros, median, abs, std
-
-    print "Just use scipy.signal.medfilt !!!"
-    print "Just use scipy.signal.medfilt !!!"
-    print "Just use scipy.signal.medfilt !!!"
-
-    if len(filtersize)<1:
-        print 'medianfilter2 requires that filtersize be a 1- or 2-element vector'
-        return -1
-    elif len(filtersize)==1:
-        filtersize = [filtersize[0], filtersize[0]]
-    else:
-        filtersize = filtersize[0:2]
-
-    npix = data.shape[0]
-    npiy = data.shape[1]
-    bigsize = npix+2*(filtersize[0]-1)
-    bigdata = zeros((bigsize,bigsize),float)
-    ind = filtersize[0]-1
-    if ind==0:
-        bigdata = data
-    else:
-        bigdata[ind:(bigsize-ind), ind:(bigsize-ind)] = data
 
+    :INPUTS:
+       data -- 2D NumPy array (need not be square).  NaNs are ignored.
 
-    # FOR NOW, WE ASSUME FILTERSIZE IS ODD!!
-    # AND THAT DATA IS SQUARE!
-    niter_x = npix + (filtersize[0]-1)
-    niter_y = npiy + (filtersize[1]-1)
-    filt = zeros((niter_x,niter_y), float)
+       filtersize -- int, or 1- or 2-sequence.  Size of the filter window.
 
-    for ii in range(niter_x):
-        for jj in range(niter_y):
-            if verbose>1:
-                print "ii,jj>>",ii,jj
-            if filtersize[0]==1:
-                indi = 1
-            else:
-                indi = filtersize[0]-1
-            if filtersize[1]==1:
-                indj = 1
-            else:
-                indj = filtersize[1]-1
-            select = bigdata[ii:(ii+indi),jj:(jj+indj)].ravel()
-            select = select[isfinite(select)]
-            #residualSelection = abs(select - median(select))
-
-            if verbose: 
-                print "select.shape>>",select.shape
-                print "threshold>>",threshold
-
-            if threshold is not None:
-                if threshold >= 0: # raw threshold
-                    doFilter = abs(bigdata[ii,jj]-median(select))/std(select)>=threshold
-                elif threshold<0:  # remove outliers before applying threshold
-                    npts_init = len(select)
-                    select = removeoutliers(select, abs(threshold), center='median')
-                    npts_final = len(select)
-                    if verbose>1:
-                        print "threshold=",threshold,", removed %i points" % (npts_init-npts_final)
-                    
-                    doFilter = abs(bigdata[ii,jj]-median(select))/std(select)>=threshold                    
-            else:  # filter everything; threshold not set.
-                doFilter = True
-
-            if verbose:
-                print "doFilter?>>",doFilter
-            if verbose>1:
-                print "select>>",select
-
-            if doFilter: 
-                newval =  median( select )
-            else:
-                newval = bigdata[ii,jj]
+    :OPTIONAL_INPUTS:
+       threshold -- None or scalar.  If set, only replace pixels whose
+                    deviation from the local median exceeds
+                    'threshold' local standard deviations.  If
+                    negative, these local statistics are first
+                    computed with outliers removed.
 
-            if verbose>1:
-                print "newval>>",newval
+    :SEE_ALSO:
+       :func:`filters.replace_outliers2d`, which does the work here.
+    """
+    # 2006/02/01 IJC at the Jet Propulsion Laboratory
+    # 2010-02-18 13:52 IJC: Converted to python
+    from xastropy.phot import filters
 
-            filt[ii,jj] = newval
+    if verbose:
+        print "Median-filtering %s array with window %s" % (np.shape(data), filtersize)
 
-    print filt.shape, [(filtersize[0]-1)/2,niter_x-(filtersize[0]-1)/2,(filtersize[0]-1)/2,niter_y-(filtersize[0]-1)/2]
-    return filt[(filtersize[0]-1)/2:niter_x-(filtersize[0]-1)/2,(filtersize[0]-1)/2:niter_y-(filtersize[0]-1)/2]
+    return filters.replace_outliers2d(data, filtersize, threshold=threshold)
 
 def stdfilt2d(data, filtersize, threshold=None,verbose=False):
-    """ For now, we assume FILTERSIZE is odd, and that DATA is square!
+    """ Compute the standard deviation of a 2D array in a sliding window.
     
     filt = stdfilt2d(data, filtersize)
-    
-    This is about the slowest way to do it, but it was easy to write.
-    """
-    # 2012-08-07 13:42 IJMC: Created from medianfilter
-    from numpy import zeros, median, abs, std, isfinite
-
-    if not hasattr(filtersize, '__iter__'):
-        filtersize = [filtersize]
-
-    if len(filtersize)<1:
-        print 'medianfilter2 requires that filtersize be a 1- or 2-element vector'
-        return -1
-    elif len(filtersize)==1:
-        filtersize = [filtersize[0], filtersize[0]]
-    else:
-        filtersize = filtersize[0:2]
-
-    npix = data.shape[0]
-    npiy = data.shape[1]
-    bigsize_x = npix+2*(filtersize[0]-1)
-    bigsize_y = npiy+2*(filtersize[1]-1)
-    bigdata = zeros((bigsize_x,bigsize_y),float)
-    ind = filtersize[0]-1
-    if ind==0:
-        bigdata = data
-    else:
-        bigdata[ind:(bigsize_x-ind), ind:(bigsize_y-ind)] = data
-
-
-    # FOR NOW, WE ASSUME FILTERSIZE IS ODD!!
-    # AND THAT DATA IS SQUARE!
-    niter_x = npix + (filtersize[0]-1)
-    niter_y = npiy + (filtersize[1]-1)
-    filt = zeros((niter_x,niter_y), float)
 
-    for ii in range(niter_x):
-        for jj in range(niter_y):
-            if verbose>1:
-                print "ii,jj>>",ii,jj
-            if filtersize[0]==1:
-                indi = 1
-            else:
-                indi = filtersize[0]-1
-            if filtersize[1]==1:
-                indj = 1
-            else:
-                indj = filtersize[1]-1
-            select = bigdata[ii:(ii+indi),jj:(jj+indj)].ravel()
-            #select = select[isfinite(select)]
-            #residualSelection = abs(select - median(select))
-
-            doFilter = True
+    :INPUTS:
+       data -- 2D NumPy array (need not be square).  NaNs are ignored.
 
-            if verbose:
-                print "doFilter?>>",doFilter
-            if verbose>1:
-                print "select>>",select
+       filtersize -- int, or 1- or 2-sequence.  Size of the filter window.
 
-            if doFilter: 
-                newval =  ( select ).std()
-            else:
-                newval = bigdata[ii,jj]
+    :NOTES:
+       'threshold' is accepted for symmetry with :func:`medianfilter`,
+       but unused.
 
-            if verbose>1:
-                print "newval>>",newval
+    :SEE_ALSO:
+       :func:`filters.std2d`, which does the work here.
+    """
+    # 2012-08-07 13:42 IJMC: Created from medianfilter
+    from xastropy.phot import filters
 
-            filt[ii,jj] = newval
+    if verbose:
+        print "Std-filtering %s array with window %s" % (np.shape(data), filtersize)
 
-    #print filt.shape, [(filtersize[0]-1)/2,niter_x-(filtersize[0]-1)/2,(filtersize[0]-1)/2,niter_y-(filtersize[0]-1)/2]
-    return filt[(filtersize[0]-1)/2:niter_x-(filtersize[0]-1)/2,(filtersize[0]-1)/2:niter_y-(filtersize[0]-1)/2]
+    return filters.std2d(data, filtersize)
 
 
 def wmean(a, w, axis=None, reterr=False):
@@ -2110,27 +1822,13 @@ def wmean(a, w, axis=None, reterr=False):
     # 2012-02-28 20:31 IJMC: Added a bit of documentation
     # 2012-03-07 10:58 IJMC: Added reterr option
 
-    newdata    = array(a, subok=True, copy=True)
-    newweights = array(w, subok=True, copy=True)
-
-    if axis==None:
-        newdata    = newdata.ravel()
-        newweights = newweights.ravel()
-        axis = 0
-
-    ash  = list(newdata.shape)
-    wsh  = list(newweights.shape)
-
-    nsh = list(ash)
-    nsh[axis] = 1
-
-    if ash<>wsh:
-        warn('Data and weight must be arrays of same shape.')
+    newdata, newweights, axis, nsh = _wprep(a, w, axis)
+    if newdata is None:
         return []
     
     wsum = newweights.sum(axis=axis).reshape(nsh) 
     
-    weightedmean = (a * newweights).sum(axis=axis).reshape(nsh) / wsum
+    weightedmean = (newdata * newweights).sum(axis=axis).reshape(nsh) / wsum
     if reterr:
         # Biased estimator:
         #e_weightedmean = sqrt((newweights * (a - weightedmean)**2).sum(axis=axis) / wsum)
@@ -2139,7 +1837,7 @@ def wmean(a, w, axis=None, reterr=False):
         #e_weightedmean = sqrt((wsum / (wsum**2 - (newweights**2).sum(axis=axis))) * (newweights * (a - weightedmean)**2).sum(axis=axis))
         
         # Standard estimator:
-        e_weightedmean = np.sqrt(1./newweights.sum(axis=axis))
+        e_weightedmean = np.sqrt(1./np.squeeze(wsum, axis=axis))
 
         ret = weightedmean, e_weightedmean
     else:
@@ -2148,6 +1846,28 @@ def wmean(a, w, axis=None, reterr=False):
     return ret
 
 
+def _wprep(a, w, axis):
+    """Views of data and weights for :func:`wmean` and :func:`wstd`.
+
+    Returns (data, weights, axis, reduced_shape), or Nones if the
+    shapes differ."""
+    newdata    = np.asanyarray(a)
+    newweights = np.asanyarray(w)
+
+    if axis is None:
+        newdata    = newdata.ravel()
+        newweights = newweights.ravel()
+        axis = 0
+
+    if newdata.shape<>newweights.shape:
+        warn('Data and weight must be arrays of same shape.')
+        return None, None, axis, None
+
+    nsh = list(newdata.shape)
+    nsh[axis] = 1
+    return newdata, newweights, axis, nsh
+
+
 def wstd(a, w, axis=None):
     """wstd(a, w, axis=None)
 
@@ -2167,28 +1887,15 @@ def wstd(a, w, axis=None):
 # 2008-07-30 12:44 IJC: Created this from 
 
 
-    newdata    = array(a, subok=True, copy=True)
-    newweights = array(w, subok=True, copy=True)
-
-    if axis==None:
-        newdata    = newdata.ravel()
-        newweights = newweights.ravel()
-        axis = 0
-
-    ash  = list(newdata.shape)
-    wsh  = list(newweights.shape)
-
-    nsh = list(ash)
-    nsh[axis] = 1
-
-    if ash<>wsh:
-        warn('Data and weight must be arrays of same shape.')
+    newdata, newweights, axis, nsh = _wprep(a, w, axis)
+    if newdata is None:
         return []
     
     wsum = newweights.sum(axis=axis).reshape(nsh) 
     omega = 1.0 * wsum / (wsum**2 - (newweights**2).sum(axis=axis).reshape(nsh))
     
-    weightedstd = omega * (newweights * (newdata-wmean(newdata, newweights, axis=axis))**2 ).sum(axis=axis).reshape(nsh)
+    weightedmean = (newdata * newweights).sum(axis=axis).reshape(nsh) / wsum
+    weightedstd = omega * (newweights * (newdata-weightedmean)**2 ).sum(axis=axis).reshape(nsh)
 
     return sqrt(weightedstd)
 
@@ -2655,22 +2362,18 @@ def gaussian2d(p, x, y):
         y : NumPy array
           Y-coordinate values at which the above relation will be computed.
 
+    :NOTES:
+      'p' may also be an (N, 4 or 5) array, to compute N gaussians at
+      once; see :mod:`profiles`, which also provides the Jacobian
+      (:func:`profiles.gaussian2d_jac`) and batch fitting.
+
     :SEE_ALSO:
       :func:`gaussian` (1D)
         """
     #2010-06-08 20:00 IJC: Created
     #2013-04-19 23:49 IJMC: Improved documentation, per BACM's request.
-    
-    x = array(x, dtype=float).copy()
-    y = array(y, dtype=float).copy()
-    p = array(p).copy()
-
-    if len(p)==4:
-        p = concatenate((p, [0]))
-
-    z = p[4] + p[0]/(2*pi*p[1]**2) * exp(-((x-p[2])**2 + (y-p[3])**2) / (2*p[1]**2))
-    
-    return z
+    from xastropy.phot import profiles
+    return profiles.gaussian2d(p, x, y)
 
 def gaussiannd(mu, cov, x):
     """ Compute an N-dimensional gaussian distribution at the position x.
@@ -2680,48 +2383,17 @@ def gaussiannd(mu, cov, x):
         cov is the NxN covariance matrix of the multinormal distribution.  
 
         x are the positions at which to compute.  If X is 2D (size M x
-          N), it is taken as M sets of N-point positions.
+          N), it is taken as M sets of N-point positions, and M values
+          are returned.
 
-        SEE ALSO:  :func:`gaussian`, :func:`gaussian2d`
+        SEE ALSO:  :func:`gaussian`, :func:`gaussian2d`, :func:`profiles.gaussiannd`
         """
     #2012-05-08 11:36 IJMC: Created
-    
-    x = np.array(x, dtype=float, copy=False)
-    mu = np.array(mu, dtype=float, copy=False)
-    cov = np.array(cov, dtype=float, copy=True)
-    
-    if x.ndim==1:
-        nx = x.size
-        niter = 0
-    elif x.ndim==2:
-        niter, nx = x.shape
-        
-    if cov.size==1:
-        cov = cov.reshape((1,1))
-
-    # Test if cov is square:
-
-    # invert
-    invcov = np.linalg.inv(cov)
-
-    # Compute mean vector:
-    if niter==0:
-        xmu = (x - mu).reshape(nx, 1)
-        term1 = ((2*np.pi)**(nx/2.) * np.sqrt(np.linalg.det(cov)))
-        term2 = np.exp(-0.5 * np.dot(xmu.transpose(), np.dot(invcov, xmu)))
-        ret = term2 / term1
-    else:
-        for ii in range(niter):
-            xmu = (x[ii] - mu).reshape(nx, 1)
-            term1 = ((2*np.pi)**(nx/2.) * np.sqrt(np.linalg.det(cov)))
-            term2 = np.exp(-0.5 * np.dot(xmu.transpose(), np.dot(invcov, xmu)))
-            ret[ii] = term2 / term1
-            
-
-    ret = np.zeros(nx, dtype=float)
-
-
-    return term2 / term1
+    from xastropy.phot import profiles
+    ret = profiles.gaussiannd(mu, cov, x)
+    if np.ndim(ret)==0:
+        ret = ret.reshape(1, 1)
+    return ret
 
 
 def gaussian2d_ellip(p, x, y):
@@ -2755,25 +2427,15 @@ def gaussian2d_ellip(p, x, y):
 
           z =  p[6] + p0/(2*pi*p1*p2) * exp(-U / 2)
 
-        SEE ALSO:  :func:`gaussian2d`, :func:`lorentzian2d`
+        'p' may also be an (N, 5-7) array, to compute N gaussians at
+        once; see :mod:`profiles`.
+
+        SEE ALSO:  :func:`gaussian2d`, :func:`lorentzian2d`,
+                   :func:`profiles.gaussian2d_ellip_jac`
         """
     #2012-02-11 18:06 IJMC: Created from IDL GAUSS2DFIT
-    
-    x = array(x, dtype=float).copy()
-    y = array(y, dtype=float).copy()
-    p = array(p).copy()
-
-    if len(p)==5:
-        p = concatenate((p, [0, 0]))
-    elif len(p)==6:
-        p = concatenate((p, [0]))
-
-    xp = (x - p[3]) * np.cos(p[5]) - (y - p[4]) * np.sin(p[5])
-    yp = (x - p[3]) * np.sin(p[5]) + (y - p[4]) * np.cos(p[5])
-
-    z = p[6] + p[0]/(2*pi*p[1]*p[2]) * exp(-0.5 * ((xp / p[1])**2 + (yp / p[2])**2))
-    
-    return z
+    from xastropy.phot import profiles
+    return profiles.gaussian2d_ellip(p, x, y)
 
 def lorentzian2d(p, x, y):
     """ Compute a 2D Lorentzian distribution at the points x, y.
@@ -2791,32 +2453,27 @@ def lorentzian2d(p, x, y):
         p[5] -- optional ellipticitity parameter
         p[6] -- optional constant, vertical offset
 
-        SEE ALSO:  :func:`gaussian2d`
+        'p' may also be an (N, 5-7) array, to compute N profiles at
+        once; see :mod:`profiles`.
+
+        SEE ALSO:  :func:`gaussian2d`, :func:`profiles.lorentzian2d_jac`
         """
     #2012-02-04 11:38 IJMC: Created
-    
-    x = array(x, dtype=float).copy()
-    y = array(y, dtype=float).copy()
-    p = array(p).copy()
-
-    if len(p)==5:
-        p = concatenate((p, [0, 0]))
-    elif len(p)==6:
-        p = concatenate((p, [0]))
-
-    z = ((x - p[3]) / p[1])**2 + ((y - p[4]) / p[2])**2 + p[5] * (x - p[3]) * (y - p[4])
-    
-    return p[6] + p[0]/(1. + z)
+    from xastropy.phot import profiles
+    return profiles.lorentzian2d(p, x, y)
 
 def egaussian2d(p,x,y,z,w=None):
     """ Return the error associated with a 2D gaussian fit, using gaussian2d.
 
-    w is an array of weights, typically 1./sigma**2"""
+    w is an array of weights, typically 1./sigma**2
+
+    For a gradient-based fit, see :func:`profiles.chisq` and
+    :func:`profiles.gradchisq`."""
     # 2010-06-08 20:02 IJC: Created
     from numpy import ones, array
-    x = array(x, dtype=float).copy()
+    z = array(z, dtype=float)
     if w is None:
-        w = ones(w.shape,float)
+        w = ones(z.shape,float)
     z0 = gaussian2d(p,x,y)
     return (((z-z0)*w)**2).sum()
 
@@ -3121,13 +2778,88 @@ def allanvariance(data, dt=1):
 
     return (alvar*0.5)
     
-def trueanomaly(ecc, eanom=None, manom=None):
+def solvekepler(manom, ecc, tol=1e-8, maxiter=30, method='halley'):
+    """Solve Kepler's equation, M = E - e sin(E), for whole arrays at once.
+
+    :INPUTS:
+       manom -- scalar or NumPy array.  Mean anomaly, equal to 
+                2*pi*(t - t0)/period
+
+       ecc -- scalar or NumPy array.  Orbital eccentricity, 0 <= e <= 1.
+              Must be broadcastable against `manom`.
+
+    :OPTIONAL_INPUTS:
+       tol -- scalar.  Convergence tolerance on the eccentric anomaly.
+
+       maxiter -- int.  Maximum number of iterations.
+
+       method -- str.  'halley' (default) or 'newton'; both start from
+                 Markley's (1995) cubic approximation.
+
+    :OUTPUT:
+       Eccentric anomaly, with the same shape as the broadcast inputs.
+       Whole orbits are retained, so E - e sin(E) = M holds for any M.
+
+    :EXAMPLE:
+       ::
+
+           import ian_analysis as an
+           manom = np.linspace(0, 20*np.pi, 100000)
+           eanom = an.solvekepler(manom, 0.3)
+
+    :SEE_ALSO: 
+       :func:`eccentricanomaly`, :func:`trueanomaly`, :func:`rv`
+    """
+    if method not in ('halley', 'newton'):
+        raise ValueError("method must be 'halley' or 'newton'")
+
+    manom = np.asarray(manom, dtype=float)
+    ecc = np.asarray(ecc, dtype=float)
+    scalarinput = (manom.ndim==0) and (ecc.ndim==0)
+    manom, ecc = np.broadcast_arrays(np.atleast_1d(manom), np.atleast_1d(ecc))
+
+    # Reduce mean anomaly to [-pi, pi), keeping track of whole orbits:
+    mred = np.mod(manom + np.pi, 2*np.pi) - np.pi
+    morb = manom - mred
+
+    # Markley's starter is good to ~1e-4 rad over the whole (M, e) plane:
+    absm = np.abs(mred)
+    alpha = (3.*np.pi**2 + 1.6*np.pi*(np.pi - absm)/(1. + ecc)) / (np.pi**2 - 6.)
+    d = 3.*(1. - ecc) + alpha*ecc
+    q = 2.*alpha*d*(1. - ecc) - mred**2
+    r = 3.*alpha*d*(d - 1. + ecc)*mred + mred**3
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = (np.abs(r) + np.sqrt(q**3 + r**2))**(2./3.)
+        eanom = (2.*r*w / (w**2 + w*q + q**2) + mred) / d
+    eanom = np.where(np.isfinite(eanom), eanom, mred)
+
+    for ii in range(maxiter):
+        esin = ecc*np.sin(eanom)
+        fp = 1. - ecc*np.cos(eanom)
+        f = eanom - esin - mred
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if method=='halley':
+                delta = f / (fp - 0.5*f*esin/fp)
+            else:
+                delta = f / fp
+        delta[fp==0] = 0.   # only at e=1, E=0, which is already exact
+        eanom -= delta
+        if (np.abs(delta) <= tol).all():
+            break
+
+    eanom += morb
+    if scalarinput:
+        eanom = eanom[0]
+
+    return eanom
+
+def trueanomaly(ecc, eanom=None, manom=None, tol=1e-8):
     """Calculate (Keplerian, orbital) true anomaly.
 
     One optional input must be given.
 
     :INPUT:
-       ecc -- scalar.  orbital eccentricity.
+       ecc -- scalar or Numpy array.  orbital eccentricity.
 
     :OPTIONAL_INPUTS:
        eanom -- scalar or Numpy array.  Eccentric anomaly.  See
@@ -3135,11 +2867,13 @@ def trueanomaly(ecc, eanom=None, manom=None):
 
        manom -- scalar or sequence.  Mean anomaly, equal to 
                 2*pi*(t - t0)/period
+
+       tol -- scalar.  Tolerance passed to :func:`solvekepler`.
     """
     # 2011-04-22 14:35 IJC: Created
 
     if manom is not None:
-        eanom = eccentricanomaly(ecc, manom=manom)
+        eanom = eccentricanomaly(ecc, manom=manom, tol=tol)
 
     if eanom is not None:
         ret = 2. * np.arctan(  np.sqrt((1+ecc)/(1.-ecc)) * np.tan(eanom/2.)  )
@@ -3154,36 +2888,22 @@ def eccentricanomaly(ecc, manom=None, tanom=None, tol=1e-8):
     One optional input must be given.
 
     :INPUT:
-       ecc -- scalar.  orbital eccentricity.
+       ecc -- scalar or Numpy array.  orbital eccentricity.
 
     :OPTIONAL_INPUTS:
 
        manom -- scalar or sequence.  Mean anomaly, equal to 
-                2*pi*(t - t0)/period
+                2*pi*(t - t0)/period.  Solved for all elements at
+                once by :func:`solvekepler`.
 
        tanom -- scalar or Numpy array.  True anomaly.  See
                :func:`trueanomaly`.
     """
     # 2011-04-22 14:35 IJC: Created
 
-    
-
     ret = None
     if manom is not None:
-        if not hasattr(manom, '__iter__'):
-            mwasscalar = True
-            manom = [manom]
-        else:
-            mwasscalar = False
-        # Solve Kepler's equation for each element of mean anomaly:
-        e = np.zeros(len(manom)) # Initialize eccentric anomaly
-        for ii,element in enumerate(manom):
-            def kep(e): return element - e + ecc*sin(e)
-            e[ii] = optimize.newton(kep, 0., tol=tol)
-
-        if mwasscalar:
-            e = e[0]
-        ret = e
+        ret = solvekepler(manom, ecc, tol=tol)
     
     elif tanom is not None:
         ret = 2. * np.arctan(np.tan(0.5 * tanom) / \
@@ -3420,7 +3140,7 @@ def generic_mcmc(*arg, **kw):
 
     :NOTES:
         If you need an efficient MCMC algorithm, you should be using
-        http://danfm.ca/emcee/
+        http://danfm.ca/emcee/ or :func:`ensemble_mcmc`
 
     """
     # 2011-06-07 07:50 IJMC: Created from various other MCMC codes,
@@ -3596,6 +3316,331 @@ def generic_mcmc(*arg, **kw):
 
 
 
+def ensemble_mcmc(*arg, **kw):
+    """Run many Metropolis-Hastings chains in lock-step, with optional
+    parallel tempering and an adaptive proposal covariance.
+
+    Takes the same inputs as :func:`generic_mcmc`, but evolves
+    'nchains' walkers at each of several temperatures simultaneously,
+    so that the model can be evaluated for all walkers in a single
+    call (see 'vectorized') or fanned out over a process pool (see
+    'threads').
+
+    :INPUTS:
+       Same as for :func:`generic_mcmc`: either
+       (func, params, stepsize, z, sigma, numit) or (allparams, (arg1,
+       arg2, ...), numit).
+
+    :OPTIONAL_INPUTS:    
+        args, nstep, posdef, holdfixed, jointpars, verbose : 
+                Same as for :func:`generic_mcmc`.
+
+        nchains : int
+                Number of walkers at each temperature.
+
+        temps : None, or 1D sequence
+                Temperature ladder for parallel tempering; temps[0]
+                must be 1.  The tempered chains sample chisq/T, and
+                only the T=1 chains are returned.  If None, use only
+                T=1.
+
+        swapevery : int
+                Propose swaps between adjacent temperatures every
+                'swapevery' steps.
+
+        adapt : bool
+                If True, periodically reset the proposal covariance to
+                (2.38^2/nfree) times the sample covariance of the T=1
+                chains over the preceding 'adaptevery' steps (cf. Haario
+                et al. 2001).  This replaces trial runs
+                with :func:`scale_mcmc_stepsize`.
+
+        nadapt : int
+                Adapt only during the first 'nadapt' steps (default:
+                numit/2), so the rest of the chain is Markovian.
+
+        adaptevery : int
+                Number of steps between covariance updates.
+
+        vectorized : bool
+                If True, each 'func' takes a 2D array of parameters,
+                one row per walker, and returns the models stacked
+                along the first axis.
+
+        threads : int
+                If not 'vectorized', evaluate the walkers via a
+                multiprocessing.Pool with this many processes.  The
+                model function(s) and data are sent to each process
+                once; each step then sends one block of walkers per
+                process.  The model function(s) must be picklable.
+
+        retcov : bool
+                If True, also return the final proposal covariance.
+
+    :OUTPUTS:
+        allparams : 3D array
+                Parameters of each T=1 chain at each saved step, of
+                shape (nchains, nparams, numit/nstep)
+        bestp : 1D array
+                Contains best paramters as determined by lowest Chi^2
+        numaccept : 1D array
+                Number of accepted steps in each T=1 chain
+        chisq : 2D array
+                Chi-squared value of each T=1 chain at each saved step
+        stepsize : 2D array
+                Final proposal covariance (only if 'retcov')
+
+    :EXAMPLE:
+       ::
+
+           def line(p, x):
+               p = np.atleast_2d(p)
+               return p[:,0:1] + p[:,1:2] * x
+
+           x = np.arange(100.)
+           y = 1. + 0.5*x + np.random.normal(size=x.size)
+           out = ensemble_mcmc(line, [0., 0.], [0.1, 0.01], y, np.ones(x.size), 
+                               2000, args=(x,), vectorized=True, 
+                               temps=[1., 2., 4.])
+    
+    :REFERENCES:
+        Haario, Saksman & Tamminen 2001, Bernoulli, 7, 223.
+        Earl & Deem 2005, PCCP, 7, 3910.
+
+    :SEE_ALSO:
+       :func:`generic_mcmc`, :func:`scale_mcmc_stepsize`
+    """
+    from multiprocessing import Pool
+
+    # Parse keywords/optional inputs:
+    defaults = dict(args=(), nstep=1, posdef=None, holdfixed=None, \
+                        jointpars=None, verbose=False, nchains=8, \
+                        temps=None, swapevery=1, adapt=True, nadapt=None, \
+                        adaptevery=100, vectorized=False, threads=None, \
+                        retcov=False)
+    for key in defaults:
+        if key not in kw:
+            kw[key] = defaults[key]
+
+    args = kw['args']
+    nstep = kw['nstep']
+    verbose = kw['verbose']
+    nchains = int(kw['nchains'])
+    vectorized = kw['vectorized']
+
+    # Parse inputs into a list of (func, z, weights, args, i0, i1):
+    if len(arg)==6:
+        func, params, stepsize, z, sigma, numit = arg
+        params = np.array(params, dtype=float, copy=True)
+        fits = [(func, z, 1./np.asarray(sigma)**2, args, 0, params.size)]
+        stepsizes = [np.array(stepsize, dtype=float, copy=True)]
+    elif len(arg)==3:
+        params, allargs, numit = arg[0:3]
+        params = np.array(params, dtype=float, copy=True)
+        fits = []
+        stepsizes = []
+        i0 = 0
+        for ii, these_args in enumerate(allargs):
+            stepsizes.append(np.array(these_args[1], dtype=float, copy=True))
+            i1 = i0 + stepsizes[-1].shape[0]
+            fits.append((these_args[0], these_args[2], \
+                             1./np.asarray(these_args[3])**2, args[ii], i0, i1))
+            i0 = i1
+    else:
+        print "Must pass either 3 or 6 parameters as input."
+        print "You passed %i." % len(arg)
+        return -1
+
+    # Assemble the (block-diagonal) proposal covariance:
+    npar = params.size
+    stepcov = np.zeros((npar, npar), dtype=float)
+    for fit, step in zip(fits, stepsizes):
+        i0, i1 = fit[4:6]
+        if step.ndim==1:
+            stepcov[i0:i1, i0:i1] = np.diag(step**2)
+        else:
+            stepcov[i0:i1, i0:i1] = step
+
+    if kw['temps'] is None:
+        temps = np.ones(1)
+    else:
+        temps = np.array(kw['temps'], dtype=float)
+    ntemps = temps.size
+    betas = 1. / temps
+    nwalk = ntemps * nchains
+
+    numit = int(numit)
+    nout = (numit + nstep - 1) // nstep
+    nadapt = numit // 2 if kw['nadapt'] is None else int(kw['nadapt'])
+    adaptevery = int(kw['adaptevery'])
+
+    # Parameter constraints, as in generic_mcmc:
+    original_params = np.copy(params)
+    posdef = kw['posdef']
+    if posdef=='all':
+        posdef = np.arange(npar)
+    elif posdef is not None:
+        posdef = np.array(posdef)
+    else:
+        posdef = np.zeros(npar, dtype=bool)
+
+    holdfixed = kw['holdfixed']
+    if holdfixed is not None:
+        holdfixed = np.array(holdfixed)
+    else:
+        holdfixed = np.zeros(npar, dtype=bool)
+
+    jointpars = kw['jointpars']
+    nfree = npar - original_params[holdfixed].size
+    if jointpars is not None:
+        nfree -= len(jointpars)
+
+    def constrain(p):
+        p[..., posdef] = np.abs(p[..., posdef])
+        p[..., holdfixed] = original_params[holdfixed]
+        if jointpars is not None:
+            for jp in jointpars:
+                p[..., jp[1]] = p[..., jp[0]]
+        return p
+
+    if kw['threads'] is not None and not vectorized:
+        # The data go to each worker once; each step then only sends
+        # one block of walker parameters per worker.
+        pool = Pool(processes=kw['threads'], initializer=_mcmc_initializer, \
+                        initargs=(fits,))
+        nblocks = int(kw['threads'])
+    else:
+        pool = None
+
+    def getchisq(p):
+        if vectorized:
+            chisq = np.zeros(p.shape[0], dtype=float)
+            for func, z, weights, these_args, i0, i1 in fits:
+                resid = ((func(p[:, i0:i1], *these_args) - z)**2) * weights
+                chisq += resid.reshape(p.shape[0], -1).sum(1)
+        elif pool is not None:
+            blocks = np.array_split(p, min(nblocks, p.shape[0]))
+            chisq = np.concatenate(pool.map(mcmc_blockfunction, blocks))
+        else:
+            chisq = np.array([mcmc_helperfunction((pp, fits)) for pp in p])
+        chisq[np.isnan(chisq)] = np.inf
+        return chisq
+
+    def sqrtcov(cov):
+        evals, evecs = np.linalg.eigh(cov)
+        return evecs * np.sqrt(np.clip(evals, 0., None))
+
+    # Initialize the walkers in a small ball around the input params:
+    stepsqrt = sqrtcov(stepcov)
+    pos = np.tile(constrain(params), (ntemps, nchains, 1))
+    scatter = np.dot(np.random.normal(size=pos.shape), stepsqrt.T)
+    scatter[:, 0] = 0.
+    pos = constrain(pos + scatter)
+
+    allparams  = np.zeros((nchains, npar, nout))
+    allchi     = np.zeros((nchains, nout), float)
+    numaccept  = np.zeros(nchains, dtype=int)
+    tempscale  = np.sqrt(temps)[:, None, None]
+    adapt_n    = 0
+    adapt_mean = np.zeros(npar)
+    adapt_m2   = np.zeros((npar, npar))
+
+    try:
+        chisq = getchisq(pos.reshape(nwalk, npar)).reshape(ntemps, nchains)
+        ibest = chisq[0].argmin()
+        bestp = pos[0, ibest].copy()
+        bestchisq = chisq[0, ibest]
+        if verbose:
+            print bestchisq
+
+        for j in range(numit):
+            # Propose and evaluate a step for every walker at once:
+            steps = np.dot(np.random.normal(size=pos.shape), stepsqrt.T)
+            nextp = constrain(pos + steps * tempscale)
+            nextchi = getchisq(nextp.reshape(nwalk, npar)).reshape(ntemps, nchains)
+
+            logaccept = -0.5 * (nextchi - chisq) * betas[:, None]
+            accept = np.log(np.random.uniform(size=logaccept.shape)) <= logaccept
+            pos[accept] = nextp[accept]
+            chisq[accept] = nextchi[accept]
+            numaccept += accept[0]
+
+            ibest = chisq[0].argmin()
+            if chisq[0, ibest] < bestchisq:
+                bestp = pos[0, ibest].copy()
+                bestchisq = chisq[0, ibest]
+
+            # Exchange states between adjacent temperatures:
+            if ntemps > 1 and ((j+1) % kw['swapevery'])==0:
+                for it in range(ntemps-1, 0, -1):
+                    logswap = -0.5 * (betas[it-1] - betas[it]) * (chisq[it] - chisq[it-1])
+                    swap = np.log(np.random.uniform(size=nchains)) <= logswap
+                    pos[it-1, swap], pos[it, swap] = pos[it, swap], pos[it-1, swap]
+                    chisq[it-1, swap], chisq[it, swap] = chisq[it, swap], chisq[it-1, swap]
+
+            # Accumulate the T=1 covariance and update the proposal:
+            if kw['adapt'] and j < nadapt:
+                batch = pos[0]
+                bmean = batch.mean(0)
+                delta = bmean - adapt_mean
+                ntot = adapt_n + nchains
+                adapt_mean += delta * nchains / float(ntot)
+                adapt_m2 += np.dot((batch - bmean).T, batch - bmean) + \
+                    np.outer(delta, delta) * adapt_n * nchains / float(ntot)
+                adapt_n = ntot
+                if ((j+1) % adaptevery)==0 and nfree > 0:
+                    newcov = adapt_m2 / (adapt_n - 1.)
+                    if np.diag(newcov).sum() > 0:
+                        stepcov = (2.38**2 / nfree) * newcov
+                        stepsqrt = sqrtcov(stepcov)
+                        if verbose:
+                            print "Step %i: updated proposal covariance" % (j+1)
+                    # Start afresh, so burn-in doesn't inflate later updates:
+                    adapt_n = 0
+                    adapt_mean[:] = 0.
+                    adapt_m2[:] = 0.
+
+            if (j%nstep)==0:
+                allparams[:, :, j//nstep] = pos[0]
+                allchi[:, j//nstep] = chisq[0]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if kw['retcov']:
+        ret = allparams, bestp, numaccept, allchi, stepcov
+    else:
+        ret = allparams, bestp, numaccept, allchi
+
+    return ret
+
+def mcmc_helperfunction(inputs):
+    """Helper function for :func:`ensemble_mcmc`. Not for general use."""
+    params, fits = inputs
+    chisq = 0.
+    for func, z, weights, args, i0, i1 in fits:
+        chisq += (((func(params[i0:i1], *args) - z)**2) * weights).sum()
+    return chisq
+
+# Per-process state for ensemble_mcmc workers:
+_mcmc_shared = dict()
+
+def _mcmc_initializer(fits):
+    """Store the fits broadcast once to each ensemble_mcmc worker."""
+    _mcmc_shared.clear()
+    _mcmc_shared['fits'] = fits
+
+def mcmc_blockfunction(params):
+    """Helper function for :func:`ensemble_mcmc`. Not for general use.
+
+    Chi-squared of each row (walker) of params, for the fits stored
+    by the pool initializer.
+    """
+    fits = _mcmc_shared['fits']
+    return np.array([mcmc_helperfunction((pp, fits)) for pp in params])
+
+
 def scale_mcmc_stepsize(accept, func, params, stepsize, z, sigma, numit=1000, scales=[0.1, 0.3, 1., 3., 10.], args=(), nstep=1, posdef=None, holdfixed=None, retall=False, jointpars=None):
     """Run :func:`generic_mcmc` and scale the input stepsize to match
     the desired input acceptance rate.
@@ -3615,6 +3660,10 @@ def scale_mcmc_stepsize(accept, func, params, stepsize, z, sigma, numit=1000, sc
 
     :REQUIREMENTS:
        :doc:`pylab` (for :func:`pylab.interp`)
+
+    :SEE_ALSO:
+       :func:`ensemble_mcmc`, whose 'adapt' option tunes the proposal
+       covariance during the run instead of with trial runs.
           """
     # 2011-06-13 16:06 IJMC: Created
 
@@ -3655,7 +3704,7 @@ def travisplanet(p):
 
     return  fstr  % (vals1 + vals2 ) 
 
-def stdfilt(vec, wid=3):
+def stdfilt(vec, wid=3, axis=-1):
     """Compute the standard deviation in a sliding window.
 
     :INPUTS:
@@ -3664,26 +3713,19 @@ def stdfilt(vec, wid=3):
 
       wid : int, odd
         width of filter; ideally odd (not even).
-        """
-    # 2012-04-05 13:58 IJMC: Created
 
-    filt = 0*vec
-    if wid<1:
-        wid = 1
-        
-    wid = int(wid)
+      axis : int
+        axis along which to filter, for N-D input.
 
-    n = len(vec)
+    :SEE_ALSO: :func:`filters.slidingstd`
+        """
+    # 2012-04-05 13:58 IJMC: Created
+    from xastropy.phot import filters
 
-    for ii in range(n):
-        i0 = np.max([0, ii -wid/2])
-        i1 = np.min([n-1, ii + wid/2])
-        filt[ii] = np.std(vec[i0:i1+1])
-        #print ii, i0, i1
+    return filters.slidingstd(vec, wid, axis=axis)
 
-    return filt
 
-def wmeanfilt(vec, wid=3, w=None):
+def wmeanfilt(vec, wid=3, w=None, axis=-1):
     """Compute the (weighted) mean in a sliding window.
 
     :INPUTS:
@@ -3692,24 +3734,20 @@ def wmeanfilt(vec, wid=3, w=None):
 
       wid : int, odd
         width of filter; ideally odd (not even).
-        """
-    # 2012-04-28 06:09 IJMC: Created
 
-    filt = 0*vec
-    if wid<1:
-        wid = 1
-        
-    wid = int(wid)
+      w : None or sequence
+        weights, e.g. 1./sigma^2; if None, compute an unweighted mean.
+
+      axis : int
+        axis along which to filter, for N-D input.
 
-    n = len(vec)
+    :SEE_ALSO: :func:`filters.slidingmean`
+        """
+    # 2012-04-28 06:09 IJMC: Created
+    from xastropy.phot import filters
 
-    for ii in range(n):
-        i0 = np.max([0, ii -wid/2])
-        i1 = np.min([n-1, ii + wid/2])
-        filt[ii] = wmean(vec[i0:i1+1], w[i0:i1+1])
-        #print ii, i0, i1
+    return filters.slidingmean(vec, wid, w=w, axis=axis)
 
-    return filt
 
 
 def planettext(planets, filename, delimiter=',', append=True):
@@ -3810,6 +3848,10 @@ def prayerbead(*arg, **kw):
       threads -- int
                    Number of threads to use (via multiprocessing.Pool)
 
+    :NOTES:
+      Fits to successive shifts are warm-started from one another; to
+      reuse one worker pool for several datasets, use
+      :class:`prayerbeadengine` directly.
                    
     :EXAMPLE: 
       ::
@@ -3826,8 +3868,6 @@ def prayerbead(*arg, **kw):
     # 2014-05-01 20:52 IJMC: Now allow multiprocessing via 'threads' keyword!
     
     #from kapteyn import kmpfit
-    import phasecurves as pc
-    from multiprocessing import Pool
 
     if kw.has_key('axis'):
         axis = kw['axis']
@@ -3869,11 +3909,10 @@ def prayerbead(*arg, **kw):
     else:
         ftol = 1e-12
 
-    #pdb.set_trace()
     if kw.has_key('threads'):
-        pool = Pool(processes=kw['threads'])
+        threads = kw.pop('threads')
     else:
-        pool = None
+        threads = None
 
     guessparams = arg[0]
     modelfunction = arg[1]
@@ -3921,37 +3960,174 @@ def prayerbead(*arg, **kw):
         return ret
 
 
-    fitter_args = (modelfunction,) + helperargs + (data, weights, kw)
-    fmin_fit = fmin(pc.errfunc, guessparams, args=fitter_args, full_output=True, disp=False, maxiter=maxiter, maxfun=maxfun)
-    bestparams = np.array(fmin_fit[0], copy=True)
-    bestmodel = modelfunction(*((guessparams,) + helperargs))
-    residuals = data - bestmodel
-    allfits = np.zeros((ndata, nparam), dtype=float)
-    allfits[0] = bestparams
-    if verbose: print "Finished prayer bead step ",
-
-        
-    #pdb.set_trace()
-    if pool is None:
-        allfits[1:] = np.array(map(pb_helperfunction, [[ii, bestmodel, bestparams, residuals, weights, modelfunction, helperargs, maxiter, maxfun, xtol, ftol, ndata, kw, verbose] for ii in xrange(1, ndata)])) 
-    else:
-        allfits[1:] = np.array(pool.map(pb_helperfunction, [[ii, bestmodel, bestparams, residuals, weights, modelfunction, helperargs, maxiter, maxfun, xtol, ftol, ndata, kw, verbose] for ii in xrange(1, ndata)])) 
+    engine = prayerbeadengine(modelfunction, helperargs, data, weights, \
+                                  threads=threads, maxiter=maxiter, maxfun=maxfun, \
+                                  xtol=xtol, ftol=ftol, kw=kw, verbose=verbose)
+    try:
+        allfits = engine.run(guessparams)
+    finally:
+        engine.close()
 
     return allfits
 
-def pb_helperfunction(inputs):
-    """Helper function for :func:`prayerbead`. Not for general use."""
-    # 2014-05-01 20:35 IJMC: Created
+# Per-process state for prayerbeadengine workers:
+_pb_shared = dict()
+
+def _pb_initializer(shared, ndata, modelfunction, helperargs, fitkw, kw):
+    """Store data broadcast once to each prayerbeadengine worker."""
+    _pb_shared.clear()
+    _pb_shared.update(shared=shared, ndata=ndata, modelfunction=modelfunction, \
+                          helperargs=helperargs, fitkw=fitkw, kw=kw)
+
+def pb_blockfunction(inputs):
+    """Helper function for :class:`prayerbeadengine`. Not for general use.
+
+    Fits the contiguous block of shifts [start, stop), warm-starting each
+    fit from the solution to the previous shift.
+    """
     import phasecurves as pc
 
-    index, bestmodel, bestparams, residuals, weights, modelfunction, helperargs, maxiter, maxfun, xtol, ftol, ndata, kw, verbose = inputs
-    shifteddata = bestmodel + np.concatenate((residuals[index::], residuals[0:index]))
-    shiftedweights = np.concatenate((weights[index::], weights[0:index]))
-    shifted_args = (modelfunction,) + helperargs + (shifteddata, shiftedweights, kw)
+    start, stop, params = inputs
+    shared, ndata = _pb_shared['shared'], _pb_shared['ndata']
+    bestmodel = np.frombuffer(shared['bestmodel'])
+    residuals = np.frombuffer(shared['residuals'])
+    weights = np.frombuffer(shared['weights'])
+    modelfunction = _pb_shared['modelfunction']
+    helperargs = _pb_shared['helperargs']
+    kw = _pb_shared['kw']
+    fitkw = _pb_shared['fitkw']
+
+    fits = np.zeros((stop - start, len(params)), dtype=float)
+    for ii, index in enumerate(range(start, stop)):
+        # The shared buffers hold the residuals & weights twice over:
+        shifteddata = bestmodel + residuals[index:index+ndata]
+        shifted_args = (modelfunction,) + helperargs + \
+            (shifteddata, weights[index:index+ndata], kw)
+        params = fmin(pc.errfunc, params, args=shifted_args, full_output=True, \
+                          disp=False, **fitkw)[0]
+        fits[ii] = params
+    return fits
+
+class prayerbeadengine(object):
+    """Persistent worker pool for Prayer-Bead (residual permutation) analysis.
+
+    Data, weights and the model are broadcast to the workers once, via
+    shared memory and the pool initializer; each call to :func:`run`
+    then only sends the index range of shifts and a set of starting
+    parameters to each worker.  Residuals and weights are stored twice
+    over, so that every cyclic permutation is a slice (a view, not a
+    copy) of the shared buffer.  Within each block of shifts, every fit
+    is warm-started from the previous shift's solution.
+
+    :INPUTS:
+       modelfunction -- function.  Called as modelfunction(params, *helperargs)
+
+       helperargs -- tuple.  Extra arguments to modelfunction.
+
+       data -- 1D NumPy array.
+
+       weights -- 1D NumPy array, same size as data.
 
-    fmin_fit = fmin(pc.errfunc, bestparams, args=shifted_args, full_output=True, disp=False, maxiter=maxiter, maxfun=maxfun, xtol=xtol, ftol=ftol)
-    if verbose: print ("%i of %i." % (index+1, ndata)),
-    return fmin_fit[0]
+    :OPTIONAL_INPUTS:
+       threads -- int or None.  Number of worker processes; if None,
+                  fit all shifts in this process.
+
+       nblocks -- int.  Number of blocks of shifts (default: 4*threads).
+
+       maxiter, maxfun, xtol, ftol -- passed to :func:`fmin`.
+
+       kw -- dict.  Keywords passed through to phasecurves.errfunc.
+
+    :EXAMPLE:
+       ::
+
+           engine = an.prayerbeadengine(model, (time,), flux, 1./err**2, threads=8)
+           allfits = engine.run(guessparams)
+           engine.setdata(flux2, 1./err2**2)   # same length, same workers
+           allfits2 = engine.run(guessparams)
+           engine.close()
+
+    :SEE_ALSO:
+       :func:`prayerbead`
+    """
+
+    def __init__(self, modelfunction, helperargs, data, weights, threads=None, \
+                     nblocks=None, maxiter=3000, maxfun=6000, xtol=1e-12, \
+                     ftol=1e-12, kw=dict(), verbose=False):
+        from multiprocessing import Pool
+        from multiprocessing.sharedctypes import RawArray
+
+        data = np.asarray(data, dtype=float).ravel()
+        self.ndata = data.size
+        self.modelfunction = modelfunction
+        self.helperargs = tuple(helperargs)
+        self.kw = kw
+        self.verbose = verbose
+        self.fitkw = dict(maxiter=maxiter, maxfun=maxfun, xtol=xtol, ftol=ftol)
+
+        self.shared = dict(bestmodel=RawArray('d', self.ndata), \
+                               residuals=RawArray('d', 2*self.ndata), \
+                               weights=RawArray('d', 2*self.ndata))
+        self.setdata(data, weights)
+
+        if threads is None:
+            self.pool = None
+            self.nblocks = 1
+            _pb_initializer(self.shared, self.ndata, modelfunction, \
+                                self.helperargs, self.fitkw, kw)
+        else:
+            self.pool = Pool(processes=threads, initializer=_pb_initializer, \
+                                 initargs=(self.shared, self.ndata, modelfunction, \
+                                               self.helperargs, self.fitkw, kw))
+            self.nblocks = 4*threads if nblocks is None else nblocks
+
+    def setdata(self, data, weights):
+        """Replace the data and weights (which must keep the same size)."""
+        data = np.array(data, dtype=float, copy=True).ravel()
+        weights = np.asarray(weights, dtype=float).ravel()
+        if data.size != self.ndata or weights.size != self.ndata:
+            raise ValueError("data and weights must have %i elements" % self.ndata)
+        self.data = data
+        self.weights = weights
+        np.frombuffer(self.shared['weights'])[:] = np.tile(weights, 2)
+
+    def run(self, guessparams):
+        """Fit the unshifted data and all ndata-1 cyclic shifts of its residuals.
+
+        :OUTPUT:
+           allfits -- 2D array of shape (ndata, nparams); the first
+                      row is the best fit to the unshifted data.
+        """
+        import phasecurves as pc
+
+        fitter_args = (self.modelfunction,) + self.helperargs + \
+            (self.data, self.weights, self.kw)
+        bestparams = np.array(fmin(pc.errfunc, guessparams, args=fitter_args, \
+                                       full_output=True, disp=False, \
+                                       **self.fitkw)[0], copy=True)
+        bestmodel = self.modelfunction(*((bestparams,) + self.helperargs))
+        np.frombuffer(self.shared['bestmodel'])[:] = bestmodel
+        np.frombuffer(self.shared['residuals'])[:] = \
+            np.tile(self.data - bestmodel, 2)
+
+        edges = np.linspace(1, self.ndata, self.nblocks + 1).astype(int)
+        blocks = [(i0, i1, bestparams) for i0, i1 in zip(edges[:-1], edges[1:]) if i1 > i0]
+        if self.pool is None:
+            fits = map(pb_blockfunction, blocks)
+        else:
+            fits = self.pool.map(pb_blockfunction, blocks)
+
+        allfits = np.vstack([bestparams.reshape(1, -1)] + list(fits))
+        if self.verbose: 
+            print "Finished %i prayer bead steps." % self.ndata
+        return allfits
+
+    def close(self):
+        """Shut down the worker pool."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
 
 def morlet(scale, k, k0=6.0, retper=False, retcoi=False, retcdelta=False, retpsi0=False):   # From Wavelet.pro; still incomplete!
@@ -4039,11 +4215,21 @@ def test_eccentric_anomaly(ecc, manom, tol=1e-8):
             oldval = val
         e3[ii] = val
     toc3 = time() - tic
+
+    tic = time()
+    e4 = solvekepler(manom, ecc, tol=tol, method='newton')
+    toc4 = time() - tic
+
+    tic = time()
+    e5 = solvekepler(manom, ecc, tol=tol, method='halley')
+    toc5 = time() - tic
     
     print "SciPy BrentQ:     [%1.6f, %1.6f, ....] -- %1.4f s" % (e0[0], e0[1], toc0)
     print "SciPy Newton:     [%1.6f, %1.6f, ....] -- %1.4f s" % (e1[0], e1[1], toc1)
     print "Explicit Newton:  [%1.6f, %1.6f, ....] -- %1.4f s" % (e2[0], e2[1], toc2)
     print "Simple iteration: [%1.6f, %1.6f, ....] -- %1.4f s" % (e3[0], e3[1], toc3)
+    print "Vector Newton:    [%1.6f, %1.6f, ....] -- %1.4f s" % (e4[0], e4[1], toc4)
+    print "Vector Halley:    [%1.6f, %1.6f, ....] -- %1.4f s" % (e5[0], e5[1], toc5)
     return
 
 
@@ -51,7 +51,7 @@ class phot:
         return lin
 
  
-def estbg(im, mask=None, bins=None, plotalot=False, rout=(3,200), badval=nan):
+def estbg(im, mask=None, bins=None, plotalot=False, rout=(3,200), badval=nan, method='histfit'):
     """Estimate the background value of a masked image via histogram fitting.
 
     INPUTS:
@@ -64,13 +64,21 @@ def estbg(im, mask=None, bins=None, plotalot=False, rout=(3,200), badval=nan):
       rout -- 2-tuple of (nsigma, niter) for analysis.removeoutliers.
               Set to (Inf, 0) to not cut any outliers.
       badval -- value returned when things go wrong.
+      method -- 'histfit' (default) fits a Gaussian to the histogram of
+                 the data (or takes their mean, if they are not
+                 quantized).  'mean', 'median', 'mode' or 'mmm' use
+                 background.skystats instead, with clipping set by rout.
 
     OUTPUT:
       b, s_b -- tuple of (background, error on background) from gaussian fit.
                  Note that the error is analagous to the standard deviation on the mean
 
     COMMENTS:
-      The fit parameters appear to be robust across a fairly wide range of bin sizes.  """
+      The fit parameters appear to be robust across a fairly wide range of bin sizes.  
+
+      The histogram is fit in closed form by background.gaussfit_hist.
+      To estimate many backgrounds at once, call background.skystats
+      directly on a stack of sky regions.  """
     # 2009-09-02 17:13 IJC: Created!
     # 2009-09-04 15:07 IJC: Added RemoveOutliers option. Use only non-empty bins in fit.
     # 2009-09-08 15:32 IJC: Error returned is now divided by sqrt(N) for SDOM
@@ -83,20 +91,23 @@ def estbg(im, mask=None, bins=None, plotalot=False, rout=(3,200), badval=nan):
     #                        ETH-Zurich for catching this!
 
     from numpy import histogram, mean, median, sqrt, linspace, isfinite, ones,std
-    from pylab import find
-    from scipy import optimize
-    from xastropy.phot.ian_analysis import removeoutliers, egaussian, gaussian, stdr
+    from xastropy.phot.ian_analysis import removeoutliers, gaussian, stdr
+    from xastropy.phot import background
     if plotalot:
         from pylab import figure, errorbar, plot, colorbar, title, hist, mean, std
         #from analysis import imshow
 
-    def gaussianChiSquared(guess, x, y, err):
-        return (egaussian(guess, x, y, e=err)**2).sum()
+    if mask is None:
+        mask = ones(im.shape)
 
+    if method<>'histfit':
+        sky, esky = background.skystats(im.ravel(), mask=(np.asarray(mask).ravel()<>0), \
+                                            method=method, nsigma=rout[0], niter=rout[1])[0:2]
+        if not isfinite(sky):
+            sky, esky = badval, badval
+        return sky, esky
 
-    if mask==None:
-        mask = ones(im.shape)
-    dat = im.ravel()[find(mask<>0)]
+    dat = im.ravel()[np.asarray(mask).ravel()<>0]
     if plotalot:
         figure(); plot(im.ravel()); plot(dat)
         print mean(dat), std(dat), rout[0]*std(dat)
@@ -110,7 +121,8 @@ def estbg(im, mask=None, bins=None, plotalot=False, rout=(3,200), badval=nan):
     if ndat==0:
         print "No data to work with!"
         return (badval, badval)
-    if bins==None:
+    dobin = True
+    if bins is None:
         if plotalot: print "no bins entered!"
         datmean = dat.mean()
         datstd = stdr(dat, nsigma=3)
@@ -120,7 +132,7 @@ def estbg(im, mask=None, bins=None, plotalot=False, rout=(3,200), badval=nan):
             dobin = False
         else:
             dobin = True
-            bins = linspace(dat.min(), dat.max(), nunique/2)
+            bins = linspace(dat.min(), dat.max(), nunique//2)
 
     if plotalot: 
         print "dat.mean, dat.std>>" + str((dat.mean(), dat.std()))
@@ -139,15 +151,15 @@ def estbg(im, mask=None, bins=None, plotalot=False, rout=(3,200), badval=nan):
         erry = sqrt(gy)
         usableIndex = gy>0
 
-        eff_binwidth = mean(bins[usableIndex][1::]-bins[usableIndex][:-1])
+        eff_binwidth = mean(bincenter[usableIndex][1::]-bincenter[usableIndex][:-1])
         guess = [gy.sum()*eff_binwidth, std(dat[datIndex]), median(dat[datIndex])]
 
         if 1.0*usableIndex.sum()/usableIndex.size < 0.5:
             out = guess
         else:
-            out = optimize.fmin(gaussianChiSquared, guess, \
-                                args=(bincenter[usableIndex],gy[usableIndex], erry[usableIndex]), \
-                                disp=plotalot)
+            out = background.gaussfit_hist(bincenter, gy)
+            if out is None:
+                out = guess
 
         if plotalot:
             from pylab import figure, errorbar, plot, colorbar, title
@@ -802,7 +814,7 @@ def subreg2(fn, center=None, dim=None, verbose=False):
 
 
 
-def aperphot(fn, timekey=None, pos=[0,0], dap=[2,4,6], mask=None, verbose=False, nanval=999, resamp=None, retfull=False):
+def aperphot(fn, timekey=None, pos=[0,0], dap=[2,4,6], mask=None, verbose=False, nanval=999, resamp=None, retfull=False, bgmethod='histfit'):
     """Do aperture photometry on a specified file.
 
     :INPUTS:
@@ -829,9 +841,16 @@ def aperphot(fn, timekey=None, pos=[0,0], dap=[2,4,6], mask=None, verbose=False,
       retfull: 
           Also return arrays of target mask, sky mask, and frame used.
           This option is a memory hog!
+
+      bgmethod : str
+          Sky estimator passed to :func:`estbg` as 'method'.
   
     :OUTPUTS:  
       :class:`phot` object.  
+
+    :SEE_ALSO:
+      :func:`aperture.batchphot`, for many stars in many frames at
+      once, with exact partial-pixel apertures.
   
     :EXAMPLE:  
       ::
@@ -942,7 +961,7 @@ def aperphot(fn, timekey=None, pos=[0,0], dap=[2,4,6], mask=None, verbose=False,
 
     #from pylab import *
     # Measure background and aperture photometry
-    thisbg, thisebg = estbg(frame, mask=mask_sky, plotalot=verbose, rout=[3,99])
+    thisbg, thisebg = estbg(frame, mask=mask_sky, plotalot=verbose, rout=[3,99], method=bgmethod)
     thisphot = (mask_targ*(frame - thisbg)).sum() /resamp/resamp
     peak = frame.max()
     peak_targ = (mask_targ * frame).max()
@@ -1002,14 +1021,12 @@ def psffiterr(xyoffset, psf, frame, w=None, scale=100, dframe=9, verbose=False):
           """
     # 2009-11-13 11:27 IJC: Created
     from numpy import round
-    import pdb
     out = psffit(psf, frame, loc=None, w=w, scale=scale, dframe=dframe, \
                      xoffs=[round(xyoffset[0])], yoffs=[round(xyoffset[1])], verbose=verbose)
     sumsqres = out[2][0,0]
-    #pdb.set_trace()
     return sumsqres
 
-def psffit(psf, frame, loc=None, w=None, scale=100, dframe=9, xoffs=range(0,100,10), yoffs=range(0,100,10), verbose=False):
+def psffit(psf, frame, loc=None, w=None, scale=100, dframe=9, xoffs=range(0,100,10), yoffs=range(0,100,10), verbose=False, refine=False):
     """
     INPUT:
        psf -- model PSF (supersampled by 'scale')
@@ -1022,118 +1039,22 @@ def psffit(psf, frame, loc=None, w=None, scale=100, dframe=9, xoffs=range(0,100,
        dframe -- [odd int] diameter of square box around target location
        xoffs -- [int array] subpixel x offsets to test.  
        yoffs -- [int array] subpixel y offsets to test.  
+       refine -- [bool] polish the best grid offset with a continuous
+                 search (the returned offsets may then be non-integer).
+
+    NOTES:
+       The binned PSF at every offset is computed once and cached (see
+       :class:`psf.PSFBasis`), and all offsets are fit in one batch.
+       To fit many stars at once, use psf.getbasis(...).fitmany().
+       As before, the quantity minimized is sum((w*residual)**2).
     """
     # 2009-10-07 14:18 IJC: Created.
     # 2011-05-11 22:16 IJC: Added a try/except/pdb debugging step
-    from numpy import arange, prod, zeros,vstack,dot, nonzero, diag,floor,abs,max,hstack
-    from numpy.linalg import pinv
-    from xastropy.phot.ian_analysis import binarray
-    from time import time
-    import pdb
-
-    tic = time()
-
-    
-    if w==None:
-        w = zeros(frame.shape)+1
-    if loc==None:
-        loc = ((frame.shape[1]-1)/2,(frame.shape[0]-1)/2)
-    if xoffs==None:
-        xoffsets = arange(scale) #arange(scale)
-    if yoffs==None:
-        yoffs = arange(scale) #arange(scale)
-
-    ycen = int(loc[0])
-    xcen = int(loc[1])
-    pycen, pxcen = nonzero(psf==psf.max())
-    # Pick a thumbnail frame size to use, and cut it out of the larger frame
-    if verbose:
-        print "frame.shape>>", frame.shape
-        print "(xcen, ycen, dframe)>>", xcen,ycen,dframe
-        print "limits>>" , (ycen-(dframe-1)/2.), (ycen+(dframe+1)/2.), (xcen-(dframe-1)/2.), (xcen+(dframe+1)/2.)
-        print "xoffs, yoffs>>", xoffs, yoffs
-    data = frame[(ycen-(dframe-1)/2.):(ycen+(dframe+1)/2.), 
-                 (xcen-(dframe-1)/2.):(xcen+(dframe+1)/2.)]
-    weights = w[(ycen-(dframe-1)/2.):(ycen+(dframe+1)/2.), 
-                 (xcen-(dframe-1)/2.):(xcen+(dframe+1)/2.)]
-    wmat = diag(weights.ravel())
-
-    extrasize = 2*max(abs(floor(1.0*hstack((xoffs,yoffs))/scale)))
-    exs = extrasize*scale/2
-    if verbose: print "extrasize>> ",extrasize
-
-    # Determine how much of the PSF to cut out, and cut it out
-    dpsf0 = (dframe+1)*scale-1
-    dpsf1 = dframe*scale-1
-    pxmin = int(pxcen-(dpsf0-1)/2-exs)
-    pxmax = int(pxcen+(dpsf0+1)/2+exs)
-    pymin = int(pycen-(dpsf0-1)/2-exs)
-    pymax = int(pycen+(dpsf0+1)/2+exs)
-    if verbose: print psf.shape, pymin, pymax, pxmin, pxmax
-    smpsf = psf[pymin:pymax, pxmin:pxmax]
-
-    if verbose: print "data.shape>>" , data.shape
-    ndata = prod(data.shape)
-    if verbose: print "ndata>> %i" % ndata
-    const = zeros(ndata,float)+1
-    background = zeros((len(xoffs),len(yoffs)), float)
-    fluxscale =  zeros((len(xoffs),len(yoffs)), float)
-    chisq = zeros((len(xoffs),len(yoffs)), float)
-    if verbose: 
-        print "wmat.shape>>", wmat.shape
-        print "data.ravel().shape>>", data.ravel().shape
-
-    wpmat = dot(wmat, data.ravel()) # outside of loop for efficiency
-    dfs = dframe * scale            # outside of loop for efficiency
-    initoffset_min = scale - 1 + exs    # outside of loop for efficiency
-    initoffset_max = scale - 1 + exs + dfs    # outside of loop for efficiency
-    nx = len(xoffs)
-    ny = len(yoffs)
-    rangeny = range(ny)
-    for ii in range(nx):
-        xoffset = xoffs[ii]
-        xmin, xmax = int(initoffset_min-xoffset), int(initoffset_max-xoffset)
-        for jj in rangeny:
-            #   Cut out the correct portion of the model PSF
-            yoffset = yoffs[jj]
-            ymin, ymax = int(initoffset_min-yoffset), int(initoffset_max-yoffset)
-            #   Bin down the PSF by the correct factor.  Sizes should now match!
-            binpsf = binarray(smpsf[ymin:ymax, xmin:xmax],scale)
-            #   Compute the best-fit background & PSF scaling factor
-            if verbose:
-                print "xmat shapes>> ",const.shape, binpsf.ravel().shape
-                print "ymin,ymax,xmin,xmax>> ",ymin,ymax, xmin,xmax
-                print "binpsf.shape>> ",binpsf.shape
-            try:
-                xmat = vstack((const,binpsf.ravel())).transpose()
-                wxmat = dot(wmat,xmat)
-                fitvec = dot(pinv(wxmat), wpmat) 
-                background[ii,jj], fluxscale[ii,jj] = fitvec
-                chisq[ii,jj] = ((dot(wxmat, fitvec) - wpmat)**2).sum()
-            except:
-                print "error occurred"
-                chisq[ii,jj] = 9e99
-                pdb.set_trace()
-                
+    return _gridfit(psf, frame, loc=loc, w=w, scale=scale, dframe=dframe, xoffs=xoffs, \
+                        yoffs=yoffs, verbose=verbose, refine=refine, prf=False)
 
-    ii,jj = nonzero(chisq==chisq.min())
-    if len(ii)>1: # more than one chisquared minimum found!
-        ii = ii[0]
-        jj = jj[0]
-    xoffset = xoffs[ii]
-    xmin, xmax = int(scale-xoffset-1+exs), int(scale-xoffset-1 + dfs+exs)
-    yoffset = yoffs[jj]
-    ymin, ymax = int(scale-yoffset-1+exs), int(scale-yoffset-1 + dfs+exs)
-    #   Bin down the PSF by the correct factor.  Sizes should now match!
-    binpsf = binarray(smpsf[ymin:ymax, xmin:xmax],scale)
-    modelpsf = background[ii,jj]+fluxscale[ii,jj]*binpsf
-    #print "%f seconds for completion!" % (time()-tic)
-    return modelpsf, data, chisq, background, fluxscale, xoffset, yoffset, chisq[ii,jj],background[ii,jj], fluxscale[ii,jj]
 
-
-
-
-def prffit(prf, frame, loc=None, w=None, scale=100, dframe=9, xoffs=range(0,100,10), yoffs=range(0,100,10), verbose=False):
+def prffit(prf, frame, loc=None, w=None, scale=100, dframe=9, xoffs=range(0,100,10), yoffs=range(0,100,10), verbose=False, refine=False):
     """
     INPUT:
        prf -- model PRF (supersampled by 'scale')
@@ -1146,93 +1067,50 @@ def prffit(prf, frame, loc=None, w=None, scale=100, dframe=9, xoffs=range(0,100,
        dframe -- [odd int] diameter of square box around target location
        xoffs -- [int array] subpixel x offsets to test.  
        yoffs -- [int array] subpixel y offsets to test.  
+       refine -- [bool] polish the best grid offset with a continuous search.
+
+    NOTES:
+       Identical to :func:`psffit`, except that the PRF is sampled (at
+       the center of each 'scale'-sized block) rather than binned.
     """
     # 2009-10-07 14:18 IJC: Created.
-    from numpy import arange, prod, zeros,vstack,dot, nonzero, diag,floor,abs,max,hstack
-    from numpy.linalg import pinv
-    from xastropy.phot.ian_analysis import binarray
-    from time import time
-    tic = time()
+    return _gridfit(prf, frame, loc=loc, w=w, scale=scale, dframe=dframe, xoffs=xoffs, \
+                        yoffs=yoffs, verbose=verbose, refine=refine, prf=True)
 
-    
-    if w==None:
-        w = zeros(frame.shape)+1
-    if loc==None:
-        loc = ((frame.shape[1]-1)/2,(frame.shape[0]-1)/2)
-    if xoffs==None:
-        xoffsets = arange(scale) #arange(scale)
-    if yoffs==None:
-        yoffs = arange(scale) #arange(scale)
+
+def _gridfit(psf, frame, loc=None, w=None, scale=100, dframe=9, xoffs=range(0,100,10), yoffs=range(0,100,10), verbose=False, refine=False, prf=False):
+    """Common engine of :func:`psffit` and :func:`prffit`."""
+    from xastropy.phot import psf as psfmod
+
+    if w is None:
+        w = np.ones(frame.shape)
+    if loc is None:
+        loc = ((frame.shape[1]-1)//2,(frame.shape[0]-1)//2)
+    if xoffs is None:
+        xoffs = arange(scale)
+    if yoffs is None:
+        yoffs = arange(scale)
 
     ycen = int(loc[0])
     xcen = int(loc[1])
-    pycen, pxcen = nonzero(prf==prf.max())
-    # Pick a thumbnail frame size to use, and cut it out of the larger frame
+    hw = (dframe-1)//2
+    data = frame[ycen-hw:ycen+hw+1, xcen-hw:xcen+hw+1]
+    weights = w[ycen-hw:ycen+hw+1, xcen-hw:xcen+hw+1]
     if verbose:
         print "frame.shape>>", frame.shape
         print "(xcen, ycen, dframe)>>", xcen,ycen,dframe
-        print "limits>>" , (ycen-(dframe-1)/2.), (ycen+(dframe+1)/2.), (xcen-(dframe-1)/2.), (xcen+(dframe+1)/2.)
-    data = frame[(ycen-(dframe-1)/2.):(ycen+(dframe+1)/2.), 
-                 (xcen-(dframe-1)/2.):(xcen+(dframe+1)/2.)]
-    weights = w[(ycen-(dframe-1)/2.):(ycen+(dframe+1)/2.), 
-                 (xcen-(dframe-1)/2.):(xcen+(dframe+1)/2.)]
-    wmat = diag(weights.ravel())
-
-    extrasize = 2*max(abs(floor(1.0*hstack((xoffs,yoffs))/scale)))
-    exs = extrasize*scale/2
-    if verbose: print "extrasize>> ",extrasize
-
-
-    if verbose: print "data.shape>>" , data.shape
-    ndata = prod(data.shape)
-    if verbose: print "ndata>> %i" % ndata
-    const = zeros(ndata,float)+1
-    background = zeros((len(xoffs),len(yoffs)), float)
-    fluxscale =  zeros((len(xoffs),len(yoffs)), float)
-    chisq = zeros((len(xoffs),len(yoffs)), float)
-    if verbose: 
-        print "wmat.shape>>", wmat.shape
-        print "data.ravel().shape>>", data.ravel().shape
-
-    wpmat = dot(wmat, data.ravel()) # outside of loop for efficiency
-    dfs = dframe * scale            # outside of loop for efficiency
-    initoffset_min = scale - 1 + exs    # outside of loop for efficiency
-    initoffset_max = scale - 1 + exs + dfs    # outside of loop for efficiency
-    nx = len(xoffs)
-    ny = len(yoffs)
-    rangeny = range(ny)
-    for ii in range(nx):
-        xoffset = xoffs[ii]
-        xmin, xmax = int(initoffset_min-xoffset), int(initoffset_max-xoffset)
-        for jj in rangeny:
-            #   Extract the correct indices of the model PRF. Sizes should now match!
-            yoffset = yoffs[jj]
-            ymin, ymax = int(initoffset_min-yoffset), int(initoffset_max-yoffset)
-            binpsf = prf[indy, indx]
-            #   Compute the best-fit background & PSF scaling factor
-            if verbose and (ii==0) and (jj==0): 
-                print "xmat shapes>> ",const.shape, binpsf.ravel().shape
-                print "ymin,ymax,xmin,xmax>> ",ymin,ymax, xmin,xmax
-                print "binpsf.shape>> ",binpsf.shape
-            xmat = vstack((const,binpsf.ravel())).transpose()
-            wxmat = dot(wmat,xmat)
-            fitvec = dot(pinv(wxmat), wpmat) 
-            background[ii,jj], fluxscale[ii,jj] = fitvec
-            chisq[ii,jj] = ((dot(wxmat, fitvec) - wpmat)**2).sum()
-
-    ii,jj = nonzero(chisq==chisq.min())
-    if len(ii)>1: # more than one chisquared minimum found!
-        ii = ii[0]
-        jj = jj[0]
-    xoffset = xoffs[ii]
-    xmin, xmax = int(scale-xoffset-1+exs), int(scale-xoffset-1 + dfs+exs)
-    yoffset = yoffs[jj]
-    ymin, ymax = int(scale-yoffset-1+exs), int(scale-yoffset-1 + dfs+exs)
-    #   Bin down the PSF by the correct factor.  Sizes should now match!
-    binpsf = binarray(smpsf[ymin:ymax, xmin:xmax],scale)
-    modelpsf = background[ii,jj]+fluxscale[ii,jj]*binpsf
-    print "%f seconds for completion!" % (time()-tic)
-    return modelpsf, data, chisq, background, fluxscale, xoffset, yoffset, chisq[ii,jj],background[ii,jj], fluxscale[ii,jj]
+        print "xoffs, yoffs>>", xoffs, yoffs
+        print "data.shape>>" , data.shape
+
+    basis = psfmod.getbasis(psf, scale=scale, dframe=dframe, xoffs=xoffs, yoffs=yoffs, prf=prf)
+    fit = basis.fitmany(data, weights=np.asarray(weights, dtype=float)**2, refine=refine)
+
+    xoffset, yoffset = fit['xoffset'], fit['yoffset']
+    if not refine:
+        xoffset, yoffset = int(xoffset), int(yoffset)
+    modelpsf = basis.model(xoffset, yoffset, fit['bestbackground'], fit['bestfluxscale'])
+    return modelpsf, data, fit['chisq'], fit['background'], fit['fluxscale'], xoffset, yoffset, \
+        fit['bestchisq'], fit['bestbackground'], fit['bestfluxscale']
 
 
 def gauss2d(param, x, y):
@@ -1254,7 +1132,8 @@ def gauss2d(param, x, y):
 
         NOTE: FWHM = 2*sqrt(2*ln(2)) * p1  ~ 2.3548*p1
 
-        SEE ALSO: egauss2d, numpy.meshgrid"""
+        SEE ALSO: egauss2d, numpy.meshgrid, and profiles.gaussian2d
+                  (many sources at once, with analytic Jacobians)"""
     #2010-01-11 22:46 IJC: Created
     from numpy import array, abs, concatenate, exp
     x = array(x, dtype=float).copy()
@@ -1277,6 +1156,8 @@ def egauss2d(param, x, y, z, ez=None):
 
         z is the array of data to be fit
         ez is an optional array of one-sigma errors to the data in z.
+
+        SEE ALSO: profiles.chisq, profiles.fitstamps
         """
     # 2010-01-11 22:59 IJC: Created
     from numpy import array, float, ones
@@ -1284,7 +1165,7 @@ def egauss2d(param, x, y, z, ez=None):
     y = array(y, dtype=float).copy()
     z = array(z, dtype=float).copy()
     p = array(param).copy()
-    if ez==None:
+    if ez is None:
         ez = ones(z.shape,float)
     else:
         ez = array(ez, dtype=float).copy()        
@@ -0,0 +1,288 @@
+"""Weighted linear least squares for one or many systems at once.
+
+:func:`wlsq` solves weighted least-squares problems without ever
+forming an N x N weight matrix: with one set of weights the weighted
+design matrix is decomposed once (by SVD, so rank-deficient problems
+behave as with a pseudo-inverse) and applied to any number of data
+vectors; with a different set of weights per data vector, the small
+normal-equation systems are formed and inverted as a batch.
+
+:func:`polyclip` fits sigma-clipped polynomials to many vectors
+sharing the same abscissa (e.g., light curves), as
+:func:`ian_analysis.polyfitr` does for one.  The normal equations are
+accumulated once, and each rejected point is removed from them by a
+rank-one downdate instead of refitting from scratch.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+
+
+def _batchsolve(amat, bvec, catch=False):
+    """Solve the symmetric systems amat[k] . x[k] = bvec[k].
+
+    Uses Cholesky factorizations, falling back to a direct solve (or,
+    for singular systems, a pseudo-inverse) one system at a time if
+    any is not positive definite.  If catch is True, singular systems
+    give zeros instead.
+    """
+    try:
+        chol = np.linalg.cholesky(amat)
+    except np.linalg.LinAlgError:
+        chol = None
+    if chol is not None:
+        ysol = np.linalg.solve(chol, bvec[..., None])
+        return np.linalg.solve(np.swapaxes(chol, -1, -2), ysol)[..., 0]
+    xsol = np.zeros(bvec.shape)
+    for kk in range(amat.shape[0]):
+        try:
+            xsol[kk] = np.linalg.solve(amat[kk], bvec[kk])
+        except np.linalg.LinAlgError:
+            if catch:
+                continue
+            xsol[kk] = np.dot(np.linalg.pinv(amat[kk]), bvec[kk])
+    return xsol
+
+
+def wlsq(x, z, w=None, retcov=False, rcond=1e-15):
+    """Weighted linear least squares, for one or many data vectors.
+
+    :INPUTS:
+      x : 2D array, shape (N, M)
+        Design matrix: N data points, M basis functions.
+
+      z : array, shape (N,) or (N, K)
+        Data, or K independent data vectors sharing the design.
+
+    :OPTIONAL_INPUTS:
+      w : None, or array of shape (N,) or (N, K)
+        Weights (e.g., 1./sigma_z**2).  Points with non-finite data,
+        weights or design-matrix rows are ignored.
+
+      retcov : bool
+        If True, also return the covariance matrices.
+
+      rcond : float
+        Relative cutoff for small singular values, as for
+        :func:`numpy.linalg.pinv`.
+
+    :RETURNS:
+      (coef, ecoef[, cov]) with coef and ecoef of shape (M,) or
+      (M, K), and cov of shape (M, M) or (K, M, M).
+
+    :SEE_ALSO:
+      :func:`ian_analysis.lsq`
+    """
+    x = np.asarray(x, dtype=float)
+    z = np.asarray(z, dtype=float)
+    single = z.ndim==1
+    if single:
+        z = z[:, None]
+    nobs, npar = x.shape
+    nsys = z.shape[1]
+
+    goodrow = np.isfinite(x).all(1)
+    if w is None:
+        w = np.ones(nobs)
+    w = np.asarray(w, dtype=float)
+    good = np.isfinite(z) & goodrow[:, None] & np.isfinite(w if w.ndim==2 else w[:, None])
+    xg = np.where(goodrow[:, None], x, 0.)
+
+    if w.ndim==1 and good.all(1).sum()==good.any(1).sum():
+        # One set of weights: decompose the weighted design matrix once.
+        rows = good[:, 0]
+        sqw = np.sqrt(w[rows])
+        umat, sval, vtmat = np.linalg.svd(xg[rows] * sqw[:, None], full_matrices=False)
+        keep = sval > rcond * sval.max()
+        sinv = np.where(keep, 1. / np.where(keep, sval, 1.), 0.)
+        coef = np.dot(vtmat.T * sinv, np.dot(umat.T, z[rows] * sqw[:, None]))
+        cov = np.dot(vtmat.T * sinv**2, vtmat)
+        ecoef = np.tile(np.sqrt(np.diag(cov))[:, None], (1, nsys))
+        if not single:
+            cov = np.tile(cov, (nsys, 1, 1))
+    else:
+        # Different weights for each system: batch of normal equations.
+        ww = np.where(good, np.broadcast_to(w.reshape(nobs, -1), (nobs, nsys)), 0.)
+        zz = np.where(good, z, 0.)
+        outer = (xg[:, :, None] * xg[:, None, :]).reshape(nobs, npar*npar)
+        amat = np.dot(ww.T, outer).reshape(nsys, npar, npar)
+        bvec = np.dot((ww * zz).T, xg)
+        cov = np.linalg.pinv(amat, rcond=rcond)
+        coef = np.einsum('kij,kj->ik', cov, bvec)
+        ecoef = np.sqrt(np.diagonal(cov, axis1=1, axis2=2)).T
+
+    if single:
+        coef, ecoef = coef[:, 0], ecoef[:, 0]
+        if cov.ndim==3:
+            cov = cov[0]
+    if retcov:
+        return coef, ecoef, cov
+    return coef, ecoef
+
+
+def _polytransform(npar, center, halfwidth):
+    """Matrix taking polynomial coefficients in t = (x-center)/halfwidth
+    to coefficients in x (both in numpy.polyval order)."""
+    # (a*x + b)**k = sum_j binom(k, j) a**j b**(k-j) x**j
+    aa, bb = 1. / halfwidth, -center / halfwidth
+    tmat = np.zeros((npar, npar))
+    binom = np.ones(1)
+    for kk in range(npar):
+        jj = np.arange(kk+1)
+        tmat[npar-1-jj, npar-1-kk] = binom * aa**jj * bb**(kk-jj)
+        binom = np.concatenate(([1.], binom[1:] + binom[:-1], [1.]))
+    return tmat
+
+
+def polyclip(x, y, N, s, w=None, fev=100, clip='both', eps=1e-13, \
+                 catchLinAlgError=False, full=False, callback=None):
+    """Sigma-clipped polynomial fits to one or many data vectors.
+
+    :INPUTS:
+      x : 1D array, length n
+        Abscissa, shared by all data vectors.
+
+      y : array, shape (n,) or (K, n)
+        Data vector(s).
+
+      N : int
+        Polynomial order.
+
+      s : float
+        Clipping threshold.  Without weights, in units of the
+        standard deviation of the residuals; with weights, in units of
+        the weighted residuals (residual * sqrt(w)).
+
+    :OPTIONAL_INPUTS:
+      w : None, or weights of the same shape as 'y' (or of length n).
+
+      fev : int
+        Maximum number of iterations.  As in
+        :func:`ian_analysis.polyfitr`, only the worst point of each
+        vector is rejected per iteration.
+
+      clip : 'both', 'above' or 'below' (see :func:`ian_analysis.polyfitr`)
+
+      catchLinAlgError : bool
+        If True, singular fits give zero coefficients; otherwise they
+        give the minimum-norm solution.
+
+      full : bool
+        If True, return (coef, chisq, niter, goodmask).
+
+      callback : function
+        If given, called after every iteration as callback(niter,
+        coef, goodmask), with arguments shaped as the outputs.
+
+    :RETURNS:
+      coef : polynomial coefficients [pN ... p1 p0], shape (N+1,) or
+             (K, N+1); see :func:`numpy.polyval`.
+
+    :EXAMPLE:
+      ::
+
+          from xastropy.phot import linfit
+          coef = linfit.polyclip(time, fluxes, 2, 3.)   # fluxes: (nstar, ntime)
+          trend = np.array([np.polyval(c, time) for c in coef])
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    single = y.ndim==1
+    y = np.atleast_2d(y)
+    nsys, nobs = y.shape
+    npar = N + 1
+    noweights = w is None
+    if noweights:
+        ww = np.ones(y.shape)
+    else:
+        ww = np.array(np.broadcast_to(np.asarray(w, dtype=float), y.shape))
+
+    good = np.isfinite(y) & np.isfinite(ww) & np.isfinite(x)[None, :]
+    ww[~good] = 0.
+    yy = np.where(good, y, 0.)
+
+    # Scale the abscissa to [-1, 1] to keep the normal equations well conditioned:
+    xfin = x[np.isfinite(x)]
+    center = 0.5 * (xfin.max() + xfin.min()) if xfin.size else 0.
+    halfwidth = 0.5 * (xfin.max() - xfin.min()) if xfin.size else 1.
+    if halfwidth==0:
+        halfwidth = 1.
+    vmat = np.vander(np.where(np.isfinite(x), (x - center) / halfwidth, 0.), npar)
+    outer = (vmat[:, :, None] * vmat[:, None, :]).reshape(nobs, npar*npar)
+    tmat = _polytransform(npar, center, halfwidth)
+
+    def accumulate(ind):
+        amat = np.dot(ww[ind], outer).reshape(-1, npar, npar)
+        return amat, np.dot(ww[ind] * yy[ind], vmat)
+
+    amat, bvec = accumulate(np.arange(nsys))
+    coef = np.zeros((nsys, npar))
+    niter = np.zeros(nsys, dtype=int)
+    active = np.arange(nsys)
+    residual = np.zeros(y.shape)
+    for ii in range(fev):
+        if active.size==0:
+            break
+        if ii > 0 and ii % 50==0:
+            # Refresh the downdated sums to limit round-off
+            amat[active], bvec[active] = accumulate(active)
+        qa = _batchsolve(amat[active], bvec[active], catch=catchLinAlgError)
+        coef[active] = qa
+        niter[active] += 1
+
+        gd = good[active]
+        res = y[active] - np.dot(qa, vmat.T)
+        if noweights:
+            with np.errstate(invalid='ignore'):
+                resg = np.where(gd, res, 0.)
+                ngood = np.maximum(gd.sum(1), 1)
+                mean = resg.sum(1) / ngood
+                std = np.sqrt((np.where(gd, res - mean[:, None], 0.)**2).sum(1) / ngood)
+            clipmetric = s * std
+        else:
+            res = res * np.sqrt(ww[active])
+            clipmetric = np.full(active.size, float(s))
+        residual[active] = res
+
+        if clip=='both':
+            metric = np.where(gd, np.abs(res), -np.inf)
+            worst = metric.max(1)
+            reject = (worst > clipmetric) & (worst >= eps)
+        elif clip=='above':
+            metric = np.where(gd, res, -np.inf)
+            worst = metric.max(1)
+            reject = worst > clipmetric
+        elif clip=='below':
+            metric = np.where(gd, -res, -np.inf)
+            worst = metric.max(1)
+            reject = worst > clipmetric
+        else:
+            reject = np.zeros(active.size, dtype=bool)
+
+        if reject.any():
+            kk, jj = np.nonzero((metric >= worst[:, None]) & reject[:, None] & gd)
+            sysind = active[kk]
+            wrej = ww[sysind, jj]
+            np.add.at(amat, sysind, -wrej[:, None, None] * \
+                          (vmat[jj, :, None] * vmat[jj, None, :]))
+            np.add.at(bvec, sysind, -(wrej * yy[sysind, jj])[:, None] * vmat[jj])
+            good[sysind, jj] = False
+            ww[sysind, jj] = 0.
+        active = active[reject]
+        if callback is not None:
+            pcoef = np.dot(coef, tmat.T)
+            if single:
+                callback(ii+1, pcoef[0], good[0])
+            else:
+                callback(ii+1, pcoef, good)
+
+    coef = np.dot(coef, tmat.T)
+    if single:
+        coef = coef[0]
+    if full:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chisq = np.where(good, residual**2 / y, 0.).sum(1)
+        if single:
+            return coef, chisq[0], niter[0], good[0]
+        return coef, chisq, niter, good
+    return coef
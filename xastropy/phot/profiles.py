@@ -0,0 +1,362 @@
+"""2D source profiles, their analytic Jacobians, and batch stamp fitting.
+
+The models here take a parameter array 'p' whose LAST axis holds the
+parameters, so a (nsrc, npar) array describes nsrc sources at once.
+The coordinates x, y are one grid shared by all sources (e.g., from
+:func:`numpy.meshgrid`) or, with persource=True, arrays whose leading
+axes match those of 'p'.  Each model has a companion '*_jac' function returning the
+partial derivatives of the model with respect to each parameter,
+stacked along a new last axis.
+
+Use :func:`fitstamps` to fit a whole stack of postage stamps with a
+vectorized Levenberg-Marquardt solver, or :func:`residuals` /
+:func:`jacobian` (for :func:`scipy.optimize.least_squares`) and
+:func:`chisq` / :func:`gradchisq` (for :func:`ian_analysis.gfit` or
+:func:`scipy.optimize.fmin_bfgs`) to fit one stamp at a time.
+
+The single-source functions :func:`ian_analysis.gaussian2d`,
+:func:`ian_analysis.gaussian2d_ellip`, :func:`ian_analysis.lorentzian2d`
+and :func:`ian_analysis.gaussiannd` are evaluated by this module.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+
+
+def _params(p, x, y, npar, defaults, persource=False):
+    """Split 'p' into broadcastable columns, padded with 'defaults'.
+
+    Returns (columns, x, y) with every column shaped to broadcast
+    against x and y.  If persource is True, the leading axes of x and
+    y must be those of p (one set of coordinates per source);
+    otherwise x and y are one grid shared by all sources.
+    """
+    p = np.asarray(p, dtype=float)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    nmin = npar - len(defaults)
+    if p.shape[-1] < nmin or p.shape[-1] > npar:
+        raise ValueError("expected %i to %i parameters, got %i" % (nmin, npar, p.shape[-1]))
+    lead = p.shape[:-1]
+    if persource:
+        xyshape = np.broadcast(x, y).shape
+        if xyshape[:len(lead)]!=lead:
+            raise ValueError("per-source coordinates must have leading shape %s" % (lead,))
+        ntrail = len(xyshape) - len(lead)
+    else:
+        ntrail = x.ndim
+    shape = lead + (1,)*ntrail
+    cols = [p[..., ii].reshape(shape) for ii in range(p.shape[-1])]
+    cols += [np.full(shape, val) for val in defaults[p.shape[-1]-nmin:]]
+    return cols, x, y
+
+
+def gaussian2d(p, x, y, persource=False):
+    """Circular 2D Gaussian(s) at the points x, y.
+
+    :INPUTS:
+       p -- (..., 4 or 5) array:
+
+            z = [p4 +] p0/(2*pi*p1**2) * exp(-((x-p2)**2+(y-p3)**2) / (2*p1**2))
+
+            p[0] -- area;  p[1] -- one-sigma dispersion;
+            p[2], p[3] -- x, y center;  p[4] -- optional constant.
+
+       x, y -- coordinate arrays (see the module docstring).
+
+       persource -- bool.  If True, x and y hold one set of
+                    coordinates per source (their leading axes are
+                    those of p); by default they are one grid shared
+                    by all sources.
+
+    :SEE_ALSO:
+       :func:`gaussian2d_jac`, :func:`ian_analysis.gaussian2d`
+    """
+    (area, sig, x0, y0, const), x, y = _params(p, x, y, 5, [0.], persource)
+    return const + area / (2*np.pi*sig**2) * \
+        np.exp(-((x-x0)**2 + (y-y0)**2) / (2*sig**2))
+
+
+def gaussian2d_jac(p, x, y, persource=False):
+    """Partial derivatives of :func:`gaussian2d` along a new last axis."""
+    npar = np.shape(p)[-1]
+    (area, sig, x0, y0, const), x, y = _params(p, x, y, 5, [0.], persource)
+    dx, dy = x - x0, y - y0
+    rsq = dx**2 + dy**2
+    shape = np.exp(-rsq / (2*sig**2)) / (2*np.pi*sig**2)
+    g = area * shape
+    jac = [shape, g * (rsq/sig**3 - 2./sig), g * dx/sig**2, g * dy/sig**2, \
+               np.ones_like(g)]
+    return np.stack(np.broadcast_arrays(*jac[0:npar]), axis=-1)
+
+
+def gaussian2d_ellip(p, x, y, persource=False):
+    """Elliptical, rotated 2D Gaussian(s) at the points x, y.
+
+    :INPUTS:
+       p -- (..., 5, 6 or 7) array:
+
+            p[0] -- area;  p[1], p[2] -- x, y dispersions;
+            p[3], p[4] -- x, y center;  p[5] -- optional rotation
+            angle (radians);  p[6] -- optional constant.
+
+            x' = (x - p3) cos p5 - (y - p4) sin p5
+            y' = (x - p3) sin p5 + (y - p4) cos p5
+            z = p6 + p0/(2*pi*p1*p2) * exp(-((x'/p1)**2 + (y'/p2)**2) / 2)
+
+       x, y -- coordinate arrays (see the module docstring).
+
+       persource -- bool.  If True, x and y hold one set of
+                    coordinates per source (their leading axes are
+                    those of p); by default they are one grid shared
+                    by all sources.
+
+    :SEE_ALSO:
+       :func:`gaussian2d_ellip_jac`, :func:`ian_analysis.gaussian2d_ellip`
+    """
+    (area, sx, sy, x0, y0, theta, const), x, y = _params(p, x, y, 7, [0., 0.], persource)
+    cth, sth = np.cos(theta), np.sin(theta)
+    xp = (x - x0) * cth - (y - y0) * sth
+    yp = (x - x0) * sth + (y - y0) * cth
+    return const + area / (2*np.pi*sx*sy) * np.exp(-0.5 * ((xp/sx)**2 + (yp/sy)**2))
+
+
+def gaussian2d_ellip_jac(p, x, y, persource=False):
+    """Partial derivatives of :func:`gaussian2d_ellip` along a new last axis."""
+    npar = np.shape(p)[-1]
+    (area, sx, sy, x0, y0, theta, const), x, y = _params(p, x, y, 7, [0., 0.], persource)
+    cth, sth = np.cos(theta), np.sin(theta)
+    xp = (x - x0) * cth - (y - y0) * sth
+    yp = (x - x0) * sth + (y - y0) * cth
+    shape = np.exp(-0.5 * ((xp/sx)**2 + (yp/sy)**2)) / (2*np.pi*sx*sy)
+    g = area * shape
+    jac = [shape, g * (xp**2/sx**3 - 1./sx), g * (yp**2/sy**3 - 1./sy), \
+               g * (xp*cth/sx**2 + yp*sth/sy**2), g * (yp*cth/sy**2 - xp*sth/sx**2), \
+               g * xp * yp * (1./sx**2 - 1./sy**2), np.ones_like(g)]
+    return np.stack(np.broadcast_arrays(*jac[0:npar]), axis=-1)
+
+
+def lorentzian2d(p, x, y, persource=False):
+    """2D Lorentzian(s) at the points x, y.
+
+    :INPUTS:
+       p -- (..., 5, 6 or 7) array:
+
+            z = (x-p3)**2 / p1**2 + (y-p4)**2 / p2**2 [+ (x-p3) * (y-p4) * p5]
+            lorentz = p0 / (1.0 + z)  [+ p6]
+
+            p[0] -- amplitude;  p[1], p[2] -- x, y dispersions;
+            p[3], p[4] -- x, y center;  p[5] -- optional ellipticity
+            parameter;  p[6] -- optional constant.
+
+       x, y -- coordinate arrays (see the module docstring).
+
+       persource -- bool.  If True, x and y hold one set of
+                    coordinates per source (their leading axes are
+                    those of p); by default they are one grid shared
+                    by all sources.
+
+    :SEE_ALSO:
+       :func:`lorentzian2d_jac`, :func:`ian_analysis.lorentzian2d`
+    """
+    (amp, sx, sy, x0, y0, ell, const), x, y = _params(p, x, y, 7, [0., 0.], persource)
+    dx, dy = x - x0, y - y0
+    return const + amp / (1. + (dx/sx)**2 + (dy/sy)**2 + ell*dx*dy)
+
+
+def lorentzian2d_jac(p, x, y, persource=False):
+    """Partial derivatives of :func:`lorentzian2d` along a new last axis."""
+    npar = np.shape(p)[-1]
+    (amp, sx, sy, x0, y0, ell, const), x, y = _params(p, x, y, 7, [0., 0.], persource)
+    dx, dy = x - x0, y - y0
+    inv = 1. / (1. + (dx/sx)**2 + (dy/sy)**2 + ell*dx*dy)
+    dldz = -amp * inv**2
+    jac = [inv, dldz * (-2*dx**2/sx**3), dldz * (-2*dy**2/sy**3), \
+               dldz * (-2*dx/sx**2 - ell*dy), dldz * (-2*dy/sy**2 - ell*dx), \
+               dldz * dx * dy, np.ones_like(inv)]
+    return np.stack(np.broadcast_arrays(*jac[0:npar]), axis=-1)
+
+
+def gaussiannd(mu, cov, x):
+    """N-dimensional Gaussian probability density at positions x.
+
+    :INPUTS:
+       mu -- length-N vector of means.
+
+       cov -- NxN covariance matrix (or a scalar variance if N=1).
+
+       x -- (..., N) array of positions.
+
+    :OUTPUT:
+       array of densities with shape x.shape[:-1].
+    """
+    mu = np.atleast_1d(np.asarray(mu, dtype=float))
+    cov = np.asarray(cov, dtype=float).reshape(mu.size, mu.size)
+    x = np.asarray(x, dtype=float)
+    chol = np.linalg.cholesky(cov)
+    xmu = (x - mu).reshape(-1, mu.size).T
+    white = np.linalg.solve(chol, xmu)
+    norm = (2*np.pi)**(0.5*mu.size) * np.prod(np.diag(chol))
+    return (np.exp(-0.5 * (white**2).sum(0)) / norm).reshape(x.shape[:-1])
+
+
+_models = dict(gaussian2d=(gaussian2d, gaussian2d_jac), \
+                   gaussian2d_ellip=(gaussian2d_ellip, gaussian2d_ellip_jac), \
+                   lorentzian2d=(lorentzian2d, lorentzian2d_jac))
+
+
+def getmodel(model):
+    """Return (function, jacobian) for a model name or model function."""
+    if callable(model):
+        for func, jac in _models.values():
+            if func is model:
+                return func, jac
+        raise ValueError("no Jacobian known for %s" % model)
+    try:
+        return _models[model]
+    except KeyError:
+        raise ValueError("model must be one of %s" % sorted(_models))
+
+
+def residuals(p, model, x, y, z, w=None):
+    """Weighted residuals sqrt(w)*(z - model), flattened.
+
+    Suitable for :func:`scipy.optimize.least_squares` together with
+    :func:`jacobian`::
+
+        from scipy import optimize
+        args = ('gaussian2d', x, y, stamp, 1./err**2)
+        fit = optimize.least_squares(profiles.residuals, p0, \\
+                                     jac=profiles.jacobian, args=args)
+    """
+    func = getmodel(model)[0]
+    resid = np.asarray(z, dtype=float) - func(p, x, y)
+    if w is not None:
+        resid = resid * np.sqrt(w)
+    return resid.ravel()
+
+
+def jacobian(p, model, x, y, z, w=None):
+    """Jacobian of :func:`residuals`, shape (npix, npar)."""
+    jac = getmodel(model)[1](p, x, y)
+    jac = np.broadcast_to(jac, np.shape(z) + jac.shape[-1:])
+    if w is not None:
+        jac = jac * np.sqrt(w)[..., None]
+    return -jac.reshape(-1, jac.shape[-1])
+
+
+def chisq(p, model, x, y, z, w=None):
+    """Chi-squared, sum(w * (z - model)**2), of a model.
+
+    With :func:`gradchisq`, usable by :func:`ian_analysis.gfit` or
+    :func:`scipy.optimize.fmin_bfgs`.
+    """
+    return (residuals(p, model, x, y, z, w)**2).sum()
+
+
+def gradchisq(p, model, x, y, z, w=None):
+    """Gradient of :func:`chisq` with respect to the parameters."""
+    return 2 * np.dot(residuals(p, model, x, y, z, w), jacobian(p, model, x, y, z, w))
+
+
+def fitstamps(model, p0, x, y, z, w=None, maxiter=100, ftol=1e-10, verbose=False):
+    """Fit a model to a stack of postage stamps, all at once.
+
+    A Levenberg-Marquardt solver with analytic Jacobians, vectorized
+    over stamps: each iteration forms and solves every stamp's normal
+    equations in one batch, and stamps drop out as they converge.
+
+    :INPUTS:
+       model -- name ('gaussian2d', 'gaussian2d_ellip' or
+                'lorentzian2d') or model function from this module.
+
+       p0 -- (nstamp, npar) array of initial guesses, or (npar,) to
+             use the same guess for every stamp.
+
+       x, y -- coordinates: one grid shared by all stamps, or arrays
+               with the shape of 'z'.
+
+       z -- (nstamp, ...) array of stamps.
+
+    :OPTIONAL_INPUTS:
+       w -- None, or weights (typically 1/sigma^2) of the same shape
+            as 'z'.  Non-finite data are given zero weight.
+
+       maxiter -- maximum number of iterations.
+
+       ftol -- stop when chi-squared improves by less than this
+               fraction.
+
+    :OUTPUTS:
+       (params, chisq, niter) -- (nstamp, npar) best-fit parameters,
+       (nstamp,) chi-squared, and the (nstamp,) iteration counts.
+
+    :EXAMPLE:
+       ::
+
+           from xastropy.phot import aperture, profiles
+           stamps, dx, dy = aperture.cutstamps(frame, xcat, ycat, 7)
+           guess = np.column_stack((stamps.sum((1, 2)), np.ones(len(xcat)) * 2., \\
+                                        np.zeros(len(xcat)), np.zeros(len(xcat)), \\
+                                        np.zeros(len(xcat))))
+           params, chi, niter = profiles.fitstamps('gaussian2d', guess, dx, dy, stamps)
+           xcen, ycen = xcat + params[:, 2], ycat + params[:, 3]
+    """
+    func, jacfunc = getmodel(model)
+    z = np.asarray(z, dtype=float)
+    nstamp = z.shape[0]
+    x = np.broadcast_to(np.asarray(x, dtype=float), z.shape).reshape(nstamp, -1)
+    y = np.broadcast_to(np.asarray(y, dtype=float), z.shape).reshape(nstamp, -1)
+    z = z.reshape(nstamp, -1)
+    if w is None:
+        w = np.ones(z.shape)
+    else:
+        w = np.array(w, dtype=float).reshape(z.shape)
+    bad = ~(np.isfinite(z) & np.isfinite(w))
+    w[bad] = 0.
+    z = np.where(bad, 0., z)
+
+    params = np.array(np.broadcast_to(np.asarray(p0, dtype=float), \
+                                          (nstamp, np.shape(p0)[-1])))
+    npar = params.shape[1]
+
+    def getchi(p, ind):
+        return (w[ind] * (z[ind] - func(p, x[ind], y[ind], persource=True))**2).sum(1)
+
+    chi = getchi(params, np.arange(nstamp))
+    lam = np.full(nstamp, 1e-3)
+    niter = np.zeros(nstamp, dtype=int)
+    active = np.arange(nstamp)
+    eye = np.eye(npar)
+    for ii in range(maxiter):
+        if active.size==0:
+            break
+        p = params[active]
+        wa = w[active]
+        jac = jacfunc(p, x[active], y[active], persource=True)
+        resid = z[active] - func(p, x[active], y[active], persource=True)
+        jtw = jac * wa[:, :, None]
+        alpha = np.einsum('spk,spl->skl', jtw, jac)
+        beta = np.einsum('spk,sp->sk', jtw, resid)
+        damped = alpha + lam[active, None, None] * eye * \
+            np.diagonal(alpha, axis1=1, axis2=2)[:, :, None]
+        try:
+            step = np.linalg.solve(damped, beta[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('skl,sl->sk', np.linalg.pinv(damped), beta)
+        trial = p + step
+        with np.errstate(invalid='ignore', over='ignore'):
+            newchi = getchi(trial, active)
+        better = newchi < chi[active]
+        improvement = np.where(better, chi[active] - newchi, 0.)
+        params[active[better]] = trial[better]
+        niter[active] += 1
+        done = (better & (improvement <= ftol * chi[active])) | (lam[active] > 1e10) | \
+            ~np.isfinite(step).all(1)
+        chi[active[better]] = newchi[better]
+        lam[active] = np.where(better, lam[active] * 0.1, lam[active] * 10.)
+        if verbose:
+            print("iteration %i: %i stamps still active" % (ii, active.size))
+        active = active[~done]
+
+    return params, chi, niter
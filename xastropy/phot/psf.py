@@ -0,0 +1,254 @@
+"""Fit a supersampled PSF (or PRF) to many stars at once.
+
+:class:`PSFBasis` bins a supersampled PSF down to detector pixels at
+every subpixel offset of a search grid, once, and keeps the result.
+Fitting a star is then a matter of solving one small weighted linear
+least-squares problem (background + flux scale) per offset; these are
+solved for all offsets, and all stars, in a single batch of closed-form
+2x2 normal equations.  The best grid point can then be refined with a
+continuous optimizer.
+
+:func:`ian_phot.psffit` and :func:`ian_phot.prffit` are built on this
+module, and share its cache of bases.
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+
+_cache = []
+_ncache = 8
+
+
+def _sat(img):
+    """Summed-area table, padded with a leading row and column of zeros."""
+    sat = np.zeros((img.shape[0]+1, img.shape[1]+1), dtype=float)
+    sat[1:, 1:] = np.asarray(img, dtype=float).cumsum(0).cumsum(1)
+    return sat
+
+
+def _normalsolve(basis, data, weights):
+    """Best background and flux scale for every (star, offset) pair.
+
+    basis is (noffset, npix); data and weights are (nstar, npix).
+    Returns (background, fluxscale, chisq), each (nstar, noffset).
+    """
+    wd = weights * data
+    sw = weights.sum(1)[:, None]
+    swd = wd.sum(1)[:, None]
+    swdd = (wd * data).sum(1)[:, None]
+    swb = np.dot(weights, basis.T)
+    swbb = np.dot(weights, (basis**2).T)
+    swbd = np.dot(wd, basis.T)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        det = sw * swbb - swb**2
+        flux = (sw * swbd - swb * swd) / det
+        bg = (swd - flux * swb) / sw
+    chisq = swdd - 2*bg*swd - 2*flux*swbd + bg**2*sw + 2*bg*flux*swb + flux**2*swbb
+    bad = ~np.isfinite(chisq)
+    chisq[bad] = np.inf
+    return bg, flux, chisq
+
+
+class PSFBasis(object):
+    """Binned copies of a supersampled PSF at a grid of subpixel offsets.
+
+    :INPUTS:
+       psf -- 2D array.  Model PSF, supersampled by 'scale'.
+
+    :OPTIONAL_INPUTS:
+       scale -- int.  Supersampling factor of 'psf'.
+
+       dframe -- odd int.  Width of the square box of detector pixels
+                 to be fit around each star.
+
+       xoffs, yoffs -- int sequences.  Subpixel offsets (in units of
+                       PSF samples) to search, as for
+                       :func:`ian_phot.psffit`.
+
+       prf -- bool.  If True, 'psf' is a pixel-response function
+              (already integrated over a detector pixel), which is
+              sampled at block centers instead of summed over blocks.
+
+    :NOTES:
+       Binned shifts are computed from a summed-area table of the PSF,
+       so any integer offset within the search range costs only four
+       lookups per pixel; fractional offsets are interpolated
+       bilinearly between the neighbouring integer offsets.
+
+    :EXAMPLE:
+       ::
+
+           from xastropy.phot import psf
+           basis = psf.getbasis(mypsf, scale=100, dframe=9)
+           fits = basis.fitmany(stamps, weights=1./errs**2, refine=True)
+    """
+    def __init__(self, psf, scale=100, dframe=9, xoffs=range(0, 100, 10), \
+                     yoffs=range(0, 100, 10), prf=False):
+        self.psf = psf
+        self.scale = int(scale)
+        self.dframe = int(dframe)
+        self.xoffs = np.asarray(xoffs, dtype=int)
+        self.yoffs = np.asarray(yoffs, dtype=int)
+        self.prf = prf
+
+        scale, dframe = self.scale, self.dframe
+        extrasize = 2*np.abs(np.floor(1.0*np.concatenate((self.xoffs, self.yoffs))/scale)).max()
+        exs = int(extrasize*scale//2)
+
+        # Cut out the part of the PSF needed, as in ian_phot.psffit:
+        pycen, pxcen = [ind[0] for ind in np.nonzero(psf==psf.max())]
+        dpsf0 = (dframe+1)*scale-1
+        pymin, pxmin = pycen-(dpsf0-1)//2-exs, pxcen-(dpsf0-1)//2-exs
+        if pymin < 0 or pxmin < 0:
+            raise ValueError("PSF is too small for this dframe, scale and offsets")
+        self.smpsf = psf[pymin:pycen+(dpsf0+1)//2+exs, pxmin:pxcen+(dpsf0+1)//2+exs]
+        self.offset0 = scale - 1 + exs
+        self.offrange = (self.offset0 - self.smpsf.shape[1] + dframe*scale, self.offset0, \
+                             self.offset0 - self.smpsf.shape[0] + dframe*scale, self.offset0)
+        if self.prf:
+            self._sat = None
+        else:
+            self._sat = _sat(self.smpsf)
+        self.basis = self.binned(self.xoffs[:, None], self.yoffs[None, :])
+
+    def _intbinned(self, xoff, yoff):
+        """Binned PSF at broadcast integer offsets; shape (..., dframe, dframe).
+
+        As with :func:`ian_analysis.binarray`, each pixel is the sum of
+        its scale x scale block of PSF samples.
+        """
+        scale, dframe = self.scale, self.dframe
+        xoff = np.asarray(xoff, dtype=int)[..., None, None]
+        yoff = np.asarray(yoff, dtype=int)[..., None, None]
+        step = np.arange(dframe) * scale
+        c0 = self.offset0 - xoff + step[None, :]
+        r0 = self.offset0 - yoff + step[:, None]
+        if self.prf:
+            return self.smpsf[r0 + scale//2, c0 + scale//2]
+        sat = self._sat
+        return sat[r0+scale, c0+scale] - sat[r0, c0+scale] - sat[r0+scale, c0] + sat[r0, c0]
+
+    def binned(self, xoff, yoff):
+        """Binned PSF at (broadcast) offsets xoff, yoff.
+
+        :INPUTS:
+           xoff, yoff -- scalars or arrays, in units of PSF samples.
+                         Non-integer offsets are interpolated.
+
+        :OUTPUT:
+           array of shape broadcast(xoff, yoff).shape + (dframe, dframe)
+        """
+        xoff = np.clip(np.asarray(xoff, dtype=float), self.offrange[0], self.offrange[1])
+        yoff = np.clip(np.asarray(yoff, dtype=float), self.offrange[2], self.offrange[3])
+        x0, y0 = np.floor(xoff), np.floor(yoff)
+        fx, fy = (xoff - x0)[..., None, None], (yoff - y0)[..., None, None]
+        if not (fx.any() or fy.any()):
+            return self._intbinned(x0, y0)
+        x1 = np.minimum(x0+1, self.offrange[1])
+        y1 = np.minimum(y0+1, self.offrange[3])
+        return (1-fx)*(1-fy)*self._intbinned(x0, y0) + fx*(1-fy)*self._intbinned(x1, y0) + \
+            (1-fx)*fy*self._intbinned(x0, y1) + fx*fy*self._intbinned(x1, y1)
+
+    def fitmany(self, stamps, weights=None, refine=False, xtol=0.1):
+        """Fit the PSF to a stack of postage stamps.
+
+        :INPUTS:
+           stamps -- array of shape (nstar, dframe, dframe) or
+                     (dframe, dframe).
+
+        :OPTIONAL_INPUTS:
+           weights -- None, or array of the same shape as 'stamps'
+                      (typically 1/sigma^2).  Zero-weight (and
+                      non-finite) pixels are ignored.
+
+           refine -- bool.  If True, polish each star's best grid
+                     offset with a Nelder-Mead search over continuous
+                     offsets, solving for background and flux scale at
+                     each step.
+
+           xtol -- offset tolerance of the refinement, in PSF samples.
+
+        :OUTPUT:
+           dict with entries:
+             chisq, background, fluxscale -- (nstar, nx, ny) grids.
+             xoffset, yoffset, bestchisq, bestbackground,
+             bestfluxscale -- (nstar,) arrays for the best fit.
+        """
+        stamps = np.asarray(stamps, dtype=float)
+        single = stamps.ndim==2
+        stamps = stamps.reshape(-1, self.dframe**2)
+        if weights is None:
+            weights = np.ones(stamps.shape)
+        else:
+            weights = np.array(weights, dtype=float).reshape(stamps.shape)
+        bad = ~(np.isfinite(stamps) & np.isfinite(weights))
+        weights[bad] = 0.
+        stamps = np.where(bad, 0., stamps)
+
+        nx, ny = self.xoffs.size, self.yoffs.size
+        bg, flux, chisq = _normalsolve(self.basis.reshape(nx*ny, -1), stamps, weights)
+        best = chisq.argmin(1)
+        rows = np.arange(stamps.shape[0])
+        out = dict(chisq=chisq.reshape(-1, nx, ny), background=bg.reshape(-1, nx, ny), \
+                       fluxscale=flux.reshape(-1, nx, ny), \
+                       xoffset=self.xoffs[best // ny].astype(float), \
+                       yoffset=self.yoffs[best % ny].astype(float), \
+                       bestchisq=chisq[rows, best], bestbackground=bg[rows, best], \
+                       bestfluxscale=flux[rows, best])
+
+        if refine:
+            from scipy import optimize
+            step = max(np.abs(np.diff(self.xoffs)).min() if nx > 1 else 1, \
+                           np.abs(np.diff(self.yoffs)).min() if ny > 1 else 1)
+
+            def profchisq(offset, ii):
+                model = self.binned(offset[0], offset[1]).reshape(1, -1)
+                return _normalsolve(model, stamps[ii:ii+1], weights[ii:ii+1])[2][0, 0]
+
+            for ii in rows:
+                start = np.array([out['xoffset'][ii], out['yoffset'][ii]])
+                simplex = np.array([start, start + [step, 0.], start + [0., step]])
+                xy = optimize.fmin(profchisq, start, args=(ii,), xtol=xtol, disp=False, \
+                                       initial_simplex=simplex)
+                model = self.binned(xy[0], xy[1]).reshape(1, -1)
+                b, f, c = _normalsolve(model, stamps[ii:ii+1], weights[ii:ii+1])
+                if c[0, 0] <= out['bestchisq'][ii]:
+                    out['xoffset'][ii], out['yoffset'][ii] = np.clip(xy, \
+                        self.offrange[0::2], self.offrange[1::2])
+                    out['bestchisq'][ii] = c[0, 0]
+                    out['bestbackground'][ii] = b[0, 0]
+                    out['bestfluxscale'][ii] = f[0, 0]
+
+        if single:
+            for key in out:
+                out[key] = out[key][0]
+        return out
+
+    def model(self, xoffset, yoffset, background, fluxscale):
+        """Binned model stamp(s) for fitted offsets and linear parameters."""
+        return np.asarray(background)[..., None, None] + \
+            np.asarray(fluxscale)[..., None, None] * self.binned(xoffset, yoffset)
+
+
+def getbasis(psf, scale=100, dframe=9, xoffs=range(0, 100, 10), \
+                 yoffs=range(0, 100, 10), prf=False):
+    """Return a (cached) :class:`PSFBasis` for these inputs.
+
+    Bases for the last few distinct (psf, scale, dframe, offsets, prf)
+    combinations are kept, so repeated fits with the same PSF do not
+    rebin it.  The cache holds a reference to 'psf' and matches it by
+    identity, so do not modify a PSF array in place after fitting with
+    it.
+    """
+    xoffs = tuple(np.asarray(xoffs, dtype=int).ravel())
+    yoffs = tuple(np.asarray(yoffs, dtype=int).ravel())
+    key = (int(scale), int(dframe), xoffs, yoffs, bool(prf))
+    for ii, (cpsf, ckey, basis) in enumerate(_cache):
+        if cpsf is psf and ckey==key:
+            _cache.append(_cache.pop(ii))
+            return basis
+    basis = PSFBasis(psf, scale=scale, dframe=dframe, xoffs=xoffs, yoffs=yoffs, prf=prf)
+    _cache.append((psf, key, basis))
+    if len(_cache) > _ncache:
+        _cache.pop(0)
+    return basis
@@ -0,0 +1,50 @@
+# Module to run tests on batch aperture photometry
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from xastropy.phot import aperture
+
+
+def test_circleoverlap():
+    dy, dx = np.mgrid[-5:6, -5:6]
+    np.testing.assert_allclose(aperture.circleoverlap(dx+0.3, dy-0.2, 3.).sum(), np.pi*9.)
+
+
+@pytest.mark.parametrize('ext', ['.fits', '.fits.gz'])
+def test_batchphot_uint16(tmpdir, ext):
+    # Flat sky of 1000 plus one star; stored as uint16 (BZERO=32768)
+    yy, xx = np.mgrid[0:64, 0:64]
+    img = 1000. + 5000.*np.exp(-0.5*((xx-30.2)**2 + (yy-20.7)**2)/1.5**2)
+    img = np.round(img)
+    filename = str(tmpdir.join('frame'+ext))
+    fits.PrimaryHDU(img.astype(np.uint16)).writeto(filename)
+    assert fits.getheader(filename)['BZERO'] == 32768
+    pos = np.array([[30.2, 20.7], [10., 50.]])
+    tab = aperture.batchphot([filename, img], pos, dap=(12, 16, 24))
+    np.testing.assert_allclose(tab['bg'], 1000.)
+    np.testing.assert_allclose(tab['phot'][[0, 2]], 5000.*2*np.pi*1.5**2, rtol=1e-3)
+    np.testing.assert_allclose(tab['phot'][[1, 3]], 0., atol=1e-6)
+    # File and array give the same answer
+    np.testing.assert_allclose(tab['phot'][0:2], tab['phot'][2:4])
+
+
+def test_batchphot_positions():
+    yy, xx = np.mgrid[0:64, 0:64]
+    frames = [1000. + 5000.*np.exp(-0.5*((xx-30.+ii)**2 + (yy-20.)**2)/1.5**2) for ii in range(3)]
+    # Per-frame positions follow the drift
+    pos = np.array([[[30.-ii, 20.]] for ii in range(3)])
+    tab = aperture.batchphot(frames, pos, dap=(12, 16, 24))
+    np.testing.assert_allclose(tab['x'], [30., 29., 28.])
+    np.testing.assert_allclose(tab['phot'], 5000.*2*np.pi*1.5**2, rtol=1e-3)
+    # One position per frame, whether frames is a list or a generator
+    with pytest.raises(ValueError):
+        aperture.batchphot(frames, pos[:2], dap=(12, 16, 24))
+    with pytest.raises(ValueError):
+        aperture.batchphot((fr for fr in frames), pos[:2], dap=(12, 16, 24))
+    with pytest.raises(ValueError):
+        aperture.batchphot((fr for fr in frames[:2]), pos, dap=(12, 16, 24))
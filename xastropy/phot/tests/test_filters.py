@@ -0,0 +1,59 @@
+# Module to run tests on the sliding-window filters
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from xastropy.phot import filters
+
+
+def _loopfilt(vec, wid, func):
+    # The window of the original stdfilt/wmeanfilt loops
+    n = len(vec)
+    return np.array([func(vec[max(0, ii-wid//2):min(n-1, ii+wid//2)+1]) for ii in range(n)])
+
+
+@pytest.mark.parametrize('wid', [3, 4, 5])
+def test_sliding_nan(wid):
+    vec = np.random.RandomState(0).normal(size=50)
+    vec[20] = np.nan
+    for func, npfunc in [(filters.slidingmean, np.mean), (filters.slidingstd, np.std)]:
+        filt = func(vec, wid)
+        ref = _loopfilt(vec, wid, npfunc)
+        # Only the windows holding the NaN are NaN
+        assert np.array_equal(np.isnan(filt), np.isnan(ref))
+        assert np.isnan(filt).sum() == 2*(wid//2) + 1
+        np.testing.assert_allclose(filt[np.isfinite(filt)], ref[np.isfinite(ref)])
+
+
+def test_sliding_axis():
+    vec = np.random.RandomState(1).normal(size=(40, 3))
+    vec[7, 1] = np.nan
+    filt = filters.slidingstd(vec, 5, axis=0)
+    np.testing.assert_allclose(filt[:, 1], filters.slidingstd(vec[:, 1], 5))
+    assert np.isfinite(filt[:, [0, 2]]).all()
+
+
+def test_sigmaclip_nan():
+    vec = np.concatenate([np.random.RandomState(2).normal(size=200), [1000., np.nan, np.inf]])
+    good = filters.sigmaclip(vec, 3)
+    assert not good[-3:].any()
+    assert good[:200].sum() > 190
+
+
+@pytest.mark.parametrize('size', [3, (4, 4), (6, 2), (3, 4)])
+def test_median2d(size):
+    img = np.random.RandomState(3).normal(size=(30, 25))
+    ky, kx = filters._filtersize(size)
+    # Brute force, with the same halo as filters.iter_tiles
+    padded = np.pad(img, ((ky//2, ky-1-ky//2), (kx//2, kx-1-kx//2)), mode='symmetric')
+    ref = np.array([[np.median(padded[ii:ii+ky, jj:jj+kx]) for jj in range(25)]
+                    for ii in range(30)])
+    # Strips with and without NaNs give the same medians
+    nanimg = img.copy()
+    nanimg[25, 3] = np.nan
+    med = filters.median2d(img, size, tilerows=7)
+    nanmed = filters.median2d(nanimg, size, tilerows=7)
+    np.testing.assert_allclose(med, ref)
+    np.testing.assert_allclose(nanmed[:15], ref[:15])
@@ -0,0 +1,65 @@
+# Module to run tests on the batched linear least squares
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from xastropy.phot import linfit
+
+
+def _data(nsys=4, nobs=30, order=2):
+    rng = np.random.RandomState(5)
+    x = np.linspace(1000., 1100., nobs)
+    coef = rng.normal(size=(nsys, order+1)) * np.array([1e-4, 1e-2, 1.])[-(order+1):]
+    y = np.array([np.polyval(c, x) for c in coef]) + 0.01*rng.normal(size=(nsys, nobs))
+    return x, y, rng
+
+
+def test_wlsq_polyfit():
+    x, y, rng = _data()
+    xt = x - 1050.
+    vmat = np.vander(xt, 3)
+    w = rng.uniform(0.5, 2., size=x.size)
+    coef, ecoef = linfit.wlsq(vmat, y.T, w)
+    for kk in range(y.shape[0]):
+        np.testing.assert_allclose(coef[:, kk], np.polyfit(xt, y[kk], 2, w=np.sqrt(w)),
+                                   rtol=1e-8, atol=1e-12)
+    # One vector; ignore NaN data
+    ybad = y[0].copy()
+    ybad[3] = np.nan
+    gd = np.isfinite(ybad)
+    coef1, ecoef1, cov = linfit.wlsq(vmat, ybad, w, retcov=True)
+    np.testing.assert_allclose(coef1, np.polyfit(xt[gd], ybad[gd], 2, w=np.sqrt(w[gd])),
+                               rtol=1e-8, atol=1e-12)
+    np.testing.assert_allclose(ecoef1, np.sqrt(np.diag(cov)))
+
+
+def test_wlsq_perweights():
+    x, y, rng = _data()
+    vmat = np.vander(x - 1050., 3)
+    w = rng.uniform(0.5, 2., size=y.T.shape)
+    coef, ecoef = linfit.wlsq(vmat, y.T, w)
+    for kk in range(y.shape[0]):
+        one, eone = linfit.wlsq(vmat, y[kk], w[:, kk])
+        np.testing.assert_allclose(coef[:, kk], one, rtol=1e-8, atol=1e-12)
+        np.testing.assert_allclose(ecoef[:, kk], eone, rtol=1e-6)
+
+
+@pytest.mark.parametrize('order', [1, 2])
+def test_polyclip(order):
+    x, y, rng = _data(order=order)
+    # No outliers: as numpy.polyfit (large x, so the rescaling matters)
+    coef = linfit.polyclip(x, y, order, 5.)
+    for kk in range(y.shape[0]):
+        np.testing.assert_allclose(coef[kk], np.polyfit(x, y[kk], order), rtol=1e-6)
+    # One outlier per vector is rejected
+    ybad = y.copy()
+    ybad[np.arange(y.shape[0]), [3, 10, 20, 25]] += 5.
+    coef, chisq, niter, good = linfit.polyclip(x, ybad, order, 3., full=True)
+    for kk in range(y.shape[0]):
+        assert good[kk].sum() == x.size - 1
+        np.testing.assert_allclose(coef[kk], np.polyfit(x[good[kk]], y[kk][good[kk]], order),
+                                   rtol=1e-6)
+    # A single vector
+    np.testing.assert_allclose(linfit.polyclip(x, ybad[1], order, 3.), coef[1])
@@ -0,0 +1,50 @@
+# Module to run tests on the 2D profile library
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from xastropy.phot import profiles
+
+
+@pytest.mark.parametrize('nsrc', [9, 10, 12])
+def test_shared_grid(nsrc):
+    # A shared grid whose shape happens to start with nsrc
+    x, y = np.meshgrid(np.arange(12.), np.arange(10.))
+    p = np.column_stack([np.arange(1., nsrc+1), np.full(nsrc, 2.), np.full(nsrc, 5.),
+                         np.full(nsrc, 4.)])
+    img = profiles.gaussian2d(p, x, y)
+    assert img.shape == (nsrc, 10, 12)
+    np.testing.assert_allclose(img[3], profiles.gaussian2d(p[3], x, y))
+    # Per-source coordinates
+    xs = np.broadcast_to(x, (nsrc, 10, 12)) + np.arange(nsrc)[:, None, None]
+    img = profiles.gaussian2d(p, xs, y[None], persource=True)
+    np.testing.assert_allclose(img[3], profiles.gaussian2d(p[3], x+3., y))
+    with pytest.raises(ValueError):
+        profiles.gaussian2d(p, np.zeros((5, 10, 12)), y, persource=True)
+
+
+@pytest.mark.parametrize('model,p', [('gaussian2d', [3., 1.5, 0.2, -0.4, 0.1]),
+                                     ('gaussian2d_ellip', [3., 1.5, 2.2, 0.2, -0.4, 0.3, 0.1]),
+                                     ('lorentzian2d', [3., 1.5, 2.2, 0.2, -0.4, 0.05, 0.1])])
+def test_jacobian(model, p):
+    func, jac = profiles.getmodel(model)
+    y, x = np.mgrid[-4:5, -4:5].astype(float)
+    p = np.array(p)
+    numjac = np.zeros(x.shape + (p.size,))
+    for ii in range(p.size):
+        dp = np.zeros(p.size)
+        dp[ii] = 1e-6
+        numjac[..., ii] = (func(p+dp, x, y) - func(p-dp, x, y)) / 2e-6
+    np.testing.assert_allclose(jac(p, x, y), numjac, atol=1e-7)
+
+
+def test_fitstamps():
+    y, x = np.mgrid[-6:7, -6:7].astype(float)
+    truth = np.array([[100., 1.5, 0.3, -0.2, 2.], [50., 2.0, -0.7, 0.4, 1.],
+                      [300., 1.2, 0.0, 0.9, 0.]])
+    stamps = profiles.gaussian2d(truth, x, y)
+    guess = np.array([80., 1.8, 0., 0., 0.])
+    params, chi, niter = profiles.fitstamps('gaussian2d', guess, x, y, stamps)
+    np.testing.assert_allclose(params, truth, rtol=1e-5, atol=1e-5)
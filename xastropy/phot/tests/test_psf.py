@@ -0,0 +1,37 @@
+# Module to run tests on PSF fitting
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from xastropy.phot import psf
+
+
+def _gausspsf(scale=10, npix=15, sigma=1.2):
+    # Normalized Gaussian, supersampled by scale
+    yy, xx = np.mgrid[0:npix*scale, 0:npix*scale]
+    cen = 0.5*(npix*scale - 1)
+    img = np.exp(-0.5*((xx-cen)**2 + (yy-cen)**2) / (sigma*scale)**2)
+    return img / img.sum()
+
+
+def test_fitmany():
+    mypsf = _gausspsf()
+    basis = psf.getbasis(mypsf, scale=10, dframe=7, xoffs=range(0, 10, 2), yoffs=range(0, 10, 2))
+    # Cached
+    assert psf.getbasis(mypsf, scale=10, dframe=7, xoffs=range(0, 10, 2),
+                        yoffs=range(0, 10, 2)) is basis
+    # Known offsets and linear parameters
+    xoff = np.array([4., 0., 8.])
+    yoff = np.array([6., 2., 0.])
+    stamps = basis.model(xoff, yoff, np.array([10., 0., -3.]), np.array([500., 80., 1e4]))
+    fit = basis.fitmany(stamps)
+    np.testing.assert_allclose(fit['xoffset'], xoff)
+    np.testing.assert_allclose(fit['yoffset'], yoff)
+    np.testing.assert_allclose(fit['bestbackground'], [10., 0., -3.], atol=1e-6)
+    np.testing.assert_allclose(fit['bestfluxscale'], [500., 80., 1e4], rtol=1e-6)
+    # Single stamp, refined between grid points
+    stamp = basis.model(5., 3., 1., 100.)
+    fit = basis.fitmany(stamp, refine=True, xtol=0.01)
+    np.testing.assert_allclose([fit['xoffset'], fit['yoffset']], [5., 3.], atol=0.1)
@@ -56,19 +56,11 @@ class SdssQso(object):
         if self.database is None:
             raise IOError('SdssQso: Need to be linked to an SDSS Database')
         # Generate file name (DR4 is different)
-        pnm = '{0:04d}'.format(
-            self.database._data[self.database.index]['PLATE'])
-        #fnm = '{0:04d}'.format(
-        #    self.database._data[self.database.index]['FIBERID'])
-        fnm = '{0:03d}'.format(
-            self.database._data[self.database.index]['FIBERID'])
-        mjd = str(self.database._data[self.database.index]['MJD'])
-        sfil = self.database._datdir+pnm+'/1d/'+'spSpec-' 
-        # Finish
-        self._specfil = sfil+mjd+'-'+pnm+'-'+fnm+'.fit'  # Is usually gzipped
+        self._specfil = str(self.database.specfil(self.database.index)[0])  # Is usually gzipped
 
     def load_spec(self):
         '''Input the Spectrum
+        For many spectra at once, see SdssQuasars.load_spectra
         '''
         from linetools.spectra.xspectrum1d import XSpectrum1D
         if self._specfil is None:
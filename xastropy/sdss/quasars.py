@@ -14,6 +14,7 @@
 # Import libraries
 import numpy as np
 import os
+import json
 
 from astropy.table import QTable, Column
 from astropy.coordinates import SkyCoord
@@ -23,6 +24,178 @@ from astropy.units import Quantity
 from xastropy.obs import radec as xor
 from xastropy.xutils import xdebug as xdb
 
+# Multiplier of PLATE in the integer (PLATE, FIBERID) key
+_FIBERMAX = 10000
+
+def _unitvec(ra, dec):
+    '''Unit vectors (N,3) for RA, DEC in degrees
+    '''
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cdec = np.cos(dec)
+    return np.column_stack([cdec*np.cos(ra), cdec*np.sin(ra), np.sin(dec)])
+
+def _read_spspec(args):
+    '''Read one spSpec file (gzipped or not), optionally via a cache
+    of its decompressed arrays
+
+    Parameters:
+    ----------
+    args: tuple
+      (filename, cachedir); cachedir may be None
+
+    Returns:
+    ----------
+    coeff0, coeff1: float
+      log10 wavelength of the first pixel and per pixel
+    flux, sig: float32 ndarray
+    Returns None if the file does not exist
+    '''
+    from astropy.io import fits
+    fil, cachedir = args
+    cfil = None
+    if cachedir is not None:
+        cfil = os.path.join(cachedir, os.path.basename(fil).replace('.fit','.npz'))
+        if os.path.isfile(cfil):
+            npz = np.load(cfil)
+            return float(npz['coeff'][0]), float(npz['coeff'][1]), npz['flux'], npz['sig']
+    if not os.path.isfile(fil):
+        fil = fil+'.gz'
+        if not os.path.isfile(fil):
+            return None
+    data, head = fits.getdata(fil, 0, header=True)
+    coeff = np.array([head['COEFF0'], head['COEFF1']])
+    # Rows are flux, continuum-subtracted flux, error, mask
+    flux = data[0].astype(np.float32)
+    sig = data[2].astype(np.float32)
+    if cfil is not None:
+        try:
+            tmp = cfil+'.tmp{:d}.npz'.format(os.getpid())
+            np.savez(tmp, coeff=coeff, flux=flux, sig=sig)
+            os.rename(tmp, cfil)
+        except (IOError, OSError):
+            pass
+    return coeff[0], coeff[1], flux, sig
+
+# Summary tables already opened by this process, keyed by (file, cachedir)
+_summaries = {}
+
+class SummaryCache(object):
+    '''Column-oriented cache of a (gzipped) summary FITS table
+
+    On first use the table is read once and each column is saved
+    uncompressed as a .npy file in cachedir, with the units and the
+    modification time of the FITS file in meta.json.  Afterwards columns
+    are memory-mapped from the cache as they are accessed; the cache is
+    rebuilt if the FITS file changes.  If cachedir cannot be written,
+    the columns are kept in memory instead.
+
+    Parameters:
+    ----------
+    summf: str
+      Summary FITS file
+    cachedir: str, optional
+      Directory for the cache [default: summf without .fits.gz + '_cache']
+    '''
+    def __init__(self, summf, cachedir=None, verbose=False):
+        self.summf = summf
+        if cachedir is None:
+            root = summf[:-3] if summf.endswith('.gz') else summf
+            cachedir = os.path.splitext(root)[0]+'_cache'
+        self.cachedir = cachedir
+        self.verbose = verbose
+        self._cols = {}
+        self._table = None
+        self.mtime = os.path.getmtime(summf)
+        meta = self._read_meta()
+        if (meta is None) or (meta['mtime'] != self.mtime):
+            meta = self._build()
+        self.colnames = [name for name,unit in meta['columns']]
+        self._units = dict((name,unit) for name,unit in meta['columns'])
+        self.nrow = meta['nrow']
+
+    def _read_meta(self):
+        try:
+            with open(os.path.join(self.cachedir,'meta.json')) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _build(self):
+        '''Read the FITS table and write the cache
+        '''
+        from astropy.table import Table
+        if self.verbose:
+            print('SDSS_QUASAR: Caching {:s} in {:s}'.format(self.summf, self.cachedir))
+        tab = Table.read(self.summf)
+        columns = [[name, None if tab[name].unit is None else tab[name].unit.to_string()]
+            for name in tab.colnames]
+        meta = dict(mtime=self.mtime, nrow=len(tab), columns=columns)
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            # Write to temporary files and rename, so that other processes
+            # never see a partial cache
+            tmp = '.tmp{:d}'.format(os.getpid())
+            for name in tab.colnames:
+                fil = os.path.join(self.cachedir, name+'.npy')
+                with open(fil+tmp, 'wb') as fh:
+                    np.save(fh, np.asarray(tab[name]))
+                os.rename(fil+tmp, fil)
+            fil = os.path.join(self.cachedir, 'meta.json')
+            with open(fil+tmp, 'w') as fh:
+                json.dump(meta, fh)
+            os.rename(fil+tmp, fil)
+        except (IOError, OSError):
+            if self.verbose:
+                print('SDSS_QUASAR: Cannot write {:s}; keeping the table in memory'.format(
+                    self.cachedir))
+            for name in tab.colnames:
+                self._cols[name] = np.asarray(tab[name])
+        return meta
+
+    def column(self, name):
+        '''One column (Quantity if it has units), read on first access
+        '''
+        if name not in self._units:
+            raise KeyError(name)
+        data = self._cols.get(name)
+        if data is None:
+            data = np.load(os.path.join(self.cachedir, name+'.npy'), mmap_mode='r')
+            self._cols[name] = data
+        unit = self._units[name]
+        if unit is None:
+            return Column(data, name=name, copy=False)
+        return Quantity(data, unit, copy=False)
+
+    def table(self):
+        '''All columns as a QTable (no data are copied)
+        '''
+        if self._table is None:
+            self._table = QTable([self.column(name) for name in self.colnames],
+                names=self.colnames, copy=False)
+        return self._table
+
+    def __getitem__(self, item):
+        '''Column by name; rows (as for a QTable) otherwise
+        '''
+        if isinstance(item, basestring):
+            return self.column(item)
+        return self.table()[item]
+
+    def __len__(self):
+        return self.nrow
+
+def get_summary(summf, cachedir=None, verbose=False):
+    '''SummaryCache of summf, shared by all callers in this process
+    '''
+    key = (os.path.abspath(summf), cachedir)
+    summ = _summaries.get(key)
+    if (summ is None) or (summ.mtime != os.path.getmtime(summf)):
+        summ = SummaryCache(summf, cachedir=cachedir, verbose=verbose)
+        _summaries[key] = summ
+    return summ
+
 class SdssQuasars(object):
     '''Class to handle a data release of SDSS quasars
 
@@ -30,9 +203,12 @@ class SdssQuasars(object):
     ----------
     version: str, optional
        'DR7'   :: JXP version of DR7 [DEFAULT]
+    cachedir: str, optional
+       Directory for the column cache of the summary table; see
+       SummaryCache
     '''
     # Init
-    def __init__(self, version=None, verbose=True):
+    def __init__(self, version=None, verbose=True, cachedir=None):
         # Set version
         if version is None:
             self._version = 'DR7'
@@ -50,8 +226,202 @@ class SdssQuasars(object):
         self._summf = self._path+self._version.lower()+'_qso.fits.gz'
         if self.verbose:
             print('SDSS_QUASAR: Using summary file {:s}'.format(self._summf))
-        self._data = QTable.read(self._summf)
+        self._data = get_summary(self._summf, cachedir=cachedir, verbose=verbose)
+        # Lookup index (built on first use)
+        self._index = None
 
+    #### ###############################
+    def _get_index(self):
+        '''Index the catalog for fast lookups (once)
+          keys, order -- sorted integer (PLATE, FIBERID) keys and the
+                         rows they belong to
+          tree -- k-d tree of the unit vectors of (RAOBJ, DECOBJ)
+        '''
+        from scipy.spatial import cKDTree
+        if self._index is None:
+            key = (np.asarray(self._data['PLATE']).astype(np.int64)*_FIBERMAX + 
+                np.asarray(self._data['FIBERID']).astype(np.int64))
+            order = np.argsort(key, kind='mergesort')
+            tree = cKDTree(_unitvec(self._data['RAOBJ'], self._data['DECOBJ']))
+            self._index = dict(keys=key[order], order=order, tree=tree)
+        return self._index
+
+    #### ###############################
+    def match_platefiber(self, plate, fiber):
+        '''Find many quasars by PLATE and FIBERID in one call
+
+        Parameters:
+        ----------
+        plate, fiber: int or array of int
+
+        Returns:
+        ----------
+        rows: int ndarray
+          Row of each quasar in the summary table; -1 if not found
+        '''
+        index = self._get_index()
+        key = (np.atleast_1d(plate).astype(np.int64)*_FIBERMAX + 
+            np.atleast_1d(fiber).astype(np.int64))
+        pos = np.searchsorted(index['keys'], key)
+        pos = np.minimum(pos, len(index['keys'])-1)
+        found = index['keys'][pos] == key
+        return np.where(found, index['order'][pos], -1)
+
+    #### ###############################
+    def match_coord(self, coord, radius=5e-3*u.deg):
+        '''Cross-match many positions against the quasars in one call
+
+        Parameters:
+        ----------
+        coord: SkyCoord, tuple or list of str
+          SkyCoord (scalar or array), (RA, DEC) arrays in degrees, or
+          names in JXXXXXX.X+XXXXXX.X format
+        radius: Angle or Quantity, optional
+          Match radius [default: 5e-3 deg]
+
+        Returns:
+        ----------
+        rows: int ndarray
+          Row of the nearest quasar within radius; -1 if none
+        sep: Quantity ndarray
+          Separation of that quasar (deg)
+        '''
+        index = self._get_index()
+        if isinstance(coord, SkyCoord):
+            ra, dec = coord.ra.deg, coord.dec.deg
+        elif isinstance(coord, tuple) and len(coord) == 2:
+            ra, dec = [Quantity(val, u.deg).value for val in coord]
+        else:
+            if isinstance(coord, basestring):
+                coord = [coord]
+            ra, dec = [radec.value for radec in xor.stod(coord)]
+        xyz = _unitvec(np.atleast_1d(ra), np.atleast_1d(dec))
+        # Chord length for the radius
+        rad = Quantity(radius, u.deg).to('radian').value
+        dist, rows = index['tree'].query(xyz, k=1, distance_upper_bound=2*np.sin(rad/2.))
+        found = np.isfinite(dist)
+        rows = np.where(found, rows, -1)
+        sep = np.where(found, 2*np.degrees(np.arcsin(np.minimum(dist, 2.)/2.)), np.nan)
+        return rows, sep*u.deg
+
+
+    #### ###############################
+    def specfil(self, rows):
+        '''Spectrum files of many quasars
+        Same naming as SdssQso.get_specfil
+
+        Parameters:
+        ----------
+        rows: int or array of int
+          Rows in the summary table
+
+        Returns:
+        ----------
+        files: str ndarray
+          spSpec files, without the .gz extension they usually have
+        '''
+        rows = np.atleast_1d(rows)
+        pnm = np.char.mod('%04d', np.asarray(self._data['PLATE'])[rows])
+        fnm = np.char.mod('%03d', np.asarray(self._data['FIBERID'])[rows])
+        mjd = np.char.mod('%d', np.asarray(self._data['MJD'])[rows])
+        sfil = np.char.add(np.char.add(self._datdir, pnm), '/1d/spSpec-')
+        for part in [mjd, '-', pnm, '-', fnm, '.fit']:
+            sfil = np.char.add(sfil, part)
+        return sfil
+
+    #### ###############################
+    def load_spectra(self, inp, nthreads=8, processes=False, cachedir=None):
+        '''Read many spectra onto a common wavelength grid
+
+        The spSpec files share the log-linear dispersion, so each spectrum
+        is placed on the grid by a whole-pixel offset (no interpolation).
+
+        Parameters:
+        ----------
+        inp: array of int, list of tuples or tuple of arrays
+          Rows in the summary table, (PLATE,FIBER) pairs, or a tuple
+          of PLATE and FIBER arrays
+        nthreads: int, optional
+          Number of files read in parallel
+        processes: bool, optional
+          Use a process pool rather than threads
+        cachedir: str, optional
+          Keep the decompressed arrays of each spectrum here (as .npz)
+          and read them from here the next time
+
+        Returns:
+        ----------
+        wave: Quantity ndarray
+          Wavelengths (Angstroms), npix
+        flux, sig: float32 ndarray
+          (nspec, npix); zero outside each spectrum
+        mask: bool ndarray
+          (nspec, npix); True for pixels with data and sig > 0
+        rows: int ndarray
+          Row in the summary table of each spectrum.  Quasars not in the
+          table or without a file are skipped.
+        '''
+        import multiprocessing
+        from multiprocessing.pool import ThreadPool
+
+        # Rows
+        if isinstance(inp, tuple):
+            rows = self.match_platefiber(inp[0], inp[1])
+        else:
+            inp = np.asarray(inp)
+            if inp.ndim == 2:
+                rows = self.match_platefiber(inp[:,0], inp[:,1])
+            else:
+                rows = np.atleast_1d(inp).astype(int)
+        if self.verbose and np.any(rows < 0):
+            print('SDSS_QUASAR: {:d} quasars not found in SDSS-{:s}'.format(
+                int(np.sum(rows < 0)), self._version))
+        rows = rows[rows >= 0]
+        files = self.specfil(rows)
+        if cachedir is not None and not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        # Read
+        args = [(fil, cachedir) for fil in files]
+        nthreads = max(min(int(nthreads), len(args)), 1)
+        if nthreads == 1:
+            spectra = [_read_spspec(arg) for arg in args]
+        else:
+            if processes:
+                pool = multiprocessing.Pool(nthreads)
+            else:
+                pool = ThreadPool(nthreads)
+            try:
+                spectra = pool.map(_read_spspec, args, chunksize=8)
+            finally:
+                pool.close()
+                pool.join()
+        found = np.array([spec is not None for spec in spectra], dtype=bool)
+        if self.verbose and not np.all(found):
+            print('SDSS_QUASAR: {:d} spectra not found'.format(int(np.sum(~found))))
+        spectra = [spec for spec in spectra if spec is not None]
+        rows = rows[found]
+        if len(spectra) == 0:
+            raise IOError('SDSS_QUASAR: No spectra found')
+
+        # Common grid
+        coeff0 = np.array([spec[0] for spec in spectra])
+        coeff1 = np.array([spec[1] for spec in spectra])
+        npix = np.array([len(spec[2]) for spec in spectra])
+        dlog = coeff1[0]
+        if np.any(np.abs(coeff1-dlog) > 1e-3*dlog):
+            raise ValueError('SDSS_QUASAR: Spectra do not share a dispersion')
+        offset = np.round((coeff0-coeff0.min())/dlog).astype(int)
+        ntot = int(np.max(offset+npix))
+        flux = np.zeros((len(spectra), ntot), dtype=np.float32)
+        sig = np.zeros((len(spectra), ntot), dtype=np.float32)
+        for ii in range(len(spectra)):
+            flux[ii, offset[ii]:offset[ii]+npix[ii]] = spectra[ii][2]
+            sig[ii, offset[ii]:offset[ii]+npix[ii]] = spectra[ii][3]
+            spectra[ii] = None  # Free as we go
+        mask = sig > 0.
+        wave = 10.**(coeff0.min() + dlog*np.arange(ntot)) * u.AA
+        return wave, flux, sig, mask, rows
 
     #### ###############################
     def get_qso(self,inp):
@@ -63,6 +433,7 @@ class SdssQuasars(object):
         inp: tuple or str
           tuple: (PLATE,FIBER)
           string (JXXXXXX.X+XXXXXX.X format)
+        For many quasars at once, see match_platefiber and match_coord
 
         Returns:
         ----------
@@ -71,16 +442,13 @@ class SdssQuasars(object):
         '''
         # Branch on inp
         if isinstance(inp,tuple):
-            mt = np.where( (self._data['PLATE']==inp[0]) & 
-                (self._data['FIBERID']==inp[1]))[0]
+            rows = self.match_platefiber(inp[0], inp[1])
         elif isinstance(inp,basestring):
-            # Get RA/DEC
-            radec = xor.stod1(inp)
-            # Match
-            mt = np.where( (np.abs(self._data['RAOBJ']-radec[0].value)<5e-3) & 
-                (np.abs(self._data['DECOBJ']-radec[1].value)<5e-3))[0]
+            # Nearest quasar to RA/DEC
+            rows, sep = self.match_coord(inp)
         else:
             raise ValueError('SDSS_QUASAR: Bad input type')
+        mt = rows[rows >= 0]
 
         # Parse and return
         if len(mt) == 0:
@@ -117,13 +485,18 @@ class SdssQuasars(object):
 
         #####
     def __getattr__(self, k):
-        """ Passback a SdssQso object
-        k: Input to get_qso
+        """ Passback a column of the summary table (read on first access)
+        k: Column name
         """
+        if k.startswith('_'):
+            raise AttributeError(k)
         try:
             return self._data[k]
         except KeyError:
-            return self._data[k.upper()]
+            try:
+                return self._data[k.upper()]
+            except KeyError:
+                raise AttributeError(k)
 
     def __repr__(self):
         ''' For printing
@@ -26,3 +26,42 @@ def test_parse_by_name():
 	sdss_dr7 = sdssq.SdssQuasars()
 	row = sdss_dr7.get_qso('J000009.42-102751.9')
 	np.testing.assert_allclose(row['Z'], 1.84493)
+
+def test_batch_match():
+    if os.getenv('SDSSPATH') is None:
+        assert True
+        return
+    sdss_dr7 = sdssq.SdssQuasars()
+    rows = sdss_dr7.match_platefiber([287,287,1], [264,264,1])
+    assert rows[0] == rows[1]
+    assert rows[2] == -1
+    np.testing.assert_allclose(sdss_dr7._data['Z'][rows[0]], 0.331188)
+    # Coordinates
+    rows2, sep = sdss_dr7.match_coord(['J000009.42-102751.9'])
+    np.testing.assert_allclose(sdss_dr7._data['Z'][rows2[0]], 1.84493)
+
+def test_summary_cache(tmpdir):
+    from astropy.table import Table
+    summf = str(tmpdir.join('test_qso.fits.gz'))
+    tab = Table([np.arange(5), np.linspace(0.,1.,5)], names=('PLATE','Z'))
+    tab['Z'].unit = u.dimensionless_unscaled
+    tab.write(summf)
+    summ = sdssq.get_summary(summf)
+    assert os.path.isfile(str(tmpdir.join('test_qso_cache','Z.npy')))
+    assert len(summ) == 5
+    np.testing.assert_allclose(summ['Z'].value, tab['Z'])
+    # Shared, and read back from the cache
+    assert sdssq.get_summary(summf) is summ
+    summ2 = sdssq.SummaryCache(summf)
+    assert summ2['PLATE'][3] == 3
+    assert len(summ2[1:3]) == 2
+
+def test_load_spectra():
+    if os.getenv('SDSSPATH') is None:
+        assert True
+        return
+    sdss_dr7 = sdssq.SdssQuasars()
+    wave, flux, sig, mask, rows = sdss_dr7.load_spectra([(287,264),(287,264)])
+    assert flux.shape == (2, len(wave))
+    assert rows[0] == rows[1]
+    assert np.any(mask[0])
@@ -0,0 +1,239 @@
+"""
+#;+
+#; NAME:
+#; ccdreduce
+#;    Version 1.0
+#;
+#; PURPOSE:
+#;    Module for simple, cached CCD reductions:  bias subtraction,
+#;      trimming, flat fielding and exposure normalization of many
+#;      frames on a process pool.  Products are tagged with a hash of
+#;      their inputs and only rebuilt when those inputs change.
+#;-
+#;------------------------------------------------------------------------------
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+import os
+import hashlib
+
+from astropy.io import fits
+
+# def input_hash(files, *extra):
+# def cached_product(outfil, inputs, build, params=(), silent=False):
+# def reduce_frames(jobs, bias=None, trim=None, flip=False, nproc=None, silent=False):
+
+HASHKEY = 'INHASH'
+# Scaling cards of raw integer frames; products are float
+SCALECARDS = ('BZERO', 'BSCALE', 'BLANK')
+
+# Calibration images already read by this process: file -> (hash, data).
+# Only the latest version of each file is kept
+_calib = {}
+
+
+def input_hash(files, *extra):
+    ''' Hash identifying a set of input files (and other parameters)
+
+    Files are identified by absolute path, size and modification time,
+    so that large raw frames need not be read to see if they changed.
+
+    Parameters
+    ----------
+    files: str or list
+      Input filename(s).  None entries are allowed.
+    extra:
+      Other parameters (e.g. exposure time, trim section) to include
+
+    Returns
+    -------
+    hash: str
+      Hexadecimal SHA-1 digest (40 characters)
+    '''
+    if isinstance(files, (list, tuple)):
+        files = list(files)
+    else:
+        files = [files]
+    sha = hashlib.sha1()
+    for ff in files:
+        if ff is None:
+            sha.update(b'None')
+            continue
+        stat = os.stat(ff)
+        sha.update('{:s}|{:d}|{:.6f}'.format(os.path.abspath(ff), stat.st_size,
+                                             stat.st_mtime).encode('utf-8'))
+    for item in extra:
+        sha.update(repr(item).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def product_hash(fil):
+    ''' Hash recorded in the header of a product, or None
+    '''
+    if not os.path.isfile(fil):
+        return None
+    try:
+        return fits.getheader(fil, 0).get(HASHKEY)
+    except (IOError, OSError):
+        return None
+
+
+def cached_product(outfil, inputs, build, params=(), silent=False):
+    ''' Return a calibration product, rebuilding it only if stale
+
+    Parameters
+    ----------
+    outfil: str
+      FITS file holding the product
+    inputs: list
+      Files the product is built from
+    build: function
+      Called with no arguments when the product must be (re)built;
+      returns (data, header) where header may be None
+    params: tuple, optional
+      Other parameters the product depends on
+
+    Returns
+    -------
+    data, header:
+      The product and its header
+    '''
+    key = input_hash(inputs, *params)
+    if product_hash(outfil) == key:
+        if not silent:
+            print('ccdreduce: {:s} is up to date'.format(outfil))
+        return fits.getdata(outfil, 0, header=True)
+    data, head = build()
+    if head is None:
+        head = fits.Header()
+    else:
+        head = head.copy()
+    for card in SCALECARDS:
+        head.remove(card, ignore_missing=True)
+    head[HASHKEY] = (key, 'Hash of the inputs')
+    if not silent:
+        print('ccdreduce: Writing {:s}'.format(outfil))
+    fits.writeto(outfil, data, head, overwrite=True)
+    return data, head
+
+
+def _getcalib(fil):
+    ''' Read a calibration image once per process
+    '''
+    if fil is None:
+        return None
+    key = input_hash(fil)
+    if fil not in _calib or _calib[fil][0] != key:
+        _calib[fil] = (key, fits.getdata(fil, 0).astype(float))
+    return _calib[fil][1]
+
+
+def reduce_one(job):
+    ''' Reduce one frame.  See reduce_frames for the job entries.
+
+    The frame is processed in place: one float copy of the raw data
+    is made on reading, and trimming and flipping are views.
+
+    Returns
+    -------
+    outfil: str
+    '''
+    img, head = fits.getdata(job['infile'], 0, header=True)
+    img = img.astype(float)
+
+    bias = _getcalib(job.get('bias'))
+    if bias is not None:
+        img -= bias
+
+    trim = job.get('trim')
+    if trim is not None:
+        img = img[trim[0]:trim[1], trim[2]:trim[3]]
+    if job.get('flip', False):
+        img = img[::-1]
+
+    flat = _getcalib(job.get('flat'))
+    if flat is not None:
+        img /= flat
+    exptime = job.get('exptime')
+    if exptime is not None:
+        img /= exptime
+
+    if job.get('keephead', True):
+        head = head.copy()
+        for card in SCALECARDS:
+            head.remove(card, ignore_missing=True)
+    else:
+        head = fits.Header()
+    head[HASHKEY] = (job['key'], 'Hash of the inputs')
+    fits.writeto(job['outfil'], np.ascontiguousarray(img), head, overwrite=True)
+    return job['outfil']
+
+
+def reduce_frames(jobs, bias=None, trim=None, flip=False, nproc=None, silent=False):
+    ''' Reduce a list of frames on a process pool, skipping those whose
+    products are up to date
+
+    Each frame is processed as
+      out = flip(trim(raw - bias)) / flat / exptime
+
+    Parameters
+    ----------
+    jobs: list of dict
+      One per frame, with keys
+        infile -- raw frame
+        outfil -- reduced frame
+        flat -- flat-field file (already trimmed/flipped), optional
+        exptime -- exposure time to normalize by, optional
+        keephead -- write the raw header to the product (default True)
+    bias: str, optional
+      Bias frame (untrimmed) subtracted from every frame
+    trim: tuple, optional
+      (row0, row1, col0, col1) section kept after bias subtraction
+    flip: bool, optional
+      Flip the trimmed frame up-down
+    nproc: int, optional
+      Number of processes.  Default is the number of CPUs; 1 runs
+      serially.
+
+    Returns
+    -------
+    outfils: list
+      Products rebuilt on this call
+    '''
+    import multiprocessing
+
+    todo = []
+    for job in jobs:
+        job = dict(job)
+        job.setdefault('bias', bias)
+        job.setdefault('trim', trim)
+        job.setdefault('flip', flip)
+        job['key'] = input_hash([job['infile'], job['bias'], job.get('flat')],
+                                job['trim'], job['flip'], job.get('exptime'),
+                                job.get('keephead', True))
+        if product_hash(job['outfil']) == job['key']:
+            continue
+        todo.append(job)
+
+    if not silent:
+        print('ccdreduce: {:d} of {:d} frames need reducing'.format(len(todo), len(jobs)))
+    if len(todo) == 0:
+        return []
+
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    nproc = min(nproc, len(todo))
+    if nproc <= 1:
+        done = [reduce_one(job) for job in todo]
+    else:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            done = pool.map(reduce_one, todo)
+        finally:
+            pool.close()
+            pool.join()
+    if not silent:
+        for outfil in done:
+            print('ccdreduce: Wrote {:s}'.format(outfil))
+    return done
@@ -0,0 +1,323 @@
+"""
+#;+
+#; NAME:
+#; imcombine
+#;    Version 1.0
+#;
+#; PURPOSE:
+#;    Module to combine (stack) many images with bounded memory.
+#;      Frames are read in blocks of rows from memory-mapped FITS
+#;      files, calibrated and combined block by block.
+#;-
+#;------------------------------------------------------------------------------
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+import os, shutil, tempfile
+
+from astropy.io import fits
+
+# def combine(files, method='median', ...):
+# def combine_block(cube, method='median', ...):
+
+_COMPRESSED = ('.gz', '.bz2', '.Z', '.zip')
+
+
+class ShapeError(ValueError):
+    ''' Frames (or calibration images) of different shapes
+    '''
+    pass
+
+
+class _Frame(object):
+    ''' Rows of an image given as a FITS filename or an array
+
+    Files are opened without scaling, so integer images with
+    BZERO/BSCALE (e.g. uint16 CCD frames) are memory-mapped too, and
+    only the rows read are scaled.  Compressed files cannot be
+    memory-mapped: they are decompressed once, into a scratch .npy
+    file in tmpdir, and mapped from there.
+    '''
+    def __init__(self, img, exten=0, tmpdir=None):
+        self.hdulist = None
+        self.bscale, self.bzero, self.blank = 1., 0., None
+        if isinstance(img, np.ndarray):
+            self.data = img
+            return
+        hdulist = fits.open(img, memmap=True, do_not_scale_image_data=True)
+        head = hdulist[exten].header
+        self.bscale = head.get('BSCALE', 1.)
+        self.bzero = head.get('BZERO', 0.)
+        if head['BITPIX'] > 0:
+            self.blank = head.get('BLANK')
+        if img.endswith(_COMPRESSED) and tmpdir is not None:
+            raw = hdulist[exten].data
+            fd, scratch = tempfile.mkstemp(suffix='.npy', dir=tmpdir)
+            os.close(fd)
+            self.data = np.lib.format.open_memmap(scratch, mode='w+', dtype=raw.dtype,
+                                                  shape=raw.shape)
+            self.data[:] = raw
+            del raw
+            hdulist.close()
+        else:
+            self.hdulist = hdulist
+            self.data = hdulist[exten].data
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def rows(self, r0, r1):
+        ''' Rows r0:r1, scaled, as float (BLANK pixels are NaN)
+        '''
+        raw = self.data[r0:r1]
+        arr = np.array(raw, dtype=float)
+        if self.blank is not None:
+            arr[raw == self.blank] = np.nan
+        if self.bscale != 1.:
+            arr *= self.bscale
+        if self.bzero != 0.:
+            arr += self.bzero
+        return arr
+
+    def close(self):
+        if self.hdulist is not None:
+            self.hdulist.close()
+        self.hdulist = None
+        self.data = None
+
+
+def combine_block(cube, method='median', nsigma=3., niter=5, nlow=1, nhigh=1):
+    ''' Combine a stack of images along its first axis
+
+    Parameters
+    ----------
+    cube: ndarray
+      (nframe, ...) array.  NaN values are ignored.
+    method: str, optional
+      'median', 'mean', 'sigclip' (mean after iterative clipping
+      about the median) or 'minmax' (mean after rejecting the nlow
+      lowest and nhigh highest values of each pixel)
+    nsigma, niter: float, int, optional
+      Clipping parameters for 'sigclip'
+    nlow, nhigh: int, optional
+      Number of low/high values rejected by 'minmax'
+
+    Returns
+    -------
+    img: ndarray
+      Combined image, cube.shape[1:]
+    '''
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'median':
+            if np.isnan(cube).any():
+                return np.nanmedian(cube, axis=0)
+            return np.median(cube, axis=0)
+        elif method == 'mean':
+            return np.nanmean(cube, axis=0)
+        elif method == 'sigclip':
+            data = cube.copy()
+            for ii in range(niter):
+                cen = np.nanmedian(data, axis=0)
+                sig = np.nanstd(data, axis=0)
+                bad = np.abs(data - cen) > nsigma*sig
+                if not bad.any():
+                    break
+                data[bad] = np.nan
+            return np.nanmean(data, axis=0)
+        elif method == 'minmax':
+            nframe = cube.shape[0]
+            if nlow + nhigh >= nframe:
+                raise ValueError('imcombine: nlow+nhigh must be less than the number of frames')
+            # NaNs sort to the end; count them as 'high' values
+            data = np.sort(cube, axis=0)[nlow:nframe-nhigh]
+            return np.nanmean(data, axis=0)
+        else:
+            raise ValueError('imcombine: Bad method {:s}'.format(method))
+
+
+def combine(files, method='median', bias=None, flat=None, scale=None, exten=0,
+            maxmem=256., nthreads=4, outfil=None, nsigma=3., niter=5, nlow=1,
+            nhigh=1, shifts=None, silent=False):
+    ''' Combine a list of FITS images, block of rows by block of rows
+
+    Only a block of rows from every frame is in memory at one time,
+    so a stack larger than RAM can be combined.  Bias subtraction,
+    flat fielding and frame scaling are applied to each block as it is
+    read.
+
+    Parameters
+    ----------
+    files: list
+      FITS filenames.  Scaled integer images (BZERO/BSCALE) are fine.
+      Gzipped files are decompressed once, to scratch files in the
+      temporary directory, as they cannot be memory-mapped.
+    method: str, optional
+      'median', 'mean', 'sigclip' or 'minmax'.  See combine_block
+    bias: ndarray or str, optional
+      Bias image (or its filename) subtracted from every frame
+    flat: ndarray or str, optional
+      Flat field (or its filename) divided into every frame
+    scale: str or ndarray, optional
+      'median' -- divide each (calibrated) frame by its median,
+                  as for flat-field frames
+      array    -- divide frame i by scale[i]
+    exten: int, optional
+      FITS extension holding the images
+    maxmem: float, optional
+      Approximate memory (MB) to use for the blocks being combined
+    nthreads: int, optional
+      Number of blocks combined in parallel
+    outfil: str, optional
+      Write the result to this FITS file, with the header of files[0]
+    nsigma, niter, nlow, nhigh: optional
+      Rejection parameters; see combine_block
+    shifts: ndarray, optional
+      (nframe, 2) array of (dy, dx) offsets of each frame from the
+      reference, as measured by register.register_frames.  Frames are
+      aligned to the reference by the nearest whole pixel before
+      combining; pixels shifted in from outside a frame are ignored.
+
+    Returns
+    -------
+    img: ndarray
+      Combined image (float64)
+
+    Raises
+    ------
+    ShapeError
+      (a ValueError) if the frames and calibration images differ in shape
+    '''
+    files = list(files)
+    nframe = len(files)
+    if nframe == 0:
+        raise ValueError('imcombine: No files to combine')
+    if (scale is not None) and hasattr(scale, 'lower') and (scale != 'median'):
+        raise ValueError('imcombine: Bad scale {:s}'.format(scale))
+
+    # Shapes
+    head0 = fits.getheader(files[0], exten)
+    shape = (head0['NAXIS2'], head0['NAXIS1'])
+    for ff in files[1:]:
+        head = fits.getheader(ff, exten)
+        if (head['NAXIS2'], head['NAXIS1']) != shape:
+            raise ShapeError('imcombine: Bad shapes! {:s}'.format(ff))
+    for img in [bias, flat]:
+        if isinstance(img, np.ndarray) and img.shape != shape:
+            raise ShapeError('imcombine: Bad shapes!')
+
+    tmpdir = tempfile.mkdtemp(prefix='imcombine')
+    frames = []
+    try:
+        calib = [None if img is None else _Frame(img, exten, tmpdir) for img in [bias, flat]]
+        frames += [frame for frame in calib if frame is not None]
+        for cframe in frames:
+            if cframe.shape != shape:
+                raise ShapeError('imcombine: Bad shapes!')
+        frames += [_Frame(ff, exten, tmpdir) for ff in files]
+        final = _combine(frames[-nframe:], shape, calib[0], calib[1], method, scale,
+                         maxmem, nthreads, nsigma, niter, nlow, nhigh, shifts, silent)
+    finally:
+        for frame in frames:
+            frame.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # Write
+    if outfil is not None:
+        if not silent:
+            print('imcombine: Writing stacked frame to {:s}'.format(outfil))
+        head = head0.copy()
+        for key in ['BZERO', 'BSCALE', 'BLANK']:
+            head.remove(key, ignore_missing=True)
+        fits.writeto(outfil, final, head, overwrite=True)
+
+    return final
+
+
+def _combine(frames, shape, bias, flat, method, scale, maxmem, nthreads, nsigma, niter,
+             nlow, nhigh, shifts, silent):
+    ''' Combine a list of opened _Frames; see combine
+    '''
+    from multiprocessing.pool import ThreadPool
+
+    nframe = len(frames)
+    # Scale factors, one frame in memory at a time
+    if scale is None:
+        scale = np.ones(nframe)
+    elif hasattr(scale, 'lower'):
+        scale = np.zeros(nframe)
+        for ii, frame in enumerate(frames):
+            arr = _calibrate(frame.rows(0, shape[0]), bias, flat, 0, shape[0])
+            scale[ii] = np.median(arr)
+            del arr
+    else:
+        scale = np.asarray(scale, dtype=float)
+    if shifts is not None:
+        shifts = np.round(np.asarray(shifts, dtype=float)).astype(int).reshape(nframe, 2)
+
+    # Blocks of rows
+    nthreads = max(int(nthreads), 1)
+    rowbytes = 8. * nframe * shape[1] * (3 if method in ['sigclip', 'minmax'] else 1)
+    nrow = int(maxmem * 2.**20 / nthreads / rowbytes)
+    nrow = min(max(nrow, 1), shape[0])
+    starts = list(range(0, shape[0], nrow))
+
+    final = np.zeros(shape)
+
+    def do_block(r0):
+        r1 = min(r0+nrow, shape[0])
+        cube = np.empty((nframe, r1-r0, shape[1]))
+        for ii, frame in enumerate(frames):
+            if shifts is None:
+                cube[ii] = frame.rows(r0, r1)
+            else:
+                cube[ii] = _shifted_rows(frame, r0, r1, shifts[ii], shape, bias, flat)
+        if shifts is None:
+            _calibrate(cube, bias, flat, r0, r1)
+        cube /= scale[:, None, None]
+        final[r0:r1] = combine_block(cube, method=method, nsigma=nsigma,
+                                     niter=niter, nlow=nlow, nhigh=nhigh)
+
+    if not silent:
+        print('imcombine: Combining {:d} frames in {:d} blocks'.format(nframe, len(starts)))
+    if nthreads == 1 or len(starts) == 1:
+        for r0 in starts:
+            do_block(r0)
+    else:
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(do_block, starts)
+        finally:
+            pool.close()
+            pool.join()
+
+    return final
+
+
+def _calibrate(arr, bias, flat, r0, r1):
+    ''' Bias subtract and flat field rows r0:r1 (the last two axes of
+    arr), in place.  bias and flat are _Frames (or None).
+    '''
+    if bias is not None:
+        arr -= bias.rows(r0, r1)
+    if flat is not None:
+        arr /= flat.rows(r0, r1)
+    return arr
+
+
+def _shifted_rows(frame, r0, r1, shift, shape, bias, flat):
+    ''' Rows r0:r1 of a frame aligned to the reference, i.e. rows
+    r0+dy:r1+dy and columns shifted by dx, calibrated before shifting.
+    Pixels from outside the frame are NaN.
+    '''
+    dy, dx = shift
+    out = np.full((r1-r0, shape[1]), np.nan)
+    s0, s1 = max(r0+dy, 0), min(r1+dy, shape[0])
+    c0, c1 = max(dx, 0), shape[1]+min(dx, 0)
+    if s1 > s0 and c1 > c0:
+        rows = _calibrate(frame.rows(s0, s1), bias, flat, s0, s1)
+        out[s0-dy-r0:s1-dy-r0, c0-dx:c1-dx] = rows[:, c0:c1]
+    return out
@@ -1,9 +1,6 @@
 # Taken by JXP from github sixtenbe
 import numpy as np
-#from math import pi, log
-import pylab
-from scipy import fft, ifft
-from scipy.optimize import curve_fit
+from scipy import ndimage
 
 '''
 i = 10000
@@ -18,17 +15,217 @@ def _datacheck_peakdetect(x_axis, y_axis):
         x_axis = range(len(y_axis))
     
     if len(y_axis) != len(x_axis):
-        raise (ValueError, 
-                'Input vectors y_axis and x_axis must have same length')
+        raise ValueError('Input vectors y_axis and x_axis must have same length')
     
     #needs to be a numpy array
     y_axis = np.array(y_axis)
     x_axis = np.array(x_axis)
     return x_axis, y_axis
     
+def extrema_mask(y_axis, lookahead = 1, delta = 0, axis = -1):
+    """
+    Vectorized search for local maxima and minima, along any axis of an
+    array (e.g. along the rows of a stack of spectra).
+    
+    A sample is a maximum if it is the largest value within 'lookahead'
+    samples on either side, it rises above the previous sample, and the
+    signal is more than 'delta' below it somewhere within 'lookahead'
+    samples on each side (minima likewise).  On a flat-topped peak the
+    first sample is taken.  This is done with sliding maximum/minimum
+    filters, so the cost does not depend on 'lookahead'.
+    
+    keyword arguments:
+    y_axis -- Array of signal(s); NaNs are never peaks
+    lookahead -- (optional) Half width, in samples, of the window in
+        which a peak must be the extreme value (default: 1)
+    delta -- (optional) Minimum drop (rise) on each side of a maximum
+        (minimum) (default: 0)
+    axis -- (optional) Axis along which to search (default: -1)
+    
+    return -- two boolean arrays (is_max, is_min) of the shape of y_axis
+    """
+    y_axis = np.asarray(y_axis, dtype=float)
+    lookahead = int(lookahead)
+    if lookahead < 1:
+        raise ValueError("Lookahead must be '1' or above in value")
+    if not (np.isscalar(delta) and delta >= 0):
+        raise ValueError("delta must be a positive number")
+    finite = np.isfinite(y_axis)
+    size = 2 * lookahead + 1
+    # Windows [i-lookahead, i] and [i, i+lookahead]
+    hsize = lookahead + 1
+    borigin, forigin = lookahead // 2, -(hsize // 2)
+    
+    # Previous sample (the first sample is never a peak)
+    prev = np.roll(y_axis, 1, axis=axis)
+    first = [slice(None)] * y_axis.ndim
+    first[axis] = 0
+    
+    masks = []
+    for sign in [1., -1.]:
+        yy = np.where(finite, sign * y_axis, -np.inf)
+        wmax = ndimage.maximum_filter1d(yy, size, axis=axis, mode='nearest')
+        mask = finite & (yy == wmax) & (yy > sign * prev)
+        yinf = np.where(finite, yy, np.inf)
+        for origin in [borigin, forigin]:
+            wmin = ndimage.minimum_filter1d(yinf, hsize, axis=axis, mode='nearest', 
+                                            origin=origin)
+            mask &= yy - wmin > delta
+        mask[tuple(first)] = False
+        masks.append(mask)
+    return masks[0], masks[1]
+    
+    
+def _alternate(y_axis, index, kind):
+    """
+    Of each run of consecutive maxima (kind True) or minima (False)
+    among the sorted extrema 'index', keep only the highest (lowest).
+    """
+    if index.size < 2:
+        return index, kind
+    run = np.concatenate(([0], np.cumsum(kind[1:] != kind[:-1])))
+    signed = np.where(kind, y_axis[index], -y_axis[index])
+    order = np.lexsort((-signed, run))
+    keep = np.sort(order[np.concatenate(([True], run[order][1:] != run[order][:-1]))])
+    return index[keep], kind[keep]
+    
+    
+def fit_parabolas(y_axis, index, x_axis = None, points = 5, row = None):
+    """
+    Least-squares parabola fits around many peaks at once, solved in
+    closed form.  Equivalent to fitting y = k * (x - tau) ** 2 + m to
+    the 'points' samples centred on each peak, without iteration.
+    
+    keyword arguments:
+    y_axis -- 1D signal, or 2D array of signals (one per row)
+    index -- Integer array of peak indices (along the last axis)
+    x_axis -- (optional) x values: 1D (shared by all rows) or of the
+        shape of y_axis.  If omitted the sample index is used.
+    points -- (optional) Number of samples in each fit; made odd
+        (default: 5)
+    row -- (optional) Row of each peak, for 2D y_axis
+    
+    return -- (tau, m, k): arrays of the fitted peak positions, peak
+        values and curvatures.  Where a fit is degenerate (or its
+        vertex falls outside the fitted samples) the sample itself is
+        returned, with k = 0.
+    """
+    y_axis = np.asarray(y_axis, dtype=float)
+    if y_axis.ndim == 1:
+        y_axis = y_axis[None, :]
+    index = np.asarray(index, dtype=int)
+    if row is None:
+        row = np.zeros(index.shape, dtype=int)
+    row = np.asarray(row, dtype=int)
+    npix = y_axis.shape[-1]
+    if x_axis is None:
+        x_axis = np.arange(npix, dtype=float)
+    x_axis = np.broadcast_to(np.asarray(x_axis, dtype=float), y_axis.shape)
+    points = int(points)
+    points += 1 - points % 2
+    half = points // 2
+    
+    cols = index[:, None] + np.arange(-half, half + 1)[None, :]
+    inside = (cols >= 0) & (cols < npix)
+    cols = np.clip(cols, 0, npix - 1)
+    x0 = x_axis[row, index]
+    y0 = y_axis[row, index]
+    uu = x_axis[row[:, None], cols] - x0[:, None]
+    yy = y_axis[row[:, None], cols]
+    ww = (inside & np.isfinite(yy) & np.isfinite(uu)).astype(float)
+    uu = np.where(ww > 0, uu, 0.)
+    yy = np.where(ww > 0, yy, 0.)
+    
+    # Normal equations for y = c0 + c1 u + c2 u^2
+    upow = uu[:, :, None] ** np.arange(5)[None, None, :]
+    su = (ww[:, :, None] * upow).sum(1)
+    sy = (ww[:, :, None] * yy[:, :, None] * upow[:, :, :3]).sum(1)
+    amat = su[:, np.array([[0, 1, 2], [1, 2, 3], [2, 3, 4]])]
+    coef = np.zeros(sy.shape)
+    ok = ww.sum(1) >= 3
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ok &= np.abs(np.linalg.det(amat)) > 0
+        if ok.any():
+            coef[ok] = np.linalg.solve(amat[ok], sy[ok, :, None])[:, :, 0]
+        c0, c1, c2 = coef.T
+        uvert = -c1 / (2 * c2)
+        ok &= (c2 != 0) & np.isfinite(uvert)
+        ok &= (uvert >= uu.min(1)) & (uvert <= uu.max(1))
+        tau = np.where(ok, x0 + uvert, x0)
+        m = np.where(ok, c0 - c1 ** 2 / (4 * c2), y0)
+    k = np.where(ok, c2, 0.)
+    return tau, m, k
+    
+    
+def peakdetect_rows(y_axis, x_axis = None, lookahead = 3, delta = 0, 
+                    points = 5, minima = False):
+    """
+    Find peaks along every row of a stack of spectra (e.g. the orders
+    of an echelle arc frame) and refine them with parabola fits, all
+    in a few array operations.
+    
+    keyword arguments:
+    y_axis -- 2D array (nrow, npix); a 1D array is treated as one row
+    x_axis -- (optional) x values, 1D (npix) or 2D (nrow, npix), e.g.
+        a wavelength solution per order.  Defaults to pixel index.
+    lookahead -- (optional) Half width of the window in which a peak
+        must be the extreme value (default: 3)
+    delta -- (optional) Minimum drop around a peak, as for extrema_mask
+        (default: 0)
+    points -- (optional) Samples per parabola fit; 0 or 1 skips the
+        fits (default: 5)
+    minima -- (optional) Find minima (absorption lines) instead of
+        maxima (default: False)
+    
+    return -- (row, index, x, y): arrays with the row and sample index
+        of each peak and its fitted position and value, ordered by row
+        then position
+    """
+    y_axis = np.asarray(y_axis, dtype=float)
+    if y_axis.ndim == 1:
+        y_axis = y_axis[None, :]
+    is_max, is_min = extrema_mask(y_axis, lookahead, delta, axis=-1)
+    row, index = np.nonzero(is_min if minima else is_max)
+    if points > 1:
+        x, y, k = fit_parabolas(y_axis, index, x_axis=x_axis, points=points, row=row)
+    else:
+        if x_axis is None:
+            x = index.astype(float)
+        else:
+            x = np.broadcast_to(np.asarray(x_axis, dtype=float), y_axis.shape)[row, index]
+        y = y_axis[row, index]
+    return row, index, x, y
+    
+    
+def parabola_vertex(y_minus, y_zero, y_plus):
+    """
+    Vertex of the parabola through three equally spaced samples, in
+    closed form.  Works elementwise on arrays, so many peaks (e.g. the
+    neighbours of every local maximum, or of a correlation peak along
+    each axis) are refined at once.
+
+    keyword arguments:
+    y_minus, y_zero, y_plus -- Samples at offsets -1, 0 and +1 (scalars
+        or arrays of the same shape)
+
+    return -- (offset, value): the vertex position relative to the
+        central sample, in units of the sample spacing, and the value
+        of the parabola there.  Where the three samples are collinear
+        the offset is 0 and the value is y_zero.
+    """
+    y_minus = np.asarray(y_minus, dtype=float)
+    y_zero = np.asarray(y_zero, dtype=float)
+    y_plus = np.asarray(y_plus, dtype=float)
+    denom = y_minus - 2. * y_zero + y_plus
+    flat = denom == 0
+    offset = np.where(flat, 0., 0.5 * (y_minus - y_plus) / np.where(flat, 1., denom))
+    value = y_zero - 0.25 * (y_minus - y_plus) * offset
+    return offset, value
+
 def _peakdetect_parabole_fitter(raw_peaks, x_axis, y_axis, points):
     """
     Performs the actual parabole fitting for the peakdetect_parabole function.
+    All peaks are fit at once, in closed form (see fit_parabolas).
     
     keyword arguments:
     raw_peaks -- A list of either the maximium or the minimum peaks, as given
@@ -42,31 +239,20 @@ def _peakdetect_parabole_fitter(raw_peaks, x_axis, y_axis, points):
         [[x, y, [fitted_x, fitted_y]]]
         
     """
-    func = lambda x, k, tau, m: k * ((x - tau) ** 2) + m
-    fitted_peaks = []
-    for peak in raw_peaks:
-        index = peak[0]
-        x_data = x_axis[index - points // 2: index + points // 2 + 1]
-        y_data = y_axis[index - points // 2: index + points // 2 + 1]
-        # get a first approximation of tau (peak position in time)
-        tau = x_axis[index]
-        # get a first approximation of peak amplitude
-        m = peak[1]
-        
-        # build list of approximations
-        # k = -m as first approximation?
-        p0 = (-m, tau, m)
-        popt, pcov = curve_fit(func, x_data, y_data, p0)
-        # retrieve tau and m i.e x and y value of peak
-        x, y = popt[1:3]
-        
-        # create a high resolution data set for the fitted waveform
-        x2 = np.linspace(x_data[0], x_data[-1], points * 10)
-        y2 = func(x2, *popt)
-        
-        fitted_peaks.append([x, y, [x2, y2]])
-        
-    return fitted_peaks
+    if len(raw_peaks) == 0:
+        return []
+    index = np.array([peak[0] for peak in raw_peaks], dtype=int)
+    tau, m, k = fit_parabolas(y_axis, index, x_axis=x_axis, points=points)
+    
+    # high resolution data sets for the fitted waveforms
+    half = points // 2
+    lo = x_axis[np.clip(index - half, 0, len(x_axis) - 1)]
+    hi = x_axis[np.clip(index + half, 0, len(x_axis) - 1)]
+    frac = np.linspace(0., 1., points * 10)
+    x2 = lo[:, None] + (hi - lo)[:, None] * frac[None, :]
+    y2 = k[:, None] * (x2 - tau[:, None]) ** 2 + m[:, None]
+    
+    return [[tau[ii], m[ii], [x2[ii], y2[ii]]] for ii in range(len(index))]
     
     
 def peakdetect(y_axis, x_axis = None, lookahead = 300, delta=0):
@@ -75,24 +261,27 @@ def peakdetect(y_axis, x_axis = None, lookahead = 300, delta=0):
     http://billauer.co.il/peakdet.html
     
     function for detecting local maximas and minmias in a signal.
-    Discovers peaks by searching for values which are surrounded by lower
-    or larger values for maximas and minimas respectively
+    Candidate maxima and minima are the points that are the largest or
+    smallest within 'lookahead' points on either side (sliding max/min
+    filters); runs of same-kind candidates keep only the most extreme.
+    The smallest swings between successive extrema are then dropped
+    until every swing is larger than delta.  The first extremum is
+    dropped if it lies within 'lookahead' points of the start, as are
+    extrema within 'lookahead' points of the end.
     
     keyword arguments:
     y_axis -- A list containg the signal over which to find peaks
     x_axis -- (optional) A x-axis whose values correspond to the y_axis list
         and is used in the return to specify the postion of the peaks. If
         omitted an index of the y_axis is used. (default: None)
-    lookahead -- (optional) distance to look ahead from a peak candidate to
-        determine if it is the actual peak (default: 200) 
+    lookahead -- (optional) half-width, in points, of the window within
+        which a peak must be the extreme value (default: 300)
         '(sample / period) / f' where '4 >= f >= 1.25' might be a good value
-    delta -- (optional) this specifies a minimum difference between a peak and
-        the following points, before a peak may be considered a peak. Useful
-        to hinder the function from picking up false peaks towards to end of
-        the signal. To work well delta should be set to delta >= RMSnoise * 5.
+    delta -- (optional) this specifies a minimum difference between
+        successive maxima and minima. Useful to hinder the function from
+        picking up false peaks in noise. To work well delta should be set
+        to delta >= RMSnoise * 5.
         (default: 0)
-            delta function causes a 20% decrease in speed, when omitted
-            Correctly used it can double the speed of the function
     
     return -- two lists [max_peaks, min_peaks] containing the positive and
         negative peaks respectively. Each cell of the lists contains a tuple
@@ -101,83 +290,59 @@ def peakdetect(y_axis, x_axis = None, lookahead = 300, delta=0):
         results to unpack one of the lists into x, y coordinates do: 
         x, y = zip(*tab)
     """
-    max_peaks = []
-    min_peaks = []
-    dump = []   #Used to pop the first hit which almost always is false
-       
     # check input data
     x_axis, y_axis = _datacheck_peakdetect(x_axis, y_axis)
+    y_axis = np.asarray(y_axis, dtype=float)
     # store data length for later use
     length = len(y_axis)
     
-    
     #perform some checks
     if lookahead < 1:
-        raise ValueError, "Lookahead must be '1' or above in value"
+        raise ValueError("Lookahead must be '1' or above in value")
     if not (np.isscalar(delta) and delta >= 0):
-        raise ValueError, "delta must be a positive number"
-    
-    #maxima and minima candidates are temporarily stored in
-    #mx and mn respectively
-    mn, mx = np.Inf, -np.Inf
-    
-    #Only detect peak if there is 'lookahead' amount of points after it
-    for index, (x, y) in enumerate(zip(x_axis[:-lookahead], 
-                                        y_axis[:-lookahead])):
-        if y > mx:
-            mx = y
-            mxpos = x
-        if y < mn:
-            mn = y
-            mnpos = x
-        
-        ####look for max####
-        if y < mx-delta and mx != np.Inf:
-            #Maxima peak candidate found
-            #look ahead in signal to ensure that this is a peak and not jitter
-            if y_axis[index:index+lookahead].max() < mx:
-                max_peaks.append([mxpos, mx])
-                dump.append(True)
-                #set algorithm to only find minima now
-                mx = np.Inf
-                mn = np.Inf
-                if index+lookahead >= length:
-                    #end is within lookahead no more peaks can be found
-                    break
-                continue
-            #else:  #slows shit down this does
-            #    mx = ahead
-            #    mxpos = x_axis[np.where(y_axis[index:index+lookahead]==mx)]
-        
-        ####look for min####
-        if y > mn+delta and mn != -np.Inf:
-            #Minima peak candidate found 
-            #look ahead in signal to ensure that this is a peak and not jitter
-            if y_axis[index:index+lookahead].min() > mn:
-                min_peaks.append([mnpos, mn])
-                dump.append(False)
-                #set algorithm to only find maxima now
-                mn = -np.Inf
-                mx = -np.Inf
-                if index+lookahead >= length:
-                    #end is within lookahead no more peaks can be found
-                    break
-            #else:  #slows shit down this does
-            #    mn = ahead
-            #    mnpos = x_axis[np.where(y_axis[index:index+lookahead]==mn)]
-    
-    
-    #Remove the false hit on the first value of the y_axis
-    try:
-        if dump[0]:
-            max_peaks.pop(0)
-        else:
-            min_peaks.pop(0)
-        del dump
-    except IndexError:
-        #no peaks were found, should the function return empty lists?
-        pass
-        
+        raise ValueError("delta must be a positive number")
+    
+    # Candidates from sliding max/min filters.  Only detect peak if
+    # there is 'lookahead' amount of points after it
+    is_max, is_min = extrema_mask(y_axis, lookahead)
+    is_max[length - lookahead:] = False
+    is_min[length - lookahead:] = False
+    index = np.nonzero(is_max | is_min)[0]
+    kind = is_max[index]
+    index, kind = _alternate(y_axis, index, kind)
+    
+    # Hysteresis: successive maxima and minima must differ by more than
+    # delta.  Remove the smallest swings (a max/min pair, or an extremum
+    # at either end) until none is left, a batch of swings at a time.
+    while index.size > 1:
+        swing = np.abs(np.diff(y_axis[index]))
+        small = swing <= delta
+        if not small.any():
+            break
+        # swings no larger than their neighbours, taking the left of ties
+        left = np.concatenate(([np.inf], swing[:-1]))
+        right = np.concatenate((swing[1:], [np.inf]))
+        pick = np.nonzero(small & (swing < left) & (swing <= right))[0]
+        drop = np.zeros(index.size, dtype=bool)
+        # at the ends only the outer extremum goes
+        if pick.size > 0 and pick[0] == 0:
+            drop[0] = True
+            pick = pick[1:]
+        if pick.size > 0 and pick[-1] == index.size - 2:
+            drop[-1] = True
+            pick = pick[:-1]
+        drop[pick] = True
+        drop[pick + 1] = True
+        index, kind = _alternate(y_axis, index[~drop], kind[~drop])
+    
+    # The first extremum is often false (see the original algorithm,
+    # which always discarded its first hit); drop it if it lies within
+    # 'lookahead' of the start
+    if index.size > 0 and index[0] < lookahead:
+        index, kind = index[1:], kind[1:]
+    
+    max_peaks = [[x_axis[ii], y_axis[ii]] for ii in index[kind]]
+    min_peaks = [[x_axis[ii], y_axis[ii]] for ii in index[~kind]]
     return [max_peaks, min_peaks]
     
     
@@ -220,6 +385,8 @@ def peakdetect_fft(y_axis, x_axis, pad_len = 5):
         results to unpack one of the lists into x, y coordinates do: 
         x, y = zip(*tab)
     """
+    import pylab
+    
     # check input data
     x_axis, y_axis = _datacheck_peakdetect(x_axis, y_axis)
     zero_indices = zero_crossings(y_axis, window = 11)
@@ -230,9 +397,9 @@ def peakdetect_fft(y_axis, x_axis, pad_len = 5):
     # are discardable as any errors induced from not using whole periods
     # should mainly manifest in the beginning and the end of the signal, but
     # not in the rest of the signal
-    fft_data = fft(y_axis[zero_indices[0]:zero_indices[last_indice]])
+    fft_data = np.fft.fft(y_axis[zero_indices[0]:zero_indices[last_indice]])
     padd = lambda x, c: x[:len(x) // 2] + [0] * c + x[len(x) // 2:]
-    n = lambda x: int(log(x)/log(2)) + 1
+    n = lambda x: int(np.log2(x)) + 1
     # padds to 2**n amount of samples
     fft_padded = padd(list(fft_data), 2 ** 
                 n(len(fft_data) * pad_len) - len(fft_data))
@@ -241,7 +408,7 @@ def peakdetect_fft(y_axis, x_axis, pad_len = 5):
     sf = len(fft_padded) / float(len(fft_data))
     # There might be a leakage giving the result an imaginary component
     # Return only the real component
-    y_axis_ifft = ifft(fft_padded).real * sf #(pad_len + 1)
+    y_axis_ifft = np.fft.ifft(fft_padded).real * sf #(pad_len + 1)
     x_axis_ifft = np.linspace(
                 x_axis[zero_indices[0]], x_axis[zero_indices[last_indice]],
                 len(y_axis_ifft))
@@ -251,7 +418,7 @@ def peakdetect_fft(y_axis, x_axis, pad_len = 5):
     #max_peaks, min_peaks = peakdetect_zero_crossing(y_axis_ifft, x_axis_ifft)
     
     # store one 20th of a period as waveform data
-    data_len = int(np.diff(zero_indices).mean()) / 10
+    data_len = int(np.diff(zero_indices).mean()) // 10
     data_len += 1 - data_len & 1
     
     
@@ -324,10 +491,10 @@ def peakdetect_parabole(y_axis, x_axis, points = 9):
     max_ = _peakdetect_parabole_fitter(max_raw, x_axis, y_axis, points)
     min_ = _peakdetect_parabole_fitter(min_raw, x_axis, y_axis, points)
     
-    max_peaks = map(lambda x: [x[0], x[1]], max_)
-    max_fitted = map(lambda x: x[-1], max_)
-    min_peaks = map(lambda x: [x[0], x[1]], min_)
-    min_fitted = map(lambda x: x[-1], min_)
+    max_peaks = [[x[0], x[1]] for x in max_]
+    max_fitted = [x[-1] for x in max_]
+    min_peaks = [[x[0], x[1]] for x in min_]
+    min_fitted = [x[-1] for x in min_]
     
     
     #pylab.plot(x_axis, y_axis)
@@ -371,6 +538,11 @@ def peakdetect_sine(y_axis, x_axis, points = 9, lock_frequency = False):
         model function should be locked to the value calculated from the raw
         peaks or if optimization process may tinker with it. (default: False)
     
+    All peaks are fit at once: with the frequency locked the model is
+    linear (a cos + b sin) and is solved in closed form; otherwise that
+    solution is refined by batched, damped Gauss-Newton iterations, and
+    peaks whose fit fails to converge keep the locked solution.
+    
     return -- two lists [max_peaks, min_peaks] containing the positive and
         negative peaks respectively. Each cell of the lists contains a tupple
         of: (position, peak_value) 
@@ -380,17 +552,16 @@ def peakdetect_sine(y_axis, x_axis, points = 9, lock_frequency = False):
     """
     # check input data
     x_axis, y_axis = _datacheck_peakdetect(x_axis, y_axis)
+    x_axis = np.asarray(x_axis, dtype=float)
+    y_axis = np.asarray(y_axis, dtype=float)
     # make the points argument odd
     points += 1 - points % 2
+    half = points // 2
     #points += 1 - int(points) & 1 slower when int conversion needed
     
     # get raw peaks
     max_raw, min_raw = peakdetect_zero_crossing(y_axis)
     
-    # define output variable
-    max_peaks = []
-    min_peaks = []
-    
     # get global offset
     offset = np.mean([np.mean(max_raw, 0)[1], np.mean(min_raw, 0)[1]])
     # fitting a k * x + m function to the peaks might be better
@@ -400,76 +571,105 @@ def peakdetect_sine(y_axis, x_axis, points = 9, lock_frequency = False):
     Hz = []
     for raw in [max_raw, min_raw]:
         if len(raw) > 1:
-            peak_pos = [x_axis[index] for index in zip(*raw)[0]]
+            peak_pos = x_axis[[peak[0] for peak in raw]]
             Hz.append(np.mean(np.diff(peak_pos)))
     Hz = 1 / np.mean(Hz)
     
     # model function
     # if cosine is used then tau could equal the x position of the peak
-    # if sine were to be used then tau would be the first zero crossing
-    if lock_frequency:
-        func = lambda x, A, tau: A * np.sin(2 * pi * Hz * (x - tau) + pi / 2)
-    else:
-        func = lambda x, A, Hz, tau: A * np.sin(2 * pi * Hz * (x - tau) + 
-                                                pi / 2)
-    #func = lambda x, A, Hz, tau: A * np.cos(2 * pi * Hz * (x - tau))
-    
+    # y = A * sin(2 * pi * Hz * (x - tau) + pi / 2) = A * cos(2 * pi * Hz * (x - tau))
     
     #get peaks
     fitted_peaks = []
     for raw_peaks in [max_raw, min_raw]:
-        peak_data = []
-        for peak in raw_peaks:
-            index = peak[0]
-            x_data = x_axis[index - points // 2: index + points // 2 + 1]
-            y_data = y_axis[index - points // 2: index + points // 2 + 1]
-            # get a first approximation of tau (peak position in time)
-            tau = x_axis[index]
-            # get a first approximation of peak amplitude
-            A = peak[1]
-            
-            # build list of approximations
-            if lock_frequency:
-                p0 = (A, tau)
-            else:
-                p0 = (A, Hz, tau)
-            
-            # subtract offset from waveshape
-            y_data -= offset
-            popt, pcov = curve_fit(func, x_data, y_data, p0)
-            # retrieve tau and A i.e x and y value of peak
-            x = popt[-1]
-            y = popt[0]
-            
-            # create a high resolution data set for the fitted waveform
-            x2 = np.linspace(x_data[0], x_data[-1], points * 10)
-            y2 = func(x2, *popt)
-            
-            # add the offset to the results
-            y += offset
-            y2 += offset
-            y_data += offset
-            
-            peak_data.append([x, y, [x2, y2]])
-       
+        if len(raw_peaks) == 0:
+            fitted_peaks.append([])
+            continue
+        index = np.array([peak[0] for peak in raw_peaks], dtype=int)
+        cols = index[:, None] + np.arange(-half, half + 1)[None, :]
+        ww = ((cols >= 0) & (cols < len(y_axis))).astype(float)
+        cols = np.clip(cols, 0, len(y_axis) - 1)
+        # x relative to each raw peak, and waveshape minus offset
+        x0 = x_axis[index]
+        uu = x_axis[cols] - x0[:, None]
+        y_data = y_axis[cols] - offset
+        
+        # locked frequency: linear least squares in (a, b)
+        omega = 2 * np.pi * Hz
+        cc, ss = np.cos(omega * uu), np.sin(omega * uu)
+        scc, sss, scs = (ww*cc*cc).sum(1), (ww*ss*ss).sum(1), (ww*cc*ss).sum(1)
+        syc, sys_ = (ww*y_data*cc).sum(1), (ww*y_data*ss).sum(1)
+        det = scc * sss - scs ** 2
+        aa = (syc * sss - sys_ * scs) / det
+        bb = (sys_ * scc - syc * scs) / det
+        A = np.hypot(aa, bb)
+        tau = np.arctan2(bb, aa) / omega
+        # choose the extremum (A>0: maximum, A<0: minimum) nearest the raw peak
+        period = 1. / Hz
+        nhalf = np.round(-tau / (period / 2.))
+        tau += nhalf * period / 2.
+        A *= np.where(nhalf % 2 == 0, 1., -1.)
+        freq = np.full(A.shape, Hz)
+        
+        if not lock_frequency:
+            # Gauss-Newton from the locked solution, each step halved until
+            # it lowers the residual.  Peaks whose fit does not converge, or
+            # puts the extremum outside the fitted points, keep the locked
+            # solution.
+            def chisq(A, freq, tau):
+                model = A[:, None] * np.cos(2 * np.pi * freq[:, None] * (uu - tau[:, None]))
+                return (ww * (y_data - model) ** 2).sum(1)
+            locked = np.array([A, freq, tau]).T
+            pars = locked.copy()
+            chi2 = chisq(*pars.T)
+            done = np.zeros(len(index), dtype=bool)
+            for it in range(50):
+                A, freq, tau = pars.T
+                theta = 2 * np.pi * freq[:, None] * (uu - tau[:, None])
+                resid = ww * (y_data - A[:, None] * np.cos(theta))
+                jac = np.empty(uu.shape + (3,))
+                jac[..., 0] = np.cos(theta)
+                jac[..., 1] = -A[:, None] * np.sin(theta) * 2 * np.pi * (uu - tau[:, None])
+                jac[..., 2] = A[:, None] * np.sin(theta) * 2 * np.pi * freq[:, None]
+                jac *= ww[..., None]
+                jtj = np.einsum('nki,nkj->nij', jac, jac)
+                jtr = np.einsum('nki,nk->ni', jac, resid)
+                step = np.einsum('nij,nj->ni', np.linalg.pinv(jtj), jtr)
+                step[done] = 0.
+                accept = done.copy()
+                for halve in range(10):
+                    trial = pars + step
+                    new_chi2 = chisq(*trial.T)
+                    better = ~accept & np.isfinite(new_chi2) & (new_chi2 <= chi2)
+                    pars[better], chi2[better] = trial[better], new_chi2[better]
+                    accept |= better
+                    if accept.all():
+                        break
+                    step[~accept] /= 2.
+                # converged: the step is negligible, or no step improves the fit
+                done |= ~accept | (np.abs(step[:, 2]) < 1e-10 * period)
+                if done.all():
+                    break
+            A, freq, tau = pars.T
+            bad = ~done | ~np.isfinite(pars).all(1) | (freq < Hz / 2.) | (freq > 2 * Hz) | \
+                (tau < uu[:, 0]) | (tau > uu[:, -1])
+            A, freq, tau = np.where(bad[:, None], locked, pars).T
+        
+        # create high resolution data sets for the fitted waveforms
+        frac = np.linspace(0., 1., points * 10)
+        x2 = uu[:, :1] + (uu[:, -1:] - uu[:, :1]) * frac[None, :]
+        y2 = A[:, None] * np.cos(2 * np.pi * freq[:, None] * (x2 - tau[:, None])) + offset
+        
+        # add the offsets back to the results
+        peak_data = [[x0[ii] + tau[ii], A[ii] + offset, [x0[ii] + x2[ii], y2[ii]]] 
+                     for ii in range(len(index))]
         fitted_peaks.append(peak_data)
     
     # structure date for output
-    max_peaks = map(lambda x: [x[0], x[1]], fitted_peaks[0])
-    max_fitted = map(lambda x: x[-1], fitted_peaks[0])
-    min_peaks = map(lambda x: [x[0], x[1]], fitted_peaks[1])
-    min_fitted = map(lambda x: x[-1], fitted_peaks[1])
-    
-    
-    #pylab.plot(x_axis, y_axis)
-    #pylab.hold(True)
-    #for max_p, max_f in zip(max_peaks, max_fitted):
-    #    pylab.plot(max_p[0], max_p[1], 'x')
-    #    pylab.plot(max_f[0], max_f[1], 'o', markersize = 2)
-    #for min_p, min_f in zip(min_peaks, min_fitted):
-    #    pylab.plot(min_p[0], min_p[1], 'x')
-    #    pylab.plot(min_f[0], min_f[1], 'o', markersize = 2)
-    #pylab.show()
+    max_peaks = [[x[0], x[1]] for x in fitted_peaks[0]]
+    max_fitted = [x[-1] for x in fitted_peaks[0]]
+    min_peaks = [[x[0], x[1]] for x in fitted_peaks[1]]
+    min_fitted = [x[-1] for x in fitted_peaks[1]]
     
     return [max_peaks, min_peaks]
 
@@ -522,42 +722,36 @@ def peakdetect_zero_crossing(y_axis, x_axis = None, window = 11):
     """
     # check input data
     x_axis, y_axis = _datacheck_peakdetect(x_axis, y_axis)
-    
-    zero_indices = zero_crossings(y_axis, window = window)
-    period_lengths = np.diff(zero_indices)
-            
-    bins_y = [y_axis[index:index + diff] for index, diff in 
-        zip(zero_indices, period_lengths)]
-    bins_x = [x_axis[index:index + diff] for index, diff in 
-        zip(zero_indices, period_lengths)]
-        
-    even_bins_y = bins_y[::2]
-    odd_bins_y = bins_y[1::2]
-    even_bins_x = bins_x[::2]
-    odd_bins_x = bins_x[1::2]
-    hi_peaks_x = []
-    lo_peaks_x = []
+    y_axis = np.asarray(y_axis)
+    
+    zero_indices = np.asarray(zero_crossings(y_axis, window = window))
+    
+    # Max, min and the first position of each, for every bin between
+    # consecutive zero crossings, without looping over bins
+    starts = zero_indices[:-1]
+    bin_max = np.maximum.reduceat(y_axis, starts)
+    bin_min = np.minimum.reduceat(y_axis, starts)
+    if len(zero_indices) > 1:
+        bin_max[-1] = y_axis[starts[-1]:zero_indices[-1]].max()
+        bin_min[-1] = y_axis[starts[-1]:zero_indices[-1]].min()
+    samples = np.arange(zero_indices[0], zero_indices[-1])
+    bin_id = np.searchsorted(starts, samples, side='right') - 1
+    
+    def first_match(values):
+        hit = np.nonzero(y_axis[samples] == values[bin_id])[0]
+        hit_bin, first = np.unique(bin_id[hit], return_index=True)
+        return samples[hit[first]]
+    max_pos = first_match(bin_max)
+    min_pos = first_match(bin_min)
     
     #check if even bin contains maxima
-    if abs(even_bins_y[0].max()) > abs(even_bins_y[0].min()):
-        hi_peaks = [bin.max() for bin in even_bins_y]
-        lo_peaks = [bin.min() for bin in odd_bins_y]
-        # get x values for peak
-        for bin_x, bin_y, peak in zip(even_bins_x, even_bins_y, hi_peaks):
-            hi_peaks_x.append(bin_x[np.where(bin_y==peak)[0][0]])
-        for bin_x, bin_y, peak in zip(odd_bins_x, odd_bins_y, lo_peaks):
-            lo_peaks_x.append(bin_x[np.where(bin_y==peak)[0][0]])
+    if abs(bin_max[0]) > abs(bin_min[0]):
+        hi, lo = slice(0, None, 2), slice(1, None, 2)
     else:
-        hi_peaks = [bin.max() for bin in odd_bins_y]
-        lo_peaks = [bin.min() for bin in even_bins_y]
-        # get x values for peak
-        for bin_x, bin_y, peak in zip(odd_bins_x, odd_bins_y, hi_peaks):
-            hi_peaks_x.append(bin_x[np.where(bin_y==peak)[0][0]])
-        for bin_x, bin_y, peak in zip(even_bins_x, even_bins_y, lo_peaks):
-            lo_peaks_x.append(bin_x[np.where(bin_y==peak)[0][0]])
+        hi, lo = slice(1, None, 2), slice(0, None, 2)
     
-    max_peaks = [[x, y] for x,y in zip(hi_peaks_x, hi_peaks)]
-    min_peaks = [[x, y] for x,y in zip(lo_peaks_x, lo_peaks)]
+    max_peaks = [[x, y] for x,y in zip(x_axis[max_pos[hi]], bin_max[hi])]
+    min_peaks = [[x, y] for x,y in zip(x_axis[min_pos[lo]], bin_min[lo])]
     
     return [max_peaks, min_peaks]
         
@@ -580,7 +774,7 @@ def _smooth(x, window_len=11, window='hanning'):
             flat window will produce a moving average smoothing.
 
     output:
-        the smoothed signal
+        the smoothed signal, of the same length as x
         
     example:
 
@@ -596,28 +790,27 @@ def _smooth(x, window_len=11, window='hanning'):
     TODO: the window parameter could be the window itself if a list instead of
     a string   
     """
+    x = np.asarray(x, dtype=float)
     if x.ndim != 1:
-        raise ValueError, "smooth only accepts 1 dimension arrays."
+        raise ValueError("smooth only accepts 1 dimension arrays.")
 
     if x.size < window_len:
-        raise ValueError, "Input vector needs to be bigger than window size."
+        raise ValueError("Input vector needs to be bigger than window size.")
     
     if window_len<3:
         return x
     
-    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise(ValueError,
+    windows = {'flat': np.ones, 'hanning': np.hanning, 'hamming': np.hamming, 
+               'bartlett': np.bartlett, 'blackman': np.blackman}
+    if not window in windows:
+        raise ValueError(
             "Window is not one of '{0}', '{1}', '{2}', '{3}', '{4}'".format(
             *('flat', 'hanning', 'hamming', 'bartlett', 'blackman')))
     
-    s = np.r_[x[window_len-1:0:-1], x, x[-1:-window_len:-1]]
-    #print(len(s))
-    if window == 'flat': #moving average
-        w = np.ones(window_len,'d')
-    else:
-        w = eval('np.' + window + '(window_len)')
-
-    y = np.convolve(w / w.sum(), s, mode = 'valid')
+    # flat window is a moving average
+    w = windows[window](window_len)
+    # Reflected ends, and the output centred on the input samples
+    y = ndimage.convolve1d(x, w / w.sum(), mode = 'mirror')
     return y
     
     
@@ -635,25 +828,18 @@ def zero_crossings(y_axis, window = 11):
     return -- the index for each zero-crossing
     """
     # smooth the curve
-    length = len(y_axis)
-    x_axis = np.asarray(range(length), int)
-    
-    # discard tail of smoothed signal
-    y_axis = _smooth(y_axis, window)[:length]
-    zero_crossings = np.where(np.diff(np.sign(y_axis)))[0]
-    indices = [x_axis[index] for index in zero_crossings]
+    y_axis = _smooth(np.asarray(y_axis, dtype=float), window)
+    indices = np.nonzero(np.diff(np.sign(y_axis)))[0]
     
+    # check if any zero crossings were found
+    if len(indices) < 1:
+        raise ValueError("No zero crossings found")
     # check if zero-crossings are valid
     diff = np.diff(indices)
-    if diff.std() / diff.mean() > 0.2:
-        print diff.std() / diff.mean()
-        print np.diff(indices)
-        raise(ValueError, 
-            "False zero-crossings found, indicates problem {0} or {1}".format(
-            "with smoothing window", "problem with offset"))
-    # check if any zero crossings were found
-    if len(zero_crossings) < 1:
-        raise(ValueError, "No zero crossings found")
+    if len(diff) > 0 and diff.std() / diff.mean() > 0.2:
+        raise ValueError(
+            "False zero-crossings found, indicates problem {0} or {1} ({2:g})".format(
+            "with smoothing window", "problem with offset", diff.std() / diff.mean()))
     
     return indices 
     # used this to test the fft function's sensitivity to spectral leakage
@@ -682,8 +868,10 @@ def _test():
     
     
 def _test_graph():
+    import pylab
+    
     i = 10000
-    x = np.linspace(0,3.7*pi,i)
+    x = np.linspace(0,3.7*np.pi,i)
     y = (0.3*np.sin(x) + np.sin(1.3 * x) + 0.9 * np.sin(4.2 * x) + 0.06 *
     np.random.randn(i))
     y *= -1
@@ -0,0 +1,92 @@
+# Module to run tests on the cached CCD reduction
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import os
+import pytest
+
+from astropy.io import fits
+
+from xastropy.xutils import ccdreduce, imcombine
+
+
+def _raw(tmpdir, name, img, blank=None):
+    # Raw frames are gzipped uint16 (BZERO=32768), as off the Nickel
+    fil = str(tmpdir.join(name+'.fits.gz'))
+    hdu = fits.PrimaryHDU(img.astype(np.uint16))
+    hdu.header['EXPTIME'] = 10.
+    if blank is not None:
+        hdu.header['BLANK'] = blank
+    hdu.writeto(fil)
+    return fil
+
+
+def test_cached_product(tmpdir):
+    rng = np.random.RandomState(2)
+    bias_fil = [_raw(tmpdir, 'b{:d}'.format(ii), 1000.+np.round(5*rng.normal(size=(20, 12))),
+                     blank=0) for ii in range(3)]
+    outfil = str(tmpdir.join('Bias.fits'))
+    nbuild = []
+
+    def build():
+        # As hrdiagram.mk_bias
+        nbuild.append(1)
+        head = fits.getheader(bias_fil[0])
+        return imcombine.combine(bias_fil, silent=True), head
+
+    img, head = ccdreduce.cached_product(outfil, bias_fil, build, silent=True)
+    ccdreduce.cached_product(outfil, bias_fil, build, silent=True)
+    assert len(nbuild) == 1
+    for card in ccdreduce.SCALECARDS:
+        assert card not in fits.getheader(outfil)
+    np.testing.assert_allclose(fits.getdata(outfil), img)
+    assert abs(np.median(img) - 1000.) < 5.
+    # Touching an input rebuilds the product
+    stat = os.stat(bias_fil[1])
+    os.utime(bias_fil[1], (stat.st_atime, stat.st_mtime+10.))
+    ccdreduce.cached_product(outfil, bias_fil, build, silent=True)
+    assert len(nbuild) == 2
+
+
+@pytest.mark.parametrize('nproc', [1, 2])
+def test_reduce_frames(tmpdir, nproc):
+    shape = (20, 12)
+    trim = (1, None, None, 10)
+    rng = np.random.RandomState(3)
+    bias = np.full(shape, 1000.)
+    bias_fil = str(tmpdir.join('Bias.fits'))
+    fits.writeto(bias_fil, bias)
+    flat = 1. + 0.1*rng.uniform(size=(19, 10))
+    flat_fil = str(tmpdir.join('Sky_V.fits'))
+    fits.writeto(flat_fil, flat)
+    sky = 20000. + np.round(100.*rng.normal(size=shape))
+    jobs = []
+    for ii in range(3):
+        jobs.append(dict(infile=_raw(tmpdir, 'd{:d}'.format(ii), sky+ii, blank=0),
+                         outfil=str(tmpdir.join('r{:d}.fits'.format(ii))),
+                         flat=flat_fil, exptime=10.))
+    done = ccdreduce.reduce_frames(jobs, bias=bias_fil, trim=trim, flip=True,
+                                   nproc=nproc, silent=True)
+    assert len(done) == 3
+    for ii, job in enumerate(jobs):
+        red, head = fits.getdata(job['outfil'], header=True)
+        good = ((sky+ii-bias)[1:, :10])[::-1] / flat / 10.
+        np.testing.assert_allclose(red, good)
+        for card in ccdreduce.SCALECARDS:
+            assert card not in head
+    # Up to date
+    assert ccdreduce.reduce_frames(jobs, bias=bias_fil, trim=trim, flip=True,
+                                   nproc=nproc, silent=True) == []
+
+
+def test_getcalib(tmpdir):
+    fil = str(tmpdir.join('Bias.fits'))
+    fits.writeto(fil, np.zeros((4, 4)))
+    assert np.all(ccdreduce._getcalib(fil) == 0.)
+    # A changed file is read again, and replaces the old image
+    fits.writeto(fil, np.ones((4, 4)), overwrite=True)
+    stat = os.stat(fil)
+    os.utime(fil, (stat.st_atime, stat.st_mtime+10.))
+    assert np.all(ccdreduce._getcalib(fil) == 1.)
+    assert len([key for key in ccdreduce._calib if fil in key]) == 1
@@ -0,0 +1,57 @@
+# Module to run tests on image stacking
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from xastropy.xutils import imcombine
+
+
+def _frames(tmpdir, ext, nframe=5, shape=(40, 30)):
+    # uint16 frames, written with BZERO=32768
+    rng = np.random.RandomState(4)
+    imgs = [np.round(30000. + 1000.*ii + 100.*rng.normal(size=shape)) for ii in range(nframe)]
+    files = []
+    for ii, img in enumerate(imgs):
+        files.append(str(tmpdir.join('d{:d}{:s}'.format(ii, ext))))
+        fits.PrimaryHDU(img.astype(np.uint16)).writeto(files[-1])
+    return files, np.array(imgs)
+
+
+@pytest.mark.parametrize('ext', ['.fits', '.fits.gz'])
+def test_combine_uint16(tmpdir, ext):
+    files, imgs = _frames(tmpdir, ext)
+    assert fits.getheader(files[0])['BZERO'] == 32768
+    # Small blocks, several threads
+    med = imcombine.combine(files, maxmem=0.01, nthreads=3, silent=True)
+    np.testing.assert_allclose(med, np.median(imgs, axis=0))
+    # Bias from a (scaled) file, and flat-field scaling
+    bias = np.full(imgs.shape[1:], 1000.)
+    bias_fil = str(tmpdir.join('bias'+ext))
+    fits.PrimaryHDU(bias.astype(np.uint16)).writeto(bias_fil)
+    flat = imcombine.combine(files, bias=bias_fil, scale='median', method='mean', silent=True)
+    cal = imgs - 1000.
+    cal /= np.median(cal, axis=(1, 2))[:, None, None]
+    np.testing.assert_allclose(flat, cal.mean(axis=0))
+
+
+def test_combine_blank(tmpdir):
+    img = np.arange(12, dtype=np.int16).reshape(3, 4)
+    hdu = fits.PrimaryHDU(img)
+    hdu.header['BLANK'] = 5
+    files = []
+    for ii in range(3):
+        files.append(str(tmpdir.join('b{:d}.fits'.format(ii))))
+        hdu.writeto(files[-1])
+    out = imcombine.combine(files, silent=True)
+    assert np.isnan(out[1, 1])
+    assert out[2, 3] == 11.
+
+
+def test_combine_shapes(tmpdir):
+    files, imgs = _frames(tmpdir, '.fits', nframe=2)
+    with pytest.raises(imcombine.ShapeError):
+        imcombine.combine(files, bias=np.zeros((3, 3)), silent=True)
@@ -0,0 +1,74 @@
+# Module to run tests on peak finding
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from xastropy.xutils import peaks as xpeaks
+
+
+def test_peakdetect():
+    # Generate data
+    x = np.linspace(0, 3.7*np.pi, 10000)
+    y = 0.3*np.sin(x) + np.sin(1.3*x) + 0.9*np.sin(4.2*x)
+    # Find
+    max_peaks, min_peaks = xpeaks.peakdetect(y, x, lookahead=300, delta=0.3)
+    xmax = np.array(max_peaks)[:,0]
+    # Maxima and minima alternate
+    assert len(max_peaks) == 8
+    assert len(min_peaks) == 7
+    np.testing.assert_allclose(xmax[1], 1.8076961, rtol=1e-6)
+
+
+def test_peakdetect_noise():
+    # Noisy sine with a period of 250 points: delta removes the noise peaks
+    rng = np.random.RandomState(11)
+    x = np.arange(2000.)
+    y = np.sin(2*np.pi*x/250.) + 0.3*rng.normal(size=x.size)
+    max_peaks, min_peaks = xpeaks.peakdetect(y, x, lookahead=20, delta=1.5)
+    np.testing.assert_array_equal(np.array(max_peaks)[:,0],
+                                  [64, 319, 562, 824, 1053, 1315, 1573, 1824])
+    np.testing.assert_array_equal(np.array(min_peaks)[:,0],
+                                  [192, 417, 690, 937, 1201, 1457, 1715, 1946])
+    # Every swing between successive extrema is larger than delta
+    ext = sorted(max_peaks + min_peaks)
+    assert np.all(np.abs(np.diff([yy for xx, yy in ext])) > 1.5)
+    # Without delta the noise peaks remain
+    max_peaks, min_peaks = xpeaks.peakdetect(y, x, lookahead=20)
+    assert len(max_peaks) == len(min_peaks) == 14
+
+
+def test_parabola_vertex():
+    offset, value = xpeaks.parabola_vertex(np.array([1., 3.]), np.array([2., 4.]),
+                                           np.array([1., 3.5]))
+    np.testing.assert_allclose(offset, [0., 0.1666666667])
+    np.testing.assert_allclose(value, [2., 4.0208333333])
+
+
+def test_peakdetect_rows():
+    # Stack of spectra with Gaussian lines
+    pix = np.arange(500.)
+    cen = np.array([[50.3, 200.7, 401.1], [80.5, 250.2, 330.9]])
+    img = np.zeros((2, 500))
+    for ii in range(2):
+        for cc in cen[ii]:
+            img[ii] += 100. * np.exp(-(pix-cc)**2 / (2*1.5**2))
+    row, index, xpk, ypk = xpeaks.peakdetect_rows(img, lookahead=5, delta=10., points=3)
+    np.testing.assert_array_equal(row, [0, 0, 0, 1, 1, 1])
+    np.testing.assert_allclose(xpk, cen.ravel(), atol=0.05)
+
+
+@pytest.mark.parametrize('lock', [False, True])
+def test_peakdetect_sine(lock):
+    # Few points per peak: the free-frequency fit must not run away
+    x = np.linspace(0, 40, 800)
+    for seed in range(5):
+        rng = np.random.RandomState(seed)
+        y = 2*np.sin(1.3*x + 0.2) + 0.1*rng.normal(size=x.size)
+        max_peaks, min_peaks = xpeaks.peakdetect_sine(y, x, points=9, lock_frequency=lock)
+        for tab, sign in [(max_peaks, 1.), (min_peaks, -1.)]:
+            xpk, ypk = np.array(tab).T
+            phase = (1.3*xpk + 0.2 - sign*np.pi/2) % (2*np.pi)
+            assert np.all(np.minimum(phase, 2*np.pi-phase) / 1.3 < 0.3)
+            assert np.all(np.abs(ypk - 2*sign) < 0.3)
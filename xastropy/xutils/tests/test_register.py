@@ -0,0 +1,45 @@
+# Module to run tests on FFT image registration
+
+### TEST_UNICODE_LITERALS
+
+import numpy as np
+import pytest
+
+from xastropy.xutils import register
+
+
+def _field(dy=0., dx=0., shape=(64, 80), seed=7):
+    # Gaussian 'stars' at known positions, offset by (dy, dx)
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    img = np.zeros(shape)
+    for ii in range(25):
+        y0 = rng.uniform(8, shape[0]-8) + dy
+        x0 = rng.uniform(8, shape[1]-8) + dx
+        img += rng.uniform(1., 10.) * np.exp(-0.5*((yy-y0)**2 + (xx-x0)**2)/1.5**2)
+    return img
+
+
+@pytest.mark.parametrize('method', ['phase', 'xcorr'])
+@pytest.mark.parametrize('shift', [(3, -5), (2.3, -1.6)])
+def test_shift(method, shift):
+    reference = register.FFTReference(_field(), method=method)
+    dy, dx, peak = reference.shift(_field(*shift))
+    assert abs(dy - shift[0]) < 0.1
+    assert abs(dx - shift[1]) < 0.1
+    with pytest.raises(ValueError):
+        reference.shift(np.zeros((10, 10)))
+
+
+def test_register_frames():
+    shifts = [(0., 0.), (1.5, 2.), (-3., 0.7), (4.2, -2.5), (0.4, 0.4)]
+    # A generator of (name, image) pairs, on several threads
+    frames = (('f{:d}'.format(ii), _field(*sh)) for ii, sh in enumerate(shifts))
+    tab = register.register_frames(_field(), frames, nthreads=2, silent=True)
+    assert list(tab['FRAME']) == ['f{:d}'.format(ii) for ii in range(len(shifts))]
+    np.testing.assert_allclose(np.array([tab['DY'], tab['DX']]).T, shifts, atol=0.15)
+    # Aligning with the negative shift recovers the reference
+    img = _field(-3., 2.)
+    aligned = register.shift_image(img, 3, -2)
+    np.testing.assert_allclose(aligned[5:-5, 5:-5], _field()[5:-5, 5:-5], atol=1e-12)
+    assert np.isnan(aligned[:3]).all()